@@ -5,7 +5,7 @@ from qcodes.parameters import ManualParameter
 from xarray import Dataset
 from numpy import array, arange, moveaxis
 from qblox_drive_AS.support import QDmanager, Data_manager
-from quantify_scheduler.gettables import ScheduleGettable
+from qblox_drive_AS.support.ScheduleCache import CachedScheduleGettable
 from quantify_core.measurement.control import MeasurementControl
 from qblox_drive_AS.support import compose_para_for_multiplexing
 from qblox_drive_AS.support.Pulse_schedule_library import drag_coef_cali, pulse_preview
@@ -43,7 +43,7 @@ def drag_cali(QD_agent:QDmanager,meas_ctrl:MeasurementControl, drag_samples:dict
         
         
         if run:
-            gettable = ScheduleGettable(
+            gettable = CachedScheduleGettable(
             QD_agent.quantum_device,
             schedule_function=sche_func,
             schedule_kwargs=sched_kwargs,
@@ -6,7 +6,7 @@ from qcodes.parameters import ManualParameter
 from xarray import Dataset
 from numpy import array, arange, moveaxis
 from qblox_drive_AS.support import QDmanager, Data_manager
-from quantify_scheduler.gettables import ScheduleGettable
+from qblox_drive_AS.support.ScheduleCache import CachedScheduleGettable
 from quantify_core.measurement.control import MeasurementControl
 from qblox_drive_AS.support import compose_para_for_multiplexing
 from qblox_drive_AS.support.Pulse_schedule_library import multi_PI_amp_cali_sche, pulse_preview
@@ -43,7 +43,7 @@ def pi_amp_cali(QD_agent:QDmanager,meas_ctrl:MeasurementControl, roamp_samples:d
         
         
         if run:
-            gettable = ScheduleGettable(
+            gettable = CachedScheduleGettable(
             QD_agent.quantum_device,
             schedule_function=sche_func,
             schedule_kwargs=sched_kwargs,
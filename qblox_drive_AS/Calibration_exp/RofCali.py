@@ -3,7 +3,7 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', "
 from qblox_drive_AS.support.UserFriend import *
 from qcodes.parameters import ManualParameter
 from xarray import Dataset
-from quantify_scheduler.gettables import ScheduleGettable
+from qblox_drive_AS.support.ScheduleCache import CachedScheduleGettable
 from quantify_core.measurement.control import MeasurementControl
 from numpy import array, NaN, arange, moveaxis
 from qblox_drive_AS.support import QDmanager, Data_manager, compose_para_for_multiplexing
@@ -36,7 +36,7 @@ def rofCali(QD_agent:QDmanager,meas_ctrl:MeasurementControl,rof_samples:dict,n_a
             )
         
         if run:
-            gettable = ScheduleGettable(
+            gettable = CachedScheduleGettable(
                 QD_agent.quantum_device,
                 schedule_function=sche_func,
                 schedule_kwargs=sched_kwargs,
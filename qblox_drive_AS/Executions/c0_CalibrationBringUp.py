@@ -0,0 +1,20 @@
+from qblox_drive_AS.support.Path_Book import find_latest_QD_pkl_for_dr
+from qblox_drive_AS.support import Data_manager
+from qblox_drive_AS.support.CalibrationGraph import CalibrationGraph
+
+
+''' fill in '''
+DRandIP = {"dr":"dr1","last_ip":"11"}
+target:str = "T1"                           # "T1", "T2", "EchoT2" or a calibration like "PiAmp"
+target_qs:list = ["q0","q1","q2","q3","q4"]
+time_range:dict = {q:[0,80e-6] for q in target_qs}
+AVG:int = 500
+dry_run:bool = True                         # only print which calibrations are stale
+
+''' Don't Touch '''
+save_dir = Data_manager().build_packs_folder()
+graph = CalibrationGraph(QD_path=find_latest_QD_pkl_for_dr(DRandIP["dr"],DRandIP["last_ip"]),data_folder=save_dir)
+if dry_run:
+    graph.plan(target,target_qs)
+else:
+    graph.bring_up(target,target_qs,time_range,avg_n=AVG)
@@ -7,9 +7,9 @@ from numpy import NaN
 from xarray import Dataset
 import matplotlib.pyplot as plt
 from qcodes.parameters import ManualParameter
-from quantify_scheduler.gettables import ScheduleGettable
+from qblox_drive_AS.support.ScheduleCache import CachedScheduleGettable
 from numpy import array, arange, real, imag, arctan2
-from qcat.analysis.resonator.photon_dep.res_data import ResonatorData
+from qblox_drive_AS.analysis.ResonatorFitting import fit_resonators
 from qblox_drive_AS.support import Data_manager, QDmanager, compose_para_for_multiplexing 
 from qblox_drive_AS.support.Pulser import ScheduleConductor
 from qblox_drive_AS.support.Pulse_schedule_library import Schedule, Readout, Multi_Readout, Integration, pulse_preview
@@ -25,8 +25,9 @@ def QD_RO_init(QD_agent:QDmanager, ro_elements:dict):
         qubit.measure.integration_time(100e-6)
 
 
-def multiplexing_CS_ana(QD_agent:QDmanager, ds:Dataset, save_pic_folder:str=None)->dict:
+def multiplexing_CS_ana(QD_agent:QDmanager, ds:Dataset, save_pic_folder:str=None, workers:int=None)->dict:
     """
+    `workers`: the processes fitting the qubits, None fits them one by one in this process.\n
     # Return\n
     A dict sorted by q_name with its fit results.\n
     Ex. {'q0':{..}, ...}\n
@@ -35,12 +36,15 @@ def multiplexing_CS_ana(QD_agent:QDmanager, ds:Dataset, save_pic_folder:str=None
     ['Qi_dia_corr', 'Qi_no_corr', 'absQc', 'Qc_dia_corr', 'Ql', 'fr', 'theta0', 'phi0', 'phi0_err', 'Ql_err', 'absQc_err', 'fr_err', 'chi_square', 'Qi_no_corr_err', 'Qi_dia_corr_err', 'A', 'alpha', 'delay', 'input_power']
     """
     fit_results = {}
+    qs = [q for q in ds.data_vars if str(q).split("_")[-1] != "freq"]
+    # all the qubits are fitted together, in a process pool if `workers` is given
+    S21s = {q: array(ds[q])[0] + array(ds[q])[1]*1j for q in qs}
+    fits = dict(zip(qs, fit_resonators([array(ds[f"{q}_freq"])[0][5:] for q in qs], [S21s[q][5:] for q in qs], workers)))
     for idx, q in enumerate(ds.data_vars):
         if str(q).split("_")[-1] != "freq":
-            S21 = array(ds[q])[0] + array(ds[q])[1]*1j
+            S21 = S21s[q]
             freq = array(ds[f"{q}_freq"])[0][5:]
-            res_er = ResonatorData(freq=freq,zdata=array(S21)[5:])
-            result, data2plot, fit2plot = res_er.fit()
+            result, data2plot, fit2plot = fits[q]
             fig, ax = plt.subplots(2,2,figsize=(12,12))
             ax0:plt.Axes = ax[0][0] 
             ax0.grid()       
@@ -178,7 +182,7 @@ class CavitySearch(ScheduleConductor):
     def __Compose__(self, *args, **kwargs):
         
         if self._execution:
-            self.__gettable = ScheduleGettable(
+            self.__gettable = CachedScheduleGettable(
             self.QD_agent.quantum_device,
             schedule_function=self.__PulseSchedule__, 
             schedule_kwargs=self.__spec_sched_kwargs,
@@ -6,7 +6,7 @@ from xarray import Dataset
 from qcodes.parameters import ManualParameter
 from qblox_drive_AS.support.UserFriend import *
 from qblox_drive_AS.support import QDmanager, Data_manager
-from quantify_scheduler.gettables import ScheduleGettable
+from qblox_drive_AS.support.ScheduleCache import CachedScheduleGettable
 from quantify_core.measurement.control import MeasurementControl
 from qblox_drive_AS.support.QuFluxFit import calc_Gcoef_inFbFqFd, calc_g
 from qblox_drive_AS.support import compose_para_for_multiplexing
@@ -57,7 +57,7 @@ def Two_tone_spec(QD_agent:QDmanager,meas_ctrl:MeasurementControl,xyf_guess:dict
     )
 
     if run:
-        gettable = ScheduleGettable(
+        gettable = CachedScheduleGettable(
             QD_agent.quantum_device,
             schedule_function=sche_func, 
             schedule_kwargs=spec_sched_kwargs,
@@ -4,13 +4,14 @@ from numpy import array, arange, NaN, ndarray
 from qcodes.parameters import ManualParameter
 from qblox_drive_AS.support.UserFriend import *
 from qblox_drive_AS.support import QDmanager, Data_manager, compose_para_for_multiplexing
-from quantify_scheduler.gettables import ScheduleGettable
+from qblox_drive_AS.support.ScheduleCache import CachedScheduleGettable
 from quantify_core.measurement.control import MeasurementControl
 from qblox_drive_AS.support.Pulse_schedule_library import One_tone_multi_sche, pulse_preview
 from qblox_drive_AS.SOP.FluxQubit import z_pulse_amp_OVER_const_z
 from xarray import Dataset
 
-def FluxCav_spec(QD_agent:QDmanager,meas_ctrl:MeasurementControl,flux_ctrl:dict,ro_elements:dict,flux_samples:ndarray,n_avg:int=300,run:bool=True)->Dataset:
+def FluxCav_spec(QD_agent:QDmanager,meas_ctrl:MeasurementControl,flux_ctrl:dict,ro_elements:dict,flux_samples:ndarray,n_avg:int=300,run:bool=True,hardware_outer:bool=True)->Dataset:
+    """ `hardware_outer`: loop the bias points on the sequencers in one program when it's possible, otherwise they're set one by one. """
     sche_func = One_tone_multi_sche
     original_rof = {}
     flux_dura = 0
@@ -39,15 +40,18 @@ def FluxCav_spec(QD_agent:QDmanager,meas_ctrl:MeasurementControl,flux_ctrl:dict,
 
     
     if run:
-        gettable = ScheduleGettable(
+        gettable = CachedScheduleGettable(
             QD_agent.quantum_device,
             schedule_function=sche_func, 
             schedule_kwargs=spec_sched_kwargs,
             real_imag=True,
             batched=True,
             num_channels=len(list(ro_elements.keys())),
+            outer_sweep="bias" if hardware_outer else None,
+            outer_samples=flux_samples*z_pulse_amp_OVER_const_z,
         )
         QD_agent.quantum_device.cfg_sched_repetitions(n_avg)
+        bias.batched = gettable.loop_outer()
         meas_ctrl.gettables(gettable)
         meas_ctrl.settables((freq,bias))
         meas_ctrl.setpoints_grid((freq_datapoint_idx,flux_samples*z_pulse_amp_OVER_const_z)) # x0, x1
@@ -7,7 +7,7 @@ from numpy import array, arange, sqrt
 from qcodes.parameters import ManualParameter
 from qblox_drive_AS.support.UserFriend import *
 from qblox_drive_AS.support import QDmanager, Data_manager
-from quantify_scheduler.gettables import ScheduleGettable
+from qblox_drive_AS.support.ScheduleCache import CachedScheduleGettable
 from quantify_core.measurement.control import MeasurementControl
 from qblox_drive_AS.support import compose_para_for_multiplexing
 from qblox_drive_AS.support.Pulse_schedule_library import multi_Z_gate_two_tone_sche, pulse_preview
@@ -16,7 +16,8 @@ from qblox_drive_AS.support.Pulse_schedule_library import multi_Z_gate_two_tone_
 z_pulse_amp_OVER_const_z = sqrt(2)/2.5
 
 
-def Zgate_two_tone_spec(QD_agent:QDmanager,meas_ctrl:MeasurementControl,XYFs:dict,Bias_element:list,Bias_samples:ndarray,n_avg:int=1000,run:bool=True):
+def Zgate_two_tone_spec(QD_agent:QDmanager,meas_ctrl:MeasurementControl,XYFs:dict,Bias_element:list,Bias_samples:ndarray,n_avg:int=1000,run:bool=True,hardware_outer:bool=True):
+    """ `hardware_outer`: loop the z amplitude points on the sequencers in one program when it's possible, otherwise they're set one by one. """
     print("Zgate 2tone start")
     
     sche_func = multi_Z_gate_two_tone_sche
@@ -49,15 +50,18 @@ def Zgate_two_tone_spec(QD_agent:QDmanager,meas_ctrl:MeasurementControl,XYFs:dic
     )
     
     if run:
-        gettable = ScheduleGettable(
+        gettable = CachedScheduleGettable(
             QD_agent.quantum_device,
             schedule_function=sche_func, 
             schedule_kwargs=spec_sched_kwargs,
             real_imag=True,
             batched=True,
             num_channels=len(list(XYFs.keys())),
+            outer_sweep="Z_amp" if hardware_outer else None,
+            outer_samples=Bias_samples*z_pulse_amp_OVER_const_z,
         )
         QD_agent.quantum_device.cfg_sched_repetitions(n_avg)
+        Z_bias.batched = gettable.loop_outer()
         meas_ctrl.gettables(gettable)
         meas_ctrl.settables([freq,Z_bias])
         meas_ctrl.setpoints_grid((freq_datapoint_idx,Bias_samples*z_pulse_amp_OVER_const_z))
@@ -8,7 +8,7 @@ from xarray import Dataset
 from numpy import NaN
 from qcodes.parameters import ManualParameter
 from qblox_drive_AS.support import QDmanager, compose_para_for_multiplexing
-from quantify_scheduler.gettables import ScheduleGettable
+from qblox_drive_AS.support.ScheduleCache import CachedScheduleGettable
 from quantify_core.measurement.control import MeasurementControl
 import matplotlib.pyplot as plt
 
@@ -19,7 +19,8 @@ from quantify_scheduler.operations.gate_library import Reset
 from quantify_scheduler.operations.pulse_library import IdlePulse,SetClockFrequency
 from quantify_scheduler.resources import ClockResource
 
-def PowerDep_spec(QD_agent:QDmanager,meas_ctrl:MeasurementControl,ro_elements:dict,power_samples:ndarray,n_avg:int=100,run:bool=True)->Dataset:
+def PowerDep_spec(QD_agent:QDmanager,meas_ctrl:MeasurementControl,ro_elements:dict,power_samples:ndarray,n_avg:int=100,run:bool=True,hardware_outer:bool=True)->Dataset:
+    """ `hardware_outer`: loop the readout amplitude points on the sequencers in one program when it's possible, otherwise they're set one by one. """
 
     sche_func = One_tone_multi_sche
     freq_datapoint_idx = arange(0,len(list(list(ro_elements.values())[0])))
@@ -51,15 +52,18 @@ def PowerDep_spec(QD_agent:QDmanager,meas_ctrl:MeasurementControl,ro_elements:di
 
     
     if run:
-        gettable = ScheduleGettable(
+        gettable = CachedScheduleGettable(
             QD_agent.quantum_device,
             schedule_function=sche_func, 
             schedule_kwargs=spec_sched_kwargs,
             real_imag=True,
             batched=True,
             num_channels=len(list(ro_elements.keys())),
+            outer_sweep="R_amp" if hardware_outer else None,
+            outer_samples=power_samples,
         )
         QD_agent.quantum_device.cfg_sched_repetitions(n_avg)
+        ro_pulse_amp.batched = gettable.loop_outer()
         meas_ctrl.gettables(gettable)
         meas_ctrl.settables([freq,ro_pulse_amp])
         meas_ctrl.setpoints_grid((freq_datapoint_idx,power_samples)) # -> (x0, x1) if do dh.to_gridded_dataset(ds)
@@ -238,7 +242,7 @@ class PowerDepCavity(ScheduleConductor):
     def __Compose__(self, *args, **kwargs):
         
         if self._execution:
-            self.__gettable = ScheduleGettable(
+            self.__gettable = CachedScheduleGettable(
             self.QD_agent.quantum_device,
             schedule_function=self.__PulseSchedule__, 
             schedule_kwargs=self.__spec_sched_kwargs,
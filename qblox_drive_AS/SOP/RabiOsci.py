@@ -7,7 +7,7 @@ from utils.tutorial_utils import show_args
 from qcodes.parameters import ManualParameter
 from numpy import linspace, array, arange, NaN, ndarray, round, full, concatenate
 from qblox_drive_AS.support import QDmanager, Data_manager, cds
-from quantify_scheduler.gettables import ScheduleGettable
+from qblox_drive_AS.support.ScheduleCache import CachedScheduleGettable
 from quantify_core.measurement.control import MeasurementControl
 from qblox_drive_AS.support.Path_Book import find_latest_QD_pkl_for_dr, meas_raw_dir
 from qblox_drive_AS.support import init_meas, init_system_atte, shut_down, coupler_zctrl, compose_para_for_multiplexing, reset_offset
@@ -81,7 +81,7 @@ def PowerRabi(QD_agent:QDmanager,meas_ctrl:MeasurementControl,pi_amp:dict,pi_dur
     
     
     if run:
-        gettable = ScheduleGettable(
+        gettable = CachedScheduleGettable(
         QD_agent.quantum_device,
         schedule_function=sche_func,
         schedule_kwargs=sched_kwargs,
@@ -157,7 +157,7 @@ def TimeRabi(QD_agent:QDmanager,meas_ctrl:MeasurementControl,pi_amp:dict,pi_dura
     
     
     if run:
-        gettable = ScheduleGettable(
+        gettable = CachedScheduleGettable(
         QD_agent.quantum_device,
         schedule_function=sche_func,
         schedule_kwargs=sched_kwargs,
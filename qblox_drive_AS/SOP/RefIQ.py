@@ -5,7 +5,7 @@ from xarray import Dataset
 import matplotlib.pyplot as plt
 from qblox_drive_AS.support.UserFriend import *
 from qblox_drive_AS.support import QDmanager
-from quantify_scheduler.gettables import ScheduleGettable
+from qblox_drive_AS.support.ScheduleCache import CachedScheduleGettable
 from qblox_drive_AS.support import compose_para_for_multiplexing
 from qblox_drive_AS.support.Pulse_schedule_library import multi_Qubit_SS_sche, Single_shot_ref_fit_analysis, pulse_preview
 
@@ -37,7 +37,7 @@ def Single_shot_ref_spec(QD_agent:QDmanager,ro_elements:dict,shots:int=1000,run:
     )
     
     if run:
-        gettable = ScheduleGettable(
+        gettable = CachedScheduleGettable(
             QD_agent.quantum_device,
             schedule_function=sche_func, 
             schedule_kwargs=sched_kwargs,
@@ -5,7 +5,7 @@ from numpy import array, arange
 from qblox_drive_AS.support.UserFriend import *
 from qcodes.parameters import ManualParameter
 from qblox_drive_AS.support import QDmanager, Data_manager
-from quantify_scheduler.gettables import ScheduleGettable
+from qblox_drive_AS.support.ScheduleCache import CachedScheduleGettable
 from quantify_core.measurement.control import MeasurementControl
 from qblox_drive_AS.support import compose_para_for_multiplexing
 from qblox_drive_AS.support.Pulse_schedule_library import multi_T1_sche, pulse_preview
@@ -39,13 +39,14 @@ def T1(QD_agent:QDmanager,meas_ctrl:MeasurementControl,time_samples:dict,repeat:
         )
     
     if run:
-        gettable = ScheduleGettable(
+        gettable = CachedScheduleGettable(
             QD_agent.quantum_device,
             schedule_function=sche_func,
             schedule_kwargs=sched_kwargs,
             real_imag=True,
             batched=True,
             num_channels=len(list(time_samples.keys())),
+            parametric_sweep="freeduration",
             )
         QD_agent.quantum_device.cfg_sched_repetitions(n_avg)
         meas_ctrl.gettables(gettable)
@@ -182,13 +183,14 @@ class EnergyRelaxPS(ScheduleConductor):
     def __Compose__(self, *args, **kwargs):
         
         if self._execution:
-            self.__gettable = ScheduleGettable(
+            self.__gettable = CachedScheduleGettable(
                 self.QD_agent.quantum_device,
                 schedule_function=self.__PulseSchedule__,
                 schedule_kwargs=self.__sched_kwargs,
                 real_imag=True,
                 batched=True,
                 num_channels=len(list(self._time_samples.keys())),
+                parametric_sweep=None if self._os_mode else "freeduration",
                 )
             self.QD_agent.quantum_device.cfg_sched_repetitions(self._avg_n)
             self.meas_ctrl.gettables(self.__gettable)
@@ -3,7 +3,7 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 from qcodes.parameters import ManualParameter
 from xarray import Dataset
 from qblox_drive_AS.support.UserFriend import *
-from quantify_scheduler.gettables import ScheduleGettable
+from qblox_drive_AS.support.ScheduleCache import CachedScheduleGettable
 from numpy import arange, array, arange
 from quantify_core.measurement.control import MeasurementControl
 from qblox_drive_AS.support import compose_para_for_multiplexing, QDmanager, Data_manager
@@ -42,13 +42,14 @@ def Ramsey(QD_agent:QDmanager,meas_ctrl:MeasurementControl,time_samples:dict, sp
         )
 
     if run:
-        gettable = ScheduleGettable(
+        gettable = CachedScheduleGettable(
             QD_agent.quantum_device,
             schedule_function=sche_func,
             schedule_kwargs=sched_kwargs,
             real_imag=True,
             batched=True,
             num_channels=len(list(time_samples.keys())),
+            parametric_sweep="freeduration",
         )
         
         QD_agent.quantum_device.cfg_sched_repetitions(n_avg)
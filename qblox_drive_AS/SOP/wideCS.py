@@ -1,4 +1,4 @@
-import os, sys, json
+import os, sys
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 import numpy as np
@@ -7,45 +7,57 @@ from xarray import Dataset, open_dataset
 from qblox_instruments import Cluster
 
 
-def wideCS(readout_module:Cluster, lo_start_freq:int, lo_stop_freq:int, num_data:int):
-
-    nco_freq = 1e6
-
-    num_averages = 10
-    integration_length = 1024
-    holdoff_length = 200
-    waveform_length = integration_length + holdoff_length
-
-    # Acquisitions
-    acquisitions = {"acq": {"num_bins": 1, "index": 0}}
-
-    # Sequence program
-    seq_prog = f"""
-        move    {num_averages},R0           # Average iterator.
-        nop
-        reset_ph
+def lo_segments(freqs:np.ndarray, if_min:float=20e6, if_max:float=480e6)->list:
+    """
+    Split the (ascending) RF frequencies into the LO settings, every frequency is reached by an NCO in [if_min, if_max] of its LO.\n
+    Returns [(lo, [indices of freqs]), ...].
+    """
+    segments = []
+    idx = 0
+    while idx < freqs.shape[0]:
+        lo = freqs[idx] - if_min
+        members = np.nonzero((freqs >= freqs[idx]) & (freqs <= lo + if_max))[0]
+        segments.append((lo, members))
+        idx = members[-1] + 1
+    return segments
+
+
+def nco_sweep_program(nco_start:int, nco_step:int, points:int, num_averages:int, holdoff_length:int, integration_length:int)->str:
+    """ Step the NCO (in 0.25 Hz) `points` times, every point is averaged `num_averages` times into its own bin. """
+    return f"""
+        move    0,R0                       # Bin index.
+        move    {points},R1                # Point iterator.
+        move    {nco_start},R2             # NCO frequency in 0.25 Hz.
+        wait_sync 4
         set_awg_offs 10000, 10000          # set amplitude of signal
-        nop
-    loop: 
+        upd_param 4
+    point:
+        set_freq R2                        # Next NCO frequency.
+        reset_ph
+        upd_param 4
+        move    {num_averages},R3          # Average iterator.
+    avg:
         wait     {holdoff_length}          # Wait time of flight
-        acquire  0,0,{integration_length}  # Acquire data and store them in bin_n0 of acq_index.
-        loop     R0,@loop                  # Run until number of average iterations is done.
+        acquire  0,R0,{integration_length} # Accumulate into the bin of this point.
+        loop     R3,@avg
+        add      R2,{nco_step},R2
+        add      R0,1,R0
+        loop     R1,@point
         stop                               # Stop the sequencer
         """
 
-    # Add sequence to single dictionary and write to JSON file.
-    sequence = {
-        "waveforms": {},
-        "weights": {},
-        "acquisitions": acquisitions,
-        "program": seq_prog,
-    }
-    with open("sequence.json", "w", encoding="utf-8") as file:
-        json.dump(sequence, file, indent=4)
-        file.close()
-
-    # Upload sequence
-    readout_module.sequencers[0].sequence("sequence.json")
+
+def wideCS(readout_module:Cluster, lo_start_freq:int, lo_stop_freq:int, num_data:int, if_min:float=20e6, if_max:float=480e6, num_averages:int=10):
+    """
+    Broadband cavity search. The NCO is stepped inside one sequencer program with a bin per frequency, the LO is only moved when the
+    NCO range [if_min, if_max] is used up, and all the bins of an LO setting are fetched in one call.\n
+    ### Args:\n
+    * lo_start_freq, lo_stop_freq, num_data: the RF frequencies to measure, `linspace(lo_start_freq, lo_stop_freq, num_data)`.\n
+    * if_min, if_max: the NCO range used (Hz), keep `if_min` away from the LO leakage.
+    """
+    integration_length = 1024
+    holdoff_length = 200
+
     readout_module.disconnect_outputs()
     readout_module.disconnect_inputs()
 
@@ -59,58 +71,45 @@ def wideCS(readout_module:Cluster, lo_start_freq:int, lo_stop_freq:int, num_data
     readout_module.out0_offset_path0(5.5)
     readout_module.out0_offset_path1(5.5)
 
-    # Configure scope mode
-    readout_module.scope_acq_sequencer_select(0)
-    readout_module.scope_acq_trigger_mode_path0("sequencer")
-    readout_module.scope_acq_trigger_mode_path1("sequencer")
-
     # Configure the sequencer
     readout_module.sequencers[0].mod_en_awg(True)
     readout_module.sequencers[0].demod_en_acq(True)
-    readout_module.sequencers[0].nco_freq(nco_freq)
     readout_module.sequencers[0].integration_length_acq(integration_length)
     readout_module.sequencers[0].sync_en(True)
 
     # NCO delay compensation
     readout_module.sequencers[0].nco_prop_delay_comp_en(True)
 
-    lo_sweep_range = np.linspace(lo_start_freq, lo_stop_freq, num_data)
-
-    I_data = []
-    Q_data = []
-
-    for lo_val in lo_sweep_range:
-        # Update the LO frequency.
-        readout_module.out0_in0_lo_freq(lo_val)
-
-        # Clear acquisitions
-        
-        readout_module.sequencers[0].delete_acquisition_data("acq")
-
+    target_freqs = np.linspace(lo_start_freq, lo_stop_freq, num_data)
+    step = (target_freqs[1]-target_freqs[0]) if num_data > 1 else 0
+    freqs = np.zeros(num_data)
+    I_data = np.zeros(num_data)
+    Q_data = np.zeros(num_data)
+
+    for lo, members in lo_segments(target_freqs, if_min, if_max):
+        # the NCO steps are integers in 0.25 Hz, the measured frequencies are kept as they are played
+        nco_start, nco_step = int(round((target_freqs[members[0]]-lo)*4)), int(round(step*4))
+        freqs[members] = lo + (nco_start + nco_step*np.arange(members.shape[0]))/4
+
+        readout_module.out0_in0_lo_freq(lo)
+        readout_module.sequencers[0].sequence({
+            "waveforms": {},
+            "weights": {},
+            "acquisitions": {"acq": {"num_bins": int(members.shape[0]), "index": 0}},
+            "program": nco_sweep_program(nco_start, nco_step, members.shape[0], num_averages, holdoff_length, integration_length),
+        })
         readout_module.arm_sequencer(0)
         readout_module.start_sequencer()
 
         # Wait for the sequencer to stop with a timeout period of one minute.
         readout_module.get_acquisition_state(0, timeout=1)
 
-        # Move acquisition data from temporary memory to acquisition list.
-        readout_module.store_scope_acquisition(0, "acq")
-
-        # Get acquisition list from instrument.
-        data = readout_module.get_acquisitions(0)["acq"]
-
-        # Store the acquisition data.
-        # The result still needs to be divided by the integration length to make sure
-        # the units are correct.
-        I_data.append(data["acquisition"]["bins"]["integration"]["path0"][0] / integration_length)
-        Q_data.append(data["acquisition"]["bins"]["integration"]["path1"][0] / integration_length)
+        # All the bins of this LO at once. The result still needs to be divided by the integration length to make sure the units are correct.
+        bins = readout_module.get_acquisitions(0)["acq"]["acquisition"]["bins"]["integration"]
+        I_data[members] = np.asarray(bins["path0"], dtype=float) / integration_length
+        Q_data[members] = np.asarray(bins["path1"], dtype=float) / integration_length
 
-    # Change data type
-    I_data = np.asarray(I_data)
-    Q_data = np.asarray(Q_data)
-
-    
-    dataset = Dataset({"data":(["mixer","freq"],np.array([I_data,Q_data]))},coords={"mixer":np.array(["I","Q"]),"freq":lo_sweep_range + nco_freq})
+    dataset = Dataset({"data":(["mixer","freq"],np.array([I_data,Q_data]))},coords={"mixer":np.array(["I","Q"]),"freq":freqs})
 
     return dataset
 
@@ -0,0 +1,291 @@
+"""
+Batch fitting engine. Fit a stack of traces like (qubit, bias, repeat, time) with the same model in one go instead of one lmfit call per trace.\n
+Two engines:\n
+* "lm": a vectorized Levenberg-Marquardt, all the traces iterate together in numpy (default, the fastest).\n
+* "pool": `scipy.optimize.curve_fit` per trace in a process pool, for the case a trace needs the full scipy machinery.\n
+Both start from the same vectorized initial guesses (the batched `fft_oscillation_guess` for the oscillating models),
+and return a xarray Dataset with the best values and their std errors in the leading dims of the data.
+"""
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', ".."))
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from numpy import ndarray
+from xarray import Dataset, DataArray
+from scipy.optimize import curve_fit
+from qblox_drive_AS.support.UserFriend import *
+from qblox_drive_AS.support.Pulse_schedule_library import T1_func, Ramsey_func, Rabi_func, Loren_func, resample_uniform
+
+
+def batch_oscillation_guess(data:ndarray, t:ndarray)->tuple[ndarray,ndarray]:
+    """ `fft_oscillation_guess` for the traces in (..., t), returns the freq and phase guesses in the leading shape. """
+    data, t = resample_uniform(data, t)
+    amp = np.fft.fft(data, axis=-1)[..., : data.shape[-1] // 2]
+    freq = np.fft.fftfreq(data.shape[-1], t[1] - t[0])[: amp.shape[-1]]
+    amp[..., 0] = 0  # Remove DC part
+    f_guess = np.abs(freq[np.argmax(np.abs(amp), axis=-1)])
+    phase_guess = 2 * np.pi - 2 * np.pi * t[np.argmax(data, axis=-1)] * f_guess
+    return f_guess, phase_guess
+
+
+def _T1_guess(data:ndarray, x:ndarray)->ndarray:
+    offset = data[:, -1]
+    A = data[:, 0] - offset
+    # the first point decays under 1/e of the amplitude
+    decayed = np.abs(data - offset[:, None]) < np.abs(A)[:, None] / np.e
+    T1 = np.where(decayed.any(axis=1), x[np.argmax(decayed, axis=1)] - x[0], np.mean(x))
+    return np.stack([A, np.where(T1 > 0, T1, np.mean(x)), offset], axis=1)
+
+
+def _Ramsey_guess(data:ndarray, x:ndarray)->ndarray:
+    f, phase = batch_oscillation_guess(data, x)
+    A = (data.max(axis=1) - data.min(axis=1)) / 2
+    return np.stack([A, np.full(data.shape[0], np.mean(x)), f, phase, data.mean(axis=1)], axis=1)
+
+
+def _Rabi_guess(data:ndarray, x:ndarray)->ndarray:
+    f, _ = batch_oscillation_guess(data, x)
+    A = (data.max(axis=1) - data.min(axis=1)) / 2
+    # Rabi_func starts from the minimum, flip the sign for the traces starting from the top
+    A = np.where(data[:, 0] > data.mean(axis=1), -A, A)
+    return np.stack([A, f, data.mean(axis=1)], axis=1)
+
+
+def _Loren_guess(data:ndarray, x:ndarray)->ndarray:
+    delta_x = np.abs(np.diff(x))
+    min_step = delta_x[delta_x > 0].min()
+    base = np.median(data, axis=1)
+    height = data.max(axis=1) - base
+    # FWHM from the points above the half height
+    above_half = data > (base + height / 2)[:, None]
+    width = np.clip(above_half.sum(axis=1) * np.mean(delta_x), min_step, x.max() - x.min())
+    A = np.pi * width * height / 2
+    return np.stack([x[np.argmax(data, axis=1)], width, A, base], axis=1)
+
+
+""" {model: (function, parameter names, initial guess, lower bounds, upper bounds)} """
+batch_models:dict = {
+    "T1": (T1_func, ["A", "T1", "offset"], _T1_guess, [-np.inf, 0, -np.inf], [np.inf, np.inf, np.inf]),
+    "Ramsey": (Ramsey_func, ["A", "T2", "f", "phase", "offset"], _Ramsey_guess, [-np.inf, 0, 0, -np.inf, -np.inf], [np.inf]*5),
+    "Rabi": (Rabi_func, ["A", "f", "offset"], _Rabi_guess, [-np.inf, 0, -np.inf], [np.inf]*3),
+    "Lorentzian": (Loren_func, ["x0", "gamma", "A", "base"], _Loren_guess, [-np.inf, 0, -np.inf, -np.inf], [np.inf]*4),
+}
+batch_models["T2"] = batch_models["Ramsey"]
+
+
+def _evaluate(func:callable, x:ndarray, paras:ndarray)->ndarray:
+    """ paras in (trace, para) -> model values in (trace, x) """
+    return func(x[None, :], *[paras[:, i, None] for i in range(paras.shape[1])])
+
+
+def _jacobian(func:callable, x:ndarray, paras:ndarray)->ndarray:
+    """ Central difference jacobian in (trace, x, para). """
+    steps = 1.49e-8 * np.where(paras != 0, np.abs(paras), 1)
+    jac = np.empty((paras.shape[0], x.shape[0], paras.shape[1]))
+    for i in range(paras.shape[1]):
+        up, down = paras.copy(), paras.copy()
+        up[:, i] += steps[:, i]
+        down[:, i] -= steps[:, i]
+        jac[:, :, i] = (_evaluate(func, x, up) - _evaluate(func, x, down)) / (2 * steps[:, i, None])
+    return jac
+
+
+def vectorized_LM(func:callable, x:ndarray, data:ndarray, p0:ndarray, lower:list, upper:list, max_iter:int=200, tol:float=1.49e-8)->tuple[ndarray,ndarray,ndarray,ndarray]:
+    """
+    Levenberg-Marquardt on all the traces together, the damping is kept per trace and the converged traces leave the iteration.\n
+    The traces still iterating after `max_iter` are marked as not successful.\n
+    ### Args:\n
+    * data: traces in (trace, x).\n
+    * p0: initial guesses in (trace, para).\n
+    * lower, upper: bounds per para, the steps are clipped into them.
+    ### Returns:\n
+    best values (trace, para), std errors (trace, para), chi-square (trace,), success (trace,)
+    """
+    lower, upper = np.asarray(lower, dtype=float), np.asarray(upper, dtype=float)
+    paras = np.clip(np.asarray(p0, dtype=float), lower, upper)
+    trace_num, para_num = paras.shape
+    residual = data - _evaluate(func, x, paras)
+    cost = (residual**2).sum(axis=1)
+    damping = np.full(trace_num, 1e-3)
+    active = np.isfinite(cost)
+    converged = np.zeros(trace_num, dtype=bool)
+    eye = np.eye(para_num)
+
+    for _ in range(max_iter):
+        idx = np.where(active)[0]
+        if idx.shape[0] == 0:
+            break
+        jac = _jacobian(func, x, paras[idx])
+        JTJ = np.einsum('nmp,nmq->npq', jac, jac)
+        grad = np.einsum('nmp,nm->np', jac, residual[idx])
+        # Marquardt scaling keeps the solve well conditioned when the paras are in very different units
+        scale = np.sqrt(np.diagonal(JTJ, axis1=1, axis2=2))
+        scale[scale == 0] = 1
+        scaled_JTJ = JTJ / (scale[:, :, None] * scale[:, None, :]) + damping[idx, None, None] * eye
+        step = np.linalg.solve(scaled_JTJ, (grad / scale)[..., None])[..., 0] / scale
+
+        new_paras = np.clip(paras[idx] + step, lower, upper)
+        new_residual = data[idx] - _evaluate(func, x, new_paras)
+        new_cost = (new_residual**2).sum(axis=1)
+        better = np.isfinite(new_cost) & (new_cost <= cost[idx])
+
+        small_gain = better & (cost[idx] - new_cost <= tol * cost[idx])
+        small_step = np.all(np.abs(new_paras - paras[idx]) <= tol * np.abs(paras[idx]), axis=1)
+
+        accepted = idx[better]
+        paras[accepted], residual[accepted], cost[accepted] = new_paras[better], new_residual[better], new_cost[better]
+        damping[idx] = np.clip(np.where(better, damping[idx] / 10, damping[idx] * 10), 1e-12, 1e12)
+
+        # no more step can lower the cost once the damping saturates, it's at the minimum within the precision
+        done = small_gain | small_step | (damping[idx] >= 1e12)
+        converged[idx[done]] = True
+        active[idx[done]] = False
+
+    # covariance from the final jacobian
+    jac = _jacobian(func, x, paras)
+    JTJ = np.einsum('nmp,nmq->npq', jac, jac)
+    scale = np.sqrt(np.diagonal(JTJ, axis1=1, axis2=2))
+    scale[scale == 0] = 1
+    outer_scale = scale[:, :, None] * scale[:, None, :]
+    dof = max(x.shape[0] - para_num, 1)
+    covar = np.linalg.pinv(JTJ / outer_scale) / outer_scale * (cost / dof)[:, None, None]
+    errors = np.sqrt(np.abs(np.diagonal(covar, axis1=1, axis2=2)))
+    success = converged & np.isfinite(paras).all(axis=1)
+    return paras, errors, cost, success
+
+
+def _curve_fit_chunk(args:tuple)->tuple[ndarray,ndarray,ndarray,ndarray]:
+    model, x, data, p0 = args
+    func, _, _, lower, upper = batch_models[model]
+    paras, errors = np.array(p0, dtype=float), np.full(p0.shape, np.nan)
+    cost, success = np.full(data.shape[0], np.nan), np.zeros(data.shape[0], dtype=bool)
+    for i, trace in enumerate(data):
+        try:
+            popt, pcov = curve_fit(func, x, trace, p0=np.clip(p0[i], lower, upper), bounds=(lower, upper), maxfev=10000)
+        except (RuntimeError, ValueError):
+            continue
+        paras[i], errors[i], success[i] = popt, np.sqrt(np.abs(np.diag(pcov))), True
+        cost[i] = ((trace - func(x, *popt))**2).sum()
+    return paras, errors, cost, success
+
+
+def pool_fit(model:str, x:ndarray, data:ndarray, p0:ndarray, workers:int=None)->tuple[ndarray,ndarray,ndarray,ndarray]:
+    """ `scipy.optimize.curve_fit` per trace, the traces are split into chunks for the process pool. Same returns as `vectorized_LM`. """
+    workers = os.cpu_count() if workers is None else workers
+    chunks = [(model, x, d, p) for d, p in zip(np.array_split(data, workers), np.array_split(p0, workers)) if d.shape[0] != 0]
+    if workers == 1 or len(chunks) == 1:
+        results = [_curve_fit_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_curve_fit_chunk, chunks))
+    return tuple(np.concatenate([result[i] for result in results]) for i in range(4))
+
+
+def batch_fit(data:ndarray|DataArray, x:ndarray=None, model:str="T1", dims:list=None, coords:dict=None, engine:str="lm", workers:int=None, max_iter:int=200)->Dataset:
+    """
+    Fit every trace in the stack with the same model.\n
+    ### Args:\n
+    * data: traces in (..., x), like (qubit, bias, repeat, time). A DataArray gives its leading dims and coords, and its last coord as `x` if `x` is None.\n
+    * x: the sweep samples of the last axis.\n
+    * model: "T1" (A*exp(-x/T1)+offset), "T2"/"Ramsey", "Rabi" or "Lorentzian", see `Pulse_schedule_library` for the functions.\n
+    * dims, coords: names and coords of the leading dims for a numpy `data`.\n
+    * engine: "lm" the vectorized Levenberg-Marquardt or "pool" the process pool of curve_fit.\n
+    * workers: processes for the "pool" engine, default is the cpu count.
+    ### Returns:\n
+    Dataset with the variables `{para}`, `{para}_err`, `chisqr` and `success` in the leading dims. The sweep samples are kept in the coord "fit_x".
+    """
+    if model not in batch_models:
+        raise KeyError(f"Unknown fitting model = {model}, only {list(batch_models.keys())} are supported !")
+    func, para_names, guesser, lower, upper = batch_models[model]
+
+    if isinstance(data, DataArray):
+        dims = list(data.dims[:-1]) if dims is None else dims
+        coords = {d: data.coords[d].values for d in dims if d in data.coords} if coords is None else coords
+        x = data.coords[data.dims[-1]].values if x is None else x
+        data = data.values
+    if x is None:
+        raise ValueError("The sweep samples `x` are required for a numpy data !")
+    data, x = np.asarray(data, dtype=float), np.asarray(x, dtype=float)
+    if x.shape[0] != data.shape[-1]:
+        raise ValueError(f"The sweep samples should be as long as the last axis of data = {data.shape[-1]} !")
+    leading_shape = data.shape[:-1]
+    dims = [f"dim_{i}" for i in range(len(leading_shape))] if dims is None else list(dims)
+    traces = data.reshape(-1, data.shape[-1])
+
+    p0 = guesser(traces, x)
+    match engine.lower():
+        case "lm":
+            with np.errstate(all="ignore"):
+                paras, errors, cost, success = vectorized_LM(func, x, traces, p0, lower, upper, max_iter)
+        case "pool":
+            paras, errors, cost, success = pool_fit(model, x, traces, p0, workers)
+        case _:
+            raise KeyError(f"Unknown fitting engine = {engine}, use 'lm' or 'pool' !")
+
+    data_vars = {}
+    for i, name in enumerate(para_names):
+        data_vars[name] = (dims, paras[:, i].reshape(leading_shape))
+        data_vars[f"{name}_err"] = (dims, errors[:, i].reshape(leading_shape))
+    data_vars["chisqr"] = (dims, cost.reshape(leading_shape))
+    data_vars["success"] = (dims, success.reshape(leading_shape))
+    ds_coords = {d: coords[d] for d in (coords or {}) if d in dims}
+    ds_coords["fit_x"] = (["fit_x"], x)
+    return Dataset(data_vars=data_vars, coords=ds_coords, attrs=dict(model=model, engine=engine))
+
+
+def batch_fit_curve(result:Dataset, x:ndarray=None)->DataArray:
+    """ The fitted curves of a `batch_fit` result on `x` (default the fitted samples), in (..., fit_x). """
+    func, para_names, _, _, _ = batch_models[result.attrs["model"]]
+    x = result.coords["fit_x"].values if x is None else np.asarray(x, dtype=float)
+    paras = np.stack([result[name].values.reshape(-1) for name in para_names], axis=1)
+    leading_dims = list(result[para_names[0]].dims)
+    curves = _evaluate(func, x, paras).reshape(result[para_names[0]].shape + (x.shape[0],))
+    return DataArray(curves, coords={**{d: result.coords[d] for d in leading_dims if d in result.coords}, "fit_x": x}, dims=leading_dims + ["fit_x"])
+
+
+def benchmark_batch_fit(traces:int=2000, points:int=100, model:str="T1", per_trace_limit:int=200)->dict:
+    """
+    Compare the lmfit per-trace loop (the way the analyzers did, run on `per_trace_limit` traces and scaled up) with the batch engines
+    on synthetic traces. Return the seconds of each method and the median relative error on the decay time.
+    """
+    from lmfit import Model
+    rng = np.random.default_rng(0)
+    func, para_names, guesser, lower, upper = batch_models[model]
+    if model == "T1":
+        x = np.linspace(0, 60, points)
+        truth = np.stack([rng.uniform(0.5, 1, traces), rng.uniform(5, 30, traces), rng.uniform(-0.1, 0.1, traces)], axis=1)
+    elif model in ["T2", "Ramsey"]:
+        x = np.linspace(0, 20e-6, points)
+        truth = np.stack([rng.uniform(0.5, 1, traces), rng.uniform(5e-6, 30e-6, traces), rng.uniform(0.3e6, 1e6, traces), rng.uniform(0, np.pi, traces), rng.uniform(-0.1, 0.1, traces)], axis=1)
+    else:
+        raise KeyError(f"Benchmark only supports T1 and Ramsey, got {model} !")
+    data = _evaluate(func, x, truth) + rng.normal(scale=0.02, size=(traces, points))
+    decay_idx = 1
+
+    ans = {}
+    start = perf_counter()
+    lm_model, p0 = Model(func), guesser(data[:per_trace_limit], x)
+    for name, lo, hi in zip(para_names, lower, upper):
+        lm_model.set_param_hint(name, min=lo, max=hi)
+    for trace, guess in zip(data[:per_trace_limit], p0):
+        lm_model.fit(trace, D=x, **dict(zip(para_names, guess)))
+    ans["lmfit_loop"] = (perf_counter() - start) * traces / min(per_trace_limit, traces)
+
+    for engine in ["lm", "pool"]:
+        start = perf_counter()
+        result = batch_fit(data, x, model, engine=engine)
+        ans[engine] = perf_counter() - start
+        fitted = result[para_names[decay_idx]].values
+        ans[f"{engine}_median_error"] = float(np.median(np.abs(fitted - truth[:, decay_idx]) / truth[:, decay_idx]))
+        ans[f"{engine}_success"] = float(result["success"].values.mean())
+
+    slightly_print(f"{model} on {traces} traces x {points} points:")
+    slightly_print(f"lmfit loop (estimated) {round(ans['lmfit_loop'], 2)} s, lm {round(ans['lm'], 3)} s, pool {round(ans['pool'], 2)} s")
+    slightly_print(f"median relative {para_names[decay_idx]} error: lm {ans['lm_median_error']:.2e}, pool {ans['pool_median_error']:.2e}")
+    return ans
+
+
+if __name__ == "__main__":
+    benchmark_batch_fit(model="T1")
+    benchmark_batch_fit(model="Ramsey")
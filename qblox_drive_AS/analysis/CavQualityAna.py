@@ -6,6 +6,7 @@ from xarray import Dataset, open_dataset
 import pandas as pd
 from qcat.analysis.resonator.photon_dep.res_data import PhotonDepResonator
 from qblox_drive_AS.support.QDmanager import QDmanager
+from qblox_drive_AS.analysis.ResonatorFitting import circle_fit_slices
 def dBm2photons():
     pass
 
@@ -105,6 +106,41 @@ def cav_photonDepAna_bridge(folder_path:str):
         plot_qualities(result_folder)
 
 
+def cav_powerDep_quickfit(folder_path:str, workers:int=None)->dict:
+    """
+    The fast look at the power sweep, the circle fit of every power slice starting from the fit of the neighbouring power.\n
+    Returns {qubit: {"output_dBm":[...], "fr":[...], "Ql":[...], "absQc":[...], "Qi_dia_corr":[...]}}, `cav_photonDepAna_bridge` is the full analysis.
+    """
+    other_info = {}
+    info_file = [os.path.join(folder_path,name) for name in os.listdir(folder_path) if (os.path.isfile(os.path.join(folder_path,name)) and name.split(".")[0]=='Additional_info')][0] 
+    with open(info_file) as J:
+            other_info = json.load(J)
+    ncs = [os.path.join(folder_path,name) for name in os.listdir(folder_path) if (os.path.isfile(os.path.join(folder_path,name)) and name.split("_")[1]=='CavitySpectro')]
+    ncs = timelabel_sort(ncs)
+    power = other_info["SA_dBm"]
+    RT_atte = other_info["RT_atte_dB"]
+    ro_elements = other_info["ro_elements"]
+    applied_attes = other_info["applied_atte"]
+
+    S21s = {qubit:[] for qubit in ro_elements}
+    for nc_file in ncs:
+        ds = open_dataset(nc_file)
+        for q_idx, qubit in enumerate(list(ro_elements.keys())):
+            S21s[qubit].append(array(ds[f"y{2*q_idx}"] * cos(deg2rad(ds[f"y{2*q_idx+1}"])) + 1j * ds[f"y{2*q_idx}"] * sin(deg2rad(ds[f"y{2*q_idx+1}"]))))
+        ds.close()
+
+    results = {}
+    for qubit in ro_elements:
+        results[qubit] = {"output_dBm":[], "fr":[], "Ql":[], "absQc":[], "Qi_dia_corr":[]}
+        fits = circle_fit_slices(array(ro_elements[qubit]), array(S21s[qubit]), warm=True, workers=workers)
+        for atte_idx, fit in enumerate(fits):
+            if fit is None: continue
+            results[qubit]["output_dBm"].append(float(power[qubit])-float(RT_atte)-float(applied_attes[atte_idx]))
+            for item in ["fr", "Ql", "absQc", "Qi_dia_corr"]:
+                results[qubit][item].append(fit[item])
+    return results
+
+
 def plot_qualities(result_folder:str):
     plot_items = ["Qi_dia_corr_fqc", "Qc_dia_corr", "Ql"]
     errors = ["Qi_dia_corr_err", "absQc_err", "Ql_err"]
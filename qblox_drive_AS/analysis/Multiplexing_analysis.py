@@ -1,5 +1,5 @@
 from numpy import array, mean, median, argmax, linspace, arange, moveaxis, empty_like, std, average, transpose, where, arctan2, sort, polyfit, delete, degrees
-from numpy import sqrt, pi
+from numpy import sqrt, pi, nan, isfinite
 from numpy import ndarray
 from xarray import Dataset, DataArray, open_dataset
 from qcat.analysis.base import QCATAna
@@ -17,11 +17,14 @@ from qcat.analysis.state_discrimination.readout_fidelity import GMMROFidelity
 from qcat.analysis.state_discrimination import p01_to_Teff
 from qcat.analysis.state_discrimination.discriminator import get_proj_distance
 from qcat.visualization.readout_fidelity import plot_readout_fidelity
-from qcat.analysis.resonator.photon_dep.res_data import ResonatorData
-from qblox_drive_AS.support import rotate_onto_Inphase, rotate_data
-from qcat.visualization.qubit_relaxation import plot_qubit_relaxation
-from qcat.analysis.qubit.relaxation import RelaxationAnalysis
+from qblox_drive_AS.support import rotate_onto_Inphase
+from qblox_drive_AS.support.IQtransform import IQ_contrast, rotate_IQ
+from qblox_drive_AS.support.PhaseTracer import traced
+from qblox_drive_AS.support.StateDiscriminator import TwoStateGMM
+from qblox_drive_AS.analysis.BatchFitting import batch_fit, batch_fit_curve
+from qblox_drive_AS.analysis.ResonatorFitting import circle_fit_slices
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from matplotlib.figure import Figure
 
 def parabola(x,a,b,c):
@@ -57,33 +60,38 @@ def plot_FreqBiasIQ(f:ndarray,z:ndarray,I:ndarray,Q:ndarray,refIQ:list=[], ax:pl
     return ax
 
 def zgate_T1_fitting(time_array:DataArray,IQ_array:DataArray, ref_IQ:list, fit:bool=True)->tuple[list,list]:
-    I_array = list(IQ_array[0]) # shape in (bias, time)
-    Q_array = list(IQ_array[1]) # shape in (bias, time)
-
-    T1s = []
-    signals = []
-    if len(ref_IQ) == 1:
-        data = moveaxis(IQ_array,0,1)
-        for bias_idx, bias_data in enumerate(data): 
-            signals.append(rotate_data(bias_data,ref_IQ[0])[0])
-            da = DataArray(data=signals[-1], coords={"time":array(time_array)*1e3})
-            da.name = 'dummy'
-            if fit:
-                my_ana = RelaxationAnalysis(da)
-                my_ana._start_analysis()
-                T1s.append(my_ana.fit_result.params["tau"].value)
-                
+    signals = IQ_contrast(array(IQ_array), ref_IQ) # shape in (bias, time)
+    T1s = batch_fit(signals, array(time_array), "T1")["T1"].values.tolist() if fit else []
+
+    return list(signals), T1s
+
+def fit_f01_curve(contrast:ndarray, z:ndarray, f:ndarray, fit_func:callable=QS_fit_analysis, workers:int=None)->Dataset:
+    """
+    Fit the qubit peak of every bias slice once and give the f01(z) curve.\n
+    ### Args:\n
+    * contrast: the 2-tone flux map in (bias, freq).\n
+    * fit_func: `QS_fit_analysis` goes to the batch Lorentzian fitting (the peak pre-guess of all the slices is vectorized),
+    the other functions are called once per slice and should return the Dataset with attrs "f01_fit".\n
+    * workers: fit the slices in parallel by this many processes, None is the vectorized fitting in this process.
+    ### Returns:\n
+    Dataset in the bias dim with "f01", "f01_err" (Hz) and "in_range" (f01 is in the freq window).
+    """
+    z, f = array(z), array(f)
+    if fit_func is QS_fit_analysis:
+        results = batch_fit(contrast, f, "Lorentzian", dims=["bias"], coords={"bias":z}, engine="lm" if workers is None else "pool", workers=workers)
+        f01, f01_err = results["x0"].values, results["x0_err"].values
     else:
-        for bias_idx, bias_data in enumerate(I_array):
-            signals.append(sqrt((array(bias_data)-ref_IQ[0])**2+(array(Q_array[bias_idx])-ref_IQ[1])**2))
-            da = DataArray(data=signals[-1], coords={"time":array(time_array)*1e3})
-            da.name = 'dummy'
-            if fit:
-                my_ana = RelaxationAnalysis(da)
-                my_ana._start_analysis()
-                T1s.append(my_ana.fit_result.params["tau"].value)
+        if workers is None:
+            fit_results = [fit_func(a_z_data, f) for a_z_data in contrast]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                fit_results = list(executor.map(fit_func, contrast, [f]*contrast.shape[0]))
+        f01 = array([res.attrs['f01_fit'] for res in fit_results])
+        f01_err = array([res.attrs.get('f01_err', nan) for res in fit_results])
 
-    return signals, T1s
+    # like lmfit, a slice that ran out of iterations still gives its f01, only the window decides
+    in_range = isfinite(f01) & (f01 >= min(f)) & (f01 <= max(f))
+    return Dataset(data_vars=dict(f01=(["bias"],f01),f01_err=(["bias"],f01_err),in_range=(["bias"],in_range)),coords=dict(bias=(["bias"],z)))
 
 def build_result_pic_path(dir_path:str,folder_name:str="")->str:
     parent = os.path.split(dir_path)[0]
@@ -238,8 +246,8 @@ class analysis_tools():
             plt.savefig(pic_path)
             plt.close()
 
-    def fluxCavity_ana(self, var_name:str):
-
+    def fluxCavity_ana(self, var_name:str, workers:int=None):
+        """ The fr of every bias slice by the warm-started circle fit, `workers` splits the slices into a process pool. """
         self.qubit = var_name
         self.freqs = array(self.ds.data_vars[f"{var_name}_freq"])[0][0]
         self.bias = array(self.ds.coords["bias"])
@@ -250,17 +258,18 @@ class analysis_tools():
         try:
             freq_fit = []
             fit_err = []
-            for idx, _ in enumerate(S21):
-                res_er = ResonatorData(freq=self.freqs,zdata=array(S21[idx]))
-                result, _, _ = res_er.fit()
-                freq_fit.append(result['fr'])
-                fit_err.append(result['chi_square'])
+            fit_bias = []
+            for bias, result in zip(self.bias, circle_fit_slices(self.freqs, S21, warm=True, workers=workers)):
+                if result is not None:
+                    freq_fit.append(result['fr'])
+                    fit_err.append(result['chi_square'])
+                    fit_bias.append(bias)
 
             _, indexs = remove_outliers_with_window(array(fit_err),int(len(fit_err)/3),m=1)
             
             for i in indexs:
                 self.collected_freq.append(freq_fit[i])
-                self.collected_flux.append(list(self.bias)[i])
+                self.collected_flux.append(fit_bias[i])
             self.fit_results = cos_fit_analysis(array(self.collected_freq),array(self.collected_flux))
             paras = array(self.fit_results.attrs['coefs'])
 
@@ -306,12 +315,7 @@ class analysis_tools():
         self.target_q = var
         self.xyf = array(self.ds[f"{self.target_q}_freq"])[0][0]
         self.xyl = array(self.ds.coords["xy_amp"])
-        ii = array(self.ds[self.target_q])[0]
-        qq = array(self.ds[self.target_q])[1]
-        if len(ref) == 2:
-            self.contrast = sqrt((ii-ref[0])**2+(qq-ref[1])**2).reshape(self.xyl.shape[0],self.xyf.shape[0])
-        else:
-            self.contrast = rotate_data(array(self.ds[self.target_q]),ref[0])[0]
+        self.contrast = IQ_contrast(array(self.ds[self.target_q]),ref).reshape(self.xyl.shape[0],self.xyf.shape[0])
         self.fit_f01s = []
         self.fif_amps = []
         if fit_func is not None and self.xyl.shape[0] != 1:
@@ -347,7 +351,7 @@ class analysis_tools():
         Plotter.pic_save_path = os.path.join(save_pic_path,f"{self.target_q}_Conti2tone_{self.ds.attrs['execution_time'] if 'execution_time' in list(self.ds.attrs) else Data_manager().get_time_now()}.png")
         Plotter.export_results()
 
-    def fluxQb_ana(self, var, fit_func:callable=None, refIQ:list=[], filter_outlier:bool=True):
+    def fluxQb_ana(self, var, fit_func:callable=None, refIQ:list=[], filter_outlier:bool=True, workers:int=None):
         self.qubit = var
         self.filtered_z, self.filtered_f = [], []
         self.ref_z = float(self.ds.attrs[f"{self.qubit}_z_ref"])
@@ -356,21 +360,15 @@ class analysis_tools():
         IQarray = array(self.ds[f"{self.qubit}"])
 
 
-        if len(refIQ) == 2:
-            self.contrast = array(sqrt((IQarray[0]-refIQ[0])**2+(IQarray[1]-refIQ[1])**2))
-        else:
-            self.contrast = rotate_data(IQarray,refIQ[0])[0]
+        self.contrast = IQ_contrast(IQarray,refIQ)
         if fit_func is not None:
-            # try:
-            self.fit_z = []
-            self.fit_f = []
-            def parabola(x,a,b,c):
-                return a*array(x)**2+b*array(x)+c
-            for z_idx, a_z_data in enumerate(self.contrast):
-                if min(self.f) <= fit_func(a_z_data,self.f).attrs['f01_fit'] and fit_func(a_z_data,self.f).attrs['f01_fit'] <= max(self.f):
-                    self.fit_f.append(fit_func(a_z_data,self.f).attrs['f01_fit']*1e-9) # GHz
-                    self.fit_z.append(self.z[z_idx])
-            
+            # every z slice is fitted once
+            self.f01_curve = fit_f01_curve(self.contrast,self.z,self.f,fit_func,workers)
+            in_range = self.f01_curve["in_range"].values
+            self.fit_f = list(self.f01_curve["f01"].values[in_range]*1e-9) # GHz
+            self.fit_z = list(self.z[in_range])
+            self.fit_packs["f01_curve"] = self.f01_curve
+
             if not filter_outlier:
                 self.paras, _ = curve_fit(parabola,self.fit_z,self.fit_f)
             else:
@@ -413,13 +411,8 @@ class analysis_tools():
     def rabi_ana(self,var:str):
         self.qubit = var
         self.rabi_type = self.ds.attrs["rabi_type"]
-        i_data = array(self.ds[var])[0]
-        q_data = array(self.ds[var])[1]
         if not self.ds.attrs["OS_mode"]:
-            if len(self.refIQ) == 2:
-                data_to_fit = sqrt((i_data-self.refIQ[0])**2+(q_data-self.refIQ[1])**2)
-            else:
-                data_to_fit = rotate_data(array(self.ds[var]),float(self.refIQ[0]))[0]
+            data_to_fit = IQ_contrast(array(self.ds[var]),self.refIQ)
         else:
             # wait GMM
             pass
@@ -439,16 +432,15 @@ class analysis_tools():
         if save_pic_path != "": slightly_print(f"pic saved located:\n{save_pic_path}")
         Fit_analysis_plot(self.fit_packs,save_path=save_pic_path,P_rescale=None,Dis=None,q=self.qubit)
 
-    def oneshot_ana(self,data:DataArray,tansition_freq_Hz:float=None):
+    def oneshot_ana(self,data:DataArray,tansition_freq_Hz:float=None,discriminator:TwoStateGMM=None):
+        """ `discriminator` is the kept one from `QDmanager.Discriminators`, a new one is trained on the data if it's None. """
         self.fq = tansition_freq_Hz
-        self.gmm2d_fidelity = GMMROFidelity()
-        self.gmm2d_fidelity._import_data(data)
-        self.gmm2d_fidelity._start_analysis()
-        g1d_fidelity = self.gmm2d_fidelity.export_G1DROFidelity()
+        self.discriminator = TwoStateGMM().train(array(data)) if discriminator is None else discriminator
+        assignment = self.discriminator.assignment_matrix(array(data))
         
-        p00 = g1d_fidelity.g1d_dist[0][0][0]
-        self.thermal_populations = g1d_fidelity.g1d_dist[0][0][1]
-        p11 = g1d_fidelity.g1d_dist[1][0][1]
+        p00 = assignment[0][0]
+        self.thermal_populations = assignment[0][1]
+        p11 = assignment[1][1]
         if self.fq is not None:
             self.effT_mK = p01_to_Teff(self.thermal_populations, self.fq)*1000
         else:
@@ -456,16 +448,15 @@ class analysis_tools():
         self.RO_fidelity_percentage = (p00+p11)*100/2
 
 
-        _, self.RO_rotate_angle = rotate_onto_Inphase(self.gmm2d_fidelity.mapped_centers[0],self.gmm2d_fidelity.mapped_centers[1])
-        z = moveaxis(array(data),0,1) # (IQ, state, shots) -> (state, IQ, shots)
-        self.rotated_data = empty_like(array(data))
-        for state_idx, state_data in enumerate(z):
-            self.rotated_data[state_idx] = rotate_data(state_data,self.RO_rotate_angle)
+        _, self.RO_rotate_angle = rotate_onto_Inphase(self.discriminator.centers[0],self.discriminator.centers[1])
+        self.rotated_data = moveaxis(rotate_IQ(array(data),self.RO_rotate_angle),0,1) # (IQ, state, shots) -> (state, IQ, shots)
         
         self.fit_packs = {"effT_mK":self.effT_mK,"thermal_population":self.thermal_populations,"RO_fidelity":self.RO_fidelity_percentage,"RO_rotation_angle":self.RO_rotate_angle}
 
     def oneshot_plot(self,save_pic_path:str=None):
+        # the GMMROFidelity is only for the figure, it's trained once on the rotated data here
         da = DataArray(moveaxis(self.rotated_data,0,1), coords= [("mixer",["I","Q"]), ("prepared_state",[0,1]), ("index",arange(array(self.rotated_data).shape[2]))] )
+        self.gmm2d_fidelity = GMMROFidelity()
         self.gmm2d_fidelity._import_data(da)
         self.gmm2d_fidelity._start_analysis()
         g1d_fidelity = self.gmm2d_fidelity.export_G1DROFidelity()
@@ -476,32 +467,24 @@ class analysis_tools():
     def T2_ana(self,var:str,ref:list):
         raw_data = self.ds[var]
         time_samples = array(self.ds[f"{var}_x"])[0][0]
-        reshaped = moveaxis(array(raw_data),0,1)  # (repeat, IQ, idx)
+        contrasts = IQ_contrast(array(raw_data),ref)  # (repeat, idx)
         self.qubit = var
+        self.echo:bool=False if raw_data.attrs["spin_num"] == 0 else True
+        # only the last repeat is plotted, the Ramsey one is fitted for the plot in T2_plot
+        self.data_n = contrasts[-1]
+        self.plot_item = {"data":self.data_n*1000,"time":array(time_samples)*1e6}
 
+        # all the repeats are fitted in one batch
+        if not self.echo:
+            results = batch_fit(contrasts, array(time_samples), "Ramsey")
+            self.T2_fit = (results["T2"].values*1e6).tolist()
+            self.fit_packs["freq"] = float(results["f"].values[-1])
+        else:
+            results = batch_fit(contrasts*1000, self.plot_item["time"], "T1")
+            self.T2_fit = results["T1"].values.tolist()
+            self.relax_fit = results.isel(dim_0=-1)
+            self.fit_packs["freq"] = 0
 
-        self.T2_fit = []
-        for idx, data in enumerate(reshaped):
-            self.echo:bool=False if raw_data.attrs["spin_num"] == 0 else True
-            if len(ref) == 1:
-                self.data_n = rotate_data(data,ref[0])[0]
-            else:
-                self.data_n = sqrt((data[0]-ref[0])**2+(data[1]-ref[1])**2)
-            self.plot_item = {"data":self.data_n*1000,"time":array(time_samples)*1e6}
-            if not self.echo:
-                self.ans = T2_fit_analysis(self.plot_item["data"]/1000,self.plot_item["time"]/1e6)
-                self.T2_fit.append(self.ans.attrs["T2_fit"]*1e6)
-                self.fit_packs["freq"] = self.ans.attrs['f']
-            else:
-                da = DataArray(data=self.plot_item["data"], coords={"time":self.plot_item["time"]*1e3})
-                da.name = "dummy"
-                my_ana = RelaxationAnalysis(da)
-                my_ana._start_analysis()
-                self.ans = my_ana.fit_result
-                self.T2_fit.append(self.ans.params["tau"].value)
-                self.fit_packs["freq"] = 0
-
-        
         self.fit_packs["median_T2"] = median(array(self.T2_fit))
         self.fit_packs["mean_T2"] = mean(array(self.T2_fit))
         self.fit_packs["std_T2"] = std(array(self.T2_fit))
@@ -509,14 +492,10 @@ class analysis_tools():
     def XYF_cali_ana(self,var:str,ref:list):
         raw_data = self.ds[f'{var}']
         time_samples =  array(self.ds[f'{var}_x'])[0][0]
-        reshaped = moveaxis(array(raw_data),0,1)  # (repeat, IQ, idx)
+        contrasts = IQ_contrast(array(raw_data),ref)  # (repeat, idx)
         self.qubit = var
-        for idx, data in enumerate(reshaped):
+        for idx, data in enumerate(contrasts):
             self.echo:bool=False if raw_data.attrs["spin_num"] == 0 else True
-            if len(ref) == 1:
-                data = rotate_data(data,ref[0])[0] # I
-            else:
-                data = sqrt((data[0]-ref[0])**2+(data[1]-ref[1])**2)
             
             self.ans = cos_fit_analysis(data,array(time_samples))
             p_deg = degrees(self.ans.attrs['coefs'][2])  # Converts radians to degrees
@@ -529,16 +508,10 @@ class analysis_tools():
         save_pic_path = os.path.join(save_pic_path,f"{self.qubit}_{'Echo' if self.echo else 'Ramsey'}_{self.ds.attrs['execution_time'].replace(' ', '_')}.png") if save_pic_path is not None else ""
         if save_pic_path != "" : slightly_print(f"pic saved located:\n{save_pic_path}")
         if not self.echo:
+            self.ans = T2_fit_analysis(self.plot_item["data"]/1000,self.plot_item["time"]/1e6)
             Fit_analysis_plot(self.ans,P_rescale=False,Dis=None,spin_echo=self.echo,save_path=save_pic_path,q=self.qubit)
         else:
-            fig, ax = plt.subplots()
-            ax = plot_qubit_relaxation(self.plot_item["time"],self.plot_item["data"], ax, self.ans)
-            ax.set_title(f"{self.qubit} T2 = {round(self.ans.params['tau'].value,1)} µs" )
-            if save_pic_path != "" : 
-                plt.savefig(save_pic_path)
-                plt.close()
-            else:
-                plt.show()
+            self.relaxation_plot("T2", save_pic_path)
 
         if len(self.T2_fit) > 1:
             Data_manager().save_histo_pic(None,{str(self.qubit):self.T2_fit},self.qubit,mode=f"{'t2' if self.echo else 't2*'}",pic_folder=os.path.split(save_pic_path)[0])
@@ -551,40 +524,40 @@ class analysis_tools():
     def T1_ana(self,var:str,ref:list):
         raw_data = self.ds[var]
         time_samples = array(self.ds[f"{var}_x"])[0][0]
-        reshaped = moveaxis(array(raw_data),0,1)  # (repeat, IQ, idx)
+        contrasts = IQ_contrast(array(raw_data),ref)*1000  # (repeat, idx)
         self.qubit = var
-        self.plot_item = {"time":array(time_samples)*1e6}
-        self.T1_fit = []
-        for idx, data in enumerate(reshaped):
-            if len(ref) == 1:
-                self.plot_item["data"] = rotate_data(data,ref[0])[0]*1000 # I
-            else:
-                self.plot_item["data"] = sqrt((data[0]-ref[0])**2+(data[1]-ref[1])**2)*1000
-            
-            da = DataArray(data=self.plot_item["data"], coords={"time":self.plot_item["time"]*1e3})
-            da.name = "dummy"
-            my_ana = RelaxationAnalysis(da)
-            my_ana._start_analysis()
-            self.ans = my_ana.fit_result
-            
-            self.T1_fit.append(self.ans.params["tau"].value)
+        # only the last repeat is plotted with its fit
+        self.plot_item = {"time":array(time_samples)*1e6, "data":contrasts[-1]}
+        # all the repeats are fitted in one batch
+        results = batch_fit(contrasts, self.plot_item["time"], "T1")
+        self.T1_fit = results["T1"].values.tolist()
+        self.relax_fit = results.isel(dim_0=-1)
         self.fit_packs["median_T1"] = median(array(self.T1_fit))
         self.fit_packs["mean_T1"] = mean(array(self.T1_fit))
         self.fit_packs["std_T1"] = std(array(self.T1_fit))
     
     def T1_plot(self,save_pic_path:str=None):
         save_pic_path = os.path.join(save_pic_path,f"{self.qubit}_T1_{self.ds.attrs['execution_time'].replace(' ', '_')}.png") if save_pic_path is not None else ""
+        if save_pic_path != "" : slightly_print(f"pic saved located:\n{save_pic_path}")
+        self.relaxation_plot("T1", save_pic_path)
+        if len(self.T1_fit) > 1:
+            Data_manager().save_histo_pic(None,{str(self.qubit):self.T1_fit},self.qubit,mode="t1",pic_folder=os.path.split(save_pic_path)[0])
+
+    def relaxation_plot(self, label:str, save_pic_path:str=""):
+        """ Plot the last repeat in `self.plot_item` (time in µs) with its `batch_fit` result `self.relax_fit`, the same fit the histogram has. """
+        fit_time = linspace(self.plot_item["time"].min(), self.plot_item["time"].max(), 1000)
         fig, ax = plt.subplots()
-        ax = plot_qubit_relaxation(self.plot_item["time"],self.plot_item["data"], ax, self.ans)
-        ax.set_title(f"{self.qubit} T1 = {round(self.ans.params['tau'].value,1)} µs" )
+        ax.scatter(self.plot_item["time"], self.plot_item["data"], s=10, label="data")
+        ax.plot(fit_time, batch_fit_curve(self.relax_fit, fit_time).values, c="red", label="fit")
+        ax.set_xlabel("Free evolution time (µs)")
+        ax.set_ylabel("Contrast (mV)")
+        ax.set_title(f"{self.qubit} {label} = {round(float(self.relax_fit['T1']),1)} ± {round(float(self.relax_fit['T1_err']),1)} µs")
+        ax.legend()
         if save_pic_path != "" : 
-            slightly_print(f"pic saved located:\n{save_pic_path}")
             plt.savefig(save_pic_path)
             plt.close()
         else:
             plt.show()
-        if len(self.T1_fit) > 1:
-            Data_manager().save_histo_pic(None,{str(self.qubit):self.T1_fit},self.qubit,mode="t1",pic_folder=os.path.split(save_pic_path)[0])
 
     def ZgateT1_ana(self,time_sort:bool=False):
         self.time_trace_mode = time_sort
@@ -593,14 +566,12 @@ class analysis_tools():
         end_times = array(self.ds.coords["end_time"])
         self.evotime_array = array(self.ds[f"{self.qubit}_time"])[0][0][0]*1e6
         z_pulse_amplitudes = array(self.ds.coords["z_voltage"])
+        # all the end times and biases are fitted in one batch, data shape in (end-time, mixer, bias, evo-time)
+        signals = IQ_contrast(array(self.ds[self.qubit]), self.refIQ, mixer_axis=1)
+        T1s = batch_fit(signals, self.evotime_array, "T1")["T1"].values.tolist() if self.prepare_excited else [[] for _ in end_times]
         if not time_sort:
-            self.T1_per_time = []
-            self.I_chennel_per_time = []  
-            for time_dep_data in array(self.ds[self.qubit]): # time_dep_data shape in  (mixer, bias, evo-time)
-                signals, T1s = zgate_T1_fitting(self.evotime_array,time_dep_data,self.refIQ,self.prepare_excited)
-                if self.prepare_excited:
-                    self.T1_per_time.append(T1s)
-            self.I_chennel_per_time.append(signals)
+            self.T1_per_time = [list(T1s_per_time) for T1s_per_time in T1s] if self.prepare_excited else []
+            self.I_chennel_per_time = list(signals)
 
 
             self.avg_I_data = average(array(self.I_chennel_per_time),axis=0)
@@ -611,10 +582,9 @@ class analysis_tools():
 
         else:
             self.T1_rec = {}
-            for end_time_idx, time_dep_data in enumerate(array(self.ds[self.qubit])):
-                signals, T1s = zgate_T1_fitting(self.evotime_array,time_dep_data,self.refIQ,self.prepare_excited)
+            for end_time_idx in range(end_times.shape[0]):
                 self.T1_rec[end_times[end_time_idx]] = {}
-                self.T1_rec[end_times[end_time_idx]]["T1s"] = T1s
+                self.T1_rec[end_times[end_time_idx]]["T1s"] = list(T1s[end_time_idx])
             self.T1_rec = dict(sorted(self.T1_rec.items(), key=lambda item: datetime.strptime(item[0], "%Y-%m-%d %H:%M:%S")))
         
         self.z = z_pulse_amplitudes+self.ds.attrs["z_offset"]
@@ -719,13 +689,9 @@ class analysis_tools():
         self.qubit = var
         self.pi_amp_coef =  moveaxis(array(self.ds[f"{var}_PIcoef"]),1,0)[0][0]
         self.pi_pair_num = array(self.ds.coords["PiPairNum"])
-        data = moveaxis(array(self.ds[var]),1,0)
+        data = IQ_contrast(array(self.ds[var]),self.refIQ) # (PiPairNum, coef)
         refined_data_folder = []
-        for PiPairNum_dep_data in data:
-            if len(self.refIQ) == 2:
-                refined_data = IQ_data_dis(PiPairNum_dep_data[0],PiPairNum_dep_data[1],self.refIQ[0],self.refIQ[1])
-            else:
-                refined_data = rotate_data(PiPairNum_dep_data,self.refIQ[0])[0]
+        for refined_data in data:
             refined_data_folder.append(cos_fit_analysis(refined_data,self.pi_amp_coef))
         
         # attrs["coefs"] = [A_fit,f_fit,phase_fit,offset_fit]
@@ -784,13 +750,9 @@ class analysis_tools():
         self.qubit = var
         self.pi_amp_coef =  moveaxis(array(self.ds[f"{var}_HalfPIcoef"]),1,0)[0][0]
         self.pi_pair_num = array(self.ds.coords["PiPairNum"])
-        data = moveaxis(array(self.ds[var]),1,0)
+        data = IQ_contrast(array(self.ds[var]),self.refIQ) # (PiPairNum, coef)
         refined_data_folder = []
-        for PiPairNum_dep_data in data:
-            if len(self.refIQ) == 2:
-                refined_data = IQ_data_dis(PiPairNum_dep_data[0],PiPairNum_dep_data[1],self.refIQ[0],self.refIQ[1])
-            else:
-                refined_data = rotate_data(PiPairNum_dep_data,self.refIQ[0])[0]
+        for refined_data in data:
             refined_data_folder.append(cos_fit_analysis(refined_data,self.pi_amp_coef))
 
         candidates = []
@@ -845,15 +807,11 @@ class analysis_tools():
         self.qubit = var
         self.drag_coef =  moveaxis(array(self.ds[f"{var}_dragcoef"]),1,0)[0][0]
         self.operations = array(self.ds.coords["operations"])
-        data = moveaxis(array(self.ds[var]),1,0)
+        data = IQ_contrast(array(self.ds[var]),self.refIQ) # (operations, coef)
         self.plot_item = {}
 
-        for idx, operation_dep_data in enumerate(data):
+        for idx, refined_data in enumerate(data):
             self.plot_item[self.operations[idx]] = {}
-            if len(self.refIQ) == 2:
-                refined_data = IQ_data_dis(operation_dep_data[0],operation_dep_data[1],self.refIQ[0],self.refIQ[1])
-            else:
-                refined_data = rotate_data(operation_dep_data,self.refIQ[0])[0]
             
             self.plot_item[self.operations[idx]]['data'] = refined_data
             coefficients = polyfit(self.drag_coef, refined_data, deg=1)  
@@ -893,39 +851,13 @@ class analysis_tools():
         p0_data = datas[0]
         p1_data = datas[1] 
         
-        gates, p_rec = [], []
         self.fq = tansition_freq_Hz  
-        self.md = GMMROFidelity()
         self.train_set = DataArray(moveaxis(array([p0_data,p1_data]),0,1), coords= [("mixer",["I","Q"]), ("prepared_state",[0,1]), ("index",arange(p0_data.shape[-1]))] )
-        self.md._import_data(self.train_set)
-        self.md._start_analysis()
-        self.g1d_fidelity = self.md.export_G1DROFidelity()
+        self.discriminator = TwoStateGMM().train(array(self.train_set))
     
-        lis = []
-        for idx, data in enumerate(datas):
-            if idx > 0: # idx = 0 is prepare ground
-                lis.append(list(moveaxis(array([data]),0,1))) # gate num, mixer, prepared_state, index
-                gates.append(gate_num[idx])
-             
-        # GMM1D (OKAY)
-        # centers_2d, centers1d, sigmas = self.md.discriminator._export_1D_paras()
-        # da = DataArray(moveaxis(moveaxis(array(lis),0,1),-1,1), coords= [("mixer",array(["I","Q"])), ("index",arange(p1_data.shape[-1])), ("gate_num",array(gates)) , ("prepared_state",array([0]))] )
-        # train_data_proj = get_proj_distance(centers_2d.transpose(), da.transpose(*tuple(da.coords)).values)
-        # dataset_proj = DataArray(train_data_proj,coords=[(i,array(da.coords[i])) for i in list(da.coords)[1:]])  
-        # self.g1d_fidelity.discriminator._import_data(dataset_proj)
-        # self.g1d_fidelity.discriminator._start_analysis()
-        # ans = self.g1d_fidelity.discriminator.result.transpose() # (prepared_state, gate_num, index)
-        
-        # GMM
-        da = DataArray(moveaxis(array(lis),0,1), coords= [("mixer",array(["I","Q"])), ("gate_num",array(gates)) , ("prepared_state",array([0])), ("index",arange(p1_data.shape[-1]))] )
-        self.md.discriminator._import_data(da)
-        self.md.discriminator._start_analysis()
-        ans = self.md.discriminator._export_result()
-
-        for dim_1_data in ans:
-            for dim_2_data in dim_1_data:
-                p = list(dim_2_data).count(1)/len(list(dim_2_data))
-                p_rec.append(p)
+        # idx = 0 is prepare ground, all the gates are classified in one go
+        gates = list(gate_num[1:])
+        p_rec = list(self.discriminator.population(moveaxis(datas[1:],0,1)))  # (IQ, gate_num, shots) -> (gate_num,)
         
         print(array(p_rec).shape)
         print(array(gates).shape)
@@ -935,6 +867,7 @@ class analysis_tools():
 
     def gateError_plot(self,save_pic_path:str=None):
         
+        self.md = GMMROFidelity()
         self.md._import_data(self.train_set)
         self.md._start_analysis()
         g1d_fidelity = self.md.export_G1DROFidelity()
@@ -981,20 +914,21 @@ class Multiplex_analyzer(QCATAna,analysis_tools):
         self.fit_func:callable = fit_func
         self.transition_freq = fq_Hz
 
+    @traced("fit")
     def _start_analysis(self,**kwargs):
         match self.exp_name:
             case 'm5':
                 self.fluxCoupler_ana(kwargs["var_name"],self.refIQ)
             case 'm6':
-                self.fluxCavity_ana(kwargs["var_name"])
+                self.fluxCavity_ana(kwargs["var_name"],workers=kwargs.get("workers"))
             case 'm8': 
                 self.conti2tone_ana(kwargs["var_name"],self.fit_func,self.refIQ)
             case 'm9': 
-                self.fluxQb_ana(kwargs["var_name"],self.fit_func,self.refIQ)
+                self.fluxQb_ana(kwargs["var_name"],self.fit_func,self.refIQ,workers=kwargs.get("workers"))
             case 'm11': 
                 self.rabi_ana(kwargs["var_name"])
             case 'm14': 
-                self.oneshot_ana(self.ds,self.transition_freq)
+                self.oneshot_ana(self.ds,self.transition_freq,kwargs.get("discriminator"))
             case 'm12':
                 self.T2_ana(kwargs["var_name"],self.refIQ)
             case 'm13':
@@ -1018,6 +952,7 @@ class Multiplex_analyzer(QCATAna,analysis_tools):
             case _:
                 raise KeyError(f"Unknown measurement = {self.exp_name} was given !")
 
+    @traced("plot")
     def _export_result( self, pic_save_folder=None):
         match self.exp_name:
             case 'm5':
@@ -10,7 +10,9 @@ from numpy import array, moveaxis, mean, std, median, arange,ndarray, pi, sin, c
 import matplotlib.pyplot as plt
 from qblox_drive_AS.analysis.Radiator.RadiatorSetAna import sort_files
 from qcat.analysis.state_discrimination import p01_to_Teff
-from qblox_drive_AS.support import rotate_onto_Inphase, rotate_data
+from qblox_drive_AS.support import rotate_onto_Inphase
+from qblox_drive_AS.support.IQtransform import rotate_IQ
+from qblox_drive_AS.support.StateDiscriminator import TwoStateGMM, DiscriminatorRegistry
 
 def a_OSdata_analPlot(nc_path:str, QD_agent:QDmanager=None, target_q:str=None, plot:bool=True, pic_path:str='', save_pic:bool=False): # 
     folder = os.path.join(os.path.split(nc_path)[0],'OS_pic')
@@ -32,36 +34,36 @@ def a_OSdata_analPlot(nc_path:str, QD_agent:QDmanager=None, target_q:str=None, p
 
     OS_data = 1000*array([[pgI_collection,peI_collection],[pgQ_collection,peQ_collection]]) # can train or predict 2*2*histo_counts*shot
     tarin_data, fit_arrays = OSdata_arranger(OS_data)
-    # train GMM
-    gmm2d_fidelity = GMMROFidelity()
-    gmm2d_fidelity._import_data(tarin_data[0])
-    gmm2d_fidelity._start_analysis()
-    g1d_fidelity = gmm2d_fidelity.export_G1DROFidelity()
     if QD_agent is not None:
         transi_freq = QD_agent.quantum_device.get_element(target_q).clock_freqs.f01()
+        # the kept discriminator is used if it was trained with the same readout
+        model = QD_agent.Discriminators.get(target_q, DiscriminatorRegistry.readout_config(QD_agent, target_q))
     else: 
         transi_freq = None
+        model = None
+    if model is None:
+        model = TwoStateGMM().train(array(tarin_data[0]))
     
    
-    _, angle = rotate_onto_Inphase(gmm2d_fidelity.centers[0],gmm2d_fidelity.centers[1])
+    _, angle = rotate_onto_Inphase(model.centers[0],model.centers[1])
     
-    p00 = g1d_fidelity.g1d_dist[0][0][0]
-    p01 = g1d_fidelity.g1d_dist[0][0][1]
-    p11 = g1d_fidelity.g1d_dist[1][0][1]
+    assignment = model.assignment_matrix(array(tarin_data[0]))
+    p00 = assignment[0][0]
+    p01 = assignment[0][1]
+    p11 = assignment[1][1]
+    effT_mK = None
     if transi_freq is not None:
         effT_mK = p01_to_Teff(p01, transi_freq)*1000
     RO_fidelity_percentage = (p00+p11)*100/2
     if plot:
-        z = moveaxis(array(tarin_data[0]),0,1) # (IQ, state, shots) -> (state, IQ, shots)
-        rotated_data = empty_like(z)
-        for state_idx, state_data in enumerate(z):
-            rotated_data[state_idx] = rotate_data(state_data,angle)
+        rotated_data = moveaxis(rotate_IQ(array(tarin_data[0]),angle),0,1) # (IQ, state, shots) -> (state, IQ, shots)
     
         da = DataArray(moveaxis(rotated_data,0,1), coords= [("mixer",["I","Q"]), ("prepared_state",[0,1]), ("index",arange(array(tarin_data[0]).shape[2]))] )
+        # the GMMROFidelity is only for the figure
+        gmm2d_fidelity = GMMROFidelity()
         gmm2d_fidelity._import_data(da)
         gmm2d_fidelity._start_analysis()
         g1d_fidelity = gmm2d_fidelity.export_G1DROFidelity()
-        print(f"!! center:\n{gmm2d_fidelity.centers}")
         plot_readout_fidelity(da, gmm2d_fidelity, g1d_fidelity,transi_freq,pic_save_path)
         plt.close()
 
@@ -79,28 +81,23 @@ def share_model_OSana(QD_agent:QDmanager,target_q:str,folder_path:str,pic_save:b
     else:
         pic_folder = None
 
-    for idx, file in enumerate(files):
+    shots = []
+    for file in files:
         SS_ds = open_dataset(file)
         ss_dict = Dataset.to_dict(SS_ds)
-        # print(ss_dict)
+        SS_ds.close()
         pe_I, pe_Q = ss_dict['data_vars']['e']['data']
         pg_I, pg_Q = ss_dict['data_vars']['g']['data']
-        pgI_collection = [pg_I]
-        pgQ_collection = [pg_Q]
-        peI_collection = [pe_I]
-        peQ_collection = [pe_Q]
-
-        OS_data = 1000*array([[pgI_collection,peI_collection],[pgQ_collection,peQ_collection]]) # can train or predict 2*2*histo_counts*shot
-        tarin_data, fit_arrays = OSdata_arranger(OS_data)
-        # train GMM
-        if idx == 0:
-            gmm2d_fidelity = GMMROFidelity()
-            gmm2d_fidelity._import_data(tarin_data[0])
-            gmm2d_fidelity._start_analysis()
-
-        gmm2d_fidelity.discriminator._import_data( fit_arrays[0] )
-        gmm2d_fidelity.discriminator._start_analysis()
-
+        shots.append(1000*array([[pg_I,pe_I],[pg_Q,pe_Q]])) # (IQ, state, shots)
+    
+    # one model for all the files, the kept one if it was trained with the same readout
+    model = QD_agent.Discriminators.get(target_q, DiscriminatorRegistry.readout_config(QD_agent, target_q))
+    if model is None:
+        model = TwoStateGMM().train(shots[0])
+    populations = model.population(moveaxis(array(shots),0,1)) # (file, state)
+    for p in populations:
+        pop_rec.append(p[0])
+        efft_rec.append(p01_to_Teff(p[0], transi_freq)*1000)
 
     return pop_rec, efft_rec
 
@@ -12,7 +12,7 @@ import matplotlib.pyplot as plt
 from xarray import DataArray
 from qblox_drive_AS.support.Path_Book import meas_raw_dir
 from qblox_drive_AS.analysis.DRtemp import Kelvin_collector
-from qcat.analysis.state_discrimination.discriminator import train_GMModel  # type: ignore
+from qblox_drive_AS.support.StateDiscriminator import TwoStateGMM
 from qcat.visualization.readout_fidelity import plot_readout_fidelity
 
 exp_items = {"1":"T1","2":"T2","3":"effT","4":"gamma1","5":"gamma2","6":"thermalPop","7":"gammaPhi"}
@@ -543,21 +543,18 @@ def a_set_analysis(set_folder_path:str, old_monitor_dict:dict, ref_iq:list, tran
     # reshape data to (I,Q)*(g,e)*shots       
     OS_data = 1000*array([[pgI_collection,peI_collection],[pgQ_collection,peQ_collection]]) # can train or predict 2*2*histo_counts*shot
     tarin_data, fit_arrays = OSdata_arranger(OS_data)
-    # train GMM
-    dist_model = train_GMModel (tarin_data[0])
-    dist_model.relabel_model(array([ref_iq]).transpose())
-    # predict all collection to calculate eff_T for every exp_idx
-    for histo_i in range(fit_arrays.shape[0]):
+    # train GMM, the prepared states label its components
+    dist_model = TwoStateGMM().train(array(tarin_data[0]))
+    # predict all collection in one go to calculate eff_T for every exp_idx
+    populations = dist_model.population(moveaxis(array(fit_arrays),0,1)) # (histo, state), |1> population
+    for histo_i in range(len(fit_arrays)):
         analysis_data = fit_arrays[histo_i] #your (2,2,N) data to analysis
 
-        new_data = moveaxis( analysis_data ,1,0)
-        p0_pop = dist_model.get_state_population(new_data[0].transpose()) # [p0in0, p0in1]
-        p1_pop = dist_model.get_state_population(new_data[1].transpose()) # [p1in0, p1in1]
         if transi_freq != 0 and transi_freq is not None:
             fig , eff_t, snr = plot_readout_fidelity(analysis_data, transi_freq, None, False)
             effT_mK.append(eff_t)
         else:
-            thermal_pop.append(p0_pop[1])
+            thermal_pop.append(populations[histo_i][0])
         
         plt.close()
     
@@ -729,19 +726,16 @@ def main_analysis(target_q:str, temperature_folder_path:str, mode:str='all' ):
         # reshape data to (I,Q)*(g,e)*shots       
         OS_data = 1000*array([[pgI_collection,peI_collection],[pgQ_collection,peQ_collection]]) # can train or predict 2*2*histo_counts*shot
         tarin_data, fit_arrays = OSdata_arranger(OS_data)
-        # train GMM
-        dist_model = train_GMModel (tarin_data[0])
-        dist_model.relabel_model(array([ref_iq]).transpose())
-        # predict all collection to calculate eff_T for every exp_idx
-        for histo_i in range(fit_arrays.shape[0]):
+        # train GMM, the prepared states label its components
+        dist_model = TwoStateGMM().train(array(tarin_data[0]))
+        # predict all collection in one go to calculate eff_T for every exp_idx
+        populations = dist_model.population(moveaxis(array(fit_arrays),0,1)) # (histo, state), |1> population
+        for histo_i in range(len(fit_arrays)):
             analysis_data = fit_arrays[histo_i] #your (2,2,N) data to analysis
 
-            new_data = moveaxis( analysis_data ,1,0)
-            p0_pop = dist_model.get_state_population(new_data[0].transpose()) # [p0in0, p0in1]
-            p1_pop = dist_model.get_state_population(new_data[1].transpose()) # [p1in0, p1in1]
             OneShot_pic_path = os.path.join(SS_folder,f"SingleShot-S{set_idx}-{histo_i}")
             fig , eff_t, snr = plot_readout_fidelity(analysis_data, transi_freq, None, False)
-            therm_pop.append(100-(p0_pop[0]*100/(p0_pop[0]+p0_pop[1])))
+            therm_pop.append(populations[histo_i][0]*100)
             effT_mK.append(eff_t)
             plt.close()
         
@@ -0,0 +1,142 @@
+"""
+Resonator fitting for the stacks of S21 traces like the bias slices of a flux-cavity map or the powers of a cavity power sweep.\n
+Two paths:\n
+* `circle_fit_slices`: the fast notch-type circle fit (cable delay, algebraic circle, phase vs frequency) for the fr and Ql of every slice.
+The slices are fitted one after another and each one starts from the fit of its neighbour, contiguous blocks of slices go to a process pool.\n
+* `fit_resonators`: the full `ResonatorData.fit()` of qcat for every trace (optionally in a process pool), for the plots and the quality factors with errors.
+"""
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', ".."))
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from numpy import ndarray
+from scipy.optimize import least_squares, minimize_scalar
+from qcat.analysis.resonator.photon_dep.res_data import ResonatorData
+from qblox_drive_AS.support.UserFriend import *
+
+
+def algebraic_circle(z:ndarray)->tuple[complex,float]:
+    """ The least-squares circle x²+y²+Dx+Ey+F = 0 through the complex points, returns (center, radius). """
+    x, y = z.real, z.imag
+    A = np.stack([x, y, np.ones_like(x)], axis=1)
+    (D, E, F), *_ = np.linalg.lstsq(A, -(x**2+y**2), rcond=None)
+    center = complex(-D/2, -E/2)
+    return center, float(np.sqrt(max(abs(center)**2 - F, 0)))
+
+
+def _circle_residual(z:ndarray)->float:
+    center, radius = algebraic_circle(z)
+    return float(np.mean((np.abs(z-center)-radius)**2))/max(radius**2, 1e-300)
+
+
+def fit_cable_delay(freq:ndarray, z:ndarray, grid:int=41)->float:
+    """ The delay (sec) making the trace the most circular, scanned around the linear phase slope of the trace and then refined. """
+    guess = -np.polyfit(freq, np.unwrap(np.angle(z)), 1)[0]/(2*np.pi)
+    span = 0.5/(freq.max()-freq.min())
+    taus = np.linspace(guess-span, guess+span, grid)
+    best = int(np.argmin([_circle_residual(z*np.exp(2j*np.pi*freq*tau)) for tau in taus]))
+    step = taus[1]-taus[0]
+    # refined in the unit of the scan step, the tolerance of the bounded search is absolute
+    ans = minimize_scalar(lambda u: _circle_residual(z*np.exp(2j*np.pi*freq*(taus[best]+u*step))), bounds=(-1, 1), method="bounded", options={"xatol":1e-5})
+    return float(taus[best]+ans.x*step)
+
+
+def _phase_model(freq:ndarray, theta0:float, Ql:float, fr:float)->ndarray:
+    return theta0 + 2*np.arctan(2*Ql*(1-freq/fr))
+
+
+def circle_fit(freq:ndarray, z:ndarray, guess:dict=None)->dict:
+    """
+    Notch-type circle fit of one trace. `guess` is the fit of a neighbouring trace ({"fr", "Ql", "delay"}), it reuses the cable delay
+    and starts the phase fit from it.
+    ### Returns:\n
+    {"fr", "Ql", "absQc", "Qi_dia_corr", "phi0", "theta0", "A", "alpha", "delay", "chi_square", "nfev"}
+    """
+    freq, z = np.asarray(freq, dtype=float), np.asarray(z, dtype=complex)
+    delay = fit_cable_delay(freq, z) if guess is None else guess["delay"]
+    z1 = z*np.exp(2j*np.pi*freq*delay)
+    center, radius = algebraic_circle(z1)
+    theta = np.angle(z1-center)
+
+    if guess is None:
+        # the fastest phase turn is the resonance, dθ/df = -4Ql/fr there
+        slope = np.convolve(np.gradient(np.unwrap(theta), freq), np.ones(3)/3, mode="same")
+        peak = int(np.argmax(np.abs(slope)))
+        fr0 = freq[peak]
+        Ql0 = -slope[peak]*fr0/4
+    else:
+        fr0, Ql0 = guess["fr"], guess["Ql"]
+        peak = int(np.argmin(np.abs(freq-fr0)))
+    p0 = [theta[peak], Ql0, fr0]
+    ans = least_squares(lambda p: np.angle(np.exp(1j*(theta-_phase_model(freq, *p)))), p0, x_scale=[1, abs(Ql0)+1, fr0], method="lm")
+    theta0, Ql, fr = ans.x
+
+    # the off-resonant point is across the circle from the resonance
+    off_res = center - radius*np.exp(1j*theta0)
+    diameter = 2*radius/abs(off_res)
+    phi0 = float(np.angle(1-center/off_res))
+    absQc = abs(Ql)/diameter
+    Qi = 1/(1/abs(Ql) - np.cos(phi0)/absQc)
+    model = off_res*(1 - diameter*np.exp(1j*phi0)/(1 + 2j*Ql*(freq/fr-1)))
+    chi_square = float(np.mean(np.abs(z1-model)**2)/abs(off_res)**2)
+    return {"fr":float(fr), "Ql":float(abs(Ql)), "absQc":float(absQc), "Qi_dia_corr":float(Qi), "phi0":phi0, "theta0":float(theta0),
+            "A":float(abs(off_res)), "alpha":float(np.angle(off_res)), "delay":delay, "chi_square":chi_square, "nfev":int(ans.nfev)}
+
+
+def _circle_fit_block(args:tuple)->list:
+    freqs, traces, warm = args
+    results, guess = [], None
+    for freq, z in zip(freqs, traces):
+        try:
+            result = circle_fit(freq, z, guess)
+            if not (freq.min() <= result["fr"] <= freq.max()):
+                # the warm start went astray, give it a cold one
+                result = circle_fit(freq, z) if guess is not None else None
+        except (ValueError, np.linalg.LinAlgError):
+            result = None
+        results.append(result)
+        if warm and result is not None:
+            guess = result
+    return results
+
+
+def circle_fit_slices(freqs:ndarray, traces:ndarray, warm:bool=True, workers:int=None)->list:
+    """
+    The circle fit of every slice in order, like the bias or power slices of a sweep.\n
+    ### Args:\n
+    * freqs: (points,) shared by the slices or (slices, points).\n
+    * traces: complex S21 in (slices, points).\n
+    * warm: start every slice from the fit of the one before it (adjacent bias or power).\n
+    * workers: split the slices into this many contiguous blocks for a process pool, None is all in this process.
+    Only give it from a script guarded by `if __name__ == "__main__":`.
+    ### Returns:\n
+    A list of the `circle_fit` dicts, None for the slices which failed.
+    """
+    traces = np.asarray(traces, dtype=complex)
+    freqs = np.asarray(freqs, dtype=float)
+    if freqs.ndim == 1:
+        freqs = np.broadcast_to(freqs, traces.shape)
+    if workers is None or workers == 1 or traces.shape[0] < 2*workers:
+        return _circle_fit_block((freqs, traces, warm))
+    blocks = [(f, t, warm) for f, t in zip(np.array_split(freqs, workers), np.array_split(traces, workers)) if t.shape[0] != 0]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return [result for block in executor.map(_circle_fit_block, blocks) for result in block]
+
+
+def _full_fit(args:tuple)->tuple:
+    freq, z = args
+    return ResonatorData(freq=freq, zdata=z).fit()
+
+
+def fit_resonators(freqs:list, traces:list, workers:int=None)->list:
+    """
+    `ResonatorData.fit()` of every trace in a process pool, the traces can have their own frequency points.\n
+    Returns a list of (result, data2plot, fit2plot) as `ResonatorData.fit()` does.\n
+    `workers`: the processes of the pool, None fits them one by one in this process. Only give it from a script guarded by
+    `if __name__ == "__main__":`, the spawned workers re-import the main script.
+    """
+    jobs = [(np.asarray(f, dtype=float), np.asarray(z, dtype=complex)) for f, z in zip(freqs, traces)]
+    if workers is None or workers == 1 or len(jobs) == 1:
+        return [_full_fit(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        return list(executor.map(_full_fit, jobs))
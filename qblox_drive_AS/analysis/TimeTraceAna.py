@@ -1,4 +1,4 @@
-import os, sys, json 
+import os, sys, json, pickle
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', ".."))
 from xarray import open_dataset
 from qblox_drive_AS.support.QDmanager import QDmanager
@@ -8,6 +8,12 @@ from datetime import datetime
 from qblox_drive_AS.support.UserFriend import *
 from matplotlib.gridspec import GridSpec as GS
 from qblox_drive_AS.analysis.Multiplexing_analysis import Multiplex_analyzer
+from qblox_drive_AS.support.MonitorStore import MonitorStore, find_store, store_name
+
+# bump it when the fitting changes, the cached results made by the other versions will be analyzed again
+analysis_version:str = "1"
+monitor_index_name:str = "TimeMonitor_index.pkl"
+monitor_results:list = ["T1_rec", "detu_rec", "T2_rec", "SS_rec", "T1_raw", "T2_raw", "T1_evo_time", "T2_evo_time"]
 
 def time_label_sort(nc_file_name:str):
     return datetime.strptime(nc_file_name.split("_")[-1].split(".")[0],"H%HM%MS%S")
@@ -127,28 +133,76 @@ def plot_timeDepCohe(time_values:ndarray, y_values:ndarray, exp:str, fig_path:st
         plt.savefig(fig_path)
     plt.close()
 
-def time_monitor_data_ana(QD_agent:QDmanager,folder_path:str,save_every_fit_pic:bool=False):
-    files = [name for name in os.listdir(folder_path) if (os.path.isfile(os.path.join(folder_path,name)) and name.split(".")[-1] == "nc")]
+def monitor_datasets(folder_path:str, analysed:dict=None):
+    """
+    Yield (exp_type, record_key, signature, Dataset) of every iteration in the folder, from the MonitorStore if there is one, otherwise from the nc files.\n
+    The record is "Monitor.h5/<exp>/<idx>" signed by its end_time for the store, or the nc file name signed by its mtime.
+    The records in `analysed` ({record_key: signature}) with the same signature are skipped without being read.
+    """
+    analysed = {} if analysed is None else analysed
+    store_path = find_store(folder_path)
+    if store_path is not None:
+        store = MonitorStore(store_path)
+        for exp_type in store.experiments():
+            end_times = store.end_times(exp_type)
+            records = [(idx, f"{store_name}/{exp_type}/{idx}", end_time) for idx, end_time in enumerate(end_times)]
+            records = [record for record in records if analysed.get(record[1]) != record[2]]
+            for (_, key, end_time), ds in zip(records, store.iter_datasets(exp_type, indices=[record[0] for record in records])):
+                yield exp_type, key, end_time, ds
+    else:
+        files = [name for name in os.listdir(folder_path) if (os.path.isfile(os.path.join(folder_path,name)) and name.split(".")[-1] == "nc")]
+        for file in files:
+            mtime = os.path.getmtime(os.path.join(folder_path,file))
+            if analysed.get(file) != mtime:
+                yield file.split("_")[0], file, mtime, open_dataset(os.path.join(folder_path,file))
+
+def load_monitor_index(folder_path:str, incremental:bool=True)->dict:
+    """ The sidecar index of `time_monitor_data_ana`, a fresh one if it's not there, `incremental` is False or it was made by another analysis_version. """
+    index = {"version": analysis_version, "records": {}, "results": {name: {} for name in monitor_results}}
+    index_path = os.path.join(folder_path, monitor_index_name)
+    if incremental and os.path.isfile(index_path):
+        with open(index_path, "rb") as index_file:
+            cached:dict = pickle.load(index_file)
+        if cached.get("version") == analysis_version:
+            index = cached
+        else:
+            warning_print(f"The monitor index was made by analysis version {cached.get('version')}, all the data will be analyzed again.")
+    return index
+
+def save_monitor_index(folder_path:str, index:dict):
+    """ Write into a temp file then replace, so a dashboard reading it never sees a half-written index. """
+    index_path = os.path.join(folder_path, monitor_index_name)
+    with open(index_path+".tmp", "wb") as index_file:
+        pickle.dump(index, index_file)
+    os.replace(index_path+".tmp", index_path)
 
-    T1, T2, SS = 0, 0 , 0
-    T1_rec, detu_rec, T2_rec, SS_rec = {}, {}, {}, {}
-    T1_raw, T2_raw = {}, {}
-    T1_evo_time, T2_evo_time = {}, {}
-    for idx, file in enumerate(files) :
-        slightly_print(f"Analysis for the {idx}-th files ...")
-        exp_type:str = file.split("_")[0]
-        path = os.path.join(folder_path,file)
-        ds = open_dataset(path)
+def _qubits_to_plot(rec:dict, changed:set, fig_path_of)->list:
+    """ The qubits got new values, or their figure is missing. """
+    return [q for q in rec if q in changed or not os.path.exists(fig_path_of(q))]
+
+def time_monitor_data_ana(QD_agent:QDmanager,folder_path:str,save_every_fit_pic:bool=False,incremental:bool=True,fq_Hz:dict=None):
+    """
+    Fit the T1, T2 and SingleShot of a time monitor folder and plot their time dependence into `folder_path/Pics`.\n
+    ### Args:\n
+    * incremental: only fit the records which are not in the sidecar index (`TimeMonitor_index.pkl`) yet, merge them into the cached time series
+    and only re-plot the qubits which got new values. False to analyze everything again.\n
+    * fq_Hz: {"q0":f01, ...} for the SingleShot, default is from `QD_agent.quantum_device`. Give it when the analysis runs beside the measurement, 
+    so the quantum_device in use is not touched.
+    """
+    index = load_monitor_index(folder_path, incremental)
+    T1_rec, detu_rec, T2_rec, SS_rec, T1_raw, T2_raw, T1_evo_time, T2_evo_time = [index["results"][name] for name in monitor_results]
+    changed = {"T1":set(), "T2":set(), "SS":set()}
+    for idx, (exp_type, record_key, signature, ds) in enumerate(monitor_datasets(folder_path, index["records"])):
+        slightly_print(f"Analysis for the {idx}-th new record ...")
         match exp_type.lower():
             case "t1":
-                T1 += 1
                 for var in [ var for var in ds.data_vars if var.split("_")[-1] != 'x']:
                     T1_picsave_folder = os.path.join(folder_path,f"{var}_T1_pics")
-                    if T1 == 1:
+                    if var not in T1_rec:
                         T1_rec[var], T1_raw[var] = {}, {}
-                        if save_every_fit_pic:
-                            if not os.path.exists(T1_picsave_folder):
-                                os.mkdir(T1_picsave_folder)
+                    if save_every_fit_pic:
+                        if not os.path.exists(T1_picsave_folder):
+                            os.mkdir(T1_picsave_folder)
                     T1_evo_time[var] = array(ds[f"{var}_x"])[0][0]
                     ANA = Multiplex_analyzer("m13")
                     if QD_agent.rotate_angle[var][0] != 0:
@@ -162,32 +216,32 @@ def time_monitor_data_ana(QD_agent:QDmanager,folder_path:str,save_every_fit_pic:
                         ANA._export_result(T1_picsave_folder)
                     T1_raw[var][ds.attrs["end_time"]] = ANA.plot_item["data"]
                     T1_rec[var][ds.attrs["end_time"]] = ANA.fit_packs["median_T1"]
+                    changed["T1"].add(var)
             case "singleshot":
-                SS += 1
                 for var in ds.data_vars:
                     SS_picsave_folder = os.path.join(folder_path,f"{var}_SingleShot_pics")
-                    if SS == 1:
+                    if var not in SS_rec:
                         SS_rec[var] = {}
-                        if save_every_fit_pic:
-                            if not os.path.exists(SS_picsave_folder):
-                                os.mkdir(SS_picsave_folder)
+                    if save_every_fit_pic:
+                        if not os.path.exists(SS_picsave_folder):
+                            os.mkdir(SS_picsave_folder)
                     ANA = Multiplex_analyzer("m14")
-                    ANA._import_data(ds[var]*1000,var_dimension=0,fq_Hz=QD_agent.quantum_device.get_element(var).clock_freqs.f01())
+                    ANA._import_data(ds[var]*1000,var_dimension=0,fq_Hz=QD_agent.quantum_device.get_element(var).clock_freqs.f01() if fq_Hz is None else fq_Hz[var])
                     ANA._start_analysis()
                     if save_every_fit_pic:
                         pic_path = os.path.join(SS_picsave_folder,f"{var}_SingleShot_{ds.attrs['end_time'].replace(' ', '_').replace(':','_').replace(' ','_')}")
                         ANA._export_result(pic_path)
                     SS_rec[var][ds.attrs["end_time"]] = ANA.fit_packs["effT_mK"]
+                    changed["SS"].add(var)
             case _:
-                T2 += 1
                 for var in [ var for var in ds.data_vars if var.split("_")[-1] != 'x']:
                     # create raw data fitting folder
                     T2_picsave_folder = os.path.join(folder_path,f"{var}_T2_pics")
-                    if T2 == 1:
+                    if var not in T2_rec:
                         T2_rec[var], detu_rec[var], T2_raw[var] = {}, {}, {}
-                        if save_every_fit_pic:
-                            if not os.path.exists(T2_picsave_folder):
-                                os.mkdir(T2_picsave_folder)
+                    if save_every_fit_pic:
+                        if not os.path.exists(T2_picsave_folder):
+                            os.mkdir(T2_picsave_folder)
                     # start analysis 
                     T2_evo_time[var] = array(ds[f"{var}_x"])[0][0]
                     ANA = Multiplex_analyzer("m12")
@@ -204,70 +258,75 @@ def time_monitor_data_ana(QD_agent:QDmanager,folder_path:str,save_every_fit_pic:
                     T2_raw[var][ds.attrs["end_time"]] = ANA.plot_item["data"]
                     detu_rec[var][ds.attrs["end_time"]] = ANA.fit_packs["freq"]*1e-6
                     T2_rec[var][ds.attrs["end_time"]] = ANA.fit_packs["median_T2"]
+                    changed["T2"].add(var)
+        index["records"][record_key] = signature
     
+    save_monitor_index(folder_path, index)
+    if incremental:
+        eyeson_print(f"New data for T1: {sorted(changed['T1'])}, T2: {sorted(changed['T2'])}, SingleShot: {sorted(changed['SS'])}")
+
     pic_folder = os.path.join(folder_path, "Pics")
     if not os.path.exists(pic_folder):
         os.mkdir(pic_folder)
 
     slightly_print(f"\nPlotting... ")
-    if T1 != 0:
-        for q in T1_rec:
-            
-            sorted_item_ans = sorted(T1_rec[q].items(), key=lambda item: datetime.strptime(item[0], "%Y-%m-%d %H:%M:%S"))
-            sorted_item_raw = sorted(T1_raw[q].items(), key=lambda item: datetime.strptime(item[0], "%Y-%m-%d %H:%M:%S"))
-            earliest_time = datetime.strptime(sorted_item_ans[0][0], "%Y-%m-%d %H:%M:%S")
-            time_diffs = []
-            sorted_values_ans, sorted_values_raw = [], []
-            for idx, item in enumerate(sorted_item_ans):
-                key = item[0]
-                value = item[1]
-                current_time = datetime.strptime(key, "%Y-%m-%d %H:%M:%S")
-                time_diff = round((current_time - earliest_time).total_seconds()/60,1)
-                time_diffs.append(time_diff)
-                sorted_values_ans.append(value)
-                sorted_values_raw.append(sorted_item_raw[idx][1])
+    for q in _qubits_to_plot(T1_rec, changed["T1"], lambda q: os.path.join(pic_folder,f"{q}_T1_timeDep.png")):
+        
+        sorted_item_ans = sorted(T1_rec[q].items(), key=lambda item: datetime.strptime(item[0], "%Y-%m-%d %H:%M:%S"))
+        sorted_item_raw = sorted(T1_raw[q].items(), key=lambda item: datetime.strptime(item[0], "%Y-%m-%d %H:%M:%S"))
+        earliest_time = datetime.strptime(sorted_item_ans[0][0], "%Y-%m-%d %H:%M:%S")
+        time_diffs = []
+        sorted_values_ans, sorted_values_raw = [], []
+        for idx, item in enumerate(sorted_item_ans):
+            key = item[0]
+            value = item[1]
+            current_time = datetime.strptime(key, "%Y-%m-%d %H:%M:%S")
+            time_diff = round((current_time - earliest_time).total_seconds()/60,1)
+            time_diffs.append(time_diff)
+            sorted_values_ans.append(value)
+            sorted_values_raw.append(sorted_item_raw[idx][1])
 
-            
-            colormap(array(time_diffs),array(T1_evo_time[q])*1e6,array(sorted_values_raw),array(sorted_values_ans),fig_path=os.path.join(pic_folder,f"{q}_T1_timeDep_colormap.png"))
-            plot_timeDepCohe(array(time_diffs), array(sorted_values_ans), "t1", units={"x":"min","y":"µs"}, fig_path=os.path.join(pic_folder,f"{q}_T1_timeDep.png"))
-    if T2 != 0:
-        for q in T2_rec:
-            sorted_item_ans = sorted(T2_rec[q].items(), key=lambda item: datetime.strptime(item[0], "%Y-%m-%d %H:%M:%S"))
-            sorted_item_detu = sorted(detu_rec[q].items(), key=lambda item: datetime.strptime(item[0], "%Y-%m-%d %H:%M:%S"))
-            sorted_item_raw = sorted(T2_raw[q].items(), key=lambda item: datetime.strptime(item[0], "%Y-%m-%d %H:%M:%S"))
-            earliest_time = datetime.strptime(sorted_item_ans[0][0], "%Y-%m-%d %H:%M:%S")
-            
-            time_diffs = []
-            sorted_values_ans, sorted_values_detu, sorted_values_raw = [], [], []
-            for idx, item in enumerate(sorted_item_ans):
-                key = item[0]
-                value = item[1]
-                current_time = datetime.strptime(key, "%Y-%m-%d %H:%M:%S")
-                time_diff = round((current_time - earliest_time).total_seconds()/60,1)
-                time_diffs.append(time_diff)
-                sorted_values_ans.append(value)
-                sorted_values_detu.append(sorted_item_detu[idx][1])
-                sorted_values_raw.append(sorted_item_raw[idx][1])
+        
+        colormap(array(time_diffs),array(T1_evo_time[q])*1e6,array(sorted_values_raw),array(sorted_values_ans),fig_path=os.path.join(pic_folder,f"{q}_T1_timeDep_colormap.png"))
+        plot_timeDepCohe(array(time_diffs), array(sorted_values_ans), "t1", units={"x":"min","y":"µs"}, fig_path=os.path.join(pic_folder,f"{q}_T1_timeDep.png"))
+    
+    for q in _qubits_to_plot(T2_rec, changed["T2"], lambda q: os.path.join(pic_folder,f"{q}_T2_timeDep.png")):
+        sorted_item_ans = sorted(T2_rec[q].items(), key=lambda item: datetime.strptime(item[0], "%Y-%m-%d %H:%M:%S"))
+        sorted_item_detu = sorted(detu_rec[q].items(), key=lambda item: datetime.strptime(item[0], "%Y-%m-%d %H:%M:%S"))
+        sorted_item_raw = sorted(T2_raw[q].items(), key=lambda item: datetime.strptime(item[0], "%Y-%m-%d %H:%M:%S"))
+        earliest_time = datetime.strptime(sorted_item_ans[0][0], "%Y-%m-%d %H:%M:%S")
+        
+        time_diffs = []
+        sorted_values_ans, sorted_values_detu, sorted_values_raw = [], [], []
+        for idx, item in enumerate(sorted_item_ans):
+            key = item[0]
+            value = item[1]
+            current_time = datetime.strptime(key, "%Y-%m-%d %H:%M:%S")
+            time_diff = round((current_time - earliest_time).total_seconds()/60,1)
+            time_diffs.append(time_diff)
+            sorted_values_ans.append(value)
+            sorted_values_detu.append(sorted_item_detu[idx][1])
+            sorted_values_raw.append(sorted_item_raw[idx][1])
 
-            
-            colormap(array(time_diffs),array(T2_evo_time[q])*1e6,array(sorted_values_raw),array(sorted_values_ans),fig_path=os.path.join(pic_folder,f"{q}_T2_timeDep_colormap.png"))
-            plot_timeDepCohe(array(time_diffs), array(sorted_values_ans), "t2", units={"x":"min","y":"µs"}, fig_path=os.path.join(pic_folder,f"{q}_T2_timeDep.png"))
-            plot_timeDepCohe(array(time_diffs), array(sorted_values_detu)-array(sorted_values_detu)[0], "δf", units={"x":"min","y":"MHz"}, fig_path=os.path.join(pic_folder,f"{q}_Detune_timeDep.png"))
-    if SS != 0:
-        for q in SS_rec:
-            sorted_item_ans = sorted(SS_rec[q].items(), key=lambda item: datetime.strptime(item[0], "%Y-%m-%d %H:%M:%S"))
-            earliest_time = datetime.strptime(sorted_item_ans[0][0], "%Y-%m-%d %H:%M:%S")
-            
-            time_diffs = []
-            sorted_values_ans = []
-            for key, value in sorted_item_ans:
-                current_time = datetime.strptime(key, "%Y-%m-%d %H:%M:%S")
-                time_diff = round((current_time - earliest_time).total_seconds()/60,1)
-                time_diffs.append(time_diff)
-                sorted_values_ans.append(value)
+        
+        colormap(array(time_diffs),array(T2_evo_time[q])*1e6,array(sorted_values_raw),array(sorted_values_ans),fig_path=os.path.join(pic_folder,f"{q}_T2_timeDep_colormap.png"))
+        plot_timeDepCohe(array(time_diffs), array(sorted_values_ans), "t2", units={"x":"min","y":"µs"}, fig_path=os.path.join(pic_folder,f"{q}_T2_timeDep.png"))
+        plot_timeDepCohe(array(time_diffs), array(sorted_values_detu)-array(sorted_values_detu)[0], "δf", units={"x":"min","y":"MHz"}, fig_path=os.path.join(pic_folder,f"{q}_Detune_timeDep.png"))
+    
+    for q in _qubits_to_plot(SS_rec, changed["SS"], lambda q: os.path.join(pic_folder,f"{q}_effT_timeDep.png")):
+        sorted_item_ans = sorted(SS_rec[q].items(), key=lambda item: datetime.strptime(item[0], "%Y-%m-%d %H:%M:%S"))
+        earliest_time = datetime.strptime(sorted_item_ans[0][0], "%Y-%m-%d %H:%M:%S")
+        
+        time_diffs = []
+        sorted_values_ans = []
+        for key, value in sorted_item_ans:
+            current_time = datetime.strptime(key, "%Y-%m-%d %H:%M:%S")
+            time_diff = round((current_time - earliest_time).total_seconds()/60,1)
+            time_diffs.append(time_diff)
+            sorted_values_ans.append(value)
 
 
-            plot_timeDepCohe(array(time_diffs), array(sorted_values_ans), "eff_Temp.", units={"x":"min","y":"mK"}, fig_path=os.path.join(pic_folder,f"{q}_effT_timeDep.png"))
+        plot_timeDepCohe(array(time_diffs), array(sorted_values_ans), "eff_Temp.", units={"x":"min","y":"mK"}, fig_path=os.path.join(pic_folder,f"{q}_effT_timeDep.png"))
     
     eyeson_print(f"\nProcedures done ! ")
 
@@ -2,6 +2,7 @@ import os, sys
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', ".."))
 from xarray import open_dataset, Dataset
 from numpy import array
+from qblox_drive_AS.support.MonitorStore import MonitorStore
 
 class MultiplexingDataReducer():
     def __init__(self, nc:str|Dataset):
@@ -20,6 +21,26 @@ class MultiplexingDataReducer():
 
 
 
+def ZgateT1_dataView(store_path:str, start:str=None, stop:str=None)->dict:
+    """
+    The summarized z-gate T1 datasets like `ZgateT1_dataReducer` makes, but read from the MonitorStore without writing any file.\n
+    Only the iterations in the end_time window [start, stop] are read.
+    ### Returns:\n
+    {"q0": Dataset in (end_time, mixer, z_voltage, time), ...}
+    """
+    store = MonitorStore(store_path)
+    first_attrs = store.iteration_attrs("zgateT1", [0])[0]
+    views = {}
+    for var in store.load("zgateT1", indices=[0]).data_vars:
+        if var.split("_")[-1] == "time": continue
+        ds = store.load("zgateT1", variables=[var, f"{var}_time"], start=start, stop=stop)
+        zT1_ds = Dataset({var:(["end_time","mixer","z_voltage","time"],ds[var].values),f"{var}_time":(["end_time","mixer","z_voltage","time"],ds[f"{var}_time"].values)},coords={"end_time":ds.coords["end_time"].values,"mixer":ds.coords["mixer"].values,"z_voltage":ds.coords["z_voltage"].values,"time":ds.coords["time"].values})
+        zT1_ds.attrs["z_offset"] = [float(first_attrs[f"{var}_ref_bias"])]
+        zT1_ds.attrs["prepare_excited"] = first_attrs["prepare_excited"]
+        views[var] = zT1_ds
+    return views
+
+
 def ZgateT1_dataReducer(raw_data_folder:str)->dict:
     
     datasets = []
@@ -3,13 +3,14 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 from xarray import Dataset
 from qblox_drive_AS.support.UserFriend import *
 from numpy import array, moveaxis, arange
-from quantify_scheduler.gettables import ScheduleGettable
+from qblox_drive_AS.support.ScheduleCache import CachedScheduleGettable
 from qblox_drive_AS.support import QDmanager, Data_manager, compose_para_for_multiplexing
-from qblox_drive_AS.support.Pulse_schedule_library import Gate_Test_SS_sche, pulse_preview
+from qblox_drive_AS.support.Pulse_schedule_library import Gate_Test_SS_interleaved_sche, pulse_preview
+from qblox_drive_AS.SOP.SingleShot import demux_preparations
 from qblox_drive_AS.support.WaveformCtrl import GateGenesis
 
 def XGateError_single_shot(QD_agent:QDmanager,ro_elements:list, max_gate_num:int,shots:int=1000, untrained:bool=False,run:bool=True):
-    sche_func = Gate_Test_SS_sche 
+    sche_func = Gate_Test_SS_interleaved_sche 
     sample_pts = 25 # fix
 
     if max_gate_num < 3:
@@ -32,48 +33,41 @@ def XGateError_single_shot(QD_agent:QDmanager,ro_elements:list, max_gate_num:int
         eyeson_print(f"{q} Integration time: {round(qubit_info.measure.integration_time()*1e6,1)} µs")
 
     
-    folder = []
     if untrained:
         slightly_print("Use default pi-pulse !")
         wf_packs = GateGenesis(q_num=len(list(QD_agent.quantum_device.elements())),c_num=0)
     else:
         wf_packs = QD_agent.Waveformer
 
-
-    def repeat_dep_sched(seq_num:int):
-        slightly_print(f"Shotting for {seq_num} pi-pulses")
-        sched_kwargs = dict(   
-            pulse_num=seq_num,
-            waveformer = wf_packs,
-            pi_amp=compose_para_for_multiplexing(QD_agent,ro_elements,'d1'),
-            pi_dura=compose_para_for_multiplexing(QD_agent,ro_elements,'d3'),
-            R_amp=compose_para_for_multiplexing(QD_agent,ro_elements,'r1'),
-            R_duration=compose_para_for_multiplexing(QD_agent,ro_elements,'r3'),
-            R_integration=compose_para_for_multiplexing(QD_agent,ro_elements,'r4'),
-            R_inte_delay=compose_para_for_multiplexing(QD_agent,ro_elements,'r2'),
+    slightly_print(f"Shotting for {pulse_repeats.tolist()} pi-pulses interleaved")
+    sched_kwargs = dict(   
+        pulse_nums=pulse_repeats.tolist(),
+        waveformer = wf_packs,
+        pi_amp=compose_para_for_multiplexing(QD_agent,ro_elements,'d1'),
+        pi_dura=compose_para_for_multiplexing(QD_agent,ro_elements,'d3'),
+        R_amp=compose_para_for_multiplexing(QD_agent,ro_elements,'r1'),
+        R_duration=compose_para_for_multiplexing(QD_agent,ro_elements,'r3'),
+        R_integration=compose_para_for_multiplexing(QD_agent,ro_elements,'r4'),
+        R_inte_delay=compose_para_for_multiplexing(QD_agent,ro_elements,'r2'),
+    )
+    
+    if run:
+        gettable = CachedScheduleGettable(
+            QD_agent.quantum_device,
+            schedule_function=sche_func, 
+            schedule_kwargs=sched_kwargs,
+            real_imag=True,
+            batched=True,
+            num_channels=len(ro_elements),
         )
-        
-        if run:
-            gettable = ScheduleGettable(
-                QD_agent.quantum_device,
-                schedule_function=sche_func, 
-                schedule_kwargs=sched_kwargs,
-                real_imag=True,
-                batched=True,
-                num_channels=len(ro_elements),
-            )
-            QD_agent.quantum_device.cfg_sched_repetitions(shots)
-            ss_da= gettable.get() # DataArray (2*ro_q, shots)
-            reshaped_data = list(array(ss_da).reshape(len(ro_elements),2,shots)) # (ro_q, IQ, shots)
-            folder.append(reshaped_data) # (state, ro_q, IQ, shots)
+        QD_agent.quantum_device.cfg_sched_repetitions(shots)
+        ss_da= gettable.get() # DataArray (2*ro_q, shots*pulse_num)
+        folder = demux_preparations(ss_da,len(ro_elements),pulse_repeats.shape[0],shots) # (ro_q, IQ, pulse_num, shots)
 
-        else:
-            pulse_preview(QD_agent.quantum_device,sche_func,sched_kwargs)
-
-    for i in pulse_repeats:        
-        repeat_dep_sched(i)
+    else:
+        pulse_preview(QD_agent.quantum_device,sche_func,sched_kwargs)
+        return None
     
-    folder = moveaxis(array(folder),0,2) # (state,ro_q,IQ,shots) -> (ro_q, IQ, state, shots)
     output_dict = {}
     for q_idx, q_name in enumerate(ro_elements):
         output_dict[q_name] = (["mixer","pulse_num","index"],folder[q_idx])
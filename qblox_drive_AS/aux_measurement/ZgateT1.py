@@ -5,7 +5,7 @@ from xarray import Dataset
 from qblox_drive_AS.support.UserFriend import *
 from qcodes.parameters import ManualParameter
 from qblox_drive_AS.support import QDmanager, Data_manager
-from quantify_scheduler.gettables import ScheduleGettable
+from qblox_drive_AS.support.ScheduleCache import CachedScheduleGettable
 from quantify_core.measurement.control import MeasurementControl
 from qblox_drive_AS.support import compose_para_for_multiplexing
 from qblox_drive_AS.support.Pulse_schedule_library import multi_Zgate_T1_sche, pulse_preview
@@ -42,7 +42,7 @@ def Zgate_T1(QD_agent:QDmanager,meas_ctrl:MeasurementControl,time_samples:dict,z
         )
     
     if run:
-        gettable = ScheduleGettable(
+        gettable = CachedScheduleGettable(
             QD_agent.quantum_device,
             schedule_function=sche_func,
             schedule_kwargs=sched_kwargs,
@@ -0,0 +1,208 @@
+"""
+Adaptive sampling for the 1D characterization sweeps (T1, Ramsey, SpinEcho, CPMG, Power/Time Rabi).\n
+The sweep starts from a coarse pass on the given grid, fits the model after every batch with the `BatchFitting` engine, and measures next the
+grid points which shrink the error of the wanted parameter (T1, T2 or the Rabi frequency) the most. It stops once the relative error of that
+parameter reaches the target for all the qubits, so the points are spent where the decay or the oscillation is actually decided.\n
+The information gain of a point x is the variance it removes from the target, (Σg)²/(s²+gᵀΣg) with g the model gradient at x, Σ the
+covariance of the current fit and s² its residual variance. The picks in a batch are greedy, Σ is updated after every pick.
+"""
+import numpy as np
+from numpy import ndarray
+from xarray import Dataset, concat
+from qblox_drive_AS.support.UserFriend import *
+from qblox_drive_AS.support.IQtransform import IQ_contrast
+from qblox_drive_AS.analysis.BatchFitting import batch_models, vectorized_LM, _jacobian
+
+""" {model: (the batch model to fit, the parameter to converge)} """
+adaptive_models:dict = {
+    "T1": ("T1", "T1"),          # also the echo decays of SpinEcho and CPMG
+    "T2": ("Ramsey", "T2"),
+    "Ramsey": ("Ramsey", "T2"),
+    "Rabi": ("Rabi", "f"),       # pi amp (or duration) = 1/(2f), the same relative error
+}
+
+
+class AdaptiveSweep():
+    """
+    ### Example:\n
+    ```
+    sweep = AdaptiveSweep("T1", {"q0": time_samples}, target_rel_err=0.05)
+    sweep.run(measure)     # measure({q: x_array}) -> {q: signal_array}, the same points for every qubit in a call
+    sweep.report()
+    ```
+    ### Args:\n
+    * model: "T1", "T2"/"Ramsey" or "Rabi".\n
+    * candidates: {"q0": the grid the points are picked from, ...}, all the qubits in the same length.\n
+    * target_rel_err: stop when error/value of the target parameter is under it for all the qubits.\n
+    * coarse_pts: the evenly spaced points of the first pass, keep more than 2 points per period for the oscillations.\n
+    * batch_pts: the points added per round, the last one of a batch fills the largest gap (it keeps the model mismatch visible).\n
+    * max_pts: the budget of points, default is the whole grid.
+    """
+    def __init__(self, model:str, candidates:dict, target_rel_err:float=0.05, coarse_pts:int=15, batch_pts:int=5, max_pts:int=None):
+        if model not in adaptive_models:
+            raise KeyError(f"Unknown adaptive model = {model}, only {list(adaptive_models.keys())} are supported !")
+        self.model:str = model
+        self.func, para_names, self.guesser, self.lower, self.upper = batch_models[adaptive_models[model][0]]
+        self.target:int = para_names.index(adaptive_models[model][1])
+        self.para_names:list = para_names
+
+        self.candidates:dict = {q: np.asarray(candidates[q], dtype=float) for q in candidates}
+        grid_pts = set([self.candidates[q].shape[0] for q in self.candidates])
+        if len(grid_pts) != 1:
+            raise ValueError(f"The qubits should have the same number of candidate points, but got {grid_pts} !")
+        self.grid_pts:int = grid_pts.pop()
+        self.target_rel_err:float = target_rel_err
+        self.coarse_pts:int = min(max(coarse_pts, len(para_names)+2), self.grid_pts)
+        self.batch_pts:int = max(batch_pts, 1)
+        self.max_pts:int = self.grid_pts if max_pts is None else min(max_pts, self.grid_pts)
+
+        # fit in the x normalized by the grid span, the parameters are in similar scales then
+        self.__scale:dict = {q: max(np.abs(self.candidates[q]).max(), 1e-30) for q in self.candidates}
+        self.measured:dict = {q: np.zeros(self.grid_pts, dtype=bool) for q in self.candidates}
+        self.signal:dict = {q: np.full(self.grid_pts, np.nan) for q in self.candidates}
+        self.paras:dict = {q: None for q in self.candidates}
+        self.covar:dict = {q: None for q in self.candidates}
+        self.residual_var:dict = {q: None for q in self.candidates}
+        self.rel_err:dict = {q: np.inf for q in self.candidates}
+        self.history:list = []    # (measured points, {q: rel_err}) after each round
+        self.__pending:dict = None
+
+    @property
+    def measured_pts(self)->int:
+        return int(self.measured[list(self.measured.keys())[0]].sum())
+
+    def __x(self, q:str, indices:ndarray=None)->ndarray:
+        x = self.candidates[q]/self.__scale[q]
+        return x if indices is None else x[indices]
+
+    def __fit(self, q:str):
+        indices = np.where(self.measured[q])[0]
+        x, data = self.__x(q, indices), self.signal[q][indices][None, :]
+        # warm start from the last round and a fresh guess together, the warm one can be stuck in a local minimum of an oscillation
+        starts = [self.guesser(data, x)[0]] if self.paras[q] is None else [self.paras[q], self.guesser(data, x)[0]]
+        with np.errstate(all="ignore"):
+            paras, _, cost, success = vectorized_LM(self.func, x, np.repeat(data, len(starts), axis=0), np.array(starts), self.lower, self.upper)
+        cost = np.where(success, cost, np.inf)
+        best = int(np.argmin(cost))
+        paras, cost, success = paras[best:best+1], cost[best:best+1], success[best:best+1]
+        dof = x.shape[0] - len(self.para_names)
+        if not success[0] or dof <= 0:
+            self.paras[q], self.covar[q], self.rel_err[q] = None, None, np.inf
+            return
+        jac = _jacobian(self.func, x, paras)[0]
+        self.residual_var[q] = max(float(cost[0])/dof, 1e-30)
+        self.covar[q] = np.linalg.pinv(jac.T @ jac) * self.residual_var[q]
+        self.paras[q] = paras[0]
+        value = abs(paras[0][self.target])
+        self.rel_err[q] = np.sqrt(abs(self.covar[q][self.target, self.target]))/value if value != 0 else np.inf
+
+    def __gap_filling(self, q:str, picks:list)->int:
+        """ The unmeasured grid point farthest from the measured and picked ones. """
+        x = self.__x(q)
+        taken = self.measured[q].copy()
+        taken[picks] = True
+        free = np.where(~taken)[0]
+        distance = np.abs(x[free][:, None] - x[taken][None, :]).min(axis=1)
+        return int(free[np.argmax(distance)])
+
+    def __design(self, q:str, num:int)->list:
+        picks = []
+        free = np.where(~self.measured[q])[0]
+        informative = num - 1 if num > 1 else num
+        if self.paras[q] is not None:
+            grad = _jacobian(self.func, self.__x(q, free), self.paras[q][None, :])[0]
+            covar, s2 = self.covar[q].copy(), self.residual_var[q]
+            for _ in range(informative):
+                Sg = grad @ covar
+                var = np.einsum('kp,kp->k', Sg, grad)
+                gain = Sg[:, self.target]**2/(s2+var)
+                gain[np.isin(free, picks)] = -np.inf
+                k = int(np.argmax(gain))
+                picks.append(int(free[k]))
+                covar -= np.outer(Sg[k], Sg[k])/(s2+var[k])
+        while len(picks) < num:
+            picks.append(self.__gap_filling(q, picks))
+        return picks
+
+    def next_points(self)->dict|None:
+        """ {q: x array} to measure next (sorted), None if the sweep is done. """
+        if self.converged() or self.measured_pts >= self.max_pts:
+            return None
+        if self.measured_pts == 0:
+            indices = np.unique(np.round(np.linspace(0, self.grid_pts-1, self.coarse_pts)).astype(int))
+            self.__pending = {q: indices for q in self.candidates}
+        else:
+            num = min(self.batch_pts, self.max_pts-self.measured_pts)
+            self.__pending = {q: np.array(self.__design(q, num)) for q in self.candidates}
+        for q in self.__pending:
+            self.__pending[q] = self.__pending[q][np.argsort(self.candidates[q][self.__pending[q]], kind="stable")]
+        return {q: self.candidates[q][self.__pending[q]] for q in self.__pending}
+
+    def update(self, signals:dict):
+        """ Put in the signals {q: array} measured on the last `next_points()`, and refit. """
+        if self.__pending is None:
+            raise ValueError("There are no pending points, call `next_points()` first !")
+        for q in self.__pending:
+            self.signal[q][self.__pending[q]] = np.asarray(signals[q], dtype=float).reshape(-1)
+            self.measured[q][self.__pending[q]] = True
+            self.__fit(q)
+        self.__pending = None
+        self.history.append((self.measured_pts, dict(self.rel_err)))
+
+    def converged(self)->bool:
+        return all([self.rel_err[q] <= self.target_rel_err for q in self.rel_err])
+
+    def run(self, measure:callable)->dict:
+        """ `measure({q: x array})` -> {q: signal array}, it's called until the sweep is done. Returns `report()`. """
+        while True:
+            samples = self.next_points()
+            if samples is None:
+                break
+            self.update(measure(samples))
+            slightly_print(f"Adaptive {self.model}: {self.measured_pts} pts, rel. err. = " + ", ".join([f"{q} {round(float(err)*100,1)}%" for q, err in self.rel_err.items()]))
+        if not self.converged():
+            warning_print(f"Adaptive {self.model} stopped at {self.measured_pts} pts before all the qubits reached {self.target_rel_err*100}% !")
+        return self.report()
+
+    def report(self)->dict:
+        """ {q: {"points", "rel_err", the target parameter}} """
+        target_name = self.para_names[self.target]
+        summary = {}
+        for q in self.candidates:
+            value = np.nan
+            if self.paras[q] is not None:
+                # T1, T2 scale with x, the frequencies with 1/x
+                value = self.paras[q][self.target]*self.__scale[q] if target_name != "f" else self.paras[q][self.target]/self.__scale[q]
+            summary[q] = {"points":int(self.measured[q].sum()), "rel_err":float(self.rel_err[q]), target_name:float(value)}
+        return summary
+
+
+def sweep_signal(ds:Dataset, q:str, ref:list)->ndarray:
+    """ The 1D signal of qubit `q` along the last dim of a raw dataset (mixer, ..., sweep), averaged over the dims in between. """
+    contrast = np.asarray(IQ_contrast(np.array(ds[q]), ref))
+    return contrast.reshape(-1, contrast.shape[-1]).mean(axis=0)
+
+
+def merge_sweep_datasets(datasets:list, sweep_dim:str, x_suffix:str)->Dataset:
+    """
+    Join the datasets measured batch by batch along `sweep_dim`, every qubit is sorted by its own samples in `{q}_{x_suffix}`.
+    It gives the same layout as a one-shot sweep, so the analyses read it as usual.
+    """
+    merged = concat(datasets, dim=sweep_dim, data_vars="all", combine_attrs="override")
+    data_vars = {}
+    for var in merged.data_vars:
+        if str(var).endswith(f"_{x_suffix}"):
+            continue
+        x_var = f"{var}_{x_suffix}"
+        x = np.asarray(merged[x_var].transpose(..., sweep_dim).values)
+        order = np.argsort(x.reshape(-1, x.shape[-1])[0], kind="stable")
+        for name in [var, x_var]:
+            da = merged[name].transpose(..., sweep_dim)
+            data_vars[name] = (list(da.dims), np.asarray(da.values)[..., order], dict(datasets[0][name].attrs))
+    coords = {dim: merged.coords[dim].values for dim in merged.coords if dim != sweep_dim}
+    coords[sweep_dim] = np.arange(merged.sizes[sweep_dim])
+    attrs = dict(datasets[0].attrs)
+    for key in ["end_time", "execution_time"]:
+        if key in datasets[-1].attrs:
+            attrs[key] = datasets[-1].attrs[key]
+    return Dataset(data_vars=data_vars, coords=coords, attrs=attrs)
@@ -0,0 +1,260 @@
+"""
+Calibration dependency graph. Every calibration is a node which knows the nodes it depends on, how old it may get and a cheap check for it.
+With the provenance kept in the QD (`QDmanager.memo_provenance`), a bring-up for a target measurement like "T1 on q0~q4" only runs what is stale:\n
+* missing: never calibrated for the qubit, calibrate it.\n
+* outdated: a node it depends on was calibrated after it, calibrate it.\n
+* aged: older than `max_age_h`, run the quick check first, re-calibrate only when the deviation is out of the tolerance.\n
+* fresh: skip it.\n
+The qubits of a node are measured in the fewest conflict-free multiplexed runs (`MultiplexPlanner`) or by the given `groups`, the nodes follow
+the dependency order.
+"""
+import numpy as np
+from datetime import datetime
+from qblox_drive_AS.support.UserFriend import *
+from qblox_drive_AS.support.QDmanager import QDmanager
+from qblox_drive_AS.support.HardwareSession import HardwareSession, QD_instrument_names, close_QD_instruments
+from qblox_drive_AS.support.MultiplexPlanner import plan_batches
+from qblox_drive_AS.support.ExpFrames import ExpGovernment, IQ_references, XYFcali, ROFcali, PiAcali, hPiAcali, DragCali, EnergyRelaxation, Ramsey, SpinEcho
+
+time_format:str = "%Y-%m-%d %H:%M:%S"
+
+
+class CalNode():
+    """
+    ### Args:\n
+    * name: the provenance name the experiment memorizes, like "XYF".\n
+    * exp: the ExpGovernment class to run.\n
+    * depends: the node names it depends on.\n
+    * params: `params(qubits, quick)` -> (args, kwargs) of `exp.SetParameters`, quick=True for the check.\n
+    * max_age_h: hours before it's aged.\n
+    * tolerance: the check passes when the deviation <= tolerance.\n
+    * deviation: `deviation(QD_agent, q, answer)` -> how far the check result is from the QD, None means there is no check and an aged node is calibrated again.
+    """
+    def __init__(self, name:str, exp:ExpGovernment, depends:list, params:callable, max_age_h:float=24, tolerance:float=None, deviation:callable=None):
+        self.name:str = name
+        self.exp:ExpGovernment = exp
+        self.depends:list = depends
+        self.params:callable = params
+        self.max_age_h:float = max_age_h
+        self.tolerance:float = tolerance
+        self.deviation:callable = deviation
+
+    @property
+    def checkable(self)->bool:
+        return self.deviation is not None and self.tolerance is not None
+
+
+def default_nodes()->dict:
+    """ The calibrations of the single qubit gates. ROLcali is not here, it doesn't update the QD. """
+    return {
+        "ROF": CalNode("ROF", ROFcali, [],
+                       lambda qs, quick: (({q:[-3e6,3e6] if quick else [-5e6,5e6] for q in qs}, 30 if quick else 100), {"avg_n":200 if quick else 500}),
+                       max_age_h=24, tolerance=0.2e6,
+                       deviation=lambda QD_agent, q, ans: abs(ans-QD_agent.quantum_device.get_element(q).clock_freqs.readout())),
+        "RefIQ": CalNode("RefIQ", IQ_references, ["ROF"],
+                         lambda qs, quick: (({q:1 for q in qs}, 10000), {}),
+                         max_age_h=12),
+        "XYF": CalNode("XYF", XYFcali, ["ROF", "RefIQ"],
+                       lambda qs, quick: ((qs, 5e-6), {"avg_n":200 if quick else 500}),
+                       max_age_h=6, tolerance=0.1e6,
+                       deviation=lambda QD_agent, q, ans: abs(ans)),
+        "PiAmp": CalNode("PiAmp", PiAcali, ["XYF"],
+                         lambda qs, quick: (({q:[0.98,1.02] if quick else [0.95,1.05] for q in qs}, 'linspace', 20 if quick else 100, [12] if quick else [12,15]), {"avg_n":200 if quick else 500}),
+                         max_age_h=12, tolerance=0.01,
+                         deviation=lambda QD_agent, q, ans: abs(ans-1)),
+        "hPiAmp": CalNode("hPiAmp", hPiAcali, ["PiAmp"],
+                          lambda qs, quick: (({q:[0.95,1.05] if quick else [0.9,1.1] for q in qs}, 'linspace', 20 if quick else 50, [5] if quick else [5,9]), {"avg_n":200 if quick else 300}),
+                          max_age_h=12, tolerance=0.01,
+                          deviation=lambda QD_agent, q, ans: abs(ans-1)),
+        "Drag": CalNode("Drag", DragCali, ["PiAmp"],
+                        lambda qs, quick: (({q:[-2,2] for q in qs}, 'linspace', 20 if quick else 50), {"avg_n":200 if quick else 500}),
+                        max_age_h=24, tolerance=0.1,
+                        deviation=lambda QD_agent, q, ans: abs(ans["optimal_drag_coef"]-QD_agent.Waveformer.get_dragRatio_for(q))),
+    }
+
+""" {target: (the measurement, the nodes it needs)} """
+target_measurements:dict = {
+    "T1": (EnergyRelaxation, ["PiAmp", "RefIQ"]),
+    "T2": (Ramsey, ["XYF", "PiAmp", "hPiAmp"]),
+    "EchoT2": (SpinEcho, ["XYF", "PiAmp", "hPiAmp"]),
+}
+
+
+class CalibrationGraph():
+    """
+    ### Example:\n
+    ```
+    graph = CalibrationGraph(QD_path, data_folder=save_dir)
+    graph.plan("T1", ["q0","q1","q2","q3","q4"])                               # dry run, prints what will be done
+    graph.bring_up("T1", ["q0","q1","q2","q3","q4"], {q:[0,80e-6] for q in qubits})
+    ```
+    Add or change the nodes by `graph.nodes["XYF"] = CalNode(...)`, a target can also be a node name to only bring it up.
+    """
+    def __init__(self, QD_path:str, data_folder:str=None, session:HardwareSession=None):
+        self.QD_path:str = QD_path
+        self.save_dir:str = data_folder
+        self.session:HardwareSession = session
+        self.nodes:dict = default_nodes()
+        self.targets:dict = dict(target_measurements)
+        self.log:list = []   # (node, q, what was done) of the last bring-up
+        self.__instruments:list = []
+
+    def __load_QD(self)->QDmanager:
+        QD_agent = QDmanager(self.QD_path)
+        QD_agent.QD_loader()
+        self.__instruments = QD_instrument_names(QD_agent)
+        return QD_agent
+
+    def __free_instruments(self):
+        """ Close the QD instruments left by the status checks and the analyses, otherwise the next QD loading complains about their names. """
+        close_QD_instruments(self.__instruments)
+
+    def order(self, target:str)->list:
+        """ The nodes the target needs, sorted by their dependencies. """
+        if target in self.targets:
+            needs = self.targets[target][1]
+        elif target in self.nodes:
+            needs = [target]
+        else:
+            raise KeyError(f"Unknown target = {target}, only {list(self.targets.keys())+list(self.nodes.keys())} are supported !")
+        ordered, visiting = [], []
+        def visit(name:str):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise ValueError(f"The calibration dependencies have a cycle through {name} !")
+            if name not in self.nodes:
+                raise KeyError(f"Unknown calibration node = {name} !")
+            visiting.append(name)
+            for dep in self.nodes[name].depends:
+                visit(dep)
+            visiting.remove(name)
+            ordered.append(name)
+        for name in needs:
+            visit(name)
+        return ordered
+
+    def status(self, QD_agent:QDmanager, name:str, q:str, renewed:list=None)->str:
+        """ "missing", "outdated", "aged" or "fresh" of the node for the qubit, the nodes in `renewed` count as just calibrated. """
+        node = self.nodes[name]
+        record = QD_agent.get_provenance(name, q)
+        if len(record) == 0:
+            return "missing"
+        for dep in node.depends:
+            if renewed is not None and dep in renewed:
+                return "outdated"
+            dep_record = QD_agent.get_provenance(dep, q)
+            if "calibrated" in dep_record and dep_record["calibrated"] > record["time"]:
+                return "outdated"
+        age_h = (datetime.now()-datetime.strptime(record["time"], time_format)).total_seconds()/3600
+        return "aged" if age_h > node.max_age_h else "fresh"
+
+    def plan(self, target:str, qubits:list)->dict:
+        """ Dry run, {node: {q: status}}. The aged nodes are assumed to pass their checks. """
+        QD_agent = self.__load_QD()
+        plans, renewed = {}, {q:[] for q in qubits}
+        for name in self.order(target):
+            plans[name] = {}
+            for q in qubits:
+                plans[name][q] = self.status(QD_agent, name, q, renewed[q])
+                if plans[name][q] in ["missing", "outdated"] or (plans[name][q] == "aged" and not self.nodes[name].checkable):
+                    renewed[q].append(name)
+            eyeson_print(f"{name}: " + ", ".join([f"{q} {plans[name][q]}" for q in qubits]))
+        self.__free_instruments()
+        return plans
+
+    def __run(self, name:str, qubits:list, quick:bool, groups:list=None)->tuple[dict,dict]:
+        """ Run the node for the qubits, one multiplexed run per group. Returns {q: answer} and the raw data paths. """
+        node = self.nodes[name]
+        answers, sources = {}, {}
+        groups = [qubits] if groups is None else [[q for q in group if q in qubits] for group in groups]
+        for group in [group for group in groups if len(group) != 0]:
+            highlight_print(f"{'Checking' if quick else 'Calibrating'} {name} for {group}")
+            EXP = node.exp(QD_path=self.QD_path, data_folder=self.save_dir)
+            EXP.session = self.session
+            EXP.update_permission = "no" if quick else "all"
+            args, kwargs = node.params(group, quick)
+            EXP.SetParameters(*args, **kwargs)
+            EXP.WorkFlow()
+            EXP.RunAnalysis()
+            self.__free_instruments()
+            answers.update(EXP.answer)
+            for q in group:
+                sources[q] = EXP.RawDataPath
+        return answers, sources
+
+    def bring_up(self, target:str, qubits:list, time_range:dict=None, time_pts:int=100, avg_n:int=500, groups:list=None)->list:
+        """
+        Run the stale calibrations the target needs, then the target measurement (always) if it's a measurement.\n
+        ### Args:\n
+        * target: "T1", "T2", "EchoT2" or a node name.\n
+        * time_range: {"q0":[0,80e-6], ...} of the target measurement.\n
+        * groups: [["q0","q2"],["q1"]] the qubits which can be measured together, default is planned by `MultiplexPlanner`.
+        Returns the target experiments, one per group.
+        """
+        self.log = []
+        if groups is None:
+            # the widest readout sweep of the nodes (ROF) decides the readout collisions
+            groups = plan_batches(self.QD_path, qubits, ro_windows={q:[-5e6,5e6] for q in qubits})
+        own_session = self.session is None
+        if own_session:
+            self.session = HardwareSession(self.QD_path)
+        try:
+            renewed = {q:[] for q in qubits}
+            for name in self.order(target):
+                node = self.nodes[name]
+                QD_agent = self.__load_QD()
+                status = {q: self.status(QD_agent, name, q, renewed[q]) for q in qubits}
+                self.__free_instruments()
+                to_check = [q for q in qubits if status[q] == "aged" and node.checkable]
+                to_calibrate = [q for q in qubits if status[q] in ["missing", "outdated"] or (status[q] == "aged" and not node.checkable)]
+                for q in [q for q in qubits if status[q] == "fresh"]:
+                    self.log.append((name, q, "skipped"))
+
+                if len(to_check) != 0:
+                    answers, sources = self.__run(name, to_check, True, groups)
+                    QD_agent = self.__load_QD()
+                    for q in to_check:
+                        deviation = node.deviation(QD_agent, q, answers[q]) if q in answers else np.inf
+                        if deviation <= node.tolerance:
+                            QD_agent.memo_provenance(name, q, source=sources[q], exp=node.exp.__name__, action="checked")
+                            self.log.append((name, q, "checked"))
+                        else:
+                            warning_print(f"{name} of {q} drifted by {deviation}, out of the tolerance {node.tolerance} !")
+                            to_calibrate.append(q)
+                    QD_agent.QD_keeper()
+                    self.__free_instruments()
+
+                if len(to_calibrate) != 0:
+                    to_calibrate = [q for q in qubits if q in to_calibrate]
+                    self.__run(name, to_calibrate, False, groups)
+                    for q in to_calibrate:
+                        renewed[q].append(name)
+                        self.log.append((name, q, "calibrated"))
+
+            EXPs = []
+            if target in self.targets:
+                if time_range is None:
+                    raise ValueError(f"Give the time_range of the {target} measurement !")
+                for group in [[q for q in group if q in qubits] for group in groups]:
+                    if len(group) == 0:
+                        continue
+                    EXP = self.targets[target][0](QD_path=self.QD_path, data_folder=self.save_dir)
+                    EXP.session = self.session
+                    EXP.SetParameters({q: time_range[q] for q in group}, 'linspace', time_pts, 1, avg_n)
+                    EXP.WorkFlow()
+                    EXP.RunAnalysis()
+                    self.__free_instruments()
+                    EXPs.append(EXP)
+        finally:
+            if own_session:
+                self.session.teardown()
+                self.session = None
+        self.report()
+        return EXPs
+
+    def report(self):
+        for action in ["calibrated", "checked", "skipped"]:
+            done = [f"{name}.{q}" for name, q, what in self.log if what == action]
+            if len(done) != 0:
+                slightly_print(f"{action}: {', '.join(done)}")
@@ -0,0 +1,338 @@
+"""
+Deterministic cluster emulator, it runs the whole ExpGovernment.WorkFlow without the hardware (like in CI or for profiling the
+compile -> upload -> acquire -> save -> analyze latency).\n
+The cluster is a qblox-instruments dummy cluster built from the modules in the hardware config, so the schedules are compiled and the
+sequencer programs are uploaded exactly like on the real one. Only the acquisitions are replaced: the compiled schedule is walked along
+its timeline and every qubit is kept as a Bloch vector with T1/T2 decay, driven by the pulses on its `:mw` port. The readout gives the
+IQ of a Lorentzian resonator which is shifted by the qubit state, so the resonator/qubit spectroscopy, Rabi, T1, T2 and single shot blobs
+all look like the real ones. The "truth" is the QD file when the emulated cluster connects.\n
+The flux pulses and offsets are not emulated, the qubits always stay at the f01 in the QD file.
+### Example:\n
+```
+from qblox_drive_AS.support.ClusterEmulator import use_emulator
+use_emulator(realtime=0)   # or set the environment variable QBLOX_EMULATOR=1
+EXP = EnergyRelaxation(QD_path=QD_path,data_folder=save_dir)
+...
+EXP.WorkFlow()             # init_meas() connects the emulated cluster
+```
+"""
+import os
+from bisect import bisect_right
+from time import perf_counter, sleep
+from numpy import ndarray, array, asarray, exp, pi, sqrt, cos, sin, isnan, random, zeros, clip
+from xarray import Dataset
+from qblox_instruments import Cluster, ClusterType
+from quantify_scheduler.instrument_coordinator import InstrumentCoordinator
+from qblox_drive_AS.support.UserFriend import *
+
+emulator_settings:dict = {
+    "enabled": os.environ.get("QBLOX_EMULATOR", "0") == "1",
+    "realtime": float(os.environ.get("QBLOX_EMULATOR_REALTIME", "1")), # wait the schedule duration (all repetitions) x realtime in every run
+    "seed": 0,
+}
+# the defaults if the QD doesn't have them yet
+default_truth:dict = {
+    "T1": 20e-6,
+    "T2": 15e-6,
+    "chi": 0.25e6,          # dispersive shift, the resonator is at readout-2*chi when the qubit is excited
+    "kappa": 1e6,           # resonator linewidth
+    "bare_shift": 1.5e6,    # bare - dressed resonator freq if the bare freq is not in the notebook
+    "critical_ro_amp": 0.5, # the resonator goes to the bare freq above this readout amp
+    "thermal_p1": 0.02,
+    "gain": 0.05,           # V per readout amp
+    "delay": 60e-9,         # electrical delay, gives the phase slope on the IQ
+    "snr": 2.5,             # state separation / single shot noise
+}
+_cluster_types:dict = {"QCM":ClusterType.CLUSTER_QCM, "QCM_RF":ClusterType.CLUSTER_QCM_RF, "QRM":ClusterType.CLUSTER_QRM, "QRM_RF":ClusterType.CLUSTER_QRM_RF}
+_gauss_area:float = sqrt(2*pi)/4  # area of the gaussian/DRAG envelope with sigma = duration/4 over the square one
+_truths:dict = {}                  # {cluster_name: {q: truth}}
+
+
+def use_emulator(enabled:bool=True, realtime:float=None, seed:int=None):
+    """
+    Switch `init_meas()` and `HardwareSession` onto the emulated cluster.\n
+    ### Args:\n
+    * realtime: 1 waits as long as the real hardware, 0 returns the data at once (for CI).\n
+    * seed: the noise is reproducible with the same seed.
+    """
+    emulator_settings["enabled"] = enabled
+    if realtime is not None:
+        emulator_settings["realtime"] = realtime
+    if seed is not None:
+        emulator_settings["seed"] = seed
+
+
+def emulator_enabled()->bool:
+    return emulator_settings["enabled"]
+
+
+def is_emulated(cluster)->bool:
+    return getattr(cluster, "name", None) in _truths
+
+
+def cluster_modules(hardware_config:dict)->tuple[str, dict]:
+    """ The cluster name and its {slot: "QCM_RF", ...} in the hardware config, both the old style and the `hardware_description` one. """
+    if "hardware_description" in hardware_config:
+        for name, instrument in hardware_config["hardware_description"].items():
+            if instrument.get("instrument_type") == "Cluster":
+                return name, {int(slot): module["instrument_type"] for slot, module in instrument["modules"].items()}
+    else:
+        for name, instrument in hardware_config.items():
+            if isinstance(instrument, dict) and instrument.get("instrument_type") == "Cluster":
+                return name, {int(key.split("module")[-1]): module["instrument_type"] for key, module in instrument.items() if isinstance(module, dict) and "instrument_type" in module}
+    raise KeyError("There is no Cluster in the hardware config !")
+
+
+def qubit_truth(QD_agent, q:str)->dict:
+    """ The parameters of the emulated qubit and its resonator, from the QD with the defaults for the ones not measured yet. """
+    element = QD_agent.quantum_device.get_element(q)
+    note = QD_agent.Notewriter.get_notebook(q)
+    truth = dict(default_truth)
+    truth["f01"] = element.clock_freqs.f01()
+    truth["readout"] = element.clock_freqs.readout()
+    truth["bare"] = note["bareF"] if note.get("bareF", 0) not in [0, None] else truth["readout"] + truth["bare_shift"]
+    truth["pi_area"] = element.rxy.amp180()*element.rxy.duration()*_gauss_area
+    for name in ["T1", "T2"]:
+        if note.get(name, 0) not in [0, None]:
+            truth[name] = note[name]*1e-6 if note[name] > 1e-3 else note[name] # the analyzers keep them in µs
+    truth["T2"] = min(truth["T2"], 2*truth["T1"])
+    return truth
+
+
+def emulated_cluster(QD_agent)->Cluster:
+    """ A dummy cluster with the modules in the hardware config of the QD, remember the qubits in the QD as the truth. """
+    name, modules = cluster_modules(QD_agent.quantum_device.hardware_config())
+    try:
+        from qcodes import Instrument
+        Instrument.find_instrument(name).close()
+    except KeyError:
+        pass
+    cluster = Cluster(name, dummy_cfg={slot: _cluster_types[modules[slot]] for slot in modules})
+    _truths[name] = {q: qubit_truth(QD_agent, q) for q in QD_agent.quantum_device.elements()}
+    eyeson_print(f"Emulated {name} with modules {modules}, qubits: {list(_truths[name].keys())}")
+    return cluster
+
+
+def _rotate(bloch:ndarray, axis:ndarray, angle:float)->ndarray:
+    """ Rodrigues rotation of the Bloch vector around the unit axis. """
+    c, s = cos(angle), sin(angle)
+    return bloch*c + _cross(axis, bloch)*s + axis*(axis@bloch)*(1-c)
+
+
+def _cross(a:ndarray, b:ndarray)->ndarray:
+    return array([a[1]*b[2]-a[2]*b[1], a[2]*b[0]-a[0]*b[2], a[0]*b[1]-a[1]*b[0]])
+
+
+class EmulatedQubit():
+    """ Bloch vector of a qubit in the frame of its drive clock, ground state is z = +1. """
+    def __init__(self, truth:dict):
+        self.truth = truth
+        self.z_eq:float = 1-2*truth["thermal_p1"]
+        self.reset(0)
+
+    def reset(self, time:float):
+        self.bloch:ndarray = array([0., 0., self.z_eq])
+        self.time:float = time
+
+    def idle(self, time:float, drive_freq:float):
+        """ Free evolution until `time`, precess with the detuning to the drive clock and decay. """
+        dt = time - self.time
+        if dt <= 0:
+            return
+        x, y, z = self.bloch
+        phase = 2*pi*(self.truth["f01"]-drive_freq)*dt
+        decay = exp(-dt/self.truth["T2"])
+        self.bloch = array([(x*cos(phase)-y*sin(phase))*decay, (x*sin(phase)+y*cos(phase))*decay, self.z_eq+(z-self.z_eq)*exp(-dt/self.truth["T1"])])
+        self.time = time
+
+    def drive(self, start:float, area:float, duration:float, phase_deg:float, drive_freq:float):
+        """ A pulse with the envelope `area` (amp x s), strong and long pulses go to the steady state of the Bloch equations. """
+        self.idle(start, drive_freq)
+        rabi = pi*area/self.truth["pi_area"]/duration if duration > 0 else 0
+        detuning = 2*pi*(self.truth["f01"]-drive_freq)
+        T1, T2 = self.truth["T1"], self.truth["T2"]
+        if duration > 3*T2:
+            p1 = 0.5*rabi**2*T1*T2/(1+detuning**2*T2**2+rabi**2*T1*T2)
+            self.bloch = array([0., 0., self.z_eq-2*p1])
+        elif rabi != 0:
+            axis = array([rabi*cos(phase_deg*pi/180), rabi*sin(phase_deg*pi/180), detuning])
+            generalized = sqrt(axis@axis)
+            self.bloch = _rotate(self.bloch, axis/generalized, generalized*duration)
+            self.bloch[:2] *= exp(-duration/T2)
+        self.time = start + duration
+
+    @property
+    def p1(self)->float:
+        return float(clip((1-self.bloch[2])/2, 0, 1))
+
+    def resonator_IQ(self, freq:float, ro_amp:float, excited):
+        """ Complex S21 x gain of the resonator with the qubit in ground (0) or excited (1), `excited` can be an array of shots. """
+        t = self.truth
+        saturation = 1/(1+(ro_amp/t["critical_ro_amp"])**4)
+        f_r = t["bare"] + (t["readout"] - t["bare"] - 2*t["chi"]*asarray(excited))*saturation
+        S21 = 1 - 0.8/(1 + 2j*(freq - f_r)/t["kappa"])
+        return t["gain"]*ro_amp*S21*exp(-2j*pi*freq*t["delay"])
+
+    def shot_noise(self, freq:float, ro_amp:float)->float:
+        t = self.truth
+        separation = abs(self.resonator_IQ(t["readout"], ro_amp, 0) - self.resonator_IQ(t["readout"], ro_amp, 1))
+        return float(separation/t["snr"])
+
+
+class EmulatedCoordinator(InstrumentCoordinator):
+    """
+    Instrument coordinator of an emulated cluster, everything is forwarded to the dummy cluster (the programs are really uploaded),
+    then the acquisitions are filled by the emulated qubits along the timeline of the compiled schedule.
+    """
+    def __init__(self, name:str, add_default_generic_icc:bool=True):
+        super().__init__(name, add_default_generic_icc)
+        self.__schedule = None
+        self.__started:float = 0
+        self.__rng = random.default_rng(emulator_settings["seed"])
+
+    def prepare(self, compiled_schedule):
+        self.__schedule = compiled_schedule
+        super().prepare(compiled_schedule)
+
+    def start(self):
+        super().start()
+        self.__started = perf_counter()
+
+    def wait_done(self, timeout_sec:int=10):
+        super().wait_done(timeout_sec)
+        if self.__schedule is not None and emulator_settings["realtime"] > 0:
+            remains = self.__schedule["duration"]*emulator_settings["realtime"] - (perf_counter()-self.__started) # duration includes the repetitions
+            if remains > 0:
+                sleep(remains)
+
+    def __truth(self)->dict:
+        for instrument in self.__schedule.get("compiled_instructions", {}):
+            if instrument in _truths:
+                return _truths[instrument]
+        return {}
+
+    def acquisition_records(self)->dict:
+        """ {(acq_channel, acq_index): (qubit, ro_freq, ro_amp, p1)} of the last prepared schedule. """
+        truth = self.__truth()
+        qubits = {q: EmulatedQubit(truth[q]) for q in truth}
+        clocks = {name: resource.data.get("freq") for name, resource in self.__schedule.resources.items()}
+        readouts = {} # {ro clock: [(start, end, amp), ...]}, the readout pulse may start a bit later than its acquisition
+        events, loops, opened = [], [], []
+        for schedulable in sorted(self.__schedule.schedulables.values(), key=lambda schedulable: schedulable["abs_time"]):
+            operation = self.__schedule.operations[schedulable["operation_id"]]
+            control_flow = operation.data.get("control_flow_info", {})
+            if "repetitions" in control_flow:
+                opened.append((schedulable["abs_time"], control_flow["repetitions"]))
+                continue
+            if "feedback_trigger_label" in control_flow:
+                # a conditional reset (see `ResetPolicy`), its pi-pulse brings the qubit to the ground state whenever it was in |1>
+                opened.append((schedulable["abs_time"], None))
+                events.append((schedulable["abs_time"], 0, "reset", [control_flow["feedback_trigger_label"]]))
+                continue
+            if control_flow.get("return_stack", False):
+                begin, repetitions = opened.pop()
+                if repetitions is not None:
+                    loops.append((begin, schedulable["abs_time"], repetitions))
+                continue
+            if any([repetitions is None for _, repetitions in opened]):
+                continue
+            for info in operation.data.get("pulse_info", []):
+                start = schedulable["abs_time"]+info.get("t0", 0)
+                if info.get("port") == "q:res" and info.get("wf_func") is not None:
+                    events.append((start, 1, "readout", info))
+                else:
+                    events.append((start, 1, "pulse", info))
+            for info in operation.data.get("acquisition_info", []):
+                events.append((schedulable["abs_time"]+info.get("t0", 0), 2, "acquisition", info))
+            if operation.data.get("gate_info", {}).get("operation_type") == "reset":
+                events.append((schedulable["abs_time"], 0, "reset", operation.data["gate_info"]["qubits"]))
+        # a loop body is counted once in the schedule timeline, the sequencers play it `repetitions` times and delay all the later operations
+        for begin, end, repetitions in sorted(loops, reverse=True):
+            period, unrolled = end-begin, []
+            for event in events:
+                if event[0] < begin:
+                    unrolled.append(event)
+                elif event[0] < end:
+                    unrolled += [(event[0]+k*period,)+event[1:] for k in range(repetitions)]
+                else:
+                    unrolled.append((event[0]+(repetitions-1)*period,)+event[1:])
+            events = unrolled
+        for start, _, kind, info in events:
+            if kind == "readout":
+                readouts.setdefault(info["clock"], []).append((start, start+info["duration"], info.get("amp", 0)))
+        events = [event for event in events if event[2] != "readout"]
+        events.sort(key=lambda event: (event[0], event[1]))
+        for clock in readouts:
+            readouts[clock].sort()
+        readout_starts = {clock: [pulse[0] for pulse in readouts[clock]] for clock in readouts}
+
+        def readout_amp(clock:str, start:float, end:float)->float:
+            if clock not in readouts:
+                return 0
+            idx = bisect_right(readout_starts[clock], end+1e-12) - 1 # the readout may start right at the end of the acquisition
+            return readouts[clock][idx][2] if idx >= 0 and readouts[clock][idx][1] > start else 0
+
+        records = {}
+        for time, _, kind, info in events:
+            if kind == "reset":
+                for q in info:
+                    if q in qubits:
+                        qubits[q].reset(time)
+            elif kind == "pulse":
+                if "clock_freq_new" in info:
+                    clocks[info["clock"]] = info["clock_freq_new"]
+                elif info.get("wf_func") is None or info.get("port") is None:
+                    continue
+                elif info["port"].split(":")[-1] == "mw" and info["port"].split(":")[0] in qubits:
+                    amp = info.get("amp", info.get("G_amp", 0))
+                    area = amp*info["duration"]*(1 if "square" in info["wf_func"] else _gauss_area)
+                    qubits[info["port"].split(":")[0]].drive(time, area, info["duration"], info.get("phase", 0), clocks[info["clock"]])
+            else:
+                q = info["clock"].split(".")[0]
+                if q not in qubits:
+                    continue
+                drive_clock = clocks.get(f"{q}.01", truth[q]["f01"])
+                qubits[q].idle(time, drive_clock)
+                records[(info["acq_channel"], info["acq_index"])] = (q, clocks.get(info["clock"], truth[q]["readout"]), readout_amp(info["clock"], time, time+info["duration"]), qubits[q].p1)
+
+        outer = getattr(self.__schedule, "outer_sweep", None)
+        if outer is not None:
+            # the timeline is the inner sweep at one outer point (see `SweepCompiler.compile_outer_sweep`), only a swept readout amplitude is emulated
+            probe_value = outer["values"][outer["probe_idx"]]
+            records = {(channel, outer_idx*outer["inner_bins"]+acq_index): (q, freq, value if ro_amp == probe_value else ro_amp, p1)
+                       for outer_idx, value in enumerate(outer["values"]) for (channel, acq_index), (q, freq, ro_amp, p1) in records.items()}
+        return records
+
+    def retrieve_acquisition(self)->Dataset:
+        acquisitions = super().retrieve_acquisition()
+        if self.__schedule is None:
+            return acquisitions
+        truth = self.__truth()
+        qubits = {q: EmulatedQubit(truth[q]) for q in truth}
+        records = self.acquisition_records()
+        for var in acquisitions.data_vars:
+            values = zeros(acquisitions[var].shape, dtype=complex)
+            index_dim = [dim for dim in acquisitions[var].dims if str(dim).startswith("acq_index")]
+            if len(index_dim) == 0:
+                continue
+            axis = acquisitions[var].dims.index(index_dim[0])
+            for position, acq_index in enumerate(acquisitions[var].coords[index_dim[0]].values):
+                if (var, int(acq_index)) not in records:
+                    continue
+                q, freq, ro_amp, p1 = records[(var, int(acq_index))]
+                qubit = qubits[q]
+                sigma = qubit.shot_noise(freq, ro_amp)
+                selector = [slice(None)]*values.ndim
+                selector[axis] = position
+                shape = values[tuple(selector)].shape
+                if values.ndim == 1: # averaged bins
+                    signal = (1-p1)*qubit.resonator_IQ(freq, ro_amp, 0) + p1*qubit.resonator_IQ(freq, ro_amp, 1)
+                    sigma /= sqrt(self.__schedule.repetitions)
+                else:                # appended shots
+                    signal = qubit.resonator_IQ(freq, ro_amp, self.__rng.random(shape) < p1)
+                values[tuple(selector)] = signal + sigma*(self.__rng.normal(size=shape) + 1j*self.__rng.normal(size=shape))/sqrt(2)
+            if acquisitions[var].dtype.kind == "c":
+                acquisitions[var].values[...] = values
+            else:
+                acquisitions[var].values[...] = values.real
+        return acquisitions
@@ -0,0 +1,121 @@
+"""
+Background workers for the slow jobs after an acquisition (saving the dataset, fitting, plotting), so the next experiment can compile and run
+on the hardware while the previous data is still being handled.\n
+The jobs wait in a bounded queue, `submit` blocks when it's full (back-pressure), so a slow analysis can never pile up the datasets in memory.
+The jobs are done in the submitted order when there is only one worker (the default), which keeps the appends into a MonitorStore in order.
+A failed job doesn't stop the measurements, it's logged when it fails and all the failures are reported again at `close`.
+"""
+from time import perf_counter
+from queue import Queue
+from threading import Thread, Lock
+from qblox_drive_AS.support.UserFriend import *
+
+_stop_signal = None
+
+
+class DataPipeline():
+    """
+    ### Example:\n
+    ```
+    pipeline = DataPipeline(max_pending=2)
+    EXP.pipeline = pipeline                                # the ExpGovernment defers its saving into the pipeline
+    pipeline.submit(time_monitor_data_ana, QD_agent, save_dir, name="analysis")
+    ...
+    pipeline.close()                                       # wait all the jobs done
+    ```
+    ### Args:\n
+    * max_pending: how many jobs can wait in the queue, `submit` blocks when it's full.\n
+    * workers: the worker threads, keep 1 if the jobs have to be done in order.\n
+    * headless_plot: switch matplotlib to "Agg" while the pipeline is open, the GUI backends can only be used in the main thread.
+    The former backend is restored at `close`.
+    """
+    def __init__(self, max_pending:int=2, workers:int=1, headless_plot:bool=True):
+        if max_pending < 1 or workers < 1:
+            raise ValueError(f"max_pending = {max_pending} and workers = {workers} should be at least 1 !")
+        self.__former_backend:str = None
+        if headless_plot:
+            import matplotlib
+            self.__former_backend = matplotlib.get_backend()
+            matplotlib.use("Agg")
+        self.__queue:Queue = Queue(maxsize=max_pending)
+        self.__lock = Lock()
+        self.__errors:list = []
+        self.__timings:dict = {"wait":[], "jobs":{}}
+        self.__workers:list = [Thread(target=self.__work, name=f"DataPipeline-{i}", daemon=True) for i in range(workers)]
+        for worker in self.__workers:
+            worker.start()
+
+    @property
+    def timings(self)->dict:
+        """ {"wait":[seconds blocked in submit, ...], "jobs":{name:[seconds, ...]}} """
+        return self.__timings
+
+    @property
+    def errors(self)->list:
+        """ [(job name, exception), ...] of the failed jobs. """
+        with self.__lock:
+            return list(self.__errors)
+
+    @property
+    def is_open(self)->bool:
+        return len(self.__workers) != 0
+
+    def __work(self):
+        while True:
+            job = self.__queue.get()
+            try:
+                if job is _stop_signal:
+                    return
+                name, func, args, kwargs = job
+                start = perf_counter()
+                try:
+                    func(*args, **kwargs)
+                except Exception as err:
+                    warning_print(f"DataPipeline job '{name}' failed: {err}")
+                    with self.__lock:
+                        self.__errors.append((name, err))
+                with self.__lock:
+                    self.__timings["jobs"].setdefault(name, []).append(perf_counter()-start)
+            finally:
+                self.__queue.task_done()
+
+    def submit(self, func:callable, *args, name:str=None, **kwargs):
+        """ Queue `func(*args, **kwargs)`, it blocks until there is a place in the queue. """
+        if not self.is_open:
+            raise RuntimeError("The DataPipeline was closed !")
+        start = perf_counter()
+        self.__queue.put((func.__name__ if name is None else name, func, args, kwargs))
+        self.__timings["wait"].append(perf_counter()-start)
+
+    def drain(self):
+        """ Wait until all the queued jobs are done, like before reading the data they save. """
+        self.__queue.join()
+
+    def close(self):
+        """ Finish all the queued jobs, stop the workers, restore the matplotlib backend and report the failed jobs. """
+        if not self.is_open:
+            return
+        for _ in self.__workers:
+            self.__queue.put(_stop_signal)
+        for worker in self.__workers:
+            worker.join()
+        self.__workers = []
+        if self.__former_backend is not None:
+            import matplotlib
+            matplotlib.use(self.__former_backend)
+            self.__former_backend = None
+        errors = self.errors
+        if len(errors) != 0:
+            failed = "; ".join([f"{name}: {type(err).__name__}: {err}" for name, err in errors])
+            warning_print(f"{len(errors)} job(s) failed in the DataPipeline, {failed}")
+
+    def report(self):
+        waited = sum(self.__timings["wait"])
+        jobs = ", ".join([f"{name} {round(sum(records),1)} s ({len(records)})" for name, records in self.__timings["jobs"].items()])
+        slightly_print(f"DataPipeline: blocked {round(waited,1)} s in submit, jobs done in background: {jobs}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
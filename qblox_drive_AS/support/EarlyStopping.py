@@ -0,0 +1,146 @@
+"""
+Chunked averaging with early stopping. Instead of one run with a fixed `avg_n`, the schedule is repeated in blocks of a few averages, the blocks
+are accumulated into a running mean and variance per point (Welford), and a qubit stops taking the new blocks once its data is good enough:\n
+* snr: peak-to-peak of the averaged signal over the median standard error of its points.\n
+* fit_rel_err: the relative error of the fitted T1/T2/Rabi frequency (same models as `AdaptiveSweep`).\n
+The experiment stops when all the qubits are done or the averages reach the cap. In a multiplexed run the qubits are read together, so a
+finished qubit keeps its frozen mean while the others go on, and the experiment time is set by the slowest qubit.
+"""
+import numpy as np
+from numpy import ndarray
+from xarray import Dataset
+from qblox_drive_AS.support.UserFriend import *
+from qblox_drive_AS.support.AdaptiveSweep import adaptive_models, sweep_signal
+from qblox_drive_AS.analysis.BatchFitting import batch_fit
+
+
+class RunningMean():
+    """ Elementwise running mean and variance over the added blocks (Welford). """
+    def __init__(self):
+        self.count:int = 0
+        self.mean:ndarray = None
+        self.__M2:ndarray = None
+
+    def add(self, values:ndarray):
+        values = np.asarray(values, dtype=float)
+        self.count += 1
+        if self.mean is None:
+            self.mean, self.__M2 = values.copy(), np.zeros_like(values)
+            return
+        delta = values - self.mean
+        self.mean += delta/self.count
+        self.__M2 += delta*(values - self.mean)
+
+    def variance(self)->ndarray:
+        """ The variance between the blocks, nan before 2 blocks. """
+        if self.count < 2:
+            return np.full_like(self.mean, np.nan)
+        return self.__M2/(self.count-1)
+
+    def sem(self)->ndarray:
+        """ The standard error of the running mean. """
+        return np.sqrt(self.variance()/self.count)
+
+
+class EarlyStopping():
+    """
+    ### Example:\n
+    ```
+    stopper = EarlyStopping("T1", refs={"q0":refIQ}, block_avg=50, max_avg=500, snr=20)
+    while not stopper.done():
+        stopper.add_block(run_with(stopper.block_avg))   # a raw dataset of every block, all in the same layout
+    dataset = stopper.dataset()                         # the means, with the achieved averages in the attrs
+    ```
+    ### Args:\n
+    * model: "T1", "T2"/"Ramsey" or "Rabi", only used by `fit_rel_err`.\n
+    * refs: {q: refIQ or rotate angle} to turn the IQ into the signal like the analyses do.\n
+    * block_avg: the averages of a block, it's cut to `max_avg` if larger.\n
+    * max_avg: the cap of the averages. The blocks are all the same size (the running variance weights them equally), so the real cap is
+    the whole blocks in it, `floor(max_avg/block_avg)*block_avg`, and it never exceeds `max_avg`.\n
+    * snr, fit_rel_err: the criteria, a qubit is done when all the given ones are met.\n
+    * min_blocks: the blocks to take before judging, at least 2 for a variance.
+    """
+    def __init__(self, model:str, refs:dict, block_avg:int=50, max_avg:int=500, snr:float=None, fit_rel_err:float=None, min_blocks:int=3):
+        if snr is None and fit_rel_err is None:
+            raise ValueError("Give at least one of the early stopping criteria, `snr` or `fit_rel_err` !")
+        if model not in adaptive_models:
+            raise KeyError(f"Unknown model = {model}, only {list(adaptive_models.keys())} are supported !")
+        self.model:str = model
+        self.refs:dict = refs
+        self.block_avg:int = max(min(int(block_avg), int(max_avg)), 1)
+        self.max_blocks:int = max(int(max_avg)//self.block_avg, 1)
+        self.snr_target:float = snr
+        self.fit_rel_err_target:float = fit_rel_err
+        self.min_blocks:int = min(max(min_blocks, 2), self.max_blocks)
+
+        self.raw:dict = {q: RunningMean() for q in refs}      # the IQ data of the qubit var
+        self.signal:dict = {q: RunningMean() for q in refs}   # the 1D signal the criteria look at
+        self.stopped:dict = {q: False for q in refs}
+        self.snr:dict = {q: np.nan for q in refs}
+        self.fit_rel_err:dict = {q: np.nan for q in refs}
+        self.blocks:int = 0
+        self.__template:Dataset = None
+
+    def __judge(self, q:str)->bool:
+        signal = self.signal[q]
+        if signal.count < self.min_blocks:
+            return False
+        met = True
+        if self.snr_target is not None:
+            noise = np.nanmedian(signal.sem())
+            self.snr[q] = float(np.ptp(signal.mean)/noise) if noise > 0 else np.inf
+            met &= self.snr[q] >= self.snr_target
+        if self.fit_rel_err_target is not None:
+            batch_model, target = adaptive_models[self.model]
+            x = self.__sweep_values(q)
+            x = x/max(np.abs(x).max(), 1e-30)   # the relative error doesn't depend on the x unit, keep the paras in similar scales
+            result = batch_fit(signal.mean[None, :], x, batch_model)
+            value, error = float(result[target].values[0]), float(result[f"{target}_err"].values[0])
+            self.fit_rel_err[q] = abs(error/value) if bool(result["success"].values[0]) and value != 0 else np.inf
+            met &= self.fit_rel_err[q] <= self.fit_rel_err_target
+        return bool(met)
+
+    def __sweep_values(self, q:str)->ndarray:
+        x_var = [var for var in self.__template.data_vars if str(var).startswith(f"{q}_")][0]
+        x = np.asarray(self.__template[x_var].values)
+        return x.reshape(-1, x.shape[-1])[0]
+
+    def add_block(self, ds:Dataset):
+        """ Accumulate the raw dataset of a block into the qubits which are still going. """
+        if self.__template is None:
+            self.__template = ds
+        self.__last_attrs = dict(ds.attrs)
+        self.blocks += 1
+        for q in self.refs:
+            if self.stopped[q]:
+                continue
+            self.raw[q].add(ds[q].values)
+            self.signal[q].add(sweep_signal(ds, q, self.refs[q]))
+            self.stopped[q] = self.__judge(q)
+            if self.stopped[q]:
+                criteria = ([f"SNR = {round(self.snr[q],1)}"] if self.snr_target is not None else []) + ([f"fit rel. err. = {round(self.fit_rel_err[q]*100,2)}%"] if self.fit_rel_err_target is not None else [])
+                slightly_print(f"{q} converged after {self.averages(q)} averages, {', '.join(criteria)}")
+
+    def averages(self, q:str)->int:
+        return self.raw[q].count*self.block_avg
+
+    def done(self)->bool:
+        return all(self.stopped.values()) or self.blocks >= self.max_blocks
+
+    def dataset(self)->Dataset:
+        """ The template dataset with the running means, the achieved averages `{q}_avg_n` are in the attrs. """
+        ds = self.__template.copy(deep=True)
+        for key in ["end_time", "execution_time"]:
+            if key in self.__last_attrs:
+                ds.attrs[key] = self.__last_attrs[key]
+        for q in self.refs:
+            ds[q].values = self.raw[q].mean
+            ds.attrs[f"{q}_avg_n"] = self.averages(q)
+            ds.attrs[f"{q}_snr"] = float(self.snr[q])
+            ds.attrs[f"{q}_fit_rel_err"] = float(self.fit_rel_err[q])
+        ds.attrs["early_stop"] = 1
+        ds.attrs["avg_block"] = self.block_avg
+        ds.attrs["avg_cap"] = self.max_blocks*self.block_avg
+        if not all(self.stopped.values()):
+            warning_print(f"Averaging reached the cap {self.max_blocks*self.block_avg} before {[q for q in self.stopped if not self.stopped[q]]} converged !")
+        return ds
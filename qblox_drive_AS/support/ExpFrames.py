@@ -7,18 +7,223 @@ from qblox_drive_AS.support.QDmanager import QDmanager, Data_manager
 from qblox_drive_AS.analysis.Multiplexing_analysis import Multiplex_analyzer, sort_timeLabel
 from qblox_drive_AS.support.UserFriend import *
 from xarray import open_dataset
-from numpy import array, linspace, arange, logspace, mean, median, std, sort
+from numpy import array, linspace, arange, logspace, mean, median, std, sort, moveaxis
 from abc import abstractmethod
 from qblox_drive_AS.support import init_meas, init_system_atte, shut_down, coupler_zctrl, advise_where_fq
 from qblox_drive_AS.support.Pulse_schedule_library import set_LO_frequency, QS_fit_analysis
 from quantify_scheduler.helpers.collections import find_port_clock_path
-from qblox_drive_AS.analysis.raw_data_demolisher import ZgateT1_dataReducer
+from qblox_drive_AS.analysis.raw_data_demolisher import ZgateT1_dataReducer, ZgateT1_dataView
 from qblox_drive_AS.analysis.TimeTraceAna import time_monitor_data_ana
+from qblox_drive_AS.support.HardwareSession import HardwareSession
+from qblox_drive_AS.support.ScheduleCache import schedule_cache
+from qblox_drive_AS.support.MonitorStore import MonitorStore, store_name, find_store, open_raw_data
+from qblox_drive_AS.support.DataPipeline import DataPipeline
+from qblox_drive_AS.support.PhaseTracer import PhaseTracer, trace, in_context
+from qblox_drive_AS.support.AdaptiveSweep import AdaptiveSweep, sweep_signal, merge_sweep_datasets
+from qblox_drive_AS.support.EarlyStopping import EarlyStopping
+from qblox_drive_AS.support.ResetPolicy import ResetPolicy, memo_threshold
+from qblox_drive_AS.support.StateDiscriminator import TwoStateGMM, DiscriminatorRegistry
+from qcat.analysis.state_discrimination import p01_to_Teff
+from functools import wraps
+
+# the methods of ExpGovernment which are traced as a phase, the outermost one writes the trace when it finishes
+traced_phases:tuple = ("WorkFlow", "PrepareHardware", "RunMeasurement", "CloseMeasurement", "RunAnalysis")
+
+
+def _traced_phase(method:callable, phase:str)->callable:
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        tracer:PhaseTracer = getattr(self, "tracer", None)
+        if tracer is None:
+            return method(self, *args, **kwargs)
+        outermost = not tracer.is_active()
+        try:
+            with tracer.span(phase, exp=type(self).__name__):
+                return method(self, *args, **kwargs)
+        finally:
+            if outermost:
+                self.save_trace()
+    wrapper.__traced_phase__ = True
+    return wrapper
 
 
 class ExpGovernment(ABC):
     def __init__(self):
         self.QD_path:str = ""
+        self.session:HardwareSession = None # give a HardwareSession to skip the re-connections between experiments
+        self.store:MonitorStore = None      # give a MonitorStore to append the data into it instead of a nc file per run
+        self.pipeline:DataPipeline = None   # give a DataPipeline to save the data in background while the next experiment runs
+        self.tracer:PhaseTracer = PhaseTracer() # share one tracer to aggregate the phase timings over many experiments, None to turn off
+        self.adaptive:dict = None           # the AdaptiveSweep settings by `SetAdaptiveSampling`, None samples the whole grid
+        self.early_stop:dict = None         # the EarlyStopping settings by `SetEarlyStopping`, None averages `avg_n` in one go
+        self.update_permission:str = None   # answers "What qubit can be updated ?" of the calibrations, 'all'/'no'/'q0', None asks by input
+        self.answer:dict = {}               # the results of the last calibration analysis, {q: value}
+        self.reset_policy:ResetPolicy = None # give a ResetPolicy to set the resets by the T1s (or the active reset), None keeps the QD resets
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for phase in traced_phases:
+            method = cls.__dict__.get(phase)
+            if method is not None and not getattr(method, "__traced_phase__", False):
+                setattr(cls, phase, _traced_phase(method, phase))
+
+    def trace_path(self)->str|None:
+        """ `<raw data name>_trace.jsonl` next to the raw data, `trace.jsonl` for a MonitorStore, None if nothing was saved. """
+        raw_data_path = getattr(self, "RawDataPath", "")
+        if raw_data_path is not None and raw_data_path != "":
+            folder, file_name = os.path.split(raw_data_path)
+            if self.store is not None and os.path.abspath(raw_data_path) == os.path.abspath(self.store.path):
+                return os.path.join(folder, "trace.jsonl")
+            return os.path.join(folder, f"{os.path.splitext(file_name)[0]}_trace.jsonl")
+        if getattr(self, "save_dir", None) is not None:
+            return os.path.join(self.save_dir, f"{type(self).__name__}_trace.jsonl")
+        return None
+
+    def save_trace(self):
+        """ Write the finished spans into `trace_path()`, they're kept in the tracer if there is no path. """
+        path = self.trace_path()
+        if path is not None and self.tracer is not None:
+            try:
+                self.tracer.flush(path)
+            except OSError as err:
+                warning_print(f"Trace can't be saved into {path}: {err}")
+
+    def defer(self, func:callable, *args, **kwargs):
+        """ Do the job in `self.pipeline` if it was given, otherwise right now. """
+        if self.pipeline is None:
+            with trace(func.__name__):
+                func(*args, **kwargs)
+        else:
+            self.pipeline.submit(in_context(func), *args, name=func.__name__, **kwargs)
+
+    def wait_saved(self):
+        """ Wait for the deferred savings before reading the raw data back. """
+        if self.pipeline is not None:
+            self.pipeline.drain()
+    
+    def SetAdaptiveSampling(self, target_rel_err:float=0.05, coarse_pts:int=15, batch_pts:int=5, max_pts:int=None):
+        """ Measure only the informative points of the grid given in `SetParameters` (T1, Ramsey, SpinEcho, CPMG, Power/Time Rabi).\n
+            ### Args:\n
+            * target_rel_err: stop when the fitted T1/T2/pi-amp of all the qubits reach this relative error.\n
+            * coarse_pts: the evenly spaced points measured first.\n
+            * batch_pts: the points added per round.\n
+            * max_pts: the budget of points, default is the whole grid.
+            The adaptive sweep measures every point once, `histo_counts` in `SetParameters` is overridden to 1 (with a warning) in this mode.
+        """
+        self.adaptive = dict(target_rel_err=target_rel_err, coarse_pts=coarse_pts, batch_pts=batch_pts, max_pts=max_pts)
+
+    def SetEarlyStopping(self, block_avg:int=50, snr:float=None, fit_rel_err:float=None, max_avg:int=None):
+        """ Average in blocks and stop once the data is good enough (T1, Ramsey, SpinEcho, CPMG, Power/Time Rabi).\n
+            ### Args:\n
+            * block_avg: the averages of a block.\n
+            * snr: the signal peak-to-peak over its median standard error to reach.\n
+            * fit_rel_err: the relative error of the fitted T1/T2/pi-amp to reach.\n
+            * max_avg: the cap of the averages, default is `avg_n` in `SetParameters`. Only whole blocks are taken, the averages stop at
+            the largest multiple of `block_avg` not over it.
+        """
+        if snr is None and fit_rel_err is None:
+            raise ValueError("Give at least one of the early stopping criteria, `snr` or `fit_rel_err` !")
+        self.early_stop = dict(block_avg=block_avg, snr=snr, fit_rel_err=fit_rel_err, max_avg=max_avg)
+
+    def sweep_repeat(self)->int:
+        """ The histogram repeats of the sweep, it's 1 in the adaptive mode because the points are picked from one history of the signals. """
+        if self.adaptive is None:
+            return self.histos
+        if self.histos != 1:
+            warning_print(f"The adaptive sampling measures the points once, histo_counts = {self.histos} is overridden to 1.")
+            # the analysis follows it too
+            self.histos = 1
+        return 1
+
+    def signal_refs(self, qubits:list)->dict:
+        """ {q: rotate angle, or refIQ if the angle is 0}, the same reference the analyses use. """
+        return {q: self.QD_agent.rotate_angle[q] if self.QD_agent.rotate_angle[q][0] != 0 else self.QD_agent.refIQ[q] for q in qubits}
+
+    def run_chunked(self, model:str, qubits:list, measure:callable)->Dataset:
+        """ Run `measure(n_avg)->Dataset` block by block until an EarlyStopping says all the qubits are done, return the averaged dataset. """
+        settings = dict(self.early_stop)
+        max_avg = settings.pop("max_avg")
+        stopper = EarlyStopping(model, self.signal_refs(qubits), max_avg=self.avg_n if max_avg is None else max_avg, **settings)
+        while not stopper.done():
+            stopper.add_block(measure(stopper.block_avg))
+        return stopper.dataset()
+
+    def acquire(self, model:str, samples:dict, measure:callable, sweep_dim:str, x_suffix:str)->Dataset:
+        """
+        Measure the 1D sweep by `measure(samples, n_avg)->Dataset`, adaptively and/or with the early stopping if they were set.\n
+        The model ("T1", "Ramsey" or "Rabi") is the one the analysis fits.
+        """
+        run = lambda batch: measure(batch, self.avg_n)
+        if self.execution:
+            if self.early_stop is not None and getattr(self, "OSmode", False):
+                warning_print("The early stopping is for the averaged data, it's ignored in the OS mode.")
+            elif self.early_stop is not None:
+                run = lambda batch: self.run_chunked(model, list(batch.keys()), lambda n_avg: measure(batch, n_avg))
+            if self.adaptive is not None:
+                return self.run_adaptive(model, samples, run, sweep_dim, x_suffix)
+        return run(samples)
+
+    def run_adaptive(self, model:str, samples:dict, measure:callable, sweep_dim:str, x_suffix:str)->Dataset:
+        """ Run `measure({q: x array})->Dataset` batch by batch on the points picked by an AdaptiveSweep, return the joined dataset. """
+        sweep = AdaptiveSweep(model, samples, **self.adaptive)
+        datasets = []
+        refs = self.signal_refs(list(samples.keys()))
+        def signals(batch:dict)->dict:
+            datasets.append(measure(batch))
+            return {q: sweep_signal(datasets[-1], q, refs[q]) for q in batch}
+        summary = sweep.run(signals)
+
+        dataset = merge_sweep_datasets(datasets, sweep_dim, x_suffix)
+        dataset.attrs["adaptive"] = 1
+        dataset.attrs["adaptive_target_rel_err"] = sweep.target_rel_err
+        dataset.attrs["adaptive_rounds"] = len(datasets)
+        for q in summary:
+            dataset.attrs[f"{q}_adaptive_pts"] = summary[q]["points"]
+            dataset.attrs[f"{q}_adaptive_rel_err"] = summary[q]["rel_err"]
+        return dataset
+
+    def update_qubits(self, QD_savior:QDmanager, answer:dict, node:str, updater:callable, source:str=""):
+        """
+        Ask what qubits can take the calibrated `answer` (or follow `self.update_permission`), update them by `updater(q, answer[q])`
+        which returns the new value, then memorize the provenance of `node` and keep the QD.
+        """
+        self.answer = answer
+        if self.update_permission is None:
+            permi = mark_input(f"What qubit can be updated ? {list(answer.keys())}/ all/ no ").lower()
+        else:
+            permi = self.update_permission.lower()
+        if permi in list(answer.keys()):
+            qubits = [permi]
+        elif permi in ["all",'y','yes']:
+            qubits = list(answer.keys())
+        else:
+            print("Updating got denied ~")
+            return
+        for q in qubits:
+            QD_savior.memo_provenance(node, q, updater(q, answer[q]), source=source, exp=type(self).__name__)
+        QD_savior.QD_keeper()
+
+    def connect_hardware(self):
+        """ Same returns as `init_meas()`, reuse the connections if `self.session` was given. The `reset_policy` is applied on the loaded QD. """
+        if self.session is None:
+            connections = init_meas(QuantumDevice_path=self.QD_path)
+        else:
+            if self.session.QD_path != self.QD_path:
+                raise ValueError(f"The session was opened with QD = {self.session.QD_path}, but this experiment uses QD = {self.QD_path}")
+            connections = self.session.connect()
+        if self.reset_policy is not None:
+            # only the measured qubits share the reset, the other elements on the device are not touched
+            if len(getattr(self, "target_qs", None) or []) == 0:
+                raise ValueError(f"{type(self).__name__} has no target_qs for the reset policy, set it before connecting the hardware !")
+            self.reset_policy.apply(connections[0], self.target_qs)
+        return connections
+    
+    def release_hardware(self):
+        """ Shut down all the instruments, or only reset the changed ones if `self.session` was given. """
+        if self.session is None:
+            shut_down(self.cluster,self.Fctrl)
+        else:
+            self.session.release()
     
     @abstractmethod
     def SetParameters(self,*args,**kwargs):
@@ -66,7 +271,7 @@ class BroadBand_CavitySearching(ExpGovernment):
         self.freq_pts = freq_pts
     
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # Set the system attenuations
         init_system_atte(self.QD_agent.quantum_device,self.target_qs,ro_out_att=self.QD_agent.Notewriter.get_DigiAtteFor(self.target_qs[len(self.target_qs)-self.counter], 'ro'))
         # Readout select
@@ -79,13 +284,14 @@ class BroadBand_CavitySearching(ExpGovernment):
         if self.save_dir is not None:
             self.save_path = os.path.join(self.save_dir,f"BroadBandCS_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
             self.__raw_data_location = self.save_path + ".nc"
-            dataset.to_netcdf(self.__raw_data_location)
+            with trace("to_netcdf"):
+                dataset.to_netcdf(self.__raw_data_location)
             self.save_fig_path = self.save_path+".png"
         else:
             self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
         self.counter -= 1
 
 
@@ -147,7 +353,7 @@ class Zoom_CavitySearching(ExpGovernment):
 
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # Set the system attenuations
         init_system_atte(self.QD_agent.quantum_device,self.target_qs,ro_out_att=self.QD_agent.Notewriter.get_DigiAtteFor(self.target_qs[0], 'ro'))
         
@@ -170,13 +376,14 @@ class Zoom_CavitySearching(ExpGovernment):
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"zoomCS_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -244,7 +451,7 @@ class PowerCavity(ExpGovernment):
         self.roamp_samples = sampling_func(*roamp_range)
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # Set the system attenuations
         init_system_atte(self.QD_agent.quantum_device,self.target_qs,ro_out_att=self.QD_agent.Notewriter.get_DigiAtteFor(self.target_qs[0], 'ro'))
         
@@ -262,13 +469,14 @@ class PowerCavity(ExpGovernment):
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"PowerCavity_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -334,7 +542,7 @@ class Dressed_CavitySearching(ExpGovernment):
 
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # Set the system attenuations
         init_system_atte(self.QD_agent.quantum_device,self.target_qs,ro_out_att=self.QD_agent.Notewriter.get_DigiAtteFor(self.target_qs[0], 'ro')) 
         
@@ -358,13 +566,14 @@ class Dressed_CavitySearching(ExpGovernment):
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"dressedCS_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -434,7 +643,7 @@ class FluxCoupler(ExpGovernment):
         self.flux_samples = sampling_func(*flux_range)
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # Set the system attenuations
         init_system_atte(self.QD_agent.quantum_device,self.target_qs,ro_out_att=self.QD_agent.Notewriter.get_DigiAtteFor(self.target_qs[0], 'ro'))
 
@@ -452,13 +661,14 @@ class FluxCoupler(ExpGovernment):
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"FluxCoupler_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -528,7 +738,7 @@ class FluxCavity(ExpGovernment):
         self.flux_samples = sampling_func(*flux_range)
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # Set the system attenuations
         init_system_atte(self.QD_agent.quantum_device,self.target_qs,ro_out_att=self.QD_agent.Notewriter.get_DigiAtteFor(self.target_qs[0], 'ro'))
         # bias coupler
@@ -548,13 +758,14 @@ class FluxCavity(ExpGovernment):
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"FluxCavity_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -634,7 +845,7 @@ class IQ_references(ExpGovernment):
 
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # Set the system attenuations
         init_system_atte(self.QD_agent.quantum_device,self.target_qs,ro_out_att=self.QD_agent.Notewriter.get_DigiAtteFor(self.target_qs[0], 'ro')) 
         # bias coupler
@@ -651,12 +862,13 @@ class IQ_references(ExpGovernment):
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"IQref_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -686,6 +898,8 @@ class IQ_references(ExpGovernment):
             ds.close()
             
             QD_savior.memo_refIQ(answer)
+            for q in answer:
+                QD_savior.memo_provenance("RefIQ", q, answer[q], source=file_path, exp=type(self).__name__)
             QD_savior.QD_keeper()
 
 
@@ -738,7 +952,7 @@ class PowerConti2tone(ExpGovernment):
             self.xyl_samples = list(xyl_range)
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # Set the system attenuations
         init_system_atte(self.QD_agent.quantum_device,self.target_qs,ro_out_att=self.QD_agent.Notewriter.get_DigiAtteFor(self.target_qs[0], 'ro'), xy_out_att=0)
         # bias coupler
@@ -768,13 +982,14 @@ class PowerConti2tone(ExpGovernment):
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"PowerCnti2tone_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
         """ User callable analysis function pack """
@@ -848,7 +1063,7 @@ class FluxQubit(ExpGovernment):
         self.z_amp_samples = sampling_func(*z_amp_range)
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # Set the system attenuations
         init_system_atte(self.QD_agent.quantum_device,self.target_qs,ro_out_att=self.QD_agent.Notewriter.get_DigiAtteFor(self.target_qs[0], 'ro'),xy_out_att=0)
         # bias coupler
@@ -877,13 +1092,14 @@ class FluxQubit(ExpGovernment):
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"FluxQubit_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -970,7 +1186,7 @@ class PowerRabiOsci(ExpGovernment):
         
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # bias coupler
         self.Fctrl = coupler_zctrl(self.Fctrl,self.QD_agent.Fluxmanager.build_Cctrl_instructions([cp for cp in self.Fctrl if cp[0]=='c' or cp[:2]=='qc'],'i'))
         # offset bias, LO and driving atte
@@ -987,18 +1203,19 @@ class PowerRabiOsci(ExpGovernment):
     def RunMeasurement(self):
         from qblox_drive_AS.SOP.RabiOsci import PowerRabi
     
-        dataset = PowerRabi(self.QD_agent,self.meas_ctrl,self.pi_amp_samples,self.pi_dura,self.avg_n,self.execution,self.OSmode)
+        dataset = self.acquire("Rabi",self.pi_amp_samples,lambda samples, n_avg: PowerRabi(self.QD_agent,self.meas_ctrl,samples,self.pi_dura,n_avg,self.execution,self.OSmode),"pi_amp","piamp")
         if self.execution:
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"PowerRabi_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -1079,7 +1296,7 @@ class TimeRabiOsci(ExpGovernment):
         
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # bias coupler
         self.Fctrl = coupler_zctrl(self.Fctrl,self.QD_agent.Fluxmanager.build_Cctrl_instructions([cp for cp in self.Fctrl if cp[0]=='c' or cp[:2]=='qc'],'i'))
         # offset bias, LO and atte
@@ -1095,18 +1312,19 @@ class TimeRabiOsci(ExpGovernment):
     def RunMeasurement(self):
         from qblox_drive_AS.SOP.RabiOsci import TimeRabi
     
-        dataset = TimeRabi(self.QD_agent,self.meas_ctrl,self.pi_amp,self.pi_dura_samples,self.avg_n,self.execution,self.OSmode)
+        dataset = self.acquire("Rabi",self.pi_dura_samples,lambda samples, n_avg: TimeRabi(self.QD_agent,self.meas_ctrl,self.pi_amp,samples,n_avg,self.execution,self.OSmode),"pi_dura","pidura")
         if self.execution:
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"TimeRabi_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -1185,7 +1403,7 @@ class SingleShot(ExpGovernment):
 
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # bias coupler
         self.Fctrl = coupler_zctrl(self.Fctrl,self.QD_agent.Fluxmanager.build_Cctrl_instructions([cp for cp in self.Fctrl if cp[0]=='c' or cp[:2]=='qc'],'i'))
         # offset bias, LO and driving atte
@@ -1203,21 +1421,25 @@ class SingleShot(ExpGovernment):
 
         dataset = Qubit_state_single_shot(self.QD_agent,self.target_qs,self.avg_n,self.execution)
         if self.execution:
-            if self.save_dir is not None:
+            if self.store is not None:
+                self.defer(self.store.append,"SingleShot",dataset)
+                self.__raw_data_location = self.store.path
+            elif self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"SingleShot_{datetime.now().strftime('%Y%m%d%H%M%S') if (self.JOBID is None or self.use_time_label) else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                self.defer(dataset.to_netcdf,self.__raw_data_location)
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None,histo_ana:bool=False):
         """ if histo_ana, it will check all the data in the same folder with the given new_file_path """
     
         if self.execution:
+            self.wait_saved()
             if new_QD_path is None:
                 QD_file = self.QD_path
             else:
@@ -1234,32 +1456,48 @@ class SingleShot(ExpGovernment):
             QD_savior.QD_loader()
 
             if not histo_ana:
-                ds = open_dataset(file_path)
+                ds = open_raw_data(file_path,"SingleShot")
                 for var in ds.data_vars:
+                    # the kept discriminator follows the drift if the readout is the same, otherwise it's retrained
+                    config = DiscriminatorRegistry.readout_config(QD_savior, var)
+                    model = QD_savior.Discriminators.fetch_or_train(var, config, array(ds[var].transpose("mixer","prepared_state","index"))*1000)
                     ANA = Multiplex_analyzer("m14")
-                    # QD_savior.StateDiscriminator = ANA.gmm2d_fidelity # will be in the future
                     ANA._import_data(ds[var]*1000,var_dimension=0,fq_Hz=QD_savior.quantum_device.get_element(var).clock_freqs.f01())
-                    ANA._start_analysis()
+                    ANA._start_analysis(discriminator=model)
                     pic_path = os.path.join(fig_path,f"{var}_SingleShot_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                     ANA._export_result(pic_path)
                     highlight_print(f"{var} rotate angle = {round(ANA.fit_packs['RO_rotation_angle'],2)} in degree.")
                     QD_savior.rotate_angle[var] = [ANA.fit_packs["RO_rotation_angle"]]
+                    memo_threshold(QD_savior, var, model.centers, scale=1000) # for the thresholded acquisition of the active reset
                 ds.close()
                 
                 QD_savior.QD_keeper()
             else:
 
                 eff_T, thermal_pop = {}, {}
-                files = sort_timeLabel([os.path.join(fig_path,name) for name in os.listdir(fig_path) if (os.path.isfile(os.path.join(fig_path,name)) and name.split(".")[-1]=='nc')])
-                for nc_idx, nc_file in enumerate(files):
-                    ds = open_dataset(nc_file)
+                store_path = find_store(fig_path)
+                if store_path is None:
+                    files = sort_timeLabel([os.path.join(fig_path,name) for name in os.listdir(fig_path) if (os.path.isfile(os.path.join(fig_path,name)) and name.split(".")[-1]=='nc')])
+                    datasets = (open_dataset(nc_file) for nc_file in files)
+                else:
+                    datasets = MonitorStore(store_path).iter_datasets("SingleShot")
+                shots = {}
+                for ds in datasets:
                     for var in ds.data_vars:
-                        if nc_idx == 0: eff_T[var], thermal_pop[var] = [], []
-                        ANA = Multiplex_analyzer("m14")
-                        ANA._import_data(ds[var]*1000,var_dimension=0,fq_Hz=QD_savior.quantum_device.get_element(var).clock_freqs.f01())
-                        ANA._start_analysis()
-                        eff_T[var].append(ANA.fit_packs["effT_mK"])
-                        thermal_pop[var].append(ANA.fit_packs["thermal_population"]*100)
+                        if var not in shots: shots[var] = []
+                        shots[var].append(array(ds[var].transpose("mixer","prepared_state","index"))*1000)
+                    ds.close()
+                # the histos are classified in one go by the kept discriminator instead of training a GMM for every file
+                for var in shots:
+                    data = moveaxis(array(shots[var]),0,1) # (IQ, histo, state, shots)
+                    model = QD_savior.Discriminators.get(var, DiscriminatorRegistry.readout_config(QD_savior, var))
+                    if model is None:
+                        warning_print(f"{var} has no discriminator for this readout, train one with the first histo.")
+                        model = TwoStateGMM().train(data[:,0])
+                    populations = model.population(data[:,:,0]) # P(1|prepared 0) of every histo
+                    fq = QD_savior.quantum_device.get_element(var).clock_freqs.f01()
+                    eff_T[var] = [p01_to_Teff(p, fq)*1000 for p in populations]
+                    thermal_pop[var] = list(populations*100)
                 
                 for qubit in eff_T:
                     highlight_print(f"{qubit}: {round(median(array(eff_T[qubit])),1)} +/- {round(std(array(eff_T[qubit])),1)} mK")
@@ -1326,7 +1564,7 @@ class Ramsey(ExpGovernment):
         
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # bias coupler
         self.Fctrl = coupler_zctrl(self.Fctrl,self.QD_agent.Fluxmanager.build_Cctrl_instructions([cp for cp in self.Fctrl if cp[0]=='c' or cp[:2]=='qc'],'i'))
         # offset bias, LO and atte
@@ -1342,18 +1580,20 @@ class Ramsey(ExpGovernment):
     def RunMeasurement(self):
         from qblox_drive_AS.SOP.T2 import Ramsey
     
-        dataset = Ramsey(self.QD_agent,self.meas_ctrl,self.time_samples,self.spin_num,self.histos,self.avg_n,self.execution)
+        repeat = self.sweep_repeat()
+        dataset = self.acquire("Ramsey",self.time_samples,lambda samples, n_avg: Ramsey(self.QD_agent,self.meas_ctrl,samples,self.spin_num,repeat,n_avg,self.execution),"idx","x")
         if self.execution:
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"Ramsey_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -1461,7 +1701,7 @@ class SpinEcho(ExpGovernment):
         
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # bias coupler
         self.Fctrl = coupler_zctrl(self.Fctrl,self.QD_agent.Fluxmanager.build_Cctrl_instructions([cp for cp in self.Fctrl if cp[0]=='c' or cp[:2]=='qc'],'i'))
         # offset bias, LO and atte
@@ -1476,18 +1716,20 @@ class SpinEcho(ExpGovernment):
     def RunMeasurement(self):
         from qblox_drive_AS.SOP.T2 import Ramsey
     
-        dataset = Ramsey(self.QD_agent,self.meas_ctrl,self.time_samples,self.spin_num,self.histos,self.avg_n,self.execution)
+        repeat = self.sweep_repeat()
+        dataset = self.acquire("T1",self.time_samples,lambda samples, n_avg: Ramsey(self.QD_agent,self.meas_ctrl,samples,self.spin_num,repeat,n_avg,self.execution),"idx","x")
         if self.execution:
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"SpinEcho_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -1592,7 +1834,7 @@ class CPMG(ExpGovernment):
         
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # bias coupler
         self.Fctrl = coupler_zctrl(self.Fctrl,self.QD_agent.Fluxmanager.build_Cctrl_instructions([cp for cp in self.Fctrl if cp[0]=='c' or cp[:2]=='qc'],'i'))
         # offset bias, LO and atte
@@ -1606,24 +1848,29 @@ class CPMG(ExpGovernment):
     def RunMeasurement(self):
         from qblox_drive_AS.SOP.T2 import Ramsey
     
-        dataset = Ramsey(self.QD_agent,self.meas_ctrl,self.time_samples,self.spin_num,self.histos,self.avg_n,self.execution)
+        repeat = self.sweep_repeat()
+        dataset = self.acquire("T1",self.time_samples,lambda samples, n_avg: Ramsey(self.QD_agent,self.meas_ctrl,samples,self.spin_num,repeat,n_avg,self.execution),"idx","x")
         if self.execution:
-            if self.save_dir is not None:
+            if self.store is not None:
+                self.defer(self.store.append,"CPMG",dataset)
+                self.__raw_data_location = self.store.path
+            elif self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"CPMG_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                self.defer(dataset.to_netcdf,self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
         """ User callable analysis function pack """
         
         if self.execution:
+            self.wait_saved()
             if new_QD_path is None:
                 QD_file = self.QD_path
             else:
@@ -1639,7 +1886,7 @@ class CPMG(ExpGovernment):
             QD_savior = QDmanager(QD_file)
             QD_savior.QD_loader()
 
-            ds = open_dataset(file_path)
+            ds = open_raw_data(file_path,"CPMG")
         
             for var in ds.data_vars:
                 if var.split("_")[-1] != 'x':
@@ -1723,7 +1970,7 @@ class EnergyRelaxation(ExpGovernment):
         
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # bias coupler
         self.Fctrl = coupler_zctrl(self.Fctrl,self.QD_agent.Fluxmanager.build_Cctrl_instructions([cp for cp in self.Fctrl if cp[0]=='c' or cp[:2]=='qc'],'i'))
         # offset bias, LO and atte
@@ -1737,35 +1984,41 @@ class EnergyRelaxation(ExpGovernment):
     def RunMeasurement(self):
         from qblox_drive_AS.SOP.T1 import T1, EnergyRelaxPS
         meas = EnergyRelaxPS()
-        meas.set_time_samples = self.time_samples
         meas.set_os_mode = self.OSmode
-        meas.set_n_avg = self.avg_n
-        meas.set_repeat = self.histos
+        meas.set_repeat = self.sweep_repeat()
         meas.meas_ctrl = self.meas_ctrl
         meas.QD_agent = self.QD_agent
-        
-        meas.run()
-        dataset = meas.dataset
+        def measure(time_samples:dict, n_avg:int)->Dataset:
+            meas.set_time_samples = time_samples
+            meas.set_n_avg = n_avg
+            meas.run()
+            return meas.dataset
+
+        dataset = self.acquire("T1",self.time_samples,measure,"idx","x")
 
 
         # dataset = T1(self.QD_agent,self.meas_ctrl,self.time_samples,self.histos,self.avg_n,self.execution)
         if self.execution:
-            if self.save_dir is not None:
+            if self.store is not None:
+                self.defer(self.store.append,"T1",dataset)
+                self.__raw_data_location = self.store.path
+            elif self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"T1_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                self.defer(dataset.to_netcdf,self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
         """ User callable analysis function pack """
         
         if self.execution:
+            self.wait_saved()
             if new_QD_path is None:
                 QD_file = self.QD_path
             else:
@@ -1781,7 +2034,7 @@ class EnergyRelaxation(ExpGovernment):
             QD_savior = QDmanager(QD_file)
             QD_savior.QD_loader()
 
-            ds = open_dataset(file_path)
+            ds = open_raw_data(file_path,"T1")
         
             for var in ds.data_vars:
                 if var.split("_")[-1] != 'x':
@@ -1843,7 +2096,7 @@ class XYFcali(ExpGovernment):
         
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # bias coupler
         self.Fctrl = coupler_zctrl(self.Fctrl,self.QD_agent.Fluxmanager.build_Cctrl_instructions([cp for cp in self.Fctrl if cp[0]=='c' or cp[:2]=='qc'],'i'))
         # offset bias, LO and atte
@@ -1863,13 +2116,14 @@ class XYFcali(ExpGovernment):
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"XYFcali_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -1915,16 +2169,10 @@ class XYFcali(ExpGovernment):
                     highlight_print(f"{var}: actual detune = {round(answer[var]*1e-6,4)} MHz")
             ds.close()
 
-            permi = mark_input(f"What qubit can be updated ? {list(answer.keys())}/ all/ no ").lower()
-            if permi in list(answer.keys()):
-                QD_savior.quantum_device.get_element(permi).clock_freqs.f01(QD_savior.quantum_device.get_element(permi).clock_freqs.f01()-answer[permi])
-                QD_savior.QD_keeper()
-            elif permi in ["all",'y','yes']:
-                for q in answer:
-                    QD_savior.quantum_device.get_element(q).clock_freqs.f01(QD_savior.quantum_device.get_element(q).clock_freqs.f01()-answer[q])
-                QD_savior.QD_keeper()
-            else:
-                print("Updating got denied ~")
+            def updater(q:str, detune:float)->float:
+                QD_savior.quantum_device.get_element(q).clock_freqs.f01(QD_savior.quantum_device.get_element(q).clock_freqs.f01()-detune)
+                return QD_savior.quantum_device.get_element(q).clock_freqs.f01()
+            self.update_qubits(QD_savior,answer,"XYF",updater,file_path)
 
     def WorkFlow(self):
         
@@ -1960,7 +2208,7 @@ class ROFcali(ExpGovernment):
         
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # bias coupler
         self.Fctrl = coupler_zctrl(self.Fctrl,self.QD_agent.Fluxmanager.build_Cctrl_instructions([cp for cp in self.Fctrl if cp[0]=='c' or cp[:2]=='qc'],'i'))
         # offset bias, LO and atte
@@ -1982,13 +2230,14 @@ class ROFcali(ExpGovernment):
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"ROFcali_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -2021,16 +2270,10 @@ class ROFcali(ExpGovernment):
                     answer[var] = ANA.fit_packs[var]["optimal_rof"]
             ds.close()
 
-            permi = mark_input(f"What qubit can be updated ? {list(answer.keys())}/ all/ no ").lower()
-            if permi in list(answer.keys()):
-                QD_savior.quantum_device.get_element(permi).clock_freqs.readout(answer[permi])
-                QD_savior.QD_keeper()
-            elif permi in ["all",'y','yes']:
-                for q in answer:
-                    QD_savior.quantum_device.get_element(q).clock_freqs.readout(answer[q])
-                QD_savior.QD_keeper()
-            else:
-                print("Updating got denied ~")
+            def updater(q:str, rof:float)->float:
+                QD_savior.quantum_device.get_element(q).clock_freqs.readout(rof)
+                return rof
+            self.update_qubits(QD_savior,answer,"ROF",updater,file_path)
 
 
     def WorkFlow(self):
@@ -2075,7 +2318,7 @@ class PiAcali(ExpGovernment):
         
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # bias coupler
         self.Fctrl = coupler_zctrl(self.Fctrl,self.QD_agent.Fluxmanager.build_Cctrl_instructions([cp for cp in self.Fctrl if cp[0]=='c' or cp[:2]=='qc'],'i'))
         # offset bias, LO and atte
@@ -2095,13 +2338,14 @@ class PiAcali(ExpGovernment):
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"PIampcali_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -2139,16 +2383,10 @@ class PiAcali(ExpGovernment):
                     answer[var] = ANA.fit_packs["ans"]
             ds.close()
 
-            permi = mark_input(f"What qubit can be updated ? {list(answer.keys())}/ all/ no ").lower()
-            if permi in list(answer.keys()):
-                QD_savior.quantum_device.get_element(permi).rxy.amp180(QD_savior.quantum_device.get_element(permi).rxy.amp180()*answer[permi])
-                QD_savior.QD_keeper()
-            elif permi in ["all",'y','yes']:
-                for q in answer:
-                    QD_savior.quantum_device.get_element(q).rxy.amp180(QD_savior.quantum_device.get_element(q).rxy.amp180()*answer[q])
-                QD_savior.QD_keeper()
-            else:
-                print("Updating got denied ~")
+            def updater(q:str, coef:float)->float:
+                QD_savior.quantum_device.get_element(q).rxy.amp180(QD_savior.quantum_device.get_element(q).rxy.amp180()*coef)
+                return QD_savior.quantum_device.get_element(q).rxy.amp180()
+            self.update_qubits(QD_savior,answer,"PiAmp",updater,file_path)
 
     def WorkFlow(self):
         
@@ -2192,7 +2430,7 @@ class hPiAcali(ExpGovernment):
         
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # bias coupler
         self.Fctrl = coupler_zctrl(self.Fctrl,self.QD_agent.Fluxmanager.build_Cctrl_instructions([cp for cp in self.Fctrl if cp[0]=='c' or cp[:2]=='qc'],'i'))
         # offset bias, LO and atte
@@ -2212,13 +2450,14 @@ class hPiAcali(ExpGovernment):
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"halfPIampcali_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -2256,16 +2495,10 @@ class hPiAcali(ExpGovernment):
                     answer[var] = ANA.fit_packs["ans"]
 
             ds.close()
-            permi = mark_input(f"What qubit can be updated ? {list(answer.keys())}/ all/ no ").lower()
-            if permi in list(answer.keys()):
-                QD_savior.Waveformer.set_halfPIratio_for(permi, QD_savior.Waveformer.get_halfPIratio_for(permi)*answer[permi])
-                QD_savior.QD_keeper()
-            elif permi in ["all",'y','yes']:
-                for q in answer:
-                    QD_savior.Waveformer.set_halfPIratio_for(q, QD_savior.Waveformer.get_halfPIratio_for(q)*answer[q])
-                QD_savior.QD_keeper()
-            else:
-                print("Updating got denied ~")
+            def updater(q:str, coef:float)->float:
+                QD_savior.Waveformer.set_halfPIratio_for(q, QD_savior.Waveformer.get_halfPIratio_for(q)*coef)
+                return QD_savior.Waveformer.get_halfPIratio_for(q)
+            self.update_qubits(QD_savior,answer,"hPiAmp",updater,file_path)
     def WorkFlow(self):
         
         self.PrepareHardware()
@@ -2307,7 +2540,7 @@ class ROLcali(ExpGovernment):
         
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # bias coupler
         self.Fctrl = coupler_zctrl(self.Fctrl,self.QD_agent.Fluxmanager.build_Cctrl_instructions([cp for cp in self.Fctrl if cp[0]=='c' or cp[:2]=='qc'],'i'))
         # offset bias, LO and atte
@@ -2327,13 +2560,14 @@ class ROLcali(ExpGovernment):
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"ROLcali_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -2423,7 +2657,7 @@ class ZgateEnergyRelaxation(ExpGovernment):
         
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # bias coupler
         self.Fctrl = coupler_zctrl(self.Fctrl,self.QD_agent.Fluxmanager.build_Cctrl_instructions([cp for cp in self.Fctrl if cp[0]=='c' or cp[:2]=='qc'],'i'))
         # offset bias, LO and atte
@@ -2439,24 +2673,28 @@ class ZgateEnergyRelaxation(ExpGovernment):
     
         dataset = Zgate_T1(self.QD_agent,self.meas_ctrl,self.time_samples,self.bias_samples,self.avg_n,self.execution,no_pi_pulse= not self.prepare_1)
         if self.execution:
-            if self.save_dir is not None:
+            if self.store is not None:
+                self.defer(self.store.append,"zgateT1",dataset)
+                self.__raw_data_location = self.store.path
+            elif self.save_dir is not None:
                 if self.want_while:
                     self.JOBID = None
                 self.save_path = os.path.join(self.save_dir,f"zgateT1_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                self.defer(dataset.to_netcdf,self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self, new_QD_path:str=None,new_file_path:str=None, time_dep_plot:bool=False):
         """ If new file path was given, check all the data in that folder. """
         
         if self.execution:
+            self.wait_saved()
             if new_QD_path is None:
                 QD_file = self.QD_path
             else:
@@ -2473,15 +2711,21 @@ class ZgateEnergyRelaxation(ExpGovernment):
             QD_savior.QD_loader()
 
 
-            nc_paths = ZgateT1_dataReducer(fig_path)
-            for q in nc_paths:
+            store_path = find_store(fig_path)
+            if store_path is None:
+                nc_paths = ZgateT1_dataReducer(fig_path)
+                datasets = {q: open_dataset(nc_paths[q]) for q in nc_paths}
+            else:
+                datasets = ZgateT1_dataView(store_path)
+                nc_paths = {q: os.path.join(fig_path,f"{q}_ZgateT1",f"{q}_Summaized_zT1.nc") for q in datasets}
+            for q in datasets:
                 if QD_savior.rotate_angle[q][0] != 0:
                     ref = QD_savior.rotate_angle[q]
                 else:
                     eyeson_print(f"{q} rotation angle is 0, use contrast to analyze.")
                     ref = QD_savior.refIQ[q]
 
-                ds = open_dataset(nc_paths[q])
+                ds = datasets[q]
                 ANA = Multiplex_analyzer("auxA")
                 ANA._import_data(ds,var_dimension=2,refIQ=ref)
                 ANA._start_analysis(time_sort=time_dep_plot)
@@ -2492,27 +2736,49 @@ class ZgateEnergyRelaxation(ExpGovernment):
     def WorkFlow(self, histo_counts:int=None):
         idx = 1
         start_time = datetime.now()
-        while True:
-            self.PrepareHardware()
-
-            self.RunMeasurement()
-
-            self.CloseMeasurement()  
-
-            slightly_print(f"It's the {idx}-th measurement, about {round((datetime.now() - start_time).total_seconds()/60,1)} mins recorded.")
-            
-            if histo_counts is not None:
-                # ensure the histo_counts you set is truly a number
-                try: 
-                    a = int(histo_counts)/100
-                    self.want_while = True
-                except:
-                    raise TypeError(f"The arg `histo_counts` you set is not a number! We see it's {type(histo_counts)}...")
-                if histo_counts == idx:
+        # the repeated measurements share one connection if there is no given session
+        own_session = self.session is None and (histo_counts is not None or self.want_while)
+        if own_session:
+            self.session = HardwareSession(self.QD_path)
+        # the repeated measurements are appended into one store
+        own_store = self.store is None and self.save_dir is not None and (histo_counts is not None or self.want_while)
+        if own_store:
+            self.store = MonitorStore(os.path.join(self.save_dir,store_name))
+        # and saved in background while the next one runs
+        own_pipeline = self.pipeline is None and (histo_counts is not None or self.want_while)
+        if own_pipeline:
+            self.pipeline = DataPipeline()
+        try:
+            while True:
+                self.PrepareHardware()
+
+                self.RunMeasurement()
+
+                self.CloseMeasurement()  
+
+                slightly_print(f"It's the {idx}-th measurement, about {round((datetime.now() - start_time).total_seconds()/60,1)} mins recorded.")
+                
+                if histo_counts is not None:
+                    # ensure the histo_counts you set is truly a number
+                    try: 
+                        a = int(histo_counts)/100
+                        self.want_while = True
+                    except:
+                        raise TypeError(f"The arg `histo_counts` you set is not a number! We see it's {type(histo_counts)}...")
+                    if histo_counts == idx:
+                        break
+                idx += 1
+                if not self.want_while:
                     break
-            idx += 1
-            if not self.want_while:
-                break
+        finally:
+            if own_session:
+                self.session.teardown()
+                self.session = None
+            if own_pipeline:
+                self.pipeline.close()
+                self.pipeline = None
+            if own_store:
+                self.store = None
             
                 
 class QubitMonitor():
@@ -2529,7 +2795,16 @@ class QubitMonitor():
         self.time_ptsORstep:int|float = 100
         self.OS_shots:int = 10000
         self.AVG:int = 300
+        self.early_stop:dict = None      # like {"block_avg":50, "snr":20}, the T1/CPMG average in blocks up to AVG and stop once it's met, see `SetEarlyStopping`
         self.idx = 0
+        self.keep_connection:bool = True # share one HardwareSession among all the experiments
+        self.session:HardwareSession = None
+        self.use_store:bool = True # append all the iterations into one MonitorStore in save_dir instead of a nc file for each
+        self.store:MonitorStore = None
+        self.pipeline_depth:int = 2      # how many saving/analysis jobs can wait in background, 0 to do them in the loop
+        self.live_analysis:bool = True   # analyze the new data incrementally in background after every iteration
+        self.pipeline:DataPipeline = None
+        self.tracer:PhaseTracer = PhaseTracer() # shared by all the experiments, its report aggregates the whole session
 
     def StartMonitoring(self):
         start_time = datetime.now()
@@ -2537,38 +2812,84 @@ class QubitMonitor():
         if self.T2_time_range is not None:
             for q in self.T2_time_range:
                 pi_num_dict[q] = self.echo_pi_num
-        while True:
-            if self.T1_time_range is not None:
-                if len(list(self.T1_time_range.keys())) != 0:
-                    EXP = EnergyRelaxation(QD_path=self.QD_path,data_folder=self.save_dir)
-                    EXP.SetParameters(self.T1_time_range,self.time_sampling_func,self.time_ptsORstep,1,self.AVG,self.Execution)
-                    EXP.WorkFlow()
-
-            if self.T2_time_range is not None:
-                if len(list(self.T2_time_range.keys())) != 0:
-                    EXP = CPMG(QD_path=self.QD_path,data_folder=self.save_dir)
-                    EXP.SetParameters(self.T2_time_range,pi_num_dict,self.time_sampling_func,self.time_ptsORstep,1,self.AVG,self.Execution)
-                    EXP.WorkFlow(freq_detune_Hz=self.a_little_detune_Hz)
-
-            if self.OS_target_qs is not None:
-                if  self.OS_shots != 0:
-                    if len(self.OS_target_qs) == 0:
-                        self.OS_target_qs = list(set(list(self.T1_time_range.keys())+list(self.T2_time_range.keys())))
-                    EXP = SingleShot(QD_path=self.QD_path,data_folder=self.save_dir)
-                    EXP.SetParameters(self.OS_target_qs,1,self.OS_shots,self.Execution)
-                    EXP.WorkFlow()
-            slightly_print(f"It's the {self.idx}-th measurement, about {round((datetime.now() - start_time).total_seconds()/3600,2)} hrs recorded.")
-            self.idx += 1
-
-    def TimeMonitor_analysis(self,New_QD_path:str=None,New_data_file:str=None,save_all_fit_fig:bool=False):
+        if self.keep_connection:
+            self.session = HardwareSession(self.QD_path)
+        if self.use_store and self.Execution:
+            self.store = MonitorStore(os.path.join(self.save_dir,store_name))
+        if self.pipeline_depth > 0:
+            self.pipeline = DataPipeline(max_pending=self.pipeline_depth)
+        try:
+            while True:
+                cycle_start = datetime.now()
+                with self.tracer.span("monitor_cycle", idx=self.idx):
+                    EXP, fq_Hz = None, {}
+                    if self.T1_time_range is not None:
+                        if len(list(self.T1_time_range.keys())) != 0:
+                            EXP = EnergyRelaxation(QD_path=self.QD_path,data_folder=self.save_dir)
+                            EXP.session = self.session
+                            EXP.store = self.store
+                            EXP.pipeline = self.pipeline
+                            EXP.tracer = self.tracer
+                            EXP.SetParameters(self.T1_time_range,self.time_sampling_func,self.time_ptsORstep,1,self.AVG,self.Execution)
+                            if self.early_stop is not None:
+                                EXP.SetEarlyStopping(**self.early_stop)
+                            EXP.WorkFlow()
+
+                    if self.T2_time_range is not None:
+                        if len(list(self.T2_time_range.keys())) != 0:
+                            EXP = CPMG(QD_path=self.QD_path,data_folder=self.save_dir)
+                            EXP.session = self.session
+                            EXP.store = self.store
+                            EXP.pipeline = self.pipeline
+                            EXP.tracer = self.tracer
+                            EXP.SetParameters(self.T2_time_range,pi_num_dict,self.time_sampling_func,self.time_ptsORstep,1,self.AVG,self.Execution)
+                            if self.early_stop is not None:
+                                EXP.SetEarlyStopping(**self.early_stop)
+                            EXP.WorkFlow(freq_detune_Hz=self.a_little_detune_Hz)
+
+                    if self.OS_target_qs is not None:
+                        if  self.OS_shots != 0:
+                            if len(self.OS_target_qs) == 0:
+                                self.OS_target_qs = list(set(list(self.T1_time_range.keys())+list(self.T2_time_range.keys())))
+                            EXP = SingleShot(QD_path=self.QD_path,data_folder=self.save_dir)
+                            EXP.session = self.session
+                            EXP.store = self.store
+                            EXP.pipeline = self.pipeline
+                            EXP.tracer = self.tracer
+                            EXP.SetParameters(self.OS_target_qs,1,self.OS_shots,self.Execution)
+                            EXP.WorkFlow()
+                            fq_Hz = {q: EXP.QD_agent.quantum_device.get_element(q).clock_freqs.f01() for q in self.OS_target_qs}
+                    if self.live_analysis and self.Execution and self.pipeline is not None and EXP is not None:
+                        self.pipeline.submit(in_context(time_monitor_data_ana,"analysis"),EXP.QD_agent,self.save_dir,fq_Hz=fq_Hz,name="analysis")
+                if self.Execution:
+                    self.tracer.flush(os.path.join(self.save_dir,"trace.jsonl"))
+                slightly_print(f"It's the {self.idx}-th measurement, about {round((datetime.now() - start_time).total_seconds()/3600,2)} hrs recorded.")
+                slightly_print(f"This cycle took {round((datetime.now() - cycle_start).total_seconds(),1)} s.")
+                if self.session is not None:
+                    self.session.timing_report()
+                if self.pipeline is not None:
+                    self.pipeline.report()
+                schedule_cache.report()
+                self.tracer.report(top=10)
+                self.idx += 1
+        finally:
+            if self.session is not None:
+                self.session.teardown()
+            if self.pipeline is not None:
+                self.pipeline.close()
+                self.pipeline = None
+
+    def TimeMonitor_analysis(self,New_QD_path:str=None,New_data_file:str=None,save_all_fit_fig:bool=False,incremental:bool=True):
         if New_QD_path is not None:
             self.QD_path = New_QD_path
         if New_data_file is not None:
             self.save_dir = os.path.split(New_data_file)[0]
 
+        if self.pipeline is not None:
+            self.pipeline.drain()
         QD_agent = QDmanager(self.QD_path)
         QD_agent.QD_loader()
-        time_monitor_data_ana(QD_agent,self.save_dir,save_all_fit_fig)
+        time_monitor_data_ana(QD_agent,self.save_dir,save_all_fit_fig,incremental)
 
 
 class DragCali(ExpGovernment):
@@ -2604,7 +2925,7 @@ class DragCali(ExpGovernment):
         
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # bias coupler
         self.Fctrl = coupler_zctrl(self.Fctrl,self.QD_agent.Fluxmanager.build_Cctrl_instructions([cp for cp in self.Fctrl if cp[0]=='c' or cp[:2]=='qc'],'i'))
         # offset bias, LO and atte
@@ -2624,13 +2945,14 @@ class DragCali(ExpGovernment):
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"DragCali_{datetime.now().strftime('%Y%m%d%H%M%S') if self.JOBID is None else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
                 
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -2669,16 +2991,10 @@ class DragCali(ExpGovernment):
             
             ds.close()
 
-            permi = mark_input(f"What qubit can be updated ? {list(answer.keys())}/ all/ no ").lower()
-            if permi in list(answer.keys()):
-                QD_savior.Waveformer.set_dragRatio_for(permi,answer[permi]["optimal_drag_coef"])
-                QD_savior.QD_keeper()
-            elif permi in ["all",'y','yes']:
-                for q in answer:
-                    QD_savior.Waveformer.set_dragRatio_for(q, answer[q]["optimal_drag_coef"])
-                QD_savior.QD_keeper()
-            else:
-                print("Updating got denied ~")
+            def updater(q:str, fit_packs:dict)->float:
+                QD_savior.Waveformer.set_dragRatio_for(q, fit_packs["optimal_drag_coef"])
+                return QD_savior.Waveformer.get_dragRatio_for(q)
+            self.update_qubits(QD_savior,answer,"Drag",updater,file_path)
 
     def WorkFlow(self):
         
@@ -2722,7 +3038,7 @@ class XGateErrorTest(ExpGovernment):
 
 
     def PrepareHardware(self):
-        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = init_meas(QuantumDevice_path=self.QD_path)
+        self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl = self.connect_hardware()
         # bias coupler
         self.Fctrl = coupler_zctrl(self.Fctrl,self.QD_agent.Fluxmanager.build_Cctrl_instructions([cp for cp in self.Fctrl if cp[0]=='c' or cp[:2]=='qc'],'i'))
         # offset bias, LO and driving atte
@@ -2743,12 +3059,13 @@ class XGateErrorTest(ExpGovernment):
             if self.save_dir is not None:
                 self.save_path = os.path.join(self.save_dir,f"XGateErrorTest_{datetime.now().strftime('%Y%m%d%H%M%S') if (self.JOBID is None or self.use_time_label) else self.JOBID}")
                 self.__raw_data_location = self.save_path + ".nc"
-                dataset.to_netcdf(self.__raw_data_location)
+                with trace("to_netcdf"):
+                    dataset.to_netcdf(self.__raw_data_location)
             else:
                 self.save_fig_path = None
         
     def CloseMeasurement(self):
-        shut_down(self.cluster,self.Fctrl)
+        self.release_hardware()
 
 
     def RunAnalysis(self,new_QD_path:str=None,new_file_path:str=None):
@@ -1,5 +1,6 @@
 from numpy import array, ndarray, sin, sqrt, cos, pi, real
 from qblox_drive_AS.support.UserFriend import *
+from qblox_drive_AS.support.FluxModel import flux_model, bias_for_fq
 
 # TODO: Test this class to store the bias info
 # dict to save the filux bias information
@@ -43,12 +44,7 @@ class FluxBiasDict():
         """
         Return the XYF curve data fit by quadratic about target_q with the bias array.
         """
-        def FqEqn(x,a,b,Ec,coefA,d):
-            """
-            a ~ period, b ~ offset, 
-            """
-            return sqrt(8*coefA*Ec*sqrt(cos(a*(x-b))**2+d**2*sin(a*(x-b))**2))-Ec
-        return FqEqn(bias_ary,*self.__bias_dict[target_q]["qubFitParas"])
+        return flux_model(self.__bias_dict[target_q]["qubFitParas"]).fq(bias_ary)
 
 
     def get_bias_dict(self)->dict:
@@ -185,27 +181,16 @@ class FluxBiasDict():
     def get_biasWithFq_from(self,target_q:str,target_fq_Hz:float, flux_guard:float=0.4):
         """
         After we fit the tarnsition freq vs bias, we can get the bias according to the given `target_fq_Hz` for the `target_q`.\n
-        ### The given `target_fq_Hz` should unit in Hz.\n
-        Return the bias unit in V.
+        ### The given `target_fq_Hz` should unit in Hz, it can be an array of the targets.\n
+        Return the bias unit in V, 'n' (or nan in the array) if the fq can't be reached.
         """
-        import sympy as sp
-        from qblox_drive_AS.support import find_nearest
-        z = sp.Symbol('z',real=True)
         if self.__bias_dict[target_q]["qubFitParas"] == []:
             raise ValueError("You have NOT fit the transition frequency with bias!")
 
-        a,b,Ec,Ej_sum,d = self.__bias_dict[target_q]["qubFitParas"][0], self.__bias_dict[target_q]["qubFitParas"][1], self.__bias_dict[target_q]["qubFitParas"][2], self.__bias_dict[target_q]["qubFitParas"][3], self.__bias_dict[target_q]["qubFitParas"][4]
-        to_solve = sp.sqrt(8*Ej_sum*Ec*sp.sqrt(sp.cos(a*(z-b))**2+d**2*sp.sin(a*(z-b))**2))-Ec - target_fq_Hz*1e-9
-
-        candidators = array(sp.solvers.solve(to_solve, z))
-        
-        if candidators.shape[0] == 0:
-            answer = 'n'
-            fq_max = self.fqEqn_for_qub(target_q,array([self.get_sweetBiasFor(target_q)]))[0]
+        answer = bias_for_fq(self.__bias_dict[target_q]["qubFitParas"], target_fq_Hz, flux_guard)
+        if isinstance(answer, str):
             warning_print(f"Can NOT find a bias makes the fq @ {target_fq_Hz*1e-9} GHz !")
-            warning_print(f"The max fq about this qubit = {fq_max} GHz")
-        else:
-            answer = find_nearest(candidators, 0) if abs(find_nearest(candidators, 0)) < flux_guard else flux_guard
+            warning_print(f"The max fq about this qubit = {flux_model(self.__bias_dict[target_q]['qubFitParas']).fq_max} GHz")
 
         return answer
 
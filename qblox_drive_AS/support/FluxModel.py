@@ -0,0 +1,86 @@
+"""
+Numeric flux-frequency model of a transmon, fq(z) = FqEqn(z, a, b, Ec, Ej_sum, d) in GHz with the `qubFitParas` [a, b, Ec, Ej_sum, d].\n
+Within a branch (half a period) the model is monotonic and invertible in closed form:
+(fq+Ec)^4 / (8 Ej_sum Ec)^2 = cos²(a(z-b)) + d² sin²(a(z-b)) = 1 - (1-d²) sin²(a(z-b)),
+so the biases of any array of target frequencies are found without a symbolic solve. The models are cached by their fitting parameters.
+"""
+from functools import lru_cache
+from numpy import ndarray, asarray, sqrt, cos, sin, arcsin, pi, round, where, abs, nan, isnan, clip
+
+
+def FqEqn(x,a,b,Ec,coefA,d):
+    """
+    a ~ period, b ~ offset,
+    """
+    return sqrt(8*coefA*Ec*sqrt(cos(a*(x-b))**2+d**2*sin(a*(x-b))**2))-Ec
+
+
+class FluxFqModel():
+    """
+    ### Example:\n
+    ```
+    model = flux_model(QD_agent.Fluxmanager.get_bias_dict()["q0"]["qubFitParas"])
+    fq_GHz = model.fq(bias_array)
+    bias = model.bias_for(array([4.2e9, 4.3e9]))   # nan for the frequencies out of the tunable range
+    ```
+    """
+    def __init__(self, paras:tuple):
+        if len(paras) != 5:
+            raise ValueError(f"The fitting parameters should be [a, b, Ec, Ej_sum, d], but got {list(paras)} !")
+        self.a, self.b, self.Ec, self.Ej_sum, self.d = [float(p) for p in paras]
+        self.period:float = pi/abs(self.a)                        # in bias, fq(z) = fq(z + period)
+        self.fq_max:float = float(FqEqn(self.b, *self.paras))     # at the sweet spot
+        self.fq_min:float = float(FqEqn(self.b + self.period/2, *self.paras))
+        self.__scale:float = 8*self.Ej_sum*self.Ec
+
+    @property
+    def paras(self)->tuple:
+        return (self.a, self.b, self.Ec, self.Ej_sum, self.d)
+
+    def fq(self, bias:ndarray)->ndarray:
+        """ fq (GHz) of the biases (V). """
+        return FqEqn(asarray(bias, dtype=float), *self.paras)
+
+    def phase_for(self, fq_GHz:ndarray)->ndarray:
+        """ |a(z-b)| in [0, pi/2] of the target fq (GHz) on the branch going down from the sweet spot, nan out of the tunable range. """
+        fq_GHz = asarray(fq_GHz, dtype=float)
+        S = (fq_GHz + self.Ec)**4/self.__scale**2
+        flatness = 1 - self.d**2
+        if abs(flatness) < 1e-15:
+            # a symmetric SQUID doesn't tune
+            return where(abs(fq_GHz - self.fq_max) < 1e-12, 0.0, nan)
+        sin2 = (1 - S)/flatness
+        inside = (sin2 >= -1e-12) & (sin2 <= 1 + 1e-12)
+        return where(inside, arcsin(sqrt(clip(sin2, 0, 1))), nan)
+
+    def bias_for(self, target_fq_Hz:ndarray, near:float=0.0)->ndarray:
+        """ The bias (V) giving the target fq (Hz) nearest to the bias `near` over all the branches, nan if it can't be reached. """
+        phase = self.phase_for(asarray(target_fq_Hz, dtype=float)*1e-9)
+        best = None
+        for sign in [1, -1]:
+            z = self.b + sign*phase/abs(self.a)
+            z = z + round((near - z)/self.period)*self.period
+            best = z if best is None else where(abs(z - near) < abs(best - near), z, best)
+        return best
+
+
+@lru_cache(maxsize=64)
+def _cached_model(paras:tuple)->FluxFqModel:
+    return FluxFqModel(paras)
+
+
+def flux_model(paras:list)->FluxFqModel:
+    """ The `FluxFqModel` of the `qubFitParas`, built once per set of parameters. """
+    return _cached_model(tuple(float(p) for p in paras))
+
+
+def bias_for_fq(paras:list, target_fq_Hz:ndarray|float, flux_guard:float=0.4):
+    """
+    The bias nearest to 0 V giving the `target_fq_Hz` with the fitting parameters [a, b, Ec, Ej_sum, d], clipped to `flux_guard`.\n
+    Returns 'n' for a single target which can't be reached, or nan in the array.
+    """
+    bias = flux_model(paras).bias_for(target_fq_Hz)
+    bias = where(isnan(bias) | (abs(bias) < flux_guard), bias, flux_guard)
+    if bias.ndim == 0:
+        return 'n' if isnan(bias) else float(bias)
+    return bias
@@ -0,0 +1,149 @@
+""" Keep the cluster, instrument coordinator, meas_ctrl and Fctrl alive across the ExpGovernment experiments """
+from time import perf_counter
+from typing import Tuple
+from qcodes import Instrument
+from qblox_instruments import Cluster
+from quantify_core.measurement.control import MeasurementControl
+from quantify_scheduler.instrument_coordinator import InstrumentCoordinator
+from qblox_drive_AS.support.QDmanager import QDmanager
+from qblox_drive_AS.support.UserFriend import *
+from qblox_drive_AS.support.PhaseTracer import traced
+from qblox_drive_AS.support import connect_cluster, configure_measurement_control_loop, QRM_nco_init, reset_offset, get_connected_modules
+
+
+def QD_instrument_names(QD_agent:QDmanager)->list:
+    return [QD_agent.quantum_device.name] + list(QD_agent.quantum_device.elements())
+
+
+def close_QD_instruments(names:list):
+    """ Close the quantum_device and its elements by their names, the next QD loading in this process complains about the names otherwise. """
+    for name in names:
+        try:
+            Instrument.find_instrument(name).close()
+        except KeyError:
+            pass
+
+
+class HardwareSession():
+    """
+    A long-lived hardware session shared by the experiments, the cluster is connected and fully reset only once.\n
+    Between experiments only the flux offsets which are not zero and the sequencers which are still synced will be reset.\n
+    The QD file is reloaded for every experiment, so the changes made in memory by the previous experiment will not leak into the next one.
+    ### Example:\n
+    ```
+    session = HardwareSession(QD_path)
+    EXP = EnergyRelaxation(QD_path=QD_path,data_folder=save_dir)
+    EXP.session = session
+    ...
+    EXP.WorkFlow()
+    session.teardown()
+    ```
+    """
+    def __init__(self, QD_path:str):
+        self.QD_path:str = QD_path
+        self.QD_agent:QDmanager = None
+        self.cluster:Cluster = None
+        self.meas_ctrl:MeasurementControl = None
+        self.ic:InstrumentCoordinator = None
+        self.Fctrl:dict = {}
+        self.__timings:dict = {"connect":[], "QD_load":[], "reset":[], "teardown":[]}
+
+    @property
+    def timings(self)->dict:
+        """ Elapsed seconds of each connect/QD_load/reset/teardown call, like {"connect":[12.3], "QD_load":[0.4, 0.4], ...} """
+        return self.__timings
+
+    @property
+    def is_connected(self)->bool:
+        return self.cluster is not None
+
+    def __load_QD(self):
+        """ Unpickle the QD file and associate its quantum_device with the kept meas_ctrl and ic. """
+        start = perf_counter()
+        self.__close_QD()
+        self.QD_agent = QDmanager(self.QD_path)
+        self.QD_agent.QD_loader()
+        if self.meas_ctrl is not None and self.ic is not None:
+            self.QD_agent.quantum_device.instr_measurement_control(self.meas_ctrl.name)
+            self.QD_agent.quantum_device.instr_instrument_coordinator(self.ic.name)
+        self.__timings["QD_load"].append(perf_counter()-start)
+
+    def __close_QD(self):
+        """ Close the quantum_device and its elements, otherwise the next unpickling complains about the instrument names. """
+        if self.QD_agent is not None and self.QD_agent.quantum_device_loaded:
+            close_QD_instruments(QD_instrument_names(self.QD_agent))
+        self.QD_agent = None
+
+    @traced("session_connect")
+    def connect(self)->Tuple[QDmanager, Cluster, MeasurementControl, InstrumentCoordinator, dict]:
+        """
+        Same returns as `init_meas()`. The cluster will be connected only at the first call, later calls only reload the QD file.
+        """
+        if not self.is_connected:
+            import quantify_core.data.handling as dh
+            dh.set_datadir('.data')
+            start = perf_counter()
+            self.__load_QD()
+            self.cluster = connect_cluster(self.QD_path, self.QD_agent)
+            QRM_nco_init(self.cluster)
+            self.Fctrl = self.QD_agent.activate_str_Fctrl(self.cluster)
+            self.meas_ctrl, self.ic = configure_measurement_control_loop(self.QD_agent.quantum_device, self.cluster)
+            reset_offset(self.Fctrl)
+            self.cluster.reset()
+            self.__timings["connect"].append(perf_counter()-start)
+            slightly_print(f"Hardware session connected in {round(self.__timings['connect'][-1],2)} sec.")
+        else:
+            self.__load_QD()
+
+        return self.QD_agent, self.cluster, self.meas_ctrl, self.ic, self.Fctrl
+
+    @traced("session_reset")
+    def reset(self):
+        """
+        Zero the flux offsets which were changed and stop the sequencers which are still synced.\n
+        The other sequencer settings will be overwritten by the instrument coordinator in the next run.
+        """
+        if not self.is_connected:
+            return
+        start = perf_counter()
+        for ch in self.Fctrl:
+            cache = getattr(self.Fctrl[ch], "cache", None)
+            if cache is None:
+                continue # `pass` Fctrl
+            last_value = cache.get(get_if_invalid=False)
+            if last_value is None or last_value != 0:
+                self.Fctrl[ch](0.0)
+
+        self.ic.stop()
+        for module in get_connected_modules(self.cluster, None).values():
+            for sequencer in module.sequencers:
+                if sequencer.sync_en.cache.get(get_if_invalid=False):
+                    sequencer.sync_en(False)
+        self.__close_QD()
+        self.__timings["reset"].append(perf_counter()-start)
+
+    def release(self):
+        """ Called by the experiment when it's finished, keep the connection and only reset what was changed. """
+        self.reset()
+
+    def teardown(self):
+        """ Disconnect all the instruments like `shut_down()` does. """
+        if not self.is_connected:
+            return
+        start = perf_counter()
+        reset_offset(self.Fctrl)
+        self.cluster.reset()
+        self.QD_agent = None
+        Instrument.close_all()
+        self.cluster, self.meas_ctrl, self.ic, self.Fctrl = None, None, None, {}
+        self.__timings["teardown"].append(perf_counter()-start)
+        eyeson_print(f"All instr are closed and zeroed all flux bias in {round(self.__timings['teardown'][-1],2)} sec!")
+
+    def timing_report(self)->dict:
+        """ Print and return the summary {"connect":{"count":1,"total":12.3,"mean":12.3}, ...} in seconds. """
+        report = {}
+        for phase in self.__timings:
+            records = self.__timings[phase]
+            report[phase] = {"count":len(records), "total":sum(records), "mean":sum(records)/len(records) if len(records) != 0 else 0}
+            slightly_print(f"{phase}: {report[phase]['count']} times, total {round(report[phase]['total'],2)} sec, mean {round(report[phase]['mean'],2)} sec")
+        return report
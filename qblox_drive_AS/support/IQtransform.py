@@ -0,0 +1,186 @@
+"""
+Batched IQ transforms. All the functions take N-dimensional arrays with a mixer axis (I, Q) and work on every other axis in one numpy call,
+so the analyzers don't have to loop over the bias slices, repeats or prepared states.\n
+xarray `DataArray` is accepted, the mixer axis is found by the dim named "mixer" and the coords of the other dims are kept in the returns.\n
+For multi-qubit, stack the qubits on the leading axis and give the angles/refIQ per qubit, like data in (qubit, mixer, ...) with angles in (qubit,).
+"""
+from time import perf_counter
+from numpy import ndarray, asarray, cos, sin, pi, sqrt, arctan2, moveaxis, stack, random, array, exp, real, imag
+from xarray import DataArray, Dataset
+from qblox_drive_AS.support.UserFriend import *
+
+
+def _mixer_axis(data, mixer_axis:int)->int:
+    if isinstance(data, DataArray) and "mixer" in data.dims:
+        return data.dims.index("mixer")
+    return mixer_axis
+
+
+def _per_leading_axes(para, ndim:int)->ndarray:
+    """ Broadcast the per-qubit parameter (qubit,) onto the leading axes of the data without the mixer axis. """
+    para = asarray(para, dtype=float)
+    return para.reshape(para.shape + (1,)*(ndim-para.ndim))
+
+
+def _wrap(result:ndarray, data, mixer_axis:int, keep_mixer:bool):
+    """ Give the coords back if the input is a DataArray. """
+    if not isinstance(data, DataArray):
+        return result
+    if keep_mixer:
+        return data.copy(data=result)
+    dims = list(data.dims)
+    dims.pop(mixer_axis)
+    return DataArray(result, coords={d: data.coords[d] for d in data.coords if set(data.coords[d].dims).issubset(dims)}, dims=dims, name=data.name, attrs=data.attrs)
+
+
+def split_IQ(data, mixer_axis:int=0)->tuple[ndarray,ndarray]:
+    """ Views of I and Q without copy. """
+    mixer_axis = _mixer_axis(data, mixer_axis)
+    values = data.values if isinstance(data, DataArray) else asarray(data)
+    I, Q = moveaxis(values, mixer_axis, 0)
+    return I, Q
+
+
+def rotate_IQ(data, angle_degree, mixer_axis:int=0, inplace:bool=False):
+    """
+    Rotate the IQ points by -angle (same as `S21*exp(-1j*angle)`).\n
+    ### Args:\n
+    * data: array in (..., mixer, ...), the mixer axis is given by `mixer_axis` or the "mixer" dim of a DataArray.\n
+    * angle_degree: a float or the angles for the leading axes, like (qubit,).\n
+    * inplace: write the rotated values back into `data` if it's a float numpy array (or DataArray holds one).
+    """
+    mixer_axis = _mixer_axis(data, mixer_axis)
+    original = data.values if isinstance(data, DataArray) else data
+    if inplace and isinstance(original, ndarray) and original.dtype.kind == 'f':
+        values = original
+    else:
+        values = asarray(original, dtype=float).copy()
+    I, Q = moveaxis(values, mixer_axis, 0)
+    angle = _per_leading_axes(angle_degree, I.ndim)*pi/180
+    c, s = cos(angle), sin(angle)
+
+    I_copy = I.copy()
+    I *= c
+    I += Q*s
+    Q *= c
+    Q -= I_copy*s
+
+    if values is original:
+        return data
+    return _wrap(values, data, mixer_axis, keep_mixer=True)
+
+
+def rotated_I(data, angle_degree, mixer_axis:int=0):
+    """ Only the I part after the rotation, which is what the analyzers fit. Cheaper than `rotate_IQ()[0]`. """
+    mixer_axis = _mixer_axis(data, mixer_axis)
+    I, Q = split_IQ(data, mixer_axis)
+    angle = _per_leading_axes(angle_degree, I.ndim)*pi/180
+    return _wrap(I*cos(angle) + Q*sin(angle), data, mixer_axis, keep_mixer=False)
+
+
+def IQ_distance(data, refIQ, mixer_axis:int=0):
+    """ The distance to the reference IQ point, refIQ = [I, Q] or the points for the leading axes in (qubit, 2). """
+    mixer_axis = _mixer_axis(data, mixer_axis)
+    I, Q = split_IQ(data, mixer_axis)
+    refIQ = asarray(refIQ, dtype=float)
+    ref_I, ref_Q = moveaxis(refIQ, -1, 0)
+    ref_I, ref_Q = _per_leading_axes(ref_I, I.ndim), _per_leading_axes(ref_Q, I.ndim)
+    return _wrap(sqrt((I-ref_I)**2 + (Q-ref_Q)**2), data, mixer_axis, keep_mixer=False)
+
+
+def IQ_contrast(data, refIQ:list, mixer_axis:int=0):
+    """
+    The signal the analyzers fit, follows the refIQ convention in QDmanager:\n
+    * refIQ = [I, Q]: the distance to this point.\n
+    * refIQ = [angle_degree]: the I after rotating by this angle.
+    """
+    if len(refIQ) == 2:
+        return IQ_distance(data, refIQ, mixer_axis)
+    return rotated_I(data, float(refIQ[0]), mixer_axis)
+
+
+def project_IQ(data, point_0, point_1, mixer_axis:int=0):
+    """
+    Project the IQ points onto the line from `point_0` to `point_1` (like the |0> and |1> centers), 0 at point_0 and 1 at point_1.\n
+    The points can also be given for the leading axes in (qubit, 2).
+    """
+    mixer_axis = _mixer_axis(data, mixer_axis)
+    I, Q = split_IQ(data, mixer_axis)
+    point_0, point_1 = asarray(point_0, dtype=float), asarray(point_1, dtype=float)
+    vector = point_1 - point_0
+    norm = (vector**2).sum(axis=-1)
+    I0, Q0 = [_per_leading_axes(v, I.ndim) for v in moveaxis(point_0, -1, 0)]
+    vI, vQ = [_per_leading_axes(v/norm, I.ndim) for v in moveaxis(vector, -1, 0)]
+    return _wrap((I-I0)*vI + (Q-Q0)*vQ, data, mixer_axis, keep_mixer=False)
+
+
+def rotate_angle_between(point_0, point_1)->ndarray:
+    """ The angle in degree which rotates the line from point_0 to point_1 onto the I axis, points can be in (qubit, 2). """
+    vector = asarray(point_1, dtype=float) - asarray(point_0, dtype=float)
+    return arctan2(vector[..., 1], vector[..., 0])*180/pi
+
+
+def multi_qubit_contrast(ds:Dataset, refIQ:dict, qubits:list=None)->dict:
+    """
+    Contrast for all the qubits in the dataset, the qubits sharing the same data shape and refIQ convention are stacked and done in one call.\n
+    ### Args:\n
+    * ds: the dataset with the variables named by qubits in (mixer, ...).\n
+    * refIQ: {"q0":[angle] or [I, Q], ...}\n
+    * qubits: the variables to do, default are all in refIQ.
+    ### Returns:\n
+    {"q0": ndarray, ...}
+    """
+    qubits = [q for q in refIQ if q in ds.data_vars] if qubits is None else qubits
+    groups = {}
+    for q in qubits:
+        groups.setdefault((ds[q].shape, len(refIQ[q])), []).append(q)
+
+    ans = {}
+    for (shape, ref_len), group in groups.items():
+        stacked = stack([ds[q].values for q in group])  # (qubit, mixer, ...)
+        refs = array([refIQ[q] for q in group], dtype=float)
+        if ref_len == 2:
+            contrast = IQ_distance(stacked, refs, mixer_axis=1)
+        else:
+            contrast = rotated_I(stacked, refs[:, 0], mixer_axis=1)
+        for idx, q in enumerate(group):
+            ans[q] = contrast[idx]
+    return ans
+
+
+def benchmark_IQtransform(shots:int=1000000, states:int=2, qubits:int=1, repeat:int=5)->dict:
+    """
+    Microbenchmark on the single-shot like arrays in (mixer, state, shots) per qubit, compare the list round-trip rotation with the batched one.\n
+    Return the best time in seconds of each method.
+    """
+    data = random.normal(size=(qubits, 2, states, shots))
+    angles = random.uniform(-180, 180, qubits)
+
+    def legacy():
+        for q_idx in range(qubits):
+            for state_data in moveaxis(data[q_idx], 1, 0):
+                S21 = (state_data[0] + 1j*state_data[1])*exp(-1j*angles[q_idx]*pi/180)
+                array([real(S21).tolist(), imag(S21).tolist()])
+
+    methods = {
+        "legacy_rotate_data": legacy,
+        "rotate_IQ": lambda: rotate_IQ(data, angles, mixer_axis=1),
+        "rotate_IQ_inplace": lambda: rotate_IQ(data, 0, mixer_axis=1, inplace=True),
+        "rotated_I": lambda: rotated_I(data, angles, mixer_axis=1),
+        "IQ_distance": lambda: IQ_distance(data, random.normal(size=(qubits, 2)), mixer_axis=1),
+        "project_IQ": lambda: project_IQ(data, random.normal(size=(qubits, 2)), random.normal(size=(qubits, 2)), mixer_axis=1),
+    }
+    ans = {}
+    for name, method in methods.items():
+        records = []
+        for _ in range(repeat):
+            start = perf_counter()
+            method()
+            records.append(perf_counter()-start)
+        ans[name] = min(records)
+        slightly_print(f"{name}: {round(ans[name]*1000,2)} ms for {qubits} qubits x {states} states x {shots} shots")
+    return ans
+
+
+if __name__ == "__main__":
+    benchmark_IQtransform()
@@ -0,0 +1,203 @@
+"""
+Append-only store for the repeated measurements (time monitor, histo_counts, z-gate T1 while-loop), one HDF5 file instead of one `.nc` per iteration.\n
+Every experiment is a group, its variables are kept with an unlimited leading `end_time` axis chunked per iteration, so an append only writes
+the new iteration and a reader only touches the iterations (and the variables) it asks for:\n
+```
+/<exp>/end_time        (N,) str, the attrs["end_time"] of each iteration
+/<exp>/attrs           (N,) str, the json of the dataset attrs of each iteration
+/<exp>/var_attrs       (N,) str, the json of {var: attrs} of each iteration
+/<exp>/vars/<var>      (N, ...) with the attr "dims"
+/<exp>/coords/<dim>    the coords of the other dims, kept from the first iteration
+```
+The file is opened only during an append or a read (`iter_datasets` opens it for every iteration it yields), so the analysis and
+the running monitor can take turns on it.
+"""
+import os, json
+from datetime import datetime
+import h5py
+from numpy import ndarray, array, asarray, arange, where, ones, all as np_all, diff, generic
+from xarray import Dataset, open_dataset
+from qblox_drive_AS.support.UserFriend import *
+
+store_name:str = "Monitor.h5"
+time_format:str = "%Y-%m-%d %H:%M:%S"
+
+
+def _jsonable(value):
+    if isinstance(value, ndarray):
+        return value.tolist()
+    if isinstance(value, generic):
+        return value.item()
+    return str(value)
+
+
+def find_store(folder_path:str)->str:
+    """ The store path in the folder, None if there isn't one. """
+    path = os.path.join(folder_path, store_name)
+    return path if os.path.isfile(path) else None
+
+
+def open_raw_data(path:str, exp:str)->Dataset:
+    """ Open the raw data saved by an ExpGovernment, the last iteration of `exp` if it's saved in a MonitorStore. """
+    if os.path.splitext(path)[-1].lower() == os.path.splitext(store_name)[-1]:
+        store = MonitorStore(path)
+        return store.load(exp, indices=[store.count(exp)-1]).isel(end_time=0, drop=True)
+    return open_dataset(path)
+
+
+class MonitorStore():
+    """
+    ### Example:\n
+    ```
+    store = MonitorStore(os.path.join(save_dir, store_name))
+    store.append("T1", dataset)                                  # every iteration
+    store.load("T1", qubits=["q0"], start="2025-01-20 22:00:00") # (end_time, mixer, repeat, idx) of q0 after 22:00
+    for ds in store.iter_datasets("SingleShot"): ...             # the iterations like the old nc files
+    ```
+    """
+    def __init__(self, path:str):
+        self.path:str = path
+        folder = os.path.split(path)[0]
+        if folder != "" and not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def experiments(self)->list:
+        if not os.path.isfile(self.path):
+            return []
+        with h5py.File(self.path, "r") as f:
+            return list(f.keys())
+
+    def count(self, exp:str)->int:
+        """ How many iterations were appended to this experiment. """
+        if exp not in self.experiments():
+            return 0
+        with h5py.File(self.path, "r") as f:
+            return f[exp]["end_time"].shape[0]
+
+    def append(self, exp:str, dataset:Dataset, end_time:str=None)->int:
+        """
+        Append one iteration, return its index.\n
+        ### Args:\n
+        * exp: the experiment name, like "T1", "CPMG", "SingleShot", "zgateT1".\n
+        * dataset: the dataset of this iteration, the variables should keep the same shapes as the first iteration.\n
+        * end_time: default is `dataset.attrs["end_time"]` or now.
+        """
+        end_time = dataset.attrs.get("end_time", datetime.now().strftime(time_format)) if end_time is None else end_time
+        attrs_json = json.dumps(dict(dataset.attrs), default=_jsonable)
+        var_attrs_json = json.dumps({var:dict(dataset[var].attrs) for var in dataset.data_vars}, default=_jsonable)
+        with h5py.File(self.path, "a") as f:
+            if exp not in f:
+                group = f.create_group(exp)
+                group.create_dataset("end_time", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype())
+                group.create_dataset("attrs", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype())
+                group.create_dataset("var_attrs", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype())
+                coords = group.create_group("coords")
+                for name in dataset.coords:
+                    values = asarray(dataset.coords[name].values)
+                    coords.create_dataset(name, data=values.astype(h5py.string_dtype()) if values.dtype.kind in "UO" else values)
+                variables = group.create_group("vars")
+                for var in dataset.data_vars:
+                    values = asarray(dataset[var].values)
+                    h5var = variables.create_dataset(var, shape=(0,)+values.shape, maxshape=(None,)+values.shape, chunks=(1,)+values.shape, dtype=values.dtype)
+                    h5var.attrs["dims"] = json.dumps(list(dataset[var].dims))
+            group = f[exp]
+            idx = group["end_time"].shape[0]
+            if "var_attrs" not in group:
+                # stored before the variable attrs were kept per iteration
+                group.create_dataset("var_attrs", data=["{}"]*idx, maxshape=(None,), dtype=h5py.string_dtype())
+            for var in group["vars"]:
+                if var not in dataset.data_vars:
+                    raise KeyError(f"{var} is missing in this iteration of {exp}, the store needs the same variables every time !")
+                h5var = group["vars"][var]
+                values = asarray(dataset[var].values)
+                if values.shape != h5var.shape[1:]:
+                    raise ValueError(f"{exp}/{var} shape = {values.shape} is different from the stored {h5var.shape[1:]} !")
+                h5var.resize(idx+1, axis=0)
+                h5var[idx] = values
+            for name, value in [("end_time", end_time), ("attrs", attrs_json), ("var_attrs", var_attrs_json)]:
+                group[name].resize(idx+1, axis=0)
+                group[name][idx] = value
+        return idx
+
+    def end_times(self, exp:str)->ndarray:
+        with h5py.File(self.path, "r") as f:
+            return f[exp]["end_time"].asstr()[()]
+
+    def select(self, exp:str, start:str=None, stop:str=None)->ndarray:
+        """ Indices of the iterations with `start` <= end_time <= `stop` (in "%Y-%m-%d %H:%M:%S"), all if both are None. """
+        end_times = self.end_times(exp)
+        if start is None and stop is None:
+            return arange(end_times.shape[0])
+        times = array([datetime.strptime(t, time_format) for t in end_times])
+        mask = ones(times.shape[0], dtype=bool)
+        if start is not None:
+            mask &= times >= datetime.strptime(start, time_format)
+        if stop is not None:
+            mask &= times <= datetime.strptime(stop, time_format)
+        return where(mask)[0]
+
+    def iteration_attrs(self, exp:str, indices:list=None)->list:
+        """ The dataset attrs of the iterations, all if `indices` is None. """
+        with h5py.File(self.path, "r") as f:
+            attrs = f[exp]["attrs"].asstr()
+            indices = range(f[exp]["attrs"].shape[0]) if indices is None else indices
+            return [json.loads(attrs[int(i)]) for i in indices]
+
+    @staticmethod
+    def __read(h5var, indices:ndarray):
+        """ Read the iterations by a slice when they are contiguous, it's the cheapest for the chunked layout. """
+        if indices.shape[0] != 0 and np_all(diff(indices) == 1):
+            return h5var[int(indices[0]):int(indices[-1])+1]
+        return h5var[list(indices)]
+
+    def __variables(self, group, variables:list=None, qubits:list=None)->list:
+        names = list(group["vars"].keys()) if variables is None else variables
+        if qubits is not None:
+            names = [var for var in names if var.split("_")[0] in qubits]
+        return names
+
+    def __build(self, group, indices:ndarray, variables:list=None, qubits:list=None, end_time_dim:bool=True)->Dataset:
+        """ The attrs of the dataset and its variables are the ones of the first iteration in `indices`. """
+        data_vars, used_dims = {}, set()
+        var_attrs = {}
+        if indices.shape[0] != 0 and "var_attrs" in group:
+            var_attrs = json.loads(group["var_attrs"].asstr()[int(indices[0])])
+        for var in self.__variables(group, variables, qubits):
+            h5var = group["vars"][var]
+            dims = json.loads(h5var.attrs["dims"])
+            used_dims.update(dims)
+            if end_time_dim:
+                data_vars[var] = (["end_time"]+dims, self.__read(h5var, indices), var_attrs.get(var, {}))
+            else:
+                data_vars[var] = (dims, h5var[int(indices[0])], var_attrs.get(var, {}))
+        coords = {"end_time": group["end_time"].asstr()[()][indices]} if end_time_dim else {}
+        for name in group["coords"]:
+            if name in used_dims:
+                h5coord = group["coords"][name]
+                coords[name] = h5coord.asstr()[()] if h5py.check_string_dtype(h5coord.dtype) else h5coord[()]
+        attrs = json.loads(group["attrs"].asstr()[int(indices[0])]) if indices.shape[0] != 0 else {}
+        return Dataset(data_vars=data_vars, coords=coords, attrs=attrs)
+
+    def load(self, exp:str, variables:list=None, qubits:list=None, start:str=None, stop:str=None, indices:list=None)->Dataset:
+        """
+        Read the iterations into a Dataset with the leading `end_time` dim, only the asked variables and iterations are read from the file.\n
+        ### Args:\n
+        * variables: like ["q0", "q0_x"], all if None.\n
+        * qubits: keep only the variables of these qubits (named "q0" or "q0_xxx").\n
+        * start, stop: the end_time window in "%Y-%m-%d %H:%M:%S".\n
+        * indices: the iteration indices, it overrides the time window.
+        ### Returns:\n
+        The attrs are the ones of the first selected iteration.
+        """
+        indices = self.select(exp, start, stop) if indices is None else asarray(indices, dtype=int)
+        with h5py.File(self.path, "r") as f:
+            return self.__build(f[exp], indices, variables, qubits)
+
+    def iter_datasets(self, exp:str, start:str=None, stop:str=None, qubits:list=None, indices:list=None):
+        """ Yield the iterations one by one as the Dataset it was appended (without the end_time dim), `indices` overrides the time window. """
+        indices = self.select(exp, start, stop) if indices is None else asarray(indices, dtype=int)
+        for idx in indices:
+            # the file isn't held between the yields, the monitor can still append to it
+            with h5py.File(self.path, "r") as f:
+                dataset = self.__build(f[exp], asarray([idx]), qubits=qubits, end_time_dim=False)
+            yield dataset
@@ -0,0 +1,235 @@
+"""
+Group the qubits into the fewest batches which can be measured together in one multiplexed schedule.\n
+Two qubits conflict (can't be in the same batch) when:\n
+* they share a readout output, and their readout frequencies (with the sweep windows if given) are closer than `ro_spacing` or their RO attenuations differ,\n
+* they share a drive output, and they need different LOs (f01 - xy IF) or their f01 are closer than `xy_spacing`,\n
+* they share a flux output.\n
+And a batch can't use more sequencers (port-clocks) of a module than `max_sequencers`. The batches are a coloring of the conflict graph,
+solved exactly by branch and bound for a few qubits and by DSatur greedy for the more.
+"""
+from qblox_drive_AS.support.UserFriend import *
+from qblox_drive_AS.support.QDmanager import QDmanager, find_path_by_port, find_path_by_clock
+from qblox_drive_AS.support.HardwareSession import HardwareSession, QD_instrument_names, close_QD_instruments
+
+
+class MultiplexPlanner():
+    """
+    ### Example:\n
+    ```
+    planner = MultiplexPlanner(QD_agent)
+    batches = planner.plan(["q0","q1","q2","q3"])             # like [["q0","q2"], ["q1","q3"]]
+    for elements in split_elements(freq_range, batches):      # the sub dicts for SetParameters
+        ...
+    ```
+    ### Args:\n
+    * ro_spacing: the minimum distance (Hz) between the readout frequencies on the same output.\n
+    * xy_spacing: the minimum distance (Hz) between the f01 on the same drive output.\n
+    * lo_tolerance: the qubits on the same drive output should ask for the LOs within it (Hz).\n
+    * nco_range: the IF limit (Hz) of a readout output, the qubits out of LO ± nco_range are warned.\n
+    * max_sequencers: the sequencers of a module.\n
+    * exact_limit: up to this number of qubits, the fewest batches are searched exactly.
+    """
+    def __init__(self, QD_agent:QDmanager, ro_spacing:float=2e6, xy_spacing:float=10e6, lo_tolerance:float=1e6, nco_range:float=500e6, max_sequencers:int=6, exact_limit:int=16):
+        self.QD_agent:QDmanager = QD_agent
+        self.ro_spacing:float = ro_spacing
+        self.xy_spacing:float = xy_spacing
+        self.lo_tolerance:float = lo_tolerance
+        self.nco_range:float = nco_range
+        self.max_sequencers:int = max_sequencers
+        self.exact_limit:int = exact_limit
+        self.reasons:dict = {}   # {(q, q'): why they conflict}
+
+        hcfg = QD_agent.quantum_device.hardware_config()
+        self.__ro_paths:dict = self.__paths(find_path_by_port, hcfg, ":res")
+        self.__xy_paths:dict = self.__paths(find_path_by_port, hcfg, ":mw")
+        self.__z_paths:dict = self.__paths(find_path_by_clock, hcfg, ":fl", "cl0.baseband")
+        self.__lo:dict = {}
+        for cluster in [key for key in hcfg if isinstance(hcfg[key], dict)]:
+            for module in [key for key in hcfg[cluster] if isinstance(hcfg[cluster][key], dict)]:
+                for output in [key for key in hcfg[cluster][module] if isinstance(hcfg[cluster][module][key], dict)]:
+                    self.__lo[(module, output)] = hcfg[cluster][module][output].get("lo_freq", None)
+
+    @staticmethod
+    def __paths(finder:callable, hcfg:dict, *port_clock)->dict:
+        try:
+            return {q: tuple(path) for q, path in finder(hcfg, *port_clock).items()}
+        except KeyError:
+            return {}
+
+    def resources(self, q:str)->dict:
+        """ {"ro", "xy", "z": (module, output) or None, "rof", "f01", "xy_lo", "ro_att"} of the qubit. """
+        qubit = self.QD_agent.quantum_device.get_element(q)
+        rof, f01 = qubit.clock_freqs.readout(), qubit.clock_freqs.f01()
+        try:
+            xy_lo = f01 - self.QD_agent.Notewriter.get_xyIFFor(q)
+        except KeyError:
+            xy_lo = None
+        try:
+            ro_att = self.QD_agent.Notewriter.get_DigiAtteFor(q, 'ro')
+        except KeyError:
+            ro_att = None
+        return {"ro":self.__ro_paths.get(q), "xy":self.__xy_paths.get(q), "z":self.__z_paths.get(q), "rof":rof, "f01":f01, "xy_lo":xy_lo, "ro_att":ro_att}
+
+    def __conflict(self, a:dict, b:dict, window_a:list, window_b:list)->str:
+        """ Why the two qubits can't be together, "" if they can. """
+        if a["ro"] is not None and a["ro"] == b["ro"]:
+            low_a, high_a = a["rof"]+window_a[0], a["rof"]+window_a[1]
+            low_b, high_b = b["rof"]+window_b[0], b["rof"]+window_b[1]
+            if min(high_a, high_b) - max(low_a, low_b) > -self.ro_spacing:
+                return f"readout frequencies collide on {a['ro'][0]}"
+            if a["ro_att"] != b["ro_att"]:
+                return f"different RO attenuations on {a['ro'][0]}"
+        if a["xy"] is not None and a["xy"] == b["xy"]:
+            if a["xy_lo"] is None or b["xy_lo"] is None or abs(a["xy_lo"]-b["xy_lo"]) > self.lo_tolerance:
+                return f"different drive LOs on {a['xy'][0]} {a['xy'][1]}"
+            if abs(a["f01"]-b["f01"]) < self.xy_spacing:
+                return f"drive frequencies collide on {a['xy'][0]} {a['xy'][1]}"
+        if a["z"] is not None and a["z"] == b["z"]:
+            return f"the same flux output {a['z'][0]} {a['z'][1]}"
+        return ""
+
+    def conflicts(self, qubits:list, ro_windows:dict=None)->dict:
+        """ {q: [the qubits it conflicts with]}, `ro_windows` = {q: [start offset, end offset]} of the readout sweeps. """
+        windows = {q: [0, 0] if ro_windows is None or q not in ro_windows else list(ro_windows[q]) for q in qubits}
+        self.__res = {q: self.resources(q) for q in qubits}
+        for q in qubits:
+            lo = self.__lo.get(self.__res[q]["ro"])
+            if lo is not None and abs(self.__res[q]["rof"]-lo) > self.nco_range:
+                warning_print(f"{q} readout {round(self.__res[q]['rof']*1e-9,3)} GHz is out of the NCO range of LO = {round(lo*1e-9,3)} GHz !")
+        graph, self.reasons = {q: [] for q in qubits}, {}
+        for i, a in enumerate(qubits):
+            for b in qubits[i+1:]:
+                reason = self.__conflict(self.__res[a], self.__res[b], windows[a], windows[b])
+                if reason != "":
+                    graph[a].append(b)
+                    graph[b].append(a)
+                    self.reasons[(a, b)] = reason
+        return graph
+
+    def __fits(self, q:str, batch:list, graph:dict)->bool:
+        if any([p in graph[q] for p in batch]):
+            return False
+        # every port-clock takes a sequencer of its module
+        used = {}
+        for p in batch + [q]:
+            for role in ["ro", "xy", "z"]:
+                if self.__res[p][role] is not None:
+                    used[self.__res[p][role][0]] = used.get(self.__res[p][role][0], 0) + 1
+        return all([num <= self.max_sequencers for num in used.values()])
+
+    def __dsatur(self, qubits:list, graph:dict)->list:
+        batches, placed = [], {}
+        while len(placed) < len(qubits):
+            free = [q for q in qubits if q not in placed]
+            # the most saturated qubit first, then the most conflicted
+            q = max(free, key=lambda q: (len(set([placed[p] for p in graph[q] if p in placed])), len(graph[q])))
+            for idx, batch in enumerate(batches):
+                if self.__fits(q, batch, graph):
+                    batch.append(q)
+                    placed[q] = idx
+                    break
+            else:
+                batches.append([q])
+                placed[q] = len(batches)-1
+        return batches
+
+    def __exact(self, qubits:list, graph:dict, best:list, budget:int=200000)->list:
+        order = sorted(qubits, key=lambda q: -len(graph[q]))
+        best, steps = [list(batch) for batch in best], [0]
+        def place(i:int, batches:list):
+            nonlocal best
+            steps[0] += 1
+            if len(batches) >= len(best) or steps[0] > budget:
+                return
+            if i == len(order):
+                best = [list(batch) for batch in batches]
+                return
+            q = order[i]
+            for batch in batches:
+                if self.__fits(q, batch, graph):
+                    batch.append(q)
+                    place(i+1, batches)
+                    batch.pop()
+            batches.append([q])
+            place(i+1, batches)
+            batches.pop()
+        place(0, [])
+        return best
+
+    def plan(self, qubits:list, ro_windows:dict=None)->list:
+        """ The batches [[q, ...], ...] covering all the `qubits`, the fewest as possible. """
+        qubits = list(qubits)
+        if len(qubits) == 0:
+            return []
+        graph = self.conflicts(qubits, ro_windows)
+        batches = self.__dsatur(qubits, graph)
+        if len(qubits) <= self.exact_limit:
+            batches = self.__exact(qubits, graph, batches)
+        batches = sorted([sorted(batch, key=qubits.index) for batch in batches], key=lambda batch: qubits.index(batch[0]))
+        for (a, b), reason in self.reasons.items():
+            eyeson_print(f"{a} and {b} are separated: {reason}")
+        slightly_print(f"{len(qubits)} qubits in {len(batches)} multiplexed batches: {batches}")
+        return batches
+
+
+def split_elements(elements:dict, batches:list)->list:
+    """ Split the qubit dict given to a multiplexed experiment by the batches, like {"q0":..., "q1":...} -> [{"q0":...}, {"q1":...}]. """
+    return [{q: elements[q] for q in batch if q in elements} for batch in batches if any([q in elements for q in batch])]
+
+
+def plan_batches(QD_path:str, qubits:list, ro_windows:dict=None, **kwargs)->list:
+    """ Load the QD and plan the batches, the kwargs go to `MultiplexPlanner`. """
+    QD_agent = QDmanager(QD_path)
+    QD_agent.QD_loader()
+    names = QD_instrument_names(QD_agent)
+    try:
+        return MultiplexPlanner(QD_agent, **kwargs).plan(qubits, ro_windows)
+    finally:
+        close_QD_instruments(names)
+
+
+def run_in_batches(Experiment:type, QD_path:str, data_folder:str, elements:dict, params:callable, analysis:bool=False, session:HardwareSession=None, ro_windows:dict=None, **kwargs)->list:
+    """
+    Run a multiplexed experiment once per planned batch instead of once per qubit.
+
+    ### Args:
+
+    * Experiment: the ExpGovernment class, like `ROFcali`.
+
+    * elements: the qubit dict to split, like {"q0":[-5e6,5e6], "q1":[-5e6,5e6]}.
+
+    * params: `params(sub_elements)` -> (args, kwargs) of `SetParameters` for a batch.
+
+    * analysis: also run `RunAnalysis()` after every batch.
+
+    * the kwargs go to `MultiplexPlanner`.
+    ### Returns:
+
+    The experiments of the batches.
+    """
+    batches = plan_batches(QD_path, list(elements.keys()), ro_windows, **kwargs)
+    QD_agent = QDmanager(QD_path)
+    QD_agent.QD_loader()
+    names = QD_instrument_names(QD_agent)
+    close_QD_instruments(names)
+
+    own_session = session is None
+    if own_session:
+        session = HardwareSession(QD_path)
+    EXPs = []
+    try:
+        for sub_elements in split_elements(elements, batches):
+            highlight_print(f"Multiplexed batch: {list(sub_elements.keys())}")
+            EXP = Experiment(QD_path=QD_path, data_folder=data_folder)
+            EXP.session = session
+            args, kwargs = params(sub_elements)
+            EXP.SetParameters(*args, **kwargs)
+            EXP.WorkFlow()
+            if analysis:
+                EXP.RunAnalysis()
+                close_QD_instruments(names)
+            EXPs.append(EXP)
+    finally:
+        if own_session:
+            session.teardown()
+    return EXPs
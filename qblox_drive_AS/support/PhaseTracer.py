@@ -0,0 +1,228 @@
+"""
+Nested timing spans for the phases of the experiments (QD loading, cluster connect, compile, upload, hardware run, saving, fitting, plotting).\n
+Every span records its wall time, the CPU time of its thread and the peak RSS of the process when it ends. The ExpGovernment phases open the
+spans on `EXP.tracer` by themselves, the library functions decorated with `@traced(...)` only record when they are called inside an open span
+of a tracer, so they cost nothing outside the experiments.\n
+A trace is written as JSON lines, one span per line:\n
+```
+{"id": 3, "parent": 1, "run": 1, "name": "hardware_run", "exp": "EnergyRelaxation", "thread": "MainThread", "start": "2025-01-20 22:00:01.123",
+ "wall_s": 7.41, "cpu_s": 0.02, "self_s": 7.41, "peak_rss_MB": 812.4, "error": null}
+```
+"""
+import os, sys, json
+from time import perf_counter, thread_time
+from datetime import datetime
+from threading import Lock, current_thread
+from functools import wraps
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar, copy_context
+from qblox_drive_AS.support.UserFriend import *
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# (tracer, id of the open span, id of its root span) in this context
+_active:ContextVar = ContextVar("active_span", default=(None, None, None))
+
+
+def peak_rss_MB()->float|None:
+    """ The peak resident memory of this process in MB, None if the platform can't tell. """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1024**2 if sys.platform == "darwin" else peak/1024
+
+
+class PhaseTracer():
+    """
+    ### Example:\n
+    ```
+    tracer = PhaseTracer()
+    with tracer.span("WorkFlow", exp="T1"):
+        with trace("compile"):          # any code in between can open the nested spans by `trace` or `@traced`
+            ...
+    tracer.flush("T1_trace.jsonl")
+    tracer.report()
+    ```
+    The written spans are dropped from memory, but they are still counted in `report()`, so one tracer can be kept for a long monitoring session.
+    """
+    def __init__(self):
+        self.__lock = Lock()
+        self.__next_id:int = 1
+        self.__records:list = []
+        self.__open:dict = {}      # span id -> wall seconds of its closed children
+        self.__summary:dict = {}   # name -> aggregated numbers
+
+    @property
+    def records(self)->list:
+        """ The spans which are not written yet. """
+        return list(self.__records)
+
+    def is_active(self)->bool:
+        """ Is there an open span of this tracer in the current context. """
+        return _active.get()[0] is self
+
+    @contextmanager
+    def span(self, name:str, **attrs):
+        """ Open a span nested in the current open span of this tracer, `attrs` are kept in the record. """
+        tracer, parent, run = _active.get()
+        if tracer is not self:
+            parent = None
+        with self.__lock:
+            span_id = self.__next_id
+            self.__next_id += 1
+            self.__open[span_id] = 0.0
+        record = {"id":span_id, "parent":parent, "run":span_id if parent is None else run, "name":name, **attrs,
+                  "thread":current_thread().name, "start":datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]}
+        token = _active.set((self, span_id, record["run"]))
+        wall_start, cpu_start = perf_counter(), thread_time()
+        error = None
+        try:
+            yield record
+        except BaseException as err:
+            error = type(err).__name__
+            raise
+        finally:
+            wall, cpu = perf_counter()-wall_start, thread_time()-cpu_start
+            _active.reset(token)
+            with self.__lock:
+                children = self.__open.pop(span_id)
+                if parent in self.__open and not attrs.get("deferred", False):
+                    # the deferred jobs run alongside their parent, they don't take its time
+                    self.__open[parent] += wall
+                record.update({"wall_s":wall, "cpu_s":cpu, "self_s":max(wall-children, 0.0), "peak_rss_MB":peak_rss_MB(), "error":error})
+                self.__records.append(record)
+                self.__count(record)
+
+    def __count(self, record:dict):
+        summary = self.__summary.setdefault(record["name"], {"count":0, "wall_s":0.0, "self_s":0.0, "cpu_s":0.0, "max_wall_s":0.0, "peak_rss_MB":None})
+        summary["count"] += 1
+        summary["wall_s"] += record["wall_s"]
+        summary["self_s"] += record["self_s"]
+        summary["cpu_s"] += record["cpu_s"]
+        summary["max_wall_s"] = max(summary["max_wall_s"], record["wall_s"])
+        if record["peak_rss_MB"] is not None:
+            summary["peak_rss_MB"] = max(summary["peak_rss_MB"] or 0.0, record["peak_rss_MB"])
+
+    def flush(self, path:str)->int:
+        """ Append the spans which are not written yet into the JSON-lines file, return how many were written. """
+        with self.__lock:
+            records, self.__records = self.__records, []
+        if len(records) == 0:
+            return 0
+        folder = os.path.split(path)[0]
+        if folder != "" and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(path, "a") as file:
+            for record in sorted(records, key=lambda r: r["id"]):
+                file.write(json.dumps(record, default=str)+"\n")
+        return len(records)
+
+    def summary(self)->dict:
+        """ {name: {"count", "wall_s", "self_s", "cpu_s", "max_wall_s", "peak_rss_MB"}} of all the spans since this tracer was made. """
+        with self.__lock:
+            return {name: dict(numbers) for name, numbers in self.__summary.items()}
+
+    def report(self, top:int=None)->dict:
+        return print_trace_report(self.summary(), top)
+
+
+def trace(name:str, **attrs):
+    """ A span on the tracer opened in the current context, or nothing if there isn't one. """
+    tracer = _active.get()[0]
+    if tracer is None:
+        return nullcontext()
+    return tracer.span(name, **attrs)
+
+
+def traced(name:str=None):
+    """ Decorator, the calls of the function are traced as `name` (default is its qualname) when they happen inside a traced phase. """
+    def decorator(func:callable):
+        span_name = func.__qualname__ if name is None else name
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def in_context(func:callable, name:str=None)->callable:
+    """
+    Bind `func` to the current context, so the job done in another thread (like a `DataPipeline` worker) is still traced as a child
+    of the span which submitted it.
+    """
+    context = copy_context()
+    span_name = getattr(func, "__name__", "job") if name is None else name
+    def job(*args, **kwargs):
+        def run():
+            with trace(span_name, deferred=True):
+                return func(*args, **kwargs)
+        return context.run(run)
+    job.__name__ = span_name
+    return job
+
+
+_traced_classes:dict = {}
+
+def traced_class(base:type, methods:dict)->type:
+    """ A subclass of `base` with the `methods` {method name: span name} traced, like the instrument coordinator methods. """
+    key = (base, tuple(sorted(methods.items())))
+    if key not in _traced_classes:
+        namespace = {}
+        for method_name, span_name in methods.items():
+            def make(method_name:str, span_name:str):
+                def method(self, *args, **kwargs):
+                    with trace(span_name):
+                        return getattr(super(cls, self), method_name)(*args, **kwargs)
+                method.__name__ = method_name
+                return method
+            namespace[method_name] = make(method_name, span_name)
+        cls = type(f"Traced{base.__name__}", (base,), namespace)
+        _traced_classes[key] = cls
+    return _traced_classes[key]
+
+
+def load_trace(path:str)->list:
+    """ Read the spans from a trace file, or from all the `*trace.jsonl` in a folder. """
+    if os.path.isdir(path):
+        files = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith("trace.jsonl")]
+    else:
+        files = [path]
+    records = []
+    for file_path in files:
+        with open(file_path) as file:
+            records += [json.loads(line) for line in file if line.strip() != ""]
+    return records
+
+
+def summarize_trace(records:list, exp:str=None)->dict:
+    """ Aggregate the spans loaded by `load_trace` by their names like `PhaseTracer.summary()`, only the spans of `exp` if it's given. """
+    by_id = {record["id"]: record for record in records}
+    summary = {}
+    for record in records:
+        if exp is not None and by_id.get(record["run"], record).get("exp") != exp:
+            continue
+        numbers = summary.setdefault(record["name"], {"count":0, "wall_s":0.0, "self_s":0.0, "cpu_s":0.0, "max_wall_s":0.0, "peak_rss_MB":None})
+        numbers["count"] += 1
+        numbers["wall_s"] += record["wall_s"]
+        numbers["self_s"] += record.get("self_s", record["wall_s"])
+        numbers["cpu_s"] += record["cpu_s"]
+        numbers["max_wall_s"] = max(numbers["max_wall_s"], record["wall_s"])
+        if record.get("peak_rss_MB") is not None:
+            numbers["peak_rss_MB"] = max(numbers["peak_rss_MB"] or 0.0, record["peak_rss_MB"])
+    return summary
+
+
+def print_trace_report(summary:dict, top:int=None)->dict:
+    """ Print the summary sorted by the self time, `top` keeps only the most expensive phases. """
+    names = sorted(summary, key=lambda name: summary[name]["self_s"], reverse=True)
+    if top is not None:
+        names = names[:top]
+    slightly_print(f"{'phase':<28}{'count':>7}{'wall (s)':>11}{'self (s)':>11}{'cpu (s)':>10}{'max (s)':>10}{'peak RSS (MB)':>15}")
+    for name in names:
+        numbers = summary[name]
+        rss = "-" if numbers["peak_rss_MB"] is None else round(numbers["peak_rss_MB"],1)
+        slightly_print(f"{name:<28}{numbers['count']:>7}{round(numbers['wall_s'],2):>11}{round(numbers['self_s'],2):>11}{round(numbers['cpu_s'],2):>10}{round(numbers['max_wall_s'],2):>10}{rss:>15}")
+    return {name: summary[name] for name in names}
@@ -6,7 +6,6 @@ from matplotlib.patches import Ellipse
 import numpy as np
 import xarray as xr
 from scipy import special
-from scipy.integrate import quad
 from scipy.signal import butter,sosfiltfilt
 from lmfit import Model,Parameter 
 from quantify_scheduler.enums import BinMode
@@ -18,7 +17,8 @@ from quantify_scheduler.device_under_test.quantum_device import QuantumDevice
 from quantify_scheduler.operations.gate_library import Reset, Measure
 from quantify_scheduler.resources import ClockResource, BasebandClockResource
 from quantify_scheduler.helpers.collections import find_port_clock_path
-from qblox_drive_AS.support.WaveformCtrl import XY_waveform, s_factor, half_pi_ratio, GateGenesis
+from qblox_drive_AS.support.SingleShotStats import histogram_shots, two_state_statistics
+from qblox_drive_AS.support.WaveformCtrl import XY_waveform, s_factor, half_pi_ratio, GateGenesis, add_loop
 
 """ Global pulse settings """
 electrical_delay:float = 280e-9
@@ -67,7 +67,17 @@ def XY_waveform_controller(pulse_sche:Schedule, amp:float, duration:float, phase
             pass
 
 #%% fit function
+def resample_uniform(data: np.ndarray, t: np.ndarray):
+    """ Interpolate the traces in (..., t) onto evenly spaced samples if `t` isn't, like the points picked by an adaptive sweep. The FFT guesses need it. """
+    steps = np.diff(t)
+    if steps.shape[0] == 0 or np.allclose(steps, steps[0]):
+        return data, t
+    order = np.argsort(t, kind="stable")
+    uniform_t = np.linspace(t[order][0], t[order][-1], t.shape[0])
+    data = np.apply_along_axis(lambda trace: np.interp(uniform_t, t[order], trace[order]), -1, np.asarray(data, dtype=float))
+    return data, uniform_t
 def fft_oscillation_guess(data: np.ndarray, t: np.ndarray):
+    data, t = resample_uniform(data, t)
     amp = np.fft.fft(data)[: len(data) // 2] #use positive frequency
     freq = np.fft.fftfreq(len(data), t[1] - t[0])[: len(amp)]
     amp[0] = 0  # Remove DC part 
@@ -237,94 +247,28 @@ def Single_shot_ref_fit_analysis(data:tuple):
     #print ('Total prob. =',np.sum(hist)*((max(xedges)-min(xedges))/bins*(max(yedges)-min(yedges))/bins))
     return dict(data=[I,Q],data_hist=hist,coords=[X,Y],fitting=fitting,fit_pack=fit_pack)
 
-def Qubit_state_single_shot_fit_analysis(data:dict, T1:float,tau:float):
-    Ig_data,Qg_data,Ie_data,Qe_data= np.array(data['g'][0]), np.array(data['g'][1]) ,np.array(data['e'][0]), np.array(data['e'][1]) 
-    bins=401
-    g_predict= Single_shot_ref_fit_analysis(data['g'])['fit_pack']
-    Ig_guess, Qg_guess, sig_guess= g_predict[0],g_predict[1],g_predict[2]
-    I_mixdata, Q_mixdata= np.hstack([Ig_data,Ie_data]), np.hstack([Qg_data,Qe_data])
-    I_=np.linspace(I_mixdata.min(),I_mixdata.max(),bins)  
-    Q_=np.linspace(Q_mixdata.min(),Q_mixdata.max(),bins)
-    X,Y= np.meshgrid(I_,Q_)
-    hist_Ie, edges_Ie= np.histogram(Ie_data, bins=bins, density=True)
-    hist_Qe, edges_Qe= np.histogram(Qe_data, bins=bins, density=True)
-    hist, xedges, yedges = np.histogram2d(I_mixdata, Q_mixdata, bins=(bins,bins), density=True)
-    Ie_guess_idx, Qe_guess_idx=find_nearest(hist_Ie,np.max(hist_Ie)),find_nearest(hist_Qe,np.max(hist_Qe))
-    Ie_guess, Qe_guess= edges_Ie[Ie_guess_idx],edges_Qe[Qe_guess_idx]
-    #Parameter ini-guess
-    cg_I=Parameter(name='cg_I', value= Ig_guess, min=0.9*Ig_guess, max=1.5*Ig_guess) 
-    cg_Q=Parameter(name='cg_Q', value= Qg_guess, min=0.9*Qg_guess, max=1.5*Qg_guess)
-    ce_I=Parameter(name='ce_I', value= Ie_guess, min=0.3*Ie_guess, max=3*Ie_guess) 
-    ce_Q=Parameter(name='ce_Q', value= Qe_guess, min=0.3*Qe_guess, max=3*Qe_guess)
-    sigma=Parameter(name='sigma', value= sig_guess, min=0.1*sig_guess, max=3*sig_guess)
-    Ag=Parameter(name='Ag',value=np.max(hist), min=0.1*np.max(hist)) 
-    Ae=Parameter(name='Ae',value=np.max(hist), min=0.1*np.max(hist)) 
-    # mixed data fit
-    result= bigauss2d_func_model.fit(hist.transpose(),I=X,Q=Y,cg_I=cg_I,cg_Q=cg_Q,sigma=sigma,Ag=Ag,ce_I=ce_I,ce_Q=ce_Q,Ae=Ae)
-    cg_I_fit=result.best_values['cg_I']
-    cg_Q_fit=result.best_values['cg_Q']
-    ce_I_fit=result.best_values['ce_I']
-    ce_Q_fit=result.best_values['ce_Q']
-    sigma_fit=result.best_values['sigma']
-    # displace + rotate
-    angle= np.angle(ce_I_fit-cg_I_fit+(ce_Q_fit-cg_Q_fit)*1j)
-    rot_e_center= rot(ce_I_fit-cg_I_fit,ce_Q_fit-cg_Q_fit,angle)
-    rot_g_IQ= rot(Ig_data-cg_I_fit,Qg_data-cg_Q_fit,angle)
-    rot_e_IQ= rot(Ie_data-cg_I_fit,Qe_data-cg_Q_fit,angle)
-    Ig_data_new, Qg_data_new, Ie_data_new, Qe_data_new= rot_g_IQ[0],rot_g_IQ[1],rot_e_IQ[0],rot_e_IQ[1]
-    # along single quadrature fit
-    R= 10*sigma_fit #range_factor
-    xmin, xmax = np.minimum(0,rot_e_center[0])-R,np.maximum(0,rot_e_center[0])+R
-    ymin, ymax = np.minimum(0,rot_e_center[1])-R,np.maximum(0,rot_e_center[1])+R
-    hist_r_g, xedges, yedges = np.histogram2d(Ig_data_new, Qg_data_new, bins=(bins,bins),range=[[xmin, xmax], [ymin, ymax]], density=True)
-    hist_r_e, xedges, yedges = np.histogram2d(Ie_data_new, Qe_data_new, bins=(bins,bins),range=[[xmin, xmax], [ymin, ymax]], density=True)
-    New_axe_g_hist= np.sum(hist_r_g.transpose(), axis=0)
-    New_axe_e_hist= np.sum(hist_r_e.transpose(), axis=0)
-    I_ro = np.linspace(xmin, xmax,bins)
-    I_fit= np.linspace(xmin, xmax,bins*5)
-    def Reduced_bimodal_func(x,Ag,Ae):
-        return gauss_func(x,0,sigma_fit,Ag)+gauss_func(x,rot_e_center[0],sigma_fit,Ae)
-    bimodal_func_model = Model(Reduced_bimodal_func)
-    result_g= bimodal_func_model.fit(New_axe_g_hist,x=I_ro,Ag=Parameter(name='Ag',value=np.max(New_axe_g_hist), min=0.5*np.max(New_axe_g_hist)) ,Ae=Parameter(name='Ae',value=0.01*np.max(New_axe_g_hist), min=0))
-    result_e= bimodal_func_model.fit(New_axe_e_hist,x=I_ro,Ag=Parameter(name='Ag',value=0.01*np.max(New_axe_e_hist), min=0),Ae=Parameter(name='Ae',value=np.max(New_axe_e_hist), min=0.5*np.max(New_axe_e_hist)))
-    Agg_fit=result_g.best_values['Ag']
-    Aeg_fit=result_g.best_values['Ae']
-    Age_fit=result_e.best_values['Ag']
-    Aee_fit=result_e.best_values['Ae']
-    inter_point = rot_e_center[0]/2
-    def G_gg(I):
-        return Agg_fit*np.exp(-I**2/(2*sigma_fit**2))
-    def G_eg(I):
-        return Aeg_fit*np.exp(-(I-rot_e_center[0])**2/(2*sigma_fit**2))
-    def G_ge(I):
-        return Age_fit*np.exp(-I**2/(2*sigma_fit**2))
-    def G_ee(I):
-        return Aee_fit*np.exp(-(I-rot_e_center[0])**2/(2*sigma_fit**2))
-    Ggg= quad(G_gg,-np.inf,np.inf)
-    Geg= quad(G_eg,-np.inf,np.inf)
-    Gge= quad(G_ge,-np.inf,np.inf)
-    Gee= quad(G_ee,-np.inf,np.inf)
-    overlap_gg= quad(G_gg,inter_point,np.inf)
-    transi_eg= quad(G_eg,inter_point,np.inf)
-    transi_ge= quad(G_ge,-np.inf,inter_point)
-    overlap_ee= quad(G_ee,-np.inf,inter_point)
-    overlap= ((overlap_gg[0]-overlap_gg[1])/(Ggg[0]-Ggg[1])+(overlap_ee[0]-overlap_ee[1])/(Gee[0]-Gee[1]))/2
-    Peg= (transi_eg[0]-transi_eg[1])/(Ggg[0]-Ggg[1]+Geg[0]-Geg[1])+(overlap_gg[0]-overlap_gg[1])/(Ggg[0]-Ggg[1])
-    Pge= (transi_ge[0]-transi_ge[1])/(Gee[0]-Gee[1]+Gge[0]-Gge[1])+(overlap_ee[0]-overlap_ee[1])/(Gee[0]-Gee[1])
-    Thermal= (Geg[0]-Geg[1])/(Geg[0]-Geg[1]+Ggg[0]-Ggg[1])
-    Relax= (Gge[0]-Gge[1])/(Gee[0]-Gee[1]+Gge[0]-Gge[1])-Thermal
-    Relax_predict= Relax_cal(0,tau,T1)
-    Pre_decay= Relax-Relax_predict
-    D= rot_e_center[0]
-    SNR= D/sigma_fit
-    overlap_predict= (1/2)*(1-special.erf(np.sqrt(SNR**2/8)))
-    F_s= 1-overlap
-    F_g= 1-Peg
-    F_e= 1-Pge
-    F=1-(1/2)*(Peg+Pge)
-    fit_pack= [rot_e_center,Agg_fit,Aeg_fit,Age_fit,Aee_fit,sigma_fit,New_axe_g_hist,New_axe_e_hist]
-    error_pack= dict(D=D,sigma=sigma_fit,SNR=SNR,overlap=overlap,overlap_predict=overlap_predict,Peg=Peg,Pge=Pge,Thermal=Thermal,Relax=Relax,Relax_predict=Relax_predict,Pre_decay=Pre_decay, F_s=F_s,F_g=F_g,F_e=F_e,F=F)
-    return dict(rot_IQdata=[rot_g_IQ,rot_e_IQ],I_ro=I_ro,I_fit=I_fit,fit_pack=fit_pack,error_pack=error_pack)
+def Qubit_state_single_shot_fit_analysis(data:dict, T1:float,tau:float, bins:int=401, chunk:int=1000000, scatter_shots:int=10000):
+    """
+    The shots are counted into 2D histograms `chunk` shots at a time and the two-state mixture is fitted on the bins, so the memory
+    doesn't grow with the shots. `rot_IQdata` keeps at most `scatter_shots` shots of each state for the scatter plot.
+    """
+    stats= two_state_statistics(histogram_shots(data,bins=bins,chunk=chunk),T1=T1,tau=tau)
+    cg_I_fit,cg_Q_fit= stats["g_center"]
+    sigma_fit, angle= stats["sigma"], stats["angle"]
+    rot_e_center= rot(stats["e_center"][0]-cg_I_fit,stats["e_center"][1]-cg_Q_fit,angle)
+    # the amplitudes of the unit-area Gaussians on the densities along the rotated I
+    norm= np.sqrt(2*np.pi)*sigma_fit
+    Agg_fit, Aeg_fit= stats["weights_g"][0]/norm, stats["weights_g"][1]/norm
+    Age_fit, Aee_fit= stats["weights_e"][0]/norm, stats["weights_e"][1]/norm
+    rot_IQ= []
+    for state in ['g','e']:
+        step= int(np.ceil(len(data[state][0])/scatter_shots))
+        I, Q= np.array(data[state][0][::step]), np.array(data[state][1][::step])
+        rot_IQ.append(rot(I-cg_I_fit,Q-cg_Q_fit,angle))
+    I_ro= stats["I_ro"]
+    I_fit= np.linspace(I_ro[0],I_ro[-1],bins*5)
+    fit_pack= [rot_e_center,Agg_fit,Aeg_fit,Age_fit,Aee_fit,sigma_fit,stats["hist_g"],stats["hist_e"]]
+    return dict(rot_IQdata=rot_IQ,I_ro=I_ro,I_fit=I_fit,fit_pack=fit_pack,error_pack=stats["error_pack"])
 
 def Readout_F_opt_analysis(data:dict,f_samples:np.ndarray):
     mag_g,mag_e= np.array(data['g'][0]), np.array(data['e'][0]) 
@@ -387,6 +331,14 @@ def Y_pi_p(sche,pi_amp,q,pi_Du:float,ref_pulse_sche,freeDu, ref_point:str="start
     delay_c= -pi_Du-freeDu
     return XY_waveform_controller(sche,amp,pi_Du,90,q,delay_c,ref_pulse_sche,XY_waveform,ref_pt=ref_point)
 
+def X_pi_train(sche,pi_amp,qs:list,pi_Du:float,repeats:int,ref_pulse_sche,freeDu,spacing:float=0):
+    """ `repeats` pi-pulses of all the `qs` looped on the sequencers, every copy is spacing/2 idle + pi-pulse + spacing/2 idle, see `GateGenesis.XY_train`. """
+    body = Schedule("XY train")
+    anchor = body.add(IdlePulse(duration=pi_Du+spacing))
+    for q in qs:
+        XY_waveform_controller(body,pi_amp[q],pi_Du,0,q,spacing/2,anchor,XY_waveform,ref_pt='start')
+    return add_loop(sche,body,repeats,rel_time=-pi_Du-spacing-freeDu,ref_op=ref_pulse_sche)
+
 def X_12pi_p(sche,pi_amp,q,pi_Du:float,ref_pulse_sche,freeDu, ref_point:str="start"):
     amp= pi_amp[q]
     delay_c= -pi_Du-freeDu
@@ -1228,6 +1180,8 @@ def multi_ramsey_sche(
     print(f"Second phase: {second_pulse_phase}")
 
     for acq_idx in range(sameple_idx):   
+        # the echo pi-pulses are looped when all the qubits share the same train
+        looped_echo = len(set([(echo_pi_num[q], freeduration[q][acq_idx], pi_dura[q]) for q in qubits2read])) == 1 and echo_pi_num[qubits2read[0]] > 1
         for qubit_idx, q in enumerate(qubits2read):
             freeDu = freeduration[q][acq_idx]
             sched.add(Reset(q))
@@ -1242,7 +1196,12 @@ def multi_ramsey_sche(
             else:
                 first_half_pi = Y_pi_2_p(sched,pi_amp,q,pi_dura[q],spec_pulse,freeDu=electrical_delay)
         
-            if echo_pi_num[q] != 0:
+            if looped_echo:
+                if qubit_idx == len(qubits2read)-1:
+                    train = X_pi_train(sched,pi_amp,qubits2read,pi_dura[q],echo_pi_num[q],first_half_pi,0,spacing=freeDu/echo_pi_num[q])
+                    for qubit in qubits2read:
+                        X_pi_2_p(sched,pi_amp,qubit,pi_dura[qubit],train,0)
+            elif echo_pi_num[q] != 0:
                 a_separate_free_Du = freeDu / echo_pi_num[q]
                 for pi_idx in range(echo_pi_num[q]):
                     if pi_idx == 0 :
@@ -1474,15 +1433,74 @@ def Gate_Test_SS_sche(
         else:
             Multi_Readout(sched,q,spec_pulse,R_amp,R_duration,powerDep=False)
     
-        
-        for i in range(pulse_num):
-            pi_pulse = waveformer.X_pi_p(sched,pi_amp,q,pi_dura[q],spec_pulse if i==0 else pi_pulse, freeDu=electrical_delay if i==0 else 0)
-    
+        if qubit_idx == len(R_integration)-1:
+            # the pi-pulses of all the qubits are played together in one loop
+            waveformer.XY_train(sched,{qubit:pi_amp[qubit] for qubit in R_integration},pi_dura,pulse_num,spec_pulse,freeDu=electrical_delay)
     
         Integration(sched,q,R_inte_delay[q],R_integration,spec_pulse,acq_index=0,acq_channel=qubit_idx,single_shot=True,get_trace=False,trace_recordlength=0)
 
     return sched
 
+def multi_Qubit_SS_interleaved_sche(
+    ini_states:list,
+    waveformer:GateGenesis,
+    pi_amp: dict,
+    pi_dura:dict,
+    R_amp: dict,
+    R_duration: dict,
+    R_integration:dict,
+    R_inte_delay:dict,
+    repetitions:int=1,
+) -> Schedule:
+    """ All the preparations in one schedule, the shots of `ini_states[i]` are appended into acq_index i of the qubit channel. """
+    sched = Schedule("Interleaved single shot", repetitions=repetitions)
+
+    for prep_idx, ini_state in enumerate(ini_states):
+        for qubit_idx, q in enumerate(R_integration):
+
+            sched.add(Reset(q))
+            if qubit_idx == 0:
+                spec_pulse = Readout(sched,q,R_amp,R_duration,powerDep=False)
+            else:
+                Multi_Readout(sched,q,spec_pulse,R_amp,R_duration,powerDep=False)
+        
+            if ini_state=='e': 
+                waveformer.X_pi_p(sched,pi_amp,q,pi_dura[q],spec_pulse,freeDu=electrical_delay)
+
+            Integration(sched,q,R_inte_delay[q],R_integration,spec_pulse,acq_index=prep_idx,acq_channel=qubit_idx,single_shot=True,get_trace=False,trace_recordlength=0)
+
+    return sched
+
+def Gate_Test_SS_interleaved_sche(
+    pulse_nums:list,
+    waveformer:GateGenesis,
+    pi_amp: dict,
+    pi_dura:dict,
+    R_amp: dict,
+    R_duration: dict,
+    R_integration:dict,
+    R_inte_delay:dict,
+    repetitions:int=1,
+) -> Schedule:
+    """ All the pulse numbers in one schedule, the shots of `pulse_nums[i]` are appended into acq_index i of the qubit channel. """
+    sched = Schedule("Interleaved single shot", repetitions=repetitions)
+
+    for prep_idx, pulse_num in enumerate(pulse_nums):
+        for qubit_idx, q in enumerate(R_integration):
+
+            sched.add(Reset(q))
+            if qubit_idx == 0:
+                spec_pulse = Readout(sched,q,R_amp,R_duration,powerDep=False)
+            else:
+                Multi_Readout(sched,q,spec_pulse,R_amp,R_duration,powerDep=False)
+        
+            if qubit_idx == len(R_integration)-1:
+                waveformer.XY_train(sched,{qubit:pi_amp[qubit] for qubit in R_integration},pi_dura,pulse_num,spec_pulse,freeDu=electrical_delay)
+
+            Integration(sched,q,R_inte_delay[q],R_integration,spec_pulse,acq_index=prep_idx,acq_channel=qubit_idx,single_shot=True,get_trace=False,trace_recordlength=0)
+
+    return sched
+
 #? Calibrations :
 def ROF_Cali_sche(
     q:str,
@@ -1631,9 +1649,6 @@ def multi_PI_amp_cali_sche(
 
     for acq_idx in range(sameple_idx):
         for qubit_idx, q in enumerate(qubits2read):
-            amp_coef = pi_amp_coefs[q][acq_idx]
-            
-            
             sched.add(Reset(q))
             
             if qubit_idx == 0:
@@ -1641,9 +1656,8 @@ def multi_PI_amp_cali_sche(
             else:
                 Multi_Readout(sched,q,read_pulse,R_amp,R_duration)
             
-            for pi_num in range(pi_pair_num):
-                for pi_idx in range(2):
-                    spec_pulse = waveformer.X_pi_p(sched,{str(q):float(XY_amp[q])*amp_coef},q,XY_duration[q],read_pulse if (pi_num == 0 and pi_idx == 0) else spec_pulse, freeDu=electrical_delay if (pi_num == 0 and pi_idx == 0) else 0)
+            if qubit_idx == len(qubits2read)-1:
+                waveformer.XY_train(sched,{qubit:float(XY_amp[qubit])*pi_amp_coefs[qubit][acq_idx] for qubit in qubits2read},XY_duration,2*pi_pair_num,read_pulse,freeDu=electrical_delay)
                     
             Integration(sched,q,R_inte_delay[q],R_integration,read_pulse,acq_idx,acq_channel=qubit_idx,single_shot=False,get_trace=False,trace_recordlength=0)
 
@@ -1679,9 +1693,8 @@ def multi_hPI_amp_cali_sche(
             else:
                 Multi_Readout(sched,q,read_pulse,R_amp,R_duration)
             
-            for pi_num in range(pi_pair_num):
-                for pi_idx in range(4):
-                    spec_pulse = waveformer.X_pi_2_p(sched,XY_amp,q,XY_duration[q],read_pulse if (pi_num == 0 and pi_idx == 0) else spec_pulse, freeDu=electrical_delay if (pi_num == 0 and pi_idx == 0) else 0)
+            if qubit_idx == len(qubits2read)-1:
+                waveformer.XY_train(sched,{qubit:XY_amp[qubit]*waveformer.get_halfPIratio_for(qubit) for qubit in qubits2read},XY_duration,4*pi_pair_num,read_pulse,freeDu=electrical_delay)
                     
             Integration(sched,q,R_inte_delay[q],R_integration,read_pulse,acq_idx,acq_channel=qubit_idx,single_shot=False,get_trace=False,trace_recordlength=0)
 
@@ -4,6 +4,9 @@ from qblox_drive_AS.support.UserFriend import *
 from qblox_drive_AS.support.FluxBiasDict import FluxBiasDict
 from qblox_drive_AS.support.Notebook import Notebook
 from qblox_drive_AS.support.WaveformCtrl import GateGenesis
+from qblox_drive_AS.support.QDstore import QDstore, is_store
+from qblox_drive_AS.support.PhaseTracer import traced
+from qblox_drive_AS.support.StateDiscriminator import DiscriminatorRegistry
 from qblox_instruments import Cluster
 from quantify_scheduler.device_under_test.quantum_device import QuantumDevice
 from quantify_scheduler.device_under_test.transmon_element import BasicTransmonElement
@@ -117,6 +120,7 @@ class QDmanager():
         self.manager_version:str = "v2.0" # Only RatisWu can edit it
         self.path = QD_path
         self.StateDiscriminator:GMMROFidelity = GMMROFidelity()
+        self.Discriminators:DiscriminatorRegistry = DiscriminatorRegistry() # the discriminator of every qubit with its readout config
         self.Waveformer:GateGenesis = None
         self.machine_IP = ""
         self.refIQ = {}
@@ -128,7 +132,39 @@ class QDmanager():
         self.chip_name = ""
         self.chip_type = ""
         self.DiscriminatorVersion:str = ""
-
+        self.provenance:dict = {}  # {"XYF.q0": {"value", "time", "calibrated", "exp", "source", "action"}}, see `memo_provenance`
+        self.__quantum_device:QuantumDevice = None
+        self.__store:QDstore = None
+        self.__store_rev:int = None
+
+    @property
+    def quantum_device(self)->QuantumDevice:
+        """ Loaded from a QD store, the QuantumDevice will be rebuilt at the first time it's used. """
+        if self.__quantum_device is None and self.__store is not None:
+            self.__quantum_device = self.__store.build_quantum_device(self.__store_rev)
+            self.__quantum_device.hardware_config(self.Hcfg)
+        return self.__quantum_device
+
+    @quantum_device.setter
+    def quantum_device(self, quantum_device:QuantumDevice):
+        self.__quantum_device = quantum_device
+
+    @property
+    def quantum_device_loaded(self)->bool:
+        return self.__quantum_device is not None
+
+    def __getstate__(self):
+        """ Keep the same pickle layout as before, the QD store connection can't be pickled. """
+        state = dict(self.__dict__)
+        state["quantum_device"] = self.quantum_device
+        for attr in ["_QDmanager__quantum_device", "_QDmanager__store", "_QDmanager__store_rev"]:
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state:dict):
+        state = dict(state)
+        self.__dict__.update({"_QDmanager__quantum_device":state.pop("quantum_device", None), "_QDmanager__store":None, "_QDmanager__store_rev":None})
+        self.__dict__.update(state)
             
     
     def register(self,cluster_ip_adress:str,which_dr:str,chip_name:str='',chip_type = ''):
@@ -193,16 +229,81 @@ class QDmanager():
        for q in angle_dict:
            self.rotate_angle[q] = angle_dict[q]
     
+    def memo_provenance(self, node:str, target_q:str, value=None, source:str="", exp:str="", action:str="calibrated"):
+        """
+        Memorize where a calibrated parameter came from, which the CalibrationGraph uses to tell if it's stale.\n
+        ### Args:\n
+        * node: the calibration name like "XYF", "PiAmp".\n
+        * value: the new value, kept as it was for `action="checked"`.\n
+        * source: the raw data path.\n
+        * action: "calibrated" when the value was changed, "checked" when a check experiment confirmed it.
+        """
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        record = dict(self.provenance.get(f"{node}.{target_q}", {}))
+        record.update({"time":now, "exp":exp, "source":source, "action":action})
+        if action == "calibrated" or "calibrated" not in record:
+            record.update({"value":value, "calibrated":now})
+        self.provenance[f"{node}.{target_q}"] = record
+
+    def get_provenance(self, node:str, target_q:str)->dict:
+        """ The record of `memo_provenance`, empty if this node was never done for the qubit. """
+        return self.provenance.get(f"{node}.{target_q}", {})
+
     def refresh_log(self,message:str):
         """
         Leave the message for this file.
         """
         self.Log = message
 
-    def QD_loader(self, new_Hcfg:dict=None):
+    def __store_loader(self, rev:int=None):
+        """ Load everything but the QuantumDevice from the QD store, the QuantumDevice is rebuilt when it's used. """
+        self.__store = QDstore(self.path)
+        self.__store_rev = self.__store.latest_rev if rev is None else rev
+        self.__quantum_device = None
+        gift = self.__store.load_manager_state(self.__store_rev)
+        if len(gift["meta"]) == 0:
+            raise KeyError(f"There is nothing in the QD store {self.path} at revision {self.__store_rev} !")
+
+        # string/ int
+        for attr in gift["meta"]:
+            setattr(self, attr, gift["meta"][attr])
+        self.q_num:int = len(list(filter(ret_q,gift["Flux"])))
+        self.c_num:int = len(list(filter(ret_c,gift["Flux"])))
+        # class
+        self.Fluxmanager:FluxBiasDict = FluxBiasDict(qb_number=self.q_num,cp_number=self.c_num)
+        self.Fluxmanager.activate_from_dict(gift["Flux"])
+        self.Notewriter:Notebook = Notebook(q_number=self.q_num)
+        self.Notewriter.activate_from_dict(gift["Notebook"])
+        waveform_log = {"xy":{}, "z":{}}
+        for item in gift["Waveform"]:
+            mode, q = item.split(".", 1)
+            waveform_log[mode][q] = gift["Waveform"][item]
+        self.Waveformer:GateGenesis = GateGenesis(q_num=0,c_num=0,log2super=waveform_log)
+        self.StateDiscriminator = gift["Discriminator"].get("all", GMMROFidelity())
+        self.Discriminators = DiscriminatorRegistry({q: entry for q, entry in gift["Discriminator"].items() if q != "all"})
+        # dict
+        self.refIQ = gift["refIQ"]
+        self.rotate_angle = gift["rotate_angle"]
+        self.Hcfg = gift["Hcfg"]["all"]
+        self.provenance = gift["Provenance"]
+
+    @traced("QD_load")
+    def QD_loader(self, new_Hcfg:dict=None, rev:int=None):
         """
-        Load the QuantumDevice, Bias config, hardware config and Flux control callable dict from a given json file path contain the serialized QD.
+        Load the QuantumDevice, Bias config, hardware config and Flux control callable dict from a given json file path contain the serialized QD.\n
+        If the path is a QD store (*.qdb), `rev` can be given to load an older revision, the latest as default.
         """
+        if is_store(self.path):
+            self.__store_loader(rev)
+            if new_Hcfg is not None:
+                self.Hcfg = new_Hcfg
+                if self.quantum_device_loaded:
+                    self.quantum_device.hardware_config(new_Hcfg)
+                slightly_print("Saved new given Hardware config.")
+                self.made_mobileFctrl()
+            print("Old friends loaded!")
+            return
+
         with open(self.path, 'rb') as inp:
             gift:QDmanager = pickle.load(inp) # refer to `merged_file` in QD_keeper()
 
@@ -220,6 +321,7 @@ class QDmanager():
         self.Waveformer = gift.Waveformer
         self.quantum_device = gift.quantum_device
         self.StateDiscriminator = gift.StateDiscriminator
+        self.Discriminators = getattr(gift, "Discriminators", DiscriminatorRegistry())
 
         # string/ int
         self.manager_version = gift.manager_version
@@ -236,6 +338,7 @@ class QDmanager():
         self.refIQ = gift.refIQ
         self.Hcfg = gift.Hcfg
         self.rotate_angle = gift.rotate_angle
+        self.provenance = getattr(gift, "provenance", {})
         
         if new_Hcfg is not None:
             from qblox_drive_AS.support.UserFriend import slightly_print
@@ -248,6 +351,7 @@ class QDmanager():
         
         print("Old friends loaded!")
     
+    @traced("QD_keep")
     def QD_keeper(self, special_path:str=''):
         """
         Save the merged dictionary to a json file with the given path. \n
@@ -259,9 +363,25 @@ class QDmanager():
                 db.build_folder_today()
                 self.path = os.path.join(db.raw_folder,f"{self.Identity}_SumInfo.pkl")
         
-        with open(self.path if special_path == '' else special_path, 'wb') as file:
-            pickle.dump(self, file)
-            print(f'Summarized info had successfully saved to the given path!')
+        save_path = self.path if special_path == '' else special_path
+        if is_store(save_path):
+            if self.__store is None or os.path.abspath(self.__store.path) != os.path.abspath(save_path):
+                store = QDstore(save_path)
+            else:
+                store = self.__store
+            # the QuantumDevice isn't rebuilt from the latest revision means it's not changed
+            unchanged_QD = store is self.__store and self.__store_rev == store.latest_rev
+            rev = store.keep(self, message=self.Log, quantum_device=self.__quantum_device if unchanged_QD else self.quantum_device,
+                             parent_rev=self.__store_rev if store is self.__store else None)
+            if store is self.__store:
+                self.__store_rev = rev
+            else:
+                store.close()
+            print(f'Summarized info had successfully saved to the given path as revision {rev}!')
+        else:
+            with open(save_path, 'wb') as file:
+                pickle.dump(self, file)
+                print(f'Summarized info had successfully saved to the given path!')
 
     def version_converter(self, old_QD_path:str=None):
         
@@ -327,6 +447,7 @@ class QDmanager():
         self.Notewriter: Notebook = Notebook(self.q_num)
         self.Waveformer:GateGenesis = GateGenesis(q_num=self.q_num,c_num=self.cp_num)
         self.StateDiscriminator:GMMROFidelity = GMMROFidelity()
+        self.Discriminators:DiscriminatorRegistry = DiscriminatorRegistry()
 
         
         # for firmware v0.7.0
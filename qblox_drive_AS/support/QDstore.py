@@ -0,0 +1,227 @@
+"""
+Versioned QD state store in a single sqlite file (`*_SumInfo.qdb`), replacing the whole-object pickle of QDmanager.\n
+The state is split into sections (meta, Hcfg, refIQ, rotate_angle, Notebook, Flux, Waveform, Discriminator, Provenance, QD) and items (mostly the qubit names),
+every item is pickled on its own. A `commit` writes only the items which changed into a new revision (copy-on-write), the older revisions are kept
+as the history and can be loaded back by `rev`.\n
+The QuantumDevice is kept as the json of its elements, it's only rebuilt when `build_quantum_device()` is called, so the analysis which only
+needs the Notebook or refIQ doesn't have to create the qcodes instruments.
+"""
+import os, pickle, sqlite3, datetime
+from hashlib import sha256
+from quantify_scheduler.device_under_test.quantum_device import QuantumDevice
+from qblox_drive_AS.support.UserFriend import *
+
+store_format:str = "1"
+store_ext:str = ".qdb"
+QD_section:str = "QD"
+manager_sections:list = ["meta", "Hcfg", "refIQ", "rotate_angle", "Notebook", "Flux", "Waveform", "Discriminator", "Provenance"]
+meta_items:list = ["manager_version", "chip_name", "chip_type", "Identity", "Log", "Fctrl_str_ver", "machine_IP"]
+
+
+def is_store(path:str)->bool:
+    return os.path.splitext(path)[-1].lower() == store_ext
+
+
+class QDstore():
+    """
+    Single file key-value store with the revision history.\n
+    ### Example:\n
+    ```
+    store = QDstore("DR1#11_SumInfo.qdb")
+    store.load("Notebook", ["q0"])             # only the q0 notebook
+    store.update("refIQ", {"q0":[0.01,0.02]})  # a new revision with only this item changed
+    store.load("refIQ", rev=3)                 # what it was in revision 3
+    store.close()                              # or use it in a `with QDstore(path) as store:` block
+    ```
+    """
+    def __init__(self, path:str):
+        self.path:str = path
+        self.__conn = sqlite3.connect(path)
+        self.__conn.executescript("""
+            CREATE TABLE IF NOT EXISTS store_info (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS revisions (rev INTEGER PRIMARY KEY, time TEXT, message TEXT);
+            CREATE TABLE IF NOT EXISTS entries (section TEXT, item TEXT, rev INTEGER, digest TEXT, blob BLOB, PRIMARY KEY (section, item, rev));
+        """)
+        fmt = self.__conn.execute("SELECT value FROM store_info WHERE key='format'").fetchone()
+        if fmt is None:
+            self.__conn.execute("INSERT INTO store_info VALUES ('format', ?)", (store_format,))
+            self.__conn.commit()
+        elif fmt[0] != store_format:
+            raise ValueError(f"QD store format = {fmt[0]} in {path} is not supported, expect {store_format} !")
+
+    def close(self):
+        self.__conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def latest_rev(self)->int:
+        """ 0 if there is nothing committed yet. """
+        ans = self.__conn.execute("SELECT MAX(rev) FROM revisions").fetchone()[0]
+        return 0 if ans is None else ans
+
+    def revisions(self)->list:
+        """ [(rev, time, message), ...] from the oldest. """
+        return self.__conn.execute("SELECT rev, time, message FROM revisions ORDER BY rev").fetchall()
+
+    def __latest_rows(self, section:str, items:list=None, rev:int=None)->list:
+        """ [(item, digest, blob), ...] of the newest entries not later than `rev`, the deleted ones (blob is NULL) included. """
+        rev = self.latest_rev if rev is None else rev
+        query = """
+            SELECT e.item, e.digest, e.blob FROM entries e
+            WHERE e.section = ? AND e.rev = (SELECT MAX(rev) FROM entries WHERE section = e.section AND item = e.item AND rev <= ?)
+        """
+        args = [section, rev]
+        if items is not None:
+            query += f" AND e.item IN ({','.join('?'*len(items))})"
+            args += list(items)
+        return self.__conn.execute(query, args).fetchall()
+
+    def sections(self, rev:int=None)->list:
+        rev = self.latest_rev if rev is None else rev
+        return [row[0] for row in self.__conn.execute("SELECT DISTINCT section FROM entries WHERE rev <= ?", (rev,)).fetchall()]
+
+    def load(self, section:str, items:list=None, rev:int=None)->dict:
+        """
+        Partial load, only unpickle the asked items in the section.\n
+        ### Args:\n
+        * section: like "Notebook", "refIQ", "Flux"...\n
+        * items: like ["q0"], all the items in the section if None.\n
+        * rev: the revision to load, the latest if None.
+        ### Returns:\n
+        {item: value, ...}
+        """
+        return {item: pickle.loads(blob) for item, _, blob in self.__latest_rows(section, items, rev) if blob is not None}
+
+    def commit(self, changes:dict, message:str="", replace_sections:list=[])->int:
+        """
+        Write a new revision with only the items different from the latest revision.\n
+        ### Args:\n
+        * changes: {section: {item: value, ...}, ...}\n
+        * replace_sections: the items not in `changes[section]` will be deleted for these sections.
+        ### Returns:\n
+        The new revision, or the latest revision if nothing changed.
+        """
+        rows = []
+        for section in changes:
+            latest = {item: digest for item, digest, blob in self.__latest_rows(section) if blob is not None}
+            for item, value in changes[section].items():
+                blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+                digest = sha256(blob).hexdigest()
+                if latest.get(item) != digest:
+                    rows.append((section, str(item), digest, blob))
+            if section in replace_sections:
+                for item in latest:
+                    if item not in changes[section]:
+                        rows.append((section, item, None, None))
+
+        if len(rows) == 0:
+            return self.latest_rev
+
+        with self.__conn:
+            rev = self.latest_rev + 1
+            self.__conn.execute("INSERT INTO revisions VALUES (?, ?, ?)", (rev, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), message))
+            self.__conn.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?)", [(section, item, rev, digest, blob) for section, item, digest, blob in rows])
+        return rev
+
+    def update(self, section:str, items:dict, message:str="")->int:
+        """ Partial update of some items in a section, like `update("refIQ", {"q0":[0.01,0.02]})`. """
+        return self.commit({section: items}, message)
+
+    def history(self, section:str, item:str)->list:
+        """ [(rev, time, value), ...] every time this item changed, value is None if it was deleted. """
+        rows = self.__conn.execute("""
+            SELECT e.rev, r.time, e.blob FROM entries e JOIN revisions r ON e.rev = r.rev
+            WHERE e.section = ? AND e.item = ? ORDER BY e.rev
+        """, (section, item)).fetchall()
+        return [(rev, time, None if blob is None else pickle.loads(blob)) for rev, time, blob in rows]
+
+    # QuantumDevice
+    @staticmethod
+    def quantum_device_items(quantum_device:QuantumDevice)->dict:
+        """ The serialized QuantumDevice (same as it's pickled) split into items, one for each element and edge. """
+        data = quantum_device.__getstate__()["data"]
+        items = {"name": data["name"], "cfg_sched_repetitions": data["cfg_sched_repetitions"]}
+        for element_name in data["elements"]:
+            items[f"elements.{element_name}"] = data["elements"][element_name]
+        for edge_name in data["edges"]:
+            items[f"edges.{edge_name}"] = data["edges"][edge_name]
+        return items
+
+    def build_quantum_device(self, rev:int=None)->QuantumDevice:
+        """ Rebuild the QuantumDevice and its elements like unpickling it. """
+        items = self.load(QD_section, rev=rev)
+        if "name" not in items:
+            raise KeyError(f"There is no QuantumDevice in {self.path} !")
+        state = {
+            "deserialization_type": f"{QuantumDevice.__module__}.{QuantumDevice.__name__}",
+            "data": {
+                "name": items["name"],
+                "elements": {item.split(".", 1)[-1]: items[item] for item in items if item.startswith("elements.")},
+                "edges": {item.split(".", 1)[-1]: items[item] for item in items if item.startswith("edges.")},
+                "cfg_sched_repetitions": items["cfg_sched_repetitions"],
+            },
+        }
+        quantum_device = QuantumDevice.__new__(QuantumDevice)
+        quantum_device.__setstate__(state)
+        return quantum_device
+
+    # QDmanager
+    def keep(self, QD_agent, message:str="", quantum_device:QuantumDevice=None, parent_rev:int=None)->int:
+        """
+        Commit the state of a QDmanager, only the changed items will be written.\n
+        The QuantumDevice section is skipped if `quantum_device` is None, which means it was never rebuilt so nothing changed.\n
+        `parent_rev` is the revision the QDmanager was loaded from, it warns when someone else committed after it because
+        their changes on the same items will be overwritten by this state.
+        """
+        if parent_rev is not None and parent_rev != self.latest_rev:
+            newer = [f"{rev} ({time}, {msg})" for rev, time, msg in self.revisions() if rev > parent_rev]
+            warning_print(f"The QD was loaded from revision {parent_rev} but the store is at {self.latest_rev}, the items changed in revision {', '.join(newer)} will be overwritten if they are different here.")
+        waveform_log = QD_agent.Waveformer.get_log()
+        changes = {
+            "meta": {item: getattr(QD_agent, item) for item in meta_items},
+            "Hcfg": {"all": QD_agent.Hcfg},
+            "refIQ": dict(QD_agent.refIQ),
+            "rotate_angle": dict(QD_agent.rotate_angle),
+            "Notebook": dict(QD_agent.Notewriter.get_notebook()),
+            "Flux": dict(QD_agent.Fluxmanager.get_bias_dict()),
+            "Waveform": {f"{mode}.{q}": waveform_log[mode][q] for mode in waveform_log for q in waveform_log[mode]},
+            "Discriminator": {"all": QD_agent.StateDiscriminator, **QD_agent.Discriminators.entries()},
+            "Provenance": dict(getattr(QD_agent, "provenance", {})),
+        }
+        replace_sections = ["refIQ", "rotate_angle", "Notebook", "Flux", "Waveform"]
+        if quantum_device is not None:
+            changes[QD_section] = self.quantum_device_items(quantum_device)
+            replace_sections.append(QD_section)
+        return self.commit(changes, message, replace_sections)
+
+    def load_manager_state(self, rev:int=None)->dict:
+        """ {section: {item: value}} for all the sections except the QuantumDevice. """
+        return {section: self.load(section, rev=rev) for section in manager_sections}
+
+
+def migrate_SumInfo(pkl_path:str, store_path:str=None)->str:
+    """
+    Convert a `*_SumInfo.pkl` (QDmanager v2.0) into the QD store, return the store path. The pkl file is not touched.\n
+    The older dict-like pkl should be converted by `QDmanager.version_converter()` first.
+    """
+    from qblox_drive_AS.support.QDmanager import QDmanager
+    if store_path is None:
+        store_path = os.path.splitext(pkl_path)[0] + store_ext
+    QD_agent = QDmanager(pkl_path)
+    QD_agent.QD_loader()
+    with QDstore(store_path) as store:
+        rev = store.keep(QD_agent, message=f"migrated from {os.path.split(pkl_path)[-1]}", quantum_device=QD_agent.quantum_device)
+    highlight_print(f"{pkl_path} migrated into {store_path} as revision {rev}")
+    return store_path
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) not in [2, 3]:
+        raise ValueError("Usage: python QDstore.py <*_SumInfo.pkl> [store path] !")
+    migrate_SumInfo(*sys.argv[1:])
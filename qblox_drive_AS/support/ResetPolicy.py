@@ -0,0 +1,176 @@
+"""
+Reset-time policy. The idle `Reset(q)` at the start of every shot is derived from the T1 in the Notebook instead of a hand-set
+`reset.duration()`, and the qubits in a multiplexed batch share the longest one.\n
+With `active=True` the idle reset is replaced by a measurement-based conditional reset (like quantify's `ConditionalReset`, but read out
+on the shared "q:res" port as `Readout` does). The qubit is measured by a thresholded acquisition (`measure.acq_rotation`,
+`measure.acq_threshold` from the SingleShot discriminator) and flipped by a pi-pulse if it's in |1>, then the resonator rings down for
+`ring_down` before the shot goes on. A sequencer can't mix the thresholded acquisition with the SSBIntegrationComplex of the data,
+so the conditional readout takes its own sequencer by the clock "<q>.ro_reset" on the readout output.
+"""
+from numpy import log, array, mean, arctan2, pi
+from quantify_scheduler import Schedule
+from quantify_scheduler.device_under_test.quantum_device import QuantumDevice
+from quantify_scheduler.operations.gate_library import Reset, X
+from quantify_scheduler.operations.pulse_library import SquarePulse, IdlePulse
+from quantify_scheduler.operations.acquisition_library import ThresholdedAcquisition
+from quantify_scheduler.operations.control_flow_library import Conditional
+from quantify_scheduler.backends.qblox.constants import TRIGGER_DELAY
+from quantify_scheduler.resources import ClockResource
+from quantify_scheduler.helpers.collections import find_port_clock_path
+from qblox_drive_AS.support.UserFriend import *
+from qblox_drive_AS.support.QDmanager import QDmanager
+from qblox_drive_AS.support.IQtransform import rotate_IQ
+from qblox_drive_AS.support import multiples_of_x
+
+# the acquisition channels of the conditional resets are out of the data channels, the gettables drop them
+reset_acq_channel_base:int = 1000
+
+
+class ResetPolicy():
+    """
+    ### Example:\n
+    ```
+    EXP = EnergyRelaxation(QD_path, save_dir)
+    EXP.reset_policy = ResetPolicy(safety_factor=5)   # reset = 5*T1, the residual excitation exp(-5) ~ 0.7%
+    ```
+    ### Args:\n
+    * safety_factor: reset = safety_factor*T1, or give `residual` (like 0.01) to get it by -ln(residual).\n
+    * min_reset, max_reset: the bounds (sec).\n
+    * active: use the conditional active reset, the qubits without a discriminator threshold fall back to the idle reset.\n
+    * ring_down: the idle (sec) after the conditional reset of a qubit for the resonator to be empty. The pulses placed before the readout
+    (like the free evolution of T1 or Ramsey) go into these idles, so they should be long enough to hold them.
+    """
+    def __init__(self, safety_factor:float=5, residual:float=None, min_reset:float=4e-6, max_reset:float=1e-3, active:bool=False, ring_down:float=2e-6):
+        self.safety_factor:float = -log(residual) if residual is not None else safety_factor
+        self.min_reset:float = min_reset
+        self.max_reset:float = max_reset
+        self.active:bool = active
+        self.ring_down:float = ring_down
+
+    def idle_reset_for(self, QD_agent:QDmanager, q:str)->float|None:
+        """ safety_factor*T1 in sec, None if there is no T1 record of this qubit. """
+        T1_us = QD_agent.Notewriter.get_T1For(q)
+        if T1_us is None or T1_us <= 0:
+            return None
+        return min(max(multiples_of_x(self.safety_factor*T1_us*1e-6, 4e-9), self.min_reset), self.max_reset)
+
+    def apply(self, QD_agent:QDmanager, qubits:list)->dict:
+        """
+        Set the `reset.duration()` of the `qubits` measured together. The schedules add `Reset(q)` one after another, so the longest
+        reset of the batch is shared by them instead of every qubit waiting for it. Returns {q: (old reset, new reset)}.
+        """
+        olds = {q: QD_agent.quantum_device.get_element(q).reset.duration() for q in qubits}
+        actives = [q for q in qubits if self.active and has_threshold(QD_agent, q)]
+        if self.active and len(actives) != len(qubits):
+            warning_print(f"{[q for q in qubits if q not in actives]} have no discriminator threshold, do the SingleShot first. They keep the idle reset.")
+        idles = [q for q in qubits if q not in actives]
+
+        resets = {}
+        for q in idles:
+            resets[q] = self.idle_reset_for(QD_agent, q)
+            if resets[q] is None:
+                warning_print(f"{q} has no T1 record, keep its reset = {round(olds[q]*1e6,1)} µs")
+                resets[q] = olds[q]
+        if len(idles) != 0:
+            # the ring-downs of the active ones are a part of the batch reset too
+            share = multiples_of_x(max(max(resets.values())-len(actives)*self.ring_down, 0)/len(idles), 4e-9)
+            for q in idles:
+                QD_agent.quantum_device.get_element(q).reset.duration(share)
+        for q in actives:
+            QD_agent.quantum_device.get_element(q).reset.duration(self.ring_down)
+            reserve_reset_readout(QD_agent.quantum_device, q)
+        # the schedules read it from the loaded quantum_device, it's not kept in the QD file
+        QD_agent.quantum_device.active_reset = actives
+
+        changes = {q: (olds[q], QD_agent.quantum_device.get_element(q).reset.duration()) for q in qubits}
+        slightly_print("Reset policy: " + ", ".join([f"{q} {round(changes[q][0]*1e6,1)} -> {round(changes[q][1]*1e6,1)} µs{' + active' if q in actives else ''}" for q in qubits]))
+        return changes
+
+
+def has_threshold(QD_agent:QDmanager, q:str)->bool:
+    measure = QD_agent.quantum_device.get_element(q).measure
+    return measure.acq_threshold() != 0 or measure.acq_rotation() != 0
+
+
+def memo_threshold(QD_agent:QDmanager, q:str, centers, scale:float=1):
+    """
+    Keep the thresholded acquisition of a qubit from its discriminated |0> and |1> IQ centers (`GMMROFidelity.mapped_centers`),
+    rotate them onto the I axis with |1> on the right, the threshold is in the middle. `scale` is the factor the centers were multiplied with.
+    """
+    centers = array(centers, dtype=float)/scale        # (state, IQ)
+    vector = centers[1]-centers[0]
+    angle = float(arctan2(vector[1], vector[0])*180/pi)
+    rotated = rotate_IQ(centers.T, angle)              # (IQ, state)
+    element = QD_agent.quantum_device.get_element(q)
+    element.measure.acq_rotation((-angle) % 360)
+    element.measure.acq_threshold(float(mean(rotated[0])))
+
+
+def reserve_reset_readout(quantum_device:QuantumDevice, q:str):
+    """ Add the port-clock ("q:res", "<q>.ro_reset") next to the qubit readout in the hardware config, it's another sequencer on that output. """
+    hcfg = quantum_device.hardware_config()
+    path = find_port_clock_path(hcfg, "q:res", f"{q}.ro")
+    portclock_configs = hcfg
+    for key in path[:-1]:
+        portclock_configs = portclock_configs[key]
+    if not any([pc["clock"] == f"{q}.ro_reset" for pc in portclock_configs]):
+        portclock_configs.append({**portclock_configs[path[-1]], "clock":f"{q}.ro_reset"})
+        quantum_device.hardware_config(hcfg)
+
+
+def conditional_reset(quantum_device:QuantumDevice, q:str, acq_channel:int, acq_index:int)->Schedule:
+    """ Read the qubit out with its thresholded acquisition, and play a pi-pulse on it if the result is |1>. """
+    qubit = quantum_device.get_element(q)
+    measure = qubit.measure
+    sched = Schedule(f"conditional reset {q}")
+    sched.add_resource(ClockResource(name=f"{q}.ro_reset", freq=qubit.clock_freqs.readout()))
+    # the readout pulse rides on the acquisition operation like a Measure does, nothing else may play while the latch is reset
+    readout = ThresholdedAcquisition(
+        port="q:res",
+        clock=q+".ro_reset",
+        duration=measure.integration_time(),
+        acq_channel=acq_channel,
+        acq_index=acq_index,
+        feedback_trigger_label=q,
+        t0=measure.acq_delay()+4e-9,
+        acq_rotation=measure.acq_rotation(),
+        acq_threshold=measure.acq_threshold(),
+        )
+    readout.add_pulse(SquarePulse(duration=measure.pulse_duration(), amp=measure.pulse_amp(), port="q:res", clock=q+".ro_reset", t0=4e-9))
+    sched.add(readout)
+    flip = Schedule(f"flip {q}")
+    flip.add(X(q))
+    sched.add(flip, control_flow=Conditional(q), rel_time=TRIGGER_DELAY)
+    return sched
+
+
+def with_active_reset(sched:Schedule, quantum_device:QuantumDevice, qubits:list)->Schedule:
+    """
+    Put the conditional resets of the `qubits` in front of the first idle `Reset` of every shot (the idle resets are shortened by
+    `ResetPolicy.apply`). The qubits are reset one after another, a conditional acquisition must be followed by its conditional pulse
+    before the next one, and nothing else may play meanwhile.
+    """
+    first_reset = None
+    for schedulable in sched.schedulables.values():
+        if isinstance(sched.operations[schedulable["operation_id"]], Reset):
+            first_reset = schedulable["operation_id"]
+            break
+    if first_reset is None:
+        return sched
+
+    # the readout of the last shot may still be on (the next shot starts after its integration), and the resonator rings down after it
+    ro_tail = max([quantum_device.get_element(q).measure.pulse_duration() for q in qubits])
+    buffer = multiples_of_x(ro_tail+quantum_device.get_element(qubits[0]).reset.duration(), 4e-9)
+    # the identical Resets are one operation in the schedule, every shot gets its own copy for the acquisition index
+    shot_idx = 0
+    for schedulable in sched.schedulables.values():
+        if schedulable["operation_id"] == first_reset:
+            active = Schedule("active reset")
+            active.add(IdlePulse(duration=buffer))
+            for idx, q in enumerate(qubits):
+                active.add(conditional_reset(quantum_device, q, reset_acq_channel_base+idx, shot_idx))
+            active.add(sched.operations[first_reset])
+            sched.operations[f"{first_reset} active {shot_idx}"] = active
+            schedulable["operation_id"] = f"{first_reset} active {shot_idx}"
+            shot_idx += 1
+    return sched
@@ -0,0 +1,295 @@
+"""
+Content-addressed cache for the compiled schedules, so the identical schedules in histogram repeats and monitoring loops skip the compilation.\n
+The key covers the schedule function (with its module source), the sources of the pulse libraries it builds with (Pulse_schedule_library, WaveformCtrl),
+the quantify-scheduler and qblox-instruments versions, the normalized schedule kwargs, the repetitions, the device elements and `quantum_device.hardware_config()`.
+"""
+import os, json, pickle, inspect, importlib
+from hashlib import sha256
+from time import perf_counter
+from collections import OrderedDict
+from numpy import ndarray, generic, ascontiguousarray
+from quantify_scheduler.gettables import ScheduleGettable, _evaluate_parameter_dict
+from quantify_scheduler.device_under_test.quantum_device import QuantumDevice
+from quantify_scheduler.schedules.schedule import CompiledSchedule
+from qblox_drive_AS.support.UserFriend import *
+from qblox_drive_AS.support.SweepCompiler import ParametricSweep, compile_parametric_sweep, OuterSweep, compile_outer_sweep
+from qblox_drive_AS.support.PhaseTracer import trace
+from qblox_drive_AS.support.ResetPolicy import with_active_reset, reset_acq_channel_base
+
+# the modules the schedule functions build their pulses with
+pulse_library_modules:list = ["qblox_drive_AS.support.Pulse_schedule_library", "qblox_drive_AS.support.WaveformCtrl"]
+# qblox_drive_AS/Schedule_cache, give it as `cache_dir` to keep the compiled schedules across the sessions
+default_cache_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'Schedule_cache')
+
+
+def normalize_sched_kwargs(value):
+    """
+    Turn the schedule kwargs into something json can dump in a deterministic way. Arrays are represented by their dtype, shape and a digest of the bytes.\n
+    Raise TypeError for the objects without a stable representation, a repr with the memory address would never hit the cache.
+    """
+    if isinstance(value, dict):
+        return {str(k): normalize_sched_kwargs(value[k]) for k in sorted(value, key=str)}
+    elif isinstance(value, (list, tuple)):
+        return [normalize_sched_kwargs(v) for v in value]
+    elif isinstance(value, ndarray):
+        return {"dtype":str(value.dtype), "shape":list(value.shape), "digest":sha256(ascontiguousarray(value).tobytes()).hexdigest()}
+    elif isinstance(value, generic):
+        return value.item()
+    elif value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    elif isinstance(value, complex):
+        return {"real":value.real, "imag":value.imag}
+    elif hasattr(value, "get_log"):
+        # GateGenesis, the waveform settings decide what pulses will be played
+        return normalize_sched_kwargs(value.get_log())
+    else:
+        raise TypeError(f"The schedule kwarg {type(value).__name__} can't be normalized into a cache key !")
+
+
+class ScheduleCache():
+    """
+    Two tiers cache for `CompiledSchedule`, an in-memory LRU with `max_items` and an optional on-disk pickle folder `cache_dir`.\n
+    The disk tier is off by default (`cache_dir=None`), give it like `default_cache_dir` to reuse the compilations across the sessions.
+    """
+    def __init__(self, max_items:int=32, cache_dir:str=None):
+        self.max_items:int = max_items
+        self.cache_dir:str = cache_dir
+        self.__memory:OrderedDict = OrderedDict()
+        self.__module_digests:dict = {}
+        self.__counters:dict = {"memory_hits":0, "disk_hits":0, "misses":0, "compile_time":0.0, "saved_compile_time":0.0}
+        self.__compile_time_rec:dict = {}
+
+    @property
+    def counters(self)->dict:
+        """ {"memory_hits", "disk_hits", "misses", "compile_time" (sec), "saved_compile_time" (sec)} """
+        return dict(self.__counters)
+
+    def __module_digest(self, module)->str:
+        """ sha256 of the module source, "" if it can't be read. """
+        module_name = module.__name__ if module is not None else ""
+        if module_name not in self.__module_digests:
+            try:
+                self.__module_digests[module_name] = sha256(inspect.getsource(module).encode()).hexdigest()
+            except (TypeError, OSError):
+                self.__module_digests[module_name] = ""
+        return self.__module_digests[module_name]
+
+    def __function_digest(self, schedule_function:callable)->dict:
+        """ The schedule function name and the source of its module, the cache will be invalid once the schedule library is changed. """
+        func = getattr(schedule_function, "__func__", schedule_function)
+        module = inspect.getmodule(func)
+        module_name = module.__name__ if module is not None else ""
+        ans = {"name":f"{module_name}.{func.__qualname__}", "module_source":self.__module_digest(module)}
+        # ScheduleConductor.__PulseSchedule__ uses the Waveformer of its QD_agent
+        owner = getattr(schedule_function, "__self__", None)
+        QD_agent = getattr(owner, "QD_agent", None)
+        if getattr(QD_agent, "Waveformer", None) is not None:
+            ans["waveformer"] = normalize_sched_kwargs(QD_agent.Waveformer.get_log())
+        return ans
+
+    def __toolchain_digest(self)->dict:
+        """ The sources of the pulse libraries and the versions of the compiler and the instrument drivers, a change of any recompiles. """
+        import quantify_scheduler, qblox_instruments
+        ans = {name: self.__module_digest(importlib.import_module(name)) for name in pulse_library_modules}
+        ans["quantify_scheduler"] = quantify_scheduler.__version__
+        ans["qblox_instruments"] = qblox_instruments.__version__
+        return ans
+
+    def make_key(self, schedule_function:callable, sched_kwargs:dict, quantum_device:QuantumDevice, repetitions:int)->str:
+        """ sched_kwargs should be evaluated, which means no qcodes Parameter in it. """
+        content = {
+            "function":self.__function_digest(schedule_function),
+            "toolchain":self.__toolchain_digest(),
+            "kwargs":normalize_sched_kwargs(sched_kwargs),
+            "repetitions":int(repetitions),
+            "elements":quantum_device.__getstate__()["data"],
+            "hardware_config":quantum_device.hardware_config(),
+            "active_reset":list(getattr(quantum_device, "active_reset", None) or []),
+        }
+        return sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+    def __disk_path(self, key:str)->str:
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def __remember(self, key:str, compiled:CompiledSchedule):
+        self.__memory[key] = compiled
+        self.__memory.move_to_end(key)
+        while len(self.__memory) > self.max_items:
+            self.__memory.popitem(last=False)
+
+    def get(self, key:str)->CompiledSchedule|None:
+        if key in self.__memory:
+            self.__memory.move_to_end(key)
+            self.__counters["memory_hits"] += 1
+            self.__counters["saved_compile_time"] += self.__compile_time_rec.get(key, 0.0)
+            return self.__memory[key]
+
+        if self.cache_dir is not None and os.path.exists(self.__disk_path(key)):
+            try:
+                with open(self.__disk_path(key), 'rb') as inp:
+                    compile_time, compiled, *extras = pickle.load(inp)
+                if len(extras) != 0 and extras[0] is not None:
+                    compiled.outer_sweep = extras[0]
+            except Exception as err:
+                warning_print(f"Broken schedule cache file {self.__disk_path(key)} was ignored: {err}")
+            else:
+                self.__compile_time_rec[key] = compile_time
+                self.__remember(key, compiled)
+                self.__counters["disk_hits"] += 1
+                self.__counters["saved_compile_time"] += compile_time
+                return compiled
+
+        self.__counters["misses"] += 1
+        return None
+
+    def put(self, key:str, compiled:CompiledSchedule, compile_time:float=0.0):
+        self.__compile_time_rec[key] = compile_time
+        self.__counters["compile_time"] += compile_time
+        self.__remember(key, compiled)
+        if self.cache_dir is not None:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            try:
+                with open(self.__disk_path(key), 'wb') as file:
+                    # the outer sweep info is an attribute, CompiledSchedule only pickles its data
+                    pickle.dump((compile_time, compiled, getattr(compiled, "outer_sweep", None)), file)
+            except Exception as err:
+                warning_print(f"Compiled schedule can't be saved on disk, keep it in memory only: {err}")
+                if os.path.exists(self.__disk_path(key)):
+                    os.remove(self.__disk_path(key))
+
+    def clear(self, disk:bool=False):
+        """ Clear the memory tier, also remove the files in `cache_dir` if disk=True. """
+        self.__memory.clear()
+        self.__compile_time_rec.clear()
+        if disk and self.cache_dir is not None and os.path.exists(self.cache_dir):
+            for file_name in os.listdir(self.cache_dir):
+                if file_name.endswith(".pkl"):
+                    os.remove(os.path.join(self.cache_dir, file_name))
+
+    def report(self)->dict:
+        counters = self.counters
+        slightly_print(f"Schedule cache: {counters['memory_hits']} memory hits, {counters['disk_hits']} disk hits, {counters['misses']} misses, compiled for {round(counters['compile_time'],2)} sec, saved {round(counters['saved_compile_time'],2)} sec.")
+        return counters
+
+
+# shared by all the measurements in this python process
+schedule_cache = ScheduleCache()
+
+
+class CachedScheduleGettable(ScheduleGettable):
+    """
+    Same as `ScheduleGettable`, but the compiled schedule comes from the `cache` (default: the shared `schedule_cache`) if the inputs are identical.\n
+    Give `parametric_sweep` the schedule kwarg name of a uniform sweep, like "freeduration", the sweep points will be looped on the sequencers
+    instead of unrolled if possible, see `SweepCompiler.compile_parametric_sweep`.\n
+    Give `outer_sweep` the schedule kwarg name of the slow axis of a 2D map with its `outer_samples`, then call `loop_outer()` before
+    configuring meas_ctrl, if it returns True the whole map is one program and the outer settable should be batched too.\n
+    If `quantum_device.active_reset` lists qubits (see `ResetPolicy`), their idle resets are replaced by the conditional resets, the sweeps are
+    unrolled then and the acquisitions of the conditional resets are dropped from the returned data.
+    """
+    def __init__(self, *args, cache:ScheduleCache=None, parametric_sweep:str=None, outer_sweep:str=None, outer_samples:ndarray=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache:ScheduleCache = schedule_cache if cache is None else cache
+        self.parametric_sweep:str = parametric_sweep
+        self.outer_sweep:str = outer_sweep
+        self.outer_samples:ndarray = outer_samples
+        self.__outer_looped:bool = False
+
+    @property
+    def active_reset(self)->list:
+        return list(getattr(self.quantum_device, "active_reset", None) or [])
+
+    def __evaluate_outer(self):
+        """ The outer settable is only given values by meas_ctrl, the schedule kwargs are evaluated with the first outer point. """
+        kwargs = dict(self.schedule_kwargs)
+        kwargs[self.outer_sweep] = float(self.outer_samples[0])
+        self._evaluated_sched_kwargs = _evaluate_parameter_dict(kwargs)
+
+    def __key(self, kwargs:dict, repetitions:int)->str|None:
+        """ The cache key, None if some kwargs can't be a part of the key and the schedule will be compiled without the cache. """
+        try:
+            return self.cache.make_key(self.schedule_function, kwargs, self.quantum_device, repetitions)
+        except TypeError as err:
+            slightly_print(f"Schedule cache is skipped: {err}")
+            return None
+
+    def __outer_key(self, repetitions:int)->str|None:
+        kwargs = dict(self._evaluated_sched_kwargs)
+        kwargs[self.outer_sweep] = {"outer_sweep":self.outer_samples}
+        return self.__key(kwargs, repetitions)
+
+    def __compile_outer(self, repetitions:int)->CompiledSchedule|None:
+        key = self.__outer_key(repetitions)
+        compiled = None
+        if key is not None:
+            with trace("cache_lookup"):
+                compiled = self.cache.get(key)
+        if compiled is None:
+            start = perf_counter()
+            with trace("compile"):
+                compiled = compile_outer_sweep(self.quantum_device, OuterSweep(self.schedule_function, self._evaluated_sched_kwargs, self.outer_sweep, self.outer_samples), repetitions)
+            if compiled is not None and key is not None:
+                self.cache.put(key, compiled, perf_counter()-start)
+        return compiled
+
+    def loop_outer(self)->bool:
+        """ Try to compile the outer sweep into the sequencers (see `SweepCompiler.compile_outer_sweep`), True if it can be looped. """
+        self.__outer_looped = False
+        if self.outer_sweep is None or self.outer_samples is None or len(self.active_reset) != 0:
+            return False
+        self.__evaluate_outer()
+        self.__outer_looped = self.__compile_outer(self.quantum_device.cfg_sched_repetitions()) is not None
+        if self.__outer_looped:
+            slightly_print(f"The {len(self.outer_samples)} points of '{self.outer_sweep}' are looped on the sequencers, one upload for the whole map.")
+        return self.__outer_looped
+
+    def __compile_sweep(self, repetitions:int):
+        compiled = None
+        if self.parametric_sweep is not None and len(self.active_reset) == 0:
+            sweep = ParametricSweep(self.schedule_function, self._evaluated_sched_kwargs, self.parametric_sweep)
+            compiled = compile_parametric_sweep(self.quantum_device, sweep, repetitions)
+        if compiled is None:
+            sched = self.schedule_function(**self._evaluated_sched_kwargs, repetitions=repetitions)
+            if len(self.active_reset) != 0:
+                sched = with_active_reset(sched, self.quantum_device, self.active_reset)
+            self._compile(sched=sched)
+        else:
+            self._compiled_schedule = compiled
+
+    def initialize(self):
+        repetitions = self.quantum_device.cfg_sched_repetitions()
+        if self.__outer_looped:
+            self.__evaluate_outer()
+            compiled = self.__compile_outer(repetitions)
+            if compiled is None:
+                raise RuntimeError("The outer sweep was looped by `loop_outer()`, but it can't be compiled now !")
+            self._compiled_schedule = compiled
+            self.quantum_device.instr_instrument_coordinator.get_instr().prepare(self._compiled_schedule)
+            self.is_initialized = True
+            return
+
+        self._evaluated_sched_kwargs = _evaluate_parameter_dict(self.schedule_kwargs)
+        key = self.__key(self._evaluated_sched_kwargs, repetitions)
+        compiled = None
+        if key is not None:
+            with trace("cache_lookup"):
+                compiled = self.cache.get(key)
+        if compiled is None:
+            start = perf_counter()
+            with trace("compile"):
+                self.__compile_sweep(repetitions)
+            if key is not None:
+                self.cache.put(key, self._compiled_schedule, perf_counter()-start)
+        else:
+            self._compiled_schedule = compiled
+
+        instr_coordinator = self.quantum_device.instr_instrument_coordinator.get_instr()
+        instr_coordinator.prepare(self._compiled_schedule)
+
+        self.is_initialized = True
+
+    def process_acquired_data(self, acquired_data):
+        # the conditional resets acquire on their own channels, they are not the data
+        if len(self.active_reset) != 0:
+            acquired_data = acquired_data.drop_vars([ch for ch in acquired_data.data_vars if int(ch) >= reset_acq_channel_base])
+        return super().process_acquired_data(acquired_data)
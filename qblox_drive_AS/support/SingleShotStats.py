@@ -0,0 +1,146 @@
+"""
+Single-shot statistics on binned shots. The shots of the prepared |0> and |1> are counted into 2D histograms chunk by chunk (or
+minibatch by minibatch with `ShotHistogram.add`), so the memory is the bins however many shots there are. The two-state mixture is
+fitted on the weighted bin centers by `TwoStateGMM`, and the overlaps are the erf of the Gaussian tails instead of numerical integrals.
+"""
+from numpy import ndarray, array, asarray, zeros, linspace, meshgrid, histogram, histogram2d, cumsum, searchsorted, sqrt, exp, log, angle, cos, sin, inf
+from scipy.special import erfc
+from qblox_drive_AS.support.StateDiscriminator import TwoStateGMM
+from qblox_drive_AS.support.UserFriend import *
+
+
+class ShotHistogram():
+    """
+    The 2D histograms of the prepared |0> ("g") and |1> ("e") shots on the same grid.\n
+    ### Example:\n
+    ```
+    hist = ShotHistogram(bins=401)
+    for g_IQ, e_IQ in minibatches:          # (IQ, shots) of each
+        hist.add("g", *g_IQ).add("e", *e_IQ)
+    results = two_state_statistics(hist, T1, tau)
+    ```
+    ### Args:\n
+    * bins: the bins along I and Q.\n
+    * ranges: [[I min, I max], [Q min, Q max]], if None it's set by the first minibatch and widened by `margin` of its span on both sides.
+    The shots out of the grid are dropped and counted in `outside`.
+    """
+    def __init__(self, bins:int=401, ranges:list=None, margin:float=0.5):
+        self.bins:int = bins
+        self.margin:float = margin
+        self.ranges:ndarray = None if ranges is None else array(ranges, dtype=float)
+        self.counts:dict = {"g":zeros((bins, bins)), "e":zeros((bins, bins))}   # (I bins, Q bins)
+        self.outside:dict = {"g":0, "e":0}
+
+    def add(self, state:str, I:ndarray, Q:ndarray):
+        if state not in self.counts:
+            raise KeyError(f"Unknown prepared state '{state}', use 'g' or 'e' !")
+        I, Q = asarray(I, dtype=float).reshape(-1), asarray(Q, dtype=float).reshape(-1)
+        if self.ranges is None:
+            span = array([[I.min(), I.max()], [Q.min(), Q.max()]])
+            widen = (span[:, 1]-span[:, 0])*self.margin
+            self.ranges = span + array([-widen, widen]).T
+        counts, _, _ = histogram2d(I, Q, bins=self.bins, range=self.ranges)
+        self.counts[state] += counts
+        self.outside[state] += I.size - int(counts.sum())
+        return self
+
+    @property
+    def centers(self)->ndarray:
+        """ The bin centers in (IQ, I bins, Q bins). """
+        mids = []
+        for low, high in self.ranges:
+            edges = linspace(low, high, self.bins+1)
+            mids.append((edges[1:]+edges[:-1])/2)
+        return array(meshgrid(mids[0], mids[1], indexing="ij"))
+
+    def shots(self, state:str)->int:
+        return int(self.counts[state].sum())
+
+
+def histogram_shots(data:dict, bins:int=401, chunk:int=1000000)->ShotHistogram:
+    """ Count the single-shot dict {"g": (I, Q), "e": (I, Q)} into a `ShotHistogram`, `chunk` shots at a time on the grid of all the shots. """
+    lows, highs = [inf, inf], [-inf, -inf]
+    for state in ["g", "e"]:
+        for axis in range(2):
+            shots = data[state][axis]
+            for start in range(0, len(shots), chunk):
+                part = asarray(shots[start:start+chunk], dtype=float)
+                lows[axis], highs[axis] = min(lows[axis], part.min()), max(highs[axis], part.max())
+    hist = ShotHistogram(bins, ranges=[[lows[0], highs[0]], [lows[1], highs[1]]])
+    for state in ["g", "e"]:
+        I, Q = data[state][0], data[state][1]
+        for start in range(0, len(I), chunk):
+            hist.add(state, I[start:start+chunk], Q[start:start+chunk])
+    return hist
+
+
+def _weighted_median(values:ndarray, weights:ndarray)->float:
+    order = values.argsort()
+    accumulated = cumsum(weights[order])
+    return values[order][searchsorted(accumulated, accumulated[-1]/2)]
+
+
+def _component_weights(model:TwoStateGMM, points:ndarray, counts:ndarray, max_iter:int=200, tol:float=1e-10)->ndarray:
+    """ The fractions of the two fixed components in the weighted points, EM on the mixture weights only. """
+    loglike = model.log_likelihoods(points)
+    loglike -= loglike.max(axis=0)
+    fractions = array([0.5, 0.5])
+    for _ in range(max_iter):
+        p = exp(loglike + log(fractions)[:, None])
+        p /= p.sum(axis=0)
+        new = (p*counts).sum(axis=1)/counts.sum()
+        if abs(new-fractions).max() < tol:
+            fractions = new
+            break
+        fractions = new
+    return fractions
+
+
+def two_state_statistics(hist:ShotHistogram, T1:float, tau:float)->dict:
+    """
+    Fit the two-state mixture on the histograms and get the readout errors like `Qubit_state_single_shot_fit_analysis` does.
+    The components share an isotropic sigma (the mean of their fitted variances) for the overlaps.
+    ### Returns:\n
+    {"g_center", "e_center", "angle", "sigma", "weights_g" [P(0|0), P(1|0)], "weights_e" [P(0|1), P(1|1)], "I_ro", "hist_g", "hist_e", "error_pack"},
+    the hists are the densities along the rotated I with |0> at 0.
+    """
+    centers = hist.centers.reshape(2, -1)
+    g_counts, e_counts = hist.counts["g"].reshape(-1), hist.counts["e"].reshape(-1)
+    used = (g_counts + e_counts) > 0
+    points, g_counts, e_counts = centers[:, used], g_counts[used], e_counts[used]
+    if hist.outside["g"] + hist.outside["e"] != 0:
+        warning_print(f"{hist.outside['g'] + hist.outside['e']} shots are out of the histogram range and dropped.")
+
+    init = array([[_weighted_median(points[axis], counts) for axis in range(2)] for counts in [g_counts, e_counts]])
+    model = TwoStateGMM().fit(points, weights=g_counts+e_counts, init_means=init)
+    g_center, e_center = model.means[0], model.means[1]
+    sigma = float(sqrt(sum([model.weights[k]*(model.covs[k][0][0]+model.covs[k][1][1])/2 for k in range(2)])))
+    weights_g = _component_weights(model, points, g_counts)
+    weights_e = _component_weights(model, points, e_counts)
+
+    # displace + rotate, |0> at the origin and |1> on the I axis
+    theta = float(angle((e_center[0]-g_center[0]) + 1j*(e_center[1]-g_center[1])))
+    D = float(sqrt(((e_center-g_center)**2).sum()))
+    # the tail of a Gaussian beyond the middle point
+    tail = 0.5*erfc(D/(2*sqrt(2)*sigma))
+    overlap = tail
+    Thermal = weights_g[1]
+    Relax = weights_e[0] - Thermal
+    # the same sums as the former quad integrals: the mis-assigned other component plus the tail of the own one
+    Peg = weights_g[1]*(1-tail) + tail
+    Pge = weights_e[0]*(1-tail) + tail
+    SNR = D/sigma
+    overlap_predict = 0.5*erfc(sqrt(SNR**2/8))
+    Relax_predict = 1+(T1/tau)*(exp(-tau/T1)-1)   # Relax_cal(0, tau, T1)
+    error_pack = dict(D=D, sigma=sigma, SNR=SNR, overlap=overlap, overlap_predict=overlap_predict, Peg=Peg, Pge=Pge, Thermal=Thermal, Relax=Relax,
+                      Relax_predict=Relax_predict, Pre_decay=Relax-Relax_predict, F_s=1-overlap, F_g=1-Peg, F_e=1-Pge, F=1-(Peg+Pge)/2)
+
+    # the densities along the rotated I from the bin centers, it's the binned version of projecting the shots
+    R = 10*sigma
+    rot_I = (points[0]-g_center[0])*cos(theta) + (points[1]-g_center[1])*sin(theta)
+    span = [min(0, D)-R, max(0, D)+R]
+    hist_g, edges = histogram(rot_I, bins=hist.bins, range=span, weights=g_counts, density=True)
+    hist_e, _ = histogram(rot_I, bins=hist.bins, range=span, weights=e_counts, density=True)
+
+    return {"g_center":g_center, "e_center":e_center, "angle":theta, "sigma":sigma, "weights_g":weights_g, "weights_e":weights_e,
+            "I_ro":(edges[1:]+edges[:-1])/2, "hist_g":hist_g, "hist_e":hist_e, "error_pack":error_pack}
@@ -0,0 +1,220 @@
+"""
+Two-state discriminators which are trained once and kept with the QD.\n
+`TwoStateGMM` is a 2D Gaussian mixture in the IQ plane fitted by EM on its sufficient statistics, so it can be refitted on weighted points
+(like histogram bins) and updated incrementally with the new shots. `DiscriminatorRegistry` keeps a model per qubit together with the readout
+config (frequency, amplitude, integration time, attenuation) it was trained with, the model is reused until the readout config changes.
+The models are trained on the IQ in mV (1000 * the raw data), the same scale the single-shot analyses use.
+"""
+import datetime
+from numpy import ndarray, array, asarray, zeros, ones, median, sqrt, log, exp, pi, einsum, argmax, mean
+from qblox_drive_AS.support.UserFriend import *
+
+
+class TwoStateGMM():
+    """
+    Two 2D Gaussians, component 0 is |0> and component 1 is |1>.\n
+    ### Example:\n
+    ```
+    model = TwoStateGMM().train(data)     # data in (IQ, prepared_state, shots)
+    states = model.predict(other_data)    # IQ axis first, any shape after it
+    ```
+    """
+    def __init__(self):
+        self.weights:ndarray = array([0.5, 0.5])
+        self.means:ndarray = zeros((2, 2))                   # (state, IQ)
+        self.covs:ndarray = array([[[1., 0.], [0., 1.]]]*2)  # (state, IQ, IQ)
+        self.stats:tuple = None                              # the per-shot sufficient statistics (N, S, Q) of the last fit or update
+        self.shots:int = 0
+        self.updates:int = 0
+
+    @property
+    def centers(self)->ndarray:
+        """ (state, IQ) """
+        return self.means
+
+    @staticmethod
+    def __flatten(points:ndarray)->ndarray:
+        points = asarray(points, dtype=float)
+        return points.reshape(2, -1)
+
+    def log_likelihoods(self, points:ndarray)->ndarray:
+        """ log N(x | mean_k, cov_k) in (state, points), the 2x2 inverse and determinant are in closed form. """
+        x = self.__flatten(points)
+        ans = []
+        for k in range(2):
+            (a, b), (_, d) = self.covs[k]
+            det = a*d - b*b
+            dx, dy = x[0]-self.means[k][0], x[1]-self.means[k][1]
+            maha = (d*dx*dx - 2*b*dx*dy + a*dy*dy)/det
+            ans.append(-0.5*maha - log(2*pi*sqrt(det)))
+        return array(ans)
+
+    def responsibilities(self, points:ndarray)->ndarray:
+        """ The posterior of the states in (state, points) with the mixture weights. """
+        logp = self.log_likelihoods(points) + log(self.weights)[:, None]
+        top = logp.max(axis=0)
+        p = exp(logp - top)
+        return p / p.sum(axis=0)
+
+    def __sufficient_stats(self, points:ndarray, weights:ndarray=None)->tuple:
+        x = self.__flatten(points)
+        w = ones(x.shape[1]) if weights is None else asarray(weights, dtype=float).reshape(-1)
+        r = self.responsibilities(x) * w          # (state, points)
+        total = w.sum()
+        N = r.sum(axis=1) / total                  # (state,)
+        S = r @ x.T / total                        # (state, IQ)
+        Q = einsum("kn,in,jn->kij", r, x, x) / total
+        return N, S, Q
+
+    def __maximize(self, stats:tuple, reg:float=1e-6):
+        N, S, Q = stats
+        self.weights = N / N.sum()
+        self.means = S / N[:, None]
+        self.covs = Q / N[:, None, None] - einsum("ki,kj->kij", self.means, self.means)
+        scale = mean([self.covs[k][0][0] + self.covs[k][1][1] for k in range(2)])
+        self.covs += reg * scale * array([[1., 0.], [0., 1.]])
+
+    def fit(self, points:ndarray, weights:ndarray=None, init_means:ndarray=None, max_iter:int=200, tol:float=1e-8):
+        """
+        EM on the points (IQ first) or on the weighted points like the centers of histogram bins with their counts.\n
+        `init_means` in (state, IQ), the components keep the order of it.
+        """
+        x = self.__flatten(points)
+        if init_means is not None:
+            self.means = array(init_means, dtype=float)
+            spread = x.var(axis=1).mean()
+            self.covs = array([[[spread, 0.], [0., spread]]]*2)
+            self.weights = array([0.5, 0.5])
+        last = None
+        for _ in range(max_iter):
+            stats = self.__sufficient_stats(x, weights)
+            self.__maximize(stats)
+            if last is not None and abs(self.means - last).max() < tol * (1 + abs(self.means).max()):
+                break
+            last = self.means.copy()
+        self.stats = self.__sufficient_stats(x, weights)
+        self.shots = int(x.shape[1] if weights is None else asarray(weights).sum())
+        return self
+
+    def train(self, data:ndarray):
+        """ Fit the shots in (IQ, prepared_state, shots), the prepared |0> and |1> decide which component is which. """
+        data = asarray(data, dtype=float)
+        init = array([median(data[:, 0, :], axis=1), median(data[:, 1, :], axis=1)])
+        self.fit(data.reshape(2, -1), init_means=init)
+        # the component nearer to the prepared |1> is |1>
+        if ((self.means[0]-init[1])**2).sum() < ((self.means[1]-init[1])**2).sum():
+            self.weights, self.means, self.covs = self.weights[::-1].copy(), self.means[::-1].copy(), self.covs[::-1].copy()
+            self.stats = tuple(stat[::-1].copy() for stat in self.stats)
+        self.updates = 0
+        return self
+
+    def partial_fit(self, points:ndarray, weights:ndarray=None, rate:float=0.3, steps:int=3):
+        """
+        Incremental EM for the drift, the sufficient statistics are blended as (1-rate)*old + rate*new and the parameters follow them.
+        The component order is kept.
+        """
+        if self.stats is None:
+            return self.fit(points, weights)
+        x = self.__flatten(points)
+        old = self.stats
+        for _ in range(steps):
+            new = self.__sufficient_stats(x, weights)
+            blended = tuple((1-rate)*o + rate*n for o, n in zip(old, new))
+            self.__maximize(blended)
+        self.stats = blended
+        self.shots += int(x.shape[1] if weights is None else asarray(weights).sum())
+        self.updates += 1
+        return self
+
+    def predict(self, points:ndarray)->ndarray:
+        """
+        The state of every shot, IQ on the first axis and the returns keep the rest of the shape.
+        It's the most likely state without the mixture weights, so it doesn't depend on the populations of the data.
+        """
+        points = asarray(points, dtype=float)
+        return argmax(self.log_likelihoods(points), axis=0).reshape(points.shape[1:])
+
+    def population(self, points:ndarray, axis:int=-1)->ndarray:
+        """ The |1> population along the shots `axis` of the states (so the IQ axis is gone). """
+        return self.predict(points).mean(axis=axis)
+
+    def assignment_matrix(self, data:ndarray)->ndarray:
+        """ [[P(0|0), P(1|0)], [P(0|1), P(1|1)]] of the shots in (IQ, prepared_state, shots). """
+        p1 = self.population(data)
+        return array([[1-p1[0], p1[0]], [1-p1[1], p1[1]]])
+
+
+class DiscriminatorRegistry():
+    """
+    The discriminator of every qubit with the readout config it was trained with, kept in QDmanager as `Discriminators`.\n
+    ### Example:\n
+    ```
+    config = DiscriminatorRegistry.readout_config(QD_agent, "q0")
+    model = QD_agent.Discriminators.fetch_or_train("q0", config, data)   # data in (IQ, prepared_state, shots), mV
+    p1 = QD_agent.Discriminators.classify("q0", day_data).mean(axis=-1)
+    ```
+    """
+    def __init__(self, entries:dict=None):
+        self.__entries:dict = {} if entries is None else dict(entries)   # {q: {"config", "model", "trained", "updated"}}
+
+    def __contains__(self, q:str)->bool:
+        return q in self.__entries
+
+    def entries(self)->dict:
+        return dict(self.__entries)
+
+    @staticmethod
+    def readout_config(QD_agent, q:str)->dict:
+        """ The readout settings a discriminator depends on. """
+        qubit = QD_agent.quantum_device.get_element(q)
+        try:
+            ro_atte = QD_agent.Notewriter.get_DigiAtteFor(q, 'ro')
+        except KeyError:
+            ro_atte = None
+        return {"rof":qubit.clock_freqs.readout(), "ro_amp":qubit.measure.pulse_amp(), "integration":qubit.measure.integration_time(), "ro_atte":ro_atte}
+
+    @staticmethod
+    def same_config(config:dict, other:dict, rel_tol:float=1e-6)->bool:
+        if set(config) != set(other):
+            return False
+        for key in config:
+            a, b = config[key], other[key]
+            if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+                if abs(a-b) > rel_tol*max(abs(a), abs(b), 1e-12):
+                    return False
+            elif a != b:
+                return False
+        return True
+
+    def get(self, q:str, config:dict=None)->TwoStateGMM|None:
+        """ The model of the qubit, None if there isn't one or it was trained with another readout config. """
+        entry = self.__entries.get(q)
+        if entry is None or (config is not None and not self.same_config(entry["config"], config)):
+            return None
+        return entry["model"]
+
+    def train(self, q:str, config:dict, data:ndarray)->TwoStateGMM:
+        model = TwoStateGMM().train(data)
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.__entries[q] = {"config":dict(config), "model":model, "trained":now, "updated":now}
+        return model
+
+    def track(self, q:str, data:ndarray, rate:float=0.3)->TwoStateGMM:
+        """ Follow the drift by an incremental EM update with the new shots (IQ first). """
+        model = self.__entries[q]["model"].partial_fit(asarray(data, dtype=float).reshape(2, -1), rate=rate)
+        self.__entries[q]["updated"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return model
+
+    def fetch_or_train(self, q:str, config:dict, data:ndarray, rate:float=0.3)->TwoStateGMM:
+        """ Update the kept model with `data` (IQ, prepared_state, shots) if the readout config is the same, otherwise train a new one. """
+        if self.get(q, config) is None:
+            if q in self.__entries:
+                slightly_print(f"{q} readout config changed, retrain its discriminator.")
+            return self.train(q, config, data)
+        return self.track(q, data, rate)
+
+    def classify(self, q:str, data:ndarray)->ndarray:
+        """ The states of all the shots (IQ first, any shape after it) in one go. """
+        if q not in self.__entries:
+            raise KeyError(f"There is no discriminator for {q}, do the SingleShot first !")
+        return self.__entries[q]["model"].predict(data)
@@ -0,0 +1,610 @@
+"""
+Parametric sweep compilation. Instead of compiling every sweep point unrolled, only the first few points are compiled by quantify and the
+repeating part of a point is emitted as a register-driven loop in the Q1ASM programs, so the compile time doesn't grow with the number of points.\n
+Only the uniform sweeps (like `arange` samples) whose waits are linear in the sweep index can be looped, otherwise `None` is returned and
+the caller should compile the unrolled schedule as before.\n
+The outer axis of a 2D map (`OuterSweep`) is looped around the repetition loop of the inner sweep when the outer points only change the
+pulse amplitudes, so a power or flux map is compiled and uploaded once instead of once per outer point.
+"""
+import re
+from copy import deepcopy
+from time import perf_counter
+from numpy import array, round as np_round, diff, all as np_all, arange
+from quantify_scheduler.device_under_test.quantum_device import QuantumDevice
+from quantify_scheduler.schedules.schedule import CompiledSchedule
+from quantify_scheduler.enums import BinMode
+from qblox_drive_AS.support.UserFriend import *
+
+MAX_WAIT:int = 65535
+WAIT_STEP:int = 65532
+MAX_REGISTER_IDX:int = 63
+# the amplitudes stepped along an outer sweep are kept in registers with these fraction bits
+FRACTION_BITS:int = 12
+AMPLITUDE_INSTRUCTIONS:tuple = ("set_awg_offs", "set_awg_gain")
+# the unrolled schedules compiled with these numbers of points are used to find the repeating part of a sweep point
+PROBE_POINTS:tuple = (3, 4, 5)
+
+auto_wait_loop_pattern = re.compile(r"move (\d+),(R\d+)")
+label_pattern = re.compile(r"^(\w+):$")
+train_label:str = "train:"
+
+
+class ParametricSweep():
+    """
+    The compact sweep representation, one template per qubit plus the sweep vectors.\n
+    ### Args:\n
+    * schedule_function: the `multi_*` schedule builder, like `multi_T1_sche`.\n
+    * sched_kwargs: the kwargs for schedule_function, the one named `sweep_kwarg` is a dict like {"q0":array([...]), ...}.\n
+    * sweep_kwarg: the kwarg name to sweep, like "freeduration".
+    """
+    def __init__(self, schedule_function:callable, sched_kwargs:dict, sweep_kwarg:str):
+        if sweep_kwarg not in sched_kwargs:
+            raise KeyError(f"The sweep kwarg = {sweep_kwarg} can't be found in the schedule kwargs !")
+        self.schedule_function = schedule_function
+        self.sched_kwargs = sched_kwargs
+        self.sweep_kwarg = sweep_kwarg
+        self.sweep_values:dict = {q: array(sched_kwargs[sweep_kwarg][q]) for q in sched_kwargs[sweep_kwarg]}
+        self.points:int = array(list(self.sweep_values.values())[0]).shape[0]
+
+    def is_uniform(self)->bool:
+        """ All the qubits have the same number of points, and each sweep vector has a constant step on the 1 ns grid. """
+        for q in self.sweep_values:
+            if self.sweep_values[q].ndim != 1 or self.sweep_values[q].shape[0] != self.points:
+                return False
+            if self.points > 2:
+                steps = diff(np_round(self.sweep_values[q]*1e9).astype(int))
+                if not np_all(steps == steps[0]):
+                    return False
+        return True
+
+    def probe_kwargs(self, probe_points:int)->dict:
+        """ The schedule kwargs of the first `probe_points` sweep points. """
+        kwargs = dict(self.sched_kwargs)
+        kwargs[self.sweep_kwarg] = {q: self.sweep_values[q][:probe_points] for q in self.sweep_values}
+        return kwargs
+
+    def probe(self, probe_points:int, repetitions:int=1):
+        return self.schedule_function(**self.probe_kwargs(probe_points), repetitions=repetitions)
+
+
+def _compile(quantum_device:QuantumDevice, schedule)->CompiledSchedule:
+    compilation_config = quantum_device.generate_compilation_config()
+    backend = compilation_config.backend(name=compilation_config.name)
+    return backend.compile(schedule=schedule, config=compilation_config)
+
+
+def parse_program(program:str)->tuple[list,list,list]:
+    """
+    Split a quantify generated program into (header, body, tail) by the repetition loop `start:` ... `loop R0,@start`.\n
+    The auto generated long waits (move, label, wait 65532, loop, wait) in the body are collapsed into one ["wait", ns] instruction.
+    """
+    lines = [line.split("#")[0].strip() for line in program.splitlines()]
+    lines = [line for line in lines if line != ""]
+    if "start:" not in lines:
+        raise ValueError("No repetition loop in the program !")
+    start = lines.index("start:")
+    end = max(idx for idx, line in enumerate(lines) if line.startswith("loop") and line.endswith("@start"))
+    header, raw_body, tail = lines[:start+1], lines[start+1:end], lines[end:]
+
+    body = []
+    trains = [] # the labels of the opened pulse-train loops
+    idx = 0
+    while idx < len(raw_body):
+        line = raw_body[idx]
+        matched = auto_wait_loop_pattern.fullmatch(line)
+        if matched is not None and idx + 3 < len(raw_body) and label_pattern.match(raw_body[idx+1]) is not None and raw_body[idx+2] == f"wait {WAIT_STEP}" and raw_body[idx+3] == f"loop {matched.group(2)},@{raw_body[idx+1][:-1]}":
+            ns = int(matched.group(1))*WAIT_STEP
+            idx += 4
+        elif line.startswith("wait ") and line.split()[1].isdigit():
+            ns = int(line.split()[1])
+            idx += 1
+        elif label_pattern.match(line) is not None and line[:-1] not in trains:
+            # a looped pulse train (see `GateGenesis.XY_train`), its label is renamed when the program is emitted
+            trains.append(line[:-1])
+            body.append([train_label, ""])
+            idx += 1
+            continue
+        elif line.startswith("loop") and len(trains) != 0 and line.endswith(f",@{trains[-1]}"):
+            trains.pop()
+            body.append(["loop", line.split(None, 1)[1].split("@")[0]+"@"])
+            idx += 1
+            continue
+        elif label_pattern.match(line) is not None or line.startswith("loop") or line.startswith("j"):
+            raise ValueError(f"Control flow '{line}' in the schedule body is not supported !")
+        else:
+            body.append(line.split(None, 1) if " " in line else [line, ""])
+            idx += 1
+            continue
+        # merge the consecutive waits
+        if len(body) != 0 and body[-1][0] == "wait":
+            body[-1][1] += ns
+        else:
+            body.append(["wait", ns])
+
+    if len(trains) != 0:
+        raise ValueError(f"The loop '{trains[-1]}' isn't closed in the schedule body !")
+    return header, body, tail
+
+
+def _name_trains(program:list)->list:
+    """ Give the pulse-train loops unique labels, a train is emitted more than once (prefix, sweep loop and the last point). """
+    named, opened, count = [], [], 0
+    for line in program:
+        if line == train_label:
+            opened.append(f"train{count}")
+            count += 1
+            named.append(f"{opened[-1]}:")
+        elif line.startswith("loop") and line.endswith(",@") and len(opened) != 0:
+            named.append(f"{line}{opened.pop()}")
+        else:
+            named.append(line)
+    return named
+
+
+def _used_registers(program:str)->set:
+    return set(int(r) for r in re.findall(r"\bR(\d+)\b", program))
+
+
+def _register_wait(register:str, temp:str, label:str)->list:
+    """ Q1ASM for waiting the ns stored in `register`, which can be longer than the 16 bits immediate. """
+    return [
+        f"add {register},0,{temp}",
+        f"{label}_chk:",
+        f"jlt {temp},{MAX_WAIT+1},@{label}_end",
+        f"wait {WAIT_STEP}",
+        f"sub {temp},{WAIT_STEP},{temp}",
+        f"jmp @{label}_chk",
+        f"{label}_end:",
+        f"wait {temp}",
+    ]
+
+
+def _immediate_wait(ns:int, temp:str, label:str)->list:
+    """ Same as the auto generated long wait by quantify, a loop of `wait 65532` then the remainder. """
+    if ns <= MAX_WAIT:
+        return [f"wait {ns}"]
+    loops, remainder = divmod(ns, WAIT_STEP)
+    if 0 < remainder < 4:
+        loops, remainder = loops - 1, remainder + WAIT_STEP
+    ans = [f"move {loops},{temp}", f"{label}:", f"wait {WAIT_STEP}", f"loop {temp},@{label}"]
+    if remainder > 0:
+        ans.append(f"wait {remainder}")
+    return ans
+
+
+def _strip_bin(ins:list)->list:
+    """ acquire 0,3,4 -> acquire 0,*,4, the bin index is given by the register in the loop. """
+    if ins[0].startswith("acquire"):
+        args = ins[1].split(",")
+        return [ins[0], ",".join([args[0], "*"] + args[2:])]
+    return ins
+
+
+def _linear_waits(blocks:list, first_idx:int=0)->list:
+    """
+    `blocks` are the instruction lists at the consecutive sweep index `first_idx`, `first_idx`+1, ...\n
+    Return [[ins, wait_at_first_idx, step], ...], raise ValueError if the non-wait instructions change or the waits are not linear.
+    """
+    types = [ins[0] for ins in blocks[0]]
+    for block in blocks:
+        if [ins[0] for ins in block] != types:
+            raise ValueError("The sweep points have different structures !")
+    ans = []
+    for ins_idx, ins in enumerate(blocks[0]):
+        if ins[0] == "wait":
+            step = blocks[1][ins_idx][1] - ins[1]
+            for k, block in enumerate(blocks):
+                if block[ins_idx][1] != ins[1] + step*k:
+                    raise ValueError("The waits are not linear along the sweep !")
+            ans.append([ins, ins[1] - step*first_idx, step])
+        else:
+            for block in blocks:
+                if _strip_bin(block[ins_idx]) != _strip_bin(ins):
+                    raise ValueError(f"The instruction '{' '.join(ins)}' changes along the sweep !")
+            ans.append([ins, 0, 0])
+    return ans
+
+
+def _split_periods(bodies:dict)->tuple[list,list,list]:
+    """
+    The unrolled body of n points is `prefix` + n-1 `period` + `last`, where `last` includes the last point and the things after it.\n
+    `bodies` = {n: body} for the probes with n = PROBE_POINTS. Return (prefix, periods of the biggest probe, lasts of every probe).
+    """
+    n_small, n_big = min(bodies), max(bodies)
+    period_len = len(bodies[n_small+1]) - len(bodies[n_small])
+    for n in bodies:
+        if len(bodies[n]) - len(bodies[n_small]) != period_len*(n - n_small):
+            raise ValueError("The probe programs don't grow periodically !")
+    if period_len <= 0:
+        raise ValueError("No instruction belongs to a sweep point !")
+
+    for prefix_len in range(len(bodies[n_small]) - (n_small-1)*period_len + 1):
+        prefix = bodies[n_small][:prefix_len]
+        if any(bodies[n][:prefix_len] != prefix for n in bodies):
+            break
+        try:
+            periods = [bodies[n_big][prefix_len+k*period_len:prefix_len+(k+1)*period_len] for k in range(n_big-1)]
+            for n in bodies:
+                if bodies[n][prefix_len:prefix_len+(n-1)*period_len] != [ins for period in periods[:n-1] for ins in period]:
+                    raise ValueError("The periods depend on the number of points !")
+            lasts = [bodies[n][prefix_len+(n-1)*period_len:] for n in sorted(bodies)]
+            _linear_waits(periods)
+            _linear_waits(lasts)
+        except ValueError:
+            continue
+        return prefix, periods, lasts
+
+    raise ValueError("The sweep points can't be found periodically in the program !")
+
+
+def loop_program(probes:dict, points:int)->tuple[str,int]:
+    """
+    Build the register-driven program from the programs compiled with the first few sweep points.\n
+    `probes` = {n: program} where n are the consecutive PROBE_POINTS.\n
+    Return the new program and the number of acquisitions in a sweep point.
+    """
+    parsed = {n: parse_program(probes[n]) for n in probes}
+    n_small = min(parsed)
+    header, tail = parsed[n_small][0], parsed[n_small][2]
+    for n in parsed:
+        if parsed[n][0] != header or parsed[n][2] != tail:
+            raise ValueError("The program header changes with the number of points !")
+    used = _used_registers("\n".join(probes.values()))
+    free = [f"R{i}" for i in range(MAX_REGISTER_IDX, -1, -1) if i not in used]
+
+    bodies = {n: parsed[n][1] for n in parsed}
+    if all(len(bodies[n]) == len(bodies[n_small]) for n in bodies):
+        # nothing is played in a sweep point on this sequencer, like the idle ones, only the waits grow with the number of points
+        program = list(header)
+        for ins_idx, (ins, first, step) in enumerate(_linear_waits([bodies[n] for n in sorted(bodies)], first_idx=n_small)):
+            program += _immediate_wait(first + step*points, free[0], f"idle{ins_idx}") if ins[0] == "wait" else [f"{ins[0]} {ins[1]}".strip()]
+        program = _name_trains(program + tail)
+        return "\n".join([line if line.endswith(":") else f" {line}" for line in program]) + "\n", 0
+    prefix, periods, lasts = _split_periods(bodies)
+
+    period = _linear_waits(periods)
+    # the last point is at index n-1 in the probe of n points
+    last = _linear_waits(lasts, first_idx=n_small-1)
+    acquire_num = len([ins for ins, _, _ in period if ins[0].startswith("acquire")])
+    if acquire_num > 1 or acquire_num != len([ins for ins, _, _ in last if ins[0].startswith("acquire")]):
+        raise ValueError("Only one acquisition in a sweep point is supported !")
+    for ins, first, step in period:
+        if ins[0] == "wait" and min(first, first + step*(points-2)) < 4:
+            raise ValueError("The wait becomes shorter than 4 ns along the sweep !")
+    for ins, first, step in last:
+        if ins[0] == "wait" and first + step*(points-1) < 4:
+            raise ValueError("The wait becomes shorter than 4 ns along the sweep !")
+
+    varying = [ins_idx for ins_idx, (ins, first, step) in enumerate(period) if step != 0]
+    if len(free) < len(varying) + 3:
+        raise ValueError("Not enough free registers for the sweep loop !")
+    point_reg, bin_reg, temp_reg = free.pop(0), free.pop(0), free.pop(0)
+    wait_regs = {ins_idx: free.pop(0) for ins_idx in varying}
+
+    def emit(ins:list)->list:
+        if ins[0].startswith("acquire"):
+            args = ins[1].split(",")
+            return [f"{ins[0]} {','.join([args[0], bin_reg] + args[2:])}"]
+        return [f"{ins[0]} {ins[1]}".strip()]
+
+    program = list(header)
+    for ins_idx, ins in enumerate(prefix):
+        program += _immediate_wait(ins[1], temp_reg, f"pre{ins_idx}") if ins[0] == "wait" else emit(ins)
+    program.append(f"move 0,{bin_reg}")
+    for ins_idx in varying:
+        program.append(f"move {period[ins_idx][1]},{wait_regs[ins_idx]}")
+    program.append(f"move {points-1},{point_reg}")
+    program.append("sweep:")
+    for ins_idx, (ins, first, step) in enumerate(period):
+        if ins[0] != "wait":
+            program += emit(ins)
+        elif ins_idx in wait_regs:
+            program += _register_wait(wait_regs[ins_idx], temp_reg, f"sw{ins_idx}")
+        else:
+            program += _immediate_wait(first, temp_reg, f"sw{ins_idx}")
+    for ins_idx in varying:
+        step = period[ins_idx][2]
+        program.append(f"{'add' if step > 0 else 'sub'} {wait_regs[ins_idx]},{abs(step)},{wait_regs[ins_idx]}")
+    program.append(f"add {bin_reg},1,{bin_reg}")
+    program.append(f"loop {point_reg},@sweep")
+    for ins_idx, (ins, first, step) in enumerate(last):
+        program += _immediate_wait(first + step*(points-1), temp_reg, f"last{ins_idx}") if ins[0] == "wait" else emit(ins)
+    program = _name_trains(program + tail)
+
+    return "\n".join([line if line.endswith(":") else f" {line}" for line in program]) + "\n", acquire_num
+
+
+def compile_parametric_sweep(quantum_device:QuantumDevice, sweep:ParametricSweep, repetitions:int)->CompiledSchedule|None:
+    """
+    Compile the unrolled schedules with only the first few sweep points (PROBE_POINTS), find the part repeating for each point
+    and loop it in the sequencers with the waits stored in registers.\n
+    Return None if this sweep can't be looped, the caller should compile the unrolled schedule then.
+    """
+    if sweep.points <= max(PROBE_POINTS) or not sweep.is_uniform():
+        return None
+    try:
+        compiled = {n: _compile(quantum_device, sweep.probe(n, repetitions)) for n in PROBE_POINTS}
+    except Exception as err:
+        warning_print(f"Probe compilation failed, use the unrolled schedule: {err}")
+        return None
+
+    looped:CompiledSchedule = deepcopy(compiled[max(PROBE_POINTS)])
+    try:
+        for instr_name, instr_settings in looped["compiled_instructions"].items():
+            if not isinstance(instr_settings, dict):
+                continue
+            for module_name, module_settings in instr_settings.items():
+                if not isinstance(module_settings, dict) or "sequencers" not in module_settings:
+                    continue
+                for seq_name, seq_settings in module_settings["sequencers"].items():
+                    probes = {n: compiled[n]["compiled_instructions"][instr_name][module_name]["sequencers"][seq_name]["sequence"]["program"] for n in PROBE_POINTS}
+                    program, acquire_num = loop_program(probes, sweep.points)
+                    seq_settings["sequence"]["program"] = program
+                    if acquire_num != 0:
+                        if module_settings["acq_metadata"][seq_name].bin_mode != BinMode.AVERAGE:
+                            raise ValueError("Only the averaged acquisitions can be looped !")
+                        for acq_name in seq_settings["sequence"]["acquisitions"]:
+                            seq_settings["sequence"]["acquisitions"][acq_name]["num_bins"] = sweep.points
+                        acq_metadata = module_settings["acq_metadata"][seq_name]
+                        for channel in acq_metadata.acq_channels_metadata:
+                            acq_metadata.acq_channels_metadata[channel].acq_indices = list(range(sweep.points))
+    except (ValueError, KeyError) as err:
+        eyeson_print(f"This sweep can't be looped on the sequencers, use the unrolled schedule: {err}")
+        return None
+
+    # the duration also grows linearly with the number of points
+    n_small = min(PROBE_POINTS)
+    du_step = compiled[n_small+1]["duration"] - compiled[n_small]["duration"]
+    looped["duration"] = compiled[n_small]["duration"] + du_step*(sweep.points - n_small)
+    return looped
+
+
+class OuterSweep():
+    """
+    The slow axis of a 2D map, like the readout amplitude of a power cavity or the z amplitude of a flux qubit, whose points only change
+    the amplitudes in the program of the fast (inner) sweep.\n
+    ### Args:\n
+    * schedule_function, sched_kwargs: the schedule of the inner sweep, `sched_kwargs[outer_kwarg]` is replaced by one outer point.\n
+    * outer_kwarg: the kwarg name of the outer sweep, like "R_amp", "bias" or "Z_amp".\n
+    * outer_values: the outer points, should be uniform like `linspace`.
+    """
+    def __init__(self, schedule_function:callable, sched_kwargs:dict, outer_kwarg:str, outer_values):
+        if outer_kwarg not in sched_kwargs:
+            raise KeyError(f"The outer kwarg = {outer_kwarg} can't be found in the schedule kwargs !")
+        self.schedule_function = schedule_function
+        self.sched_kwargs = sched_kwargs
+        self.outer_kwarg = outer_kwarg
+        self.outer_values = array(outer_values, dtype=float).reshape(-1)
+        self.points:int = self.outer_values.shape[0]
+
+    def is_uniform(self)->bool:
+        if self.points < 3:
+            return False
+        steps = diff(self.outer_values)
+        return bool(np_all(abs(steps - steps[0]) <= 1e-9*max(abs(self.outer_values).max(), 1e-12)))
+
+    def probe_indices(self)->list:
+        """ The first, middle and last outer points which are not zero, a zero amplitude may drop the pulse from the program. """
+        nonzero = [idx for idx, value in enumerate(self.outer_values) if value != 0]
+        if len(nonzero) < 3:
+            return []
+        return [nonzero[0], nonzero[len(nonzero)//2], nonzero[-1]]
+
+    def probe(self, outer_idx:int, repetitions:int=1):
+        kwargs = dict(self.sched_kwargs)
+        kwargs[self.outer_kwarg] = float(self.outer_values[outer_idx])
+        return self.schedule_function(**kwargs, repetitions=repetitions)
+
+
+def _split_instruction(line:str)->list:
+    return line.split(None, 1) if " " in line else [line, ""]
+
+
+def _amplitude_args(probe_lines:list, probe_idx:list)->list:
+    """
+    The lines differ among the probes should be `set_awg_offs`/`set_awg_gain` with the immediates linear in the outer index.\n
+    Return [(value at outer index 0, step per outer point) or (constant, 0) for each argument].
+    """
+    ins = [_split_instruction(line) for line in probe_lines]
+    if any(i[0] != ins[0][0] for i in ins) or ins[0][0] not in AMPLITUDE_INSTRUCTIONS:
+        raise ValueError(f"'{probe_lines[0]}' changes with the outer sweep, only the amplitudes can be looped !")
+    values = [[int(v) for v in i[1].split(",")] for i in ins]
+    ans = []
+    for arg_idx in range(len(values[0])):
+        v = [values[k][arg_idx] for k in range(len(values))]
+        if v[0] == v[1] == v[2]:
+            ans.append((v[0], 0.0))
+            continue
+        step = (v[2] - v[0])/(probe_idx[2] - probe_idx[0])
+        if abs(v[0] + step*(probe_idx[1] - probe_idx[0]) - v[1]) > 1:
+            raise ValueError(f"'{probe_lines[0]}' is not linear in the outer sweep !")
+        ans.append((v[0] - step*probe_idx[0], step))
+    return ans
+
+
+def outer_loop_program(probes:list, probe_idx:list, points:int, inner_bins:int)->str:
+    """
+    Wrap the repetition loop of the inner sweep program into a loop over the outer points.\n
+    `probes` are the programs compiled at the outer indices `probe_idx`, the amplitudes which change along the outer sweep are kept
+    in fixed-point registers (FRACTION_BITS) and stepped after each outer point, the acquisitions go to the bins `outer_idx*inner_bins + bin`.
+    """
+    lines = [[line.split("#")[0].strip() for line in program.splitlines()] for program in probes]
+    lines = [[line for line in program if line != ""] for program in lines]
+    if any(len(program) != len(lines[0]) for program in lines):
+        raise ValueError("The program structure changes with the outer sweep !")
+    program_lines = lines[0]
+    if "start:" not in program_lines:
+        raise ValueError("No repetition loop in the program !")
+    start = program_lines.index("start:")
+    rep_move = re.fullmatch(r"move (\d+),(R\d+)", program_lines[start-1])
+    if rep_move is None:
+        raise ValueError("The repetition loop counter can't be found !")
+    end = max(idx for idx, line in enumerate(program_lines) if line.startswith("loop") and line.endswith("@start"))
+
+    used = _used_registers("\n".join(probes))
+    free = [f"R{i}" for i in range(MAX_REGISTER_IDX, -1, -1) if i not in used]
+    varying = {idx: _amplitude_args([program[idx] for program in lines], probe_idx) for idx in range(start+1, end) if len(set(program[idx] for program in lines)) > 1}
+    for idx in range(len(program_lines)):
+        if not start < idx < end and len(set(program[idx] for program in lines)) > 1:
+            raise ValueError(f"'{program_lines[idx]}' outside the repetition loop changes with the outer sweep !")
+    scale = 2**FRACTION_BITS
+
+    def fixed(value:float)->int:
+        # +0.5 LSB, so the arithmetic shift right rounds instead of floors
+        return int(round(value*scale)) + scale//2
+
+    # the amplitudes following the same line share a register, like the readout pulses of all the inner points
+    stepped = sorted(set((fixed(value), int(round(step*scale))) for idx in varying for value, step in varying[idx] if step != 0))
+    if len(free) < len(stepped) + 4:
+        raise ValueError("Not enough free registers for the outer loop !")
+    outer_reg, base_reg, temps = free.pop(0), free.pop(0), [free.pop(0), free.pop(0)]
+    acc_regs = {key: free.pop(0) for key in stepped}
+
+    program = program_lines[:start-1]
+    program.append(f"move 0,{base_reg}")
+    for (start_value, _), reg in acc_regs.items():
+        program.append(f"move {start_value % 2**32},{reg}")
+    program.append(f"move {points},{outer_reg}")
+    program.append("outer_sweep:")
+    program.append(program_lines[start-1])
+    program.append("start:")
+    for idx in range(start+1, end):
+        ins = _split_instruction(program_lines[idx])
+        if idx in varying:
+            args = []
+            for arg_idx, (value, step) in enumerate(varying[idx]):
+                if step == 0:
+                    program.append(f"move {int(value) % 2**32},{temps[arg_idx]}")
+                else:
+                    program.append(f"asr {acc_regs[(fixed(value), int(round(step*scale)))]},{FRACTION_BITS},{temps[arg_idx]}")
+                args.append(temps[arg_idx])
+            program.append(f"{ins[0]} {','.join(args)}")
+        elif ins[0].startswith("acquire"):
+            args = ins[1].split(",")
+            program.append(f"add {base_reg},{int(args[1])},{temps[0]}")
+            program.append(f"{ins[0]} {','.join([args[0], temps[0]] + args[2:])}")
+        else:
+            program.append(program_lines[idx])
+    program.append(program_lines[end])
+    for (_, step), reg in acc_regs.items():
+        program.append(f"{'add' if step >= 0 else 'sub'} {reg},{abs(step)},{reg}")
+    program.append(f"add {base_reg},{inner_bins},{base_reg}")
+    program.append(f"loop {outer_reg},@outer_sweep")
+    program += program_lines[end+1:]
+
+    return "\n".join([line if line.endswith(":") else f" {line}" for line in program]) + "\n"
+
+
+def _same_waveforms(sequences:list)->bool:
+    for key in ("waveforms", "weights"):
+        tables = [sequence.get(key, {}) for sequence in sequences]
+        for table in tables[1:]:
+            if table.keys() != tables[0].keys() or any(table[name]["data"] != tables[0][name]["data"] for name in table):
+                return False
+    return True
+
+
+def compile_outer_sweep(quantum_device:QuantumDevice, sweep:OuterSweep, repetitions:int)->CompiledSchedule|None:
+    """
+    Compile the inner sweep at 3 outer points, and loop the outer points on the sequencers with the changing amplitudes in registers,
+    so the whole 2D map is one program and one upload.\n
+    The compiled schedule gets the attribute `outer_sweep` = {"kwarg", "values", "probe_idx", "inner_bins"} (the schedule schema doesn't
+    allow more keys), its timeline is the inner sweep at `values[probe_idx]`.\n
+    Return None if the outer sweep can't be looped, the caller should set the outer points one by one then.
+    """
+    probe_idx = sweep.probe_indices()
+    if not sweep.is_uniform() or len(probe_idx) != 3:
+        return None
+    try:
+        compiled = [_compile(quantum_device, sweep.probe(idx, repetitions)) for idx in probe_idx]
+    except Exception as err:
+        warning_print(f"Probe compilation failed, set the outer points one by one: {err}")
+        return None
+
+    looped:CompiledSchedule = deepcopy(compiled[0])
+    inner_bins = 0
+    try:
+        for instr_name, instr_settings in looped["compiled_instructions"].items():
+            if not isinstance(instr_settings, dict):
+                continue
+            for module_name, module_settings in instr_settings.items():
+                if not isinstance(module_settings, dict) or "sequencers" not in module_settings:
+                    continue
+                for seq_name, seq_settings in module_settings["sequencers"].items():
+                    sequences = [c["compiled_instructions"][instr_name][module_name]["sequencers"][seq_name]["sequence"] for c in compiled]
+                    if not _same_waveforms(sequences):
+                        raise ValueError(f"The waveforms of {module_name} {seq_name} change with the outer sweep !")
+                    acquisitions = seq_settings["sequence"].get("acquisitions", {})
+                    bins = max([acq["num_bins"] for acq in acquisitions.values()], default=0)
+                    if bins != 0 and module_settings["acq_metadata"][seq_name].bin_mode != BinMode.AVERAGE:
+                        raise ValueError("Only the averaged acquisitions can be looped !")
+                    seq_settings["sequence"]["program"] = outer_loop_program([sequence["program"] for sequence in sequences], probe_idx, sweep.points, bins)
+                    if bins != 0:
+                        inner_bins = bins
+                        for acq_name in acquisitions:
+                            acquisitions[acq_name]["num_bins"] = bins*sweep.points
+                        acq_metadata = module_settings["acq_metadata"][seq_name]
+                        for channel in acq_metadata.acq_channels_metadata:
+                            indices = acq_metadata.acq_channels_metadata[channel].acq_indices
+                            if len(indices) != bins:
+                                raise ValueError("The acquisition channels in a sequencer have different numbers of bins !")
+                            acq_metadata.acq_channels_metadata[channel].acq_indices = list(range(bins*sweep.points))
+    except (ValueError, KeyError) as err:
+        eyeson_print(f"The outer sweep can't be looped on the sequencers, set the outer points one by one: {err}")
+        return None
+
+    looped["duration"] = compiled[0]["duration"]*sweep.points
+    looped.outer_sweep = {"kwarg":sweep.outer_kwarg, "values":sweep.outer_values.tolist(), "probe_idx":probe_idx[0], "inner_bins":inner_bins}
+    return looped
+
+
+def benchmark_parametric_sweep(quantum_device:QuantumDevice, sweep_builder:callable, points:list=[50, 200, 1000], repetitions:int=300)->dict:
+    """
+    Compare the compile time of the unrolled schedule and the parametric sweep.\n
+    ### Args:\n
+    * sweep_builder: a function takes the number of points and returns a `ParametricSweep`.
+    ### Returns:\n
+    {pts:{"unrolled":sec, "parametric":sec}, ...}
+    """
+    ans = {}
+    for pts in points:
+        sweep:ParametricSweep = sweep_builder(pts)
+        start = perf_counter()
+        _compile(quantum_device, sweep.schedule_function(**sweep.sched_kwargs, repetitions=repetitions))
+        unrolled = perf_counter() - start
+        start = perf_counter()
+        looped = compile_parametric_sweep(quantum_device, sweep, repetitions)
+        parametric = perf_counter() - start
+        ans[pts] = {"unrolled":unrolled, "parametric":parametric if looped is not None else None}
+        slightly_print(f"{pts} points: unrolled {round(unrolled,3)} sec, parametric {round(parametric,3) if looped is not None else 'not loopable'} sec")
+    return ans
+
+
+if __name__ == "__main__":
+    # python SweepCompiler.py <QD file> q0 q1 ...
+    import sys
+    from qblox_drive_AS.support.QDmanager import QDmanager
+    from qblox_drive_AS.support import compose_para_for_multiplexing
+    from qblox_drive_AS.support.Pulse_schedule_library import multi_T1_sche
+
+    if len(sys.argv) < 3:
+        raise ValueError("Usage: python SweepCompiler.py <QD file> <qubit> [qubit ...] !")
+    QD_path = sys.argv[1]
+    target_qs = sys.argv[2:]
+    QD_agent = QDmanager(QD_path)
+    QD_agent.QD_loader()
+
+    def T1_sweep(pts:int)->ParametricSweep:
+        time_samples = {q: arange(pts)*40e-9 for q in target_qs}
+        sched_kwargs = dict(
+            freeduration=time_samples,
+            pi_amp=compose_para_for_multiplexing(QD_agent,time_samples,'d1'),
+            pi_dura=compose_para_for_multiplexing(QD_agent,time_samples,'d3'),
+            R_amp=compose_para_for_multiplexing(QD_agent,time_samples,'r1'),
+            R_duration=compose_para_for_multiplexing(QD_agent,time_samples,'r3'),
+            R_integration=compose_para_for_multiplexing(QD_agent,time_samples,'r4'),
+            R_inte_delay=compose_para_for_multiplexing(QD_agent,time_samples,'r2'),
+        )
+        return ParametricSweep(multi_T1_sche, sched_kwargs, "freeduration")
+
+    benchmark_parametric_sweep(QD_agent.quantum_device, T1_sweep)
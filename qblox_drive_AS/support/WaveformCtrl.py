@@ -1,5 +1,7 @@
 """ Accompany with QDmanager to switch the waveform """
-from quantify_scheduler.operations.pulse_library import DRAGPulse, GaussPulse, SquarePulse
+import warnings
+from quantify_scheduler.operations.pulse_library import DRAGPulse, GaussPulse, SquarePulse, IdlePulse
+from quantify_scheduler.operations.control_flow_library import Loop
 from quantify_scheduler.schedules.schedule import Schedule
 
 
@@ -10,6 +12,13 @@ half_pi_ratio:float = 0.5             # pi/2 pulse amp is pi-pulse amp * half_pi
 
 
 
+def add_loop(sche:Schedule, body:Schedule, repeats:int, rel_time:float, ref_op, ref_pt:str="start"):
+    """ Add the sub-schedule `body` played `repeats` times by a loop on the sequencers, it's added once if `repeats` is 1. """
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="Loops and Conditionals are an experimental feature")
+        return sche.add(body,rel_time=rel_time,ref_op=ref_op,ref_pt=ref_pt,control_flow=Loop(repeats) if repeats > 1 else None)
+
+
 class GateGenesis():
     """ 
     2024/11/20 update \n
@@ -168,6 +177,28 @@ class GateGenesis():
         delay_c= -pi_Du-freeDu
         return self.XY_waveform_controller(sche,amp,pi_Du,0,q,delay_c,ref_pulse_sche,ref_pt=ref_point)
 
+    def XY_train(self, sche:Schedule, amps:dict, durations:dict, repeats:int, ref_pulse_sche, freeDu:float, spacing:float=0, phase:float=0):
+        """
+        A train of `repeats` identical XY-pulses for every qubit in `amps`, played by a hardware loop so the sequencers keep one copy of it.\n
+        Every copy is `spacing`/2 idle, the pulses (aligned by their ends), `spacing`/2 idle. The train ends `freeDu` before the start of `ref_pulse_sche`.\n
+        ### Args:\n
+        * amps: {q: amp}, the qubits play together in the same loop.\n
+        * durations: {q: pulse duration}.\n
+        ### Returns:\n
+        The schedulable of the train (None if `repeats` is 0), the pulses before it can be referred to it like the first pulse of a chain.\n
+        **The loop is counted as one copy in the schedule timeline, the sequencers stretch the time when they play it, so the later operations
+        (readout, acquisition) must refer to `ref_pulse_sche` instead of the train.**
+        """
+        if repeats <= 0:
+            return None
+        body_du = max([durations[q] for q in amps])
+        body = Schedule("XY train")
+        anchor = body.add(IdlePulse(duration=body_du+spacing))
+        for q in amps:
+            self.XY_waveform_controller(body,amps[q],durations[q],phase,q,body_du-durations[q]+spacing/2,anchor)
+        
+        return add_loop(sche,body,repeats,rel_time=-body_du-spacing-freeDu,ref_op=ref_pulse_sche)
+
     def Z(self,sche,Z_amp,Du,q,ref_pulse_sche,freeDu,ref_position='start'):
         delay_z= -Du-freeDu
         return self.Z_waveform_controller(sche,Z_amp,Du,q,delay_z,ref_pulse_sche,ref_pt=ref_position)
@@ -25,7 +25,14 @@ import qblox_drive_AS.support.Chip_Data_Store as cds
 from numpy import ndarray
 from numpy import asarray, real, vstack, array, imag
 from numpy import arctan2, pi, cos, sin, exp
+from qblox_drive_AS.support.IQtransform import rotate_IQ
 from qblox_drive_AS.support.UserFriend import *
+from qblox_drive_AS.support.ClusterEmulator import emulator_enabled, emulated_cluster, is_emulated, EmulatedCoordinator
+from qblox_drive_AS.support.PhaseTracer import traced, traced_class
+
+# the spans recorded on the instrument coordinator and meas_ctrl, the compile in ScheduleGettable is the self time of `meas_ctrl.run`
+coordinator_phases:dict = {"prepare":"upload", "start":"start", "wait_done":"hardware_run", "retrieve_acquisition":"retrieve"}
+meas_ctrl_phases:dict = {"run":"meas_ctrl.run", "run_adaptive":"meas_ctrl.run_adaptive"}
 
 
 def multiples_of_x(raw_number:float, x:float):
@@ -39,22 +46,18 @@ def find_nearest(ary:ndarray, value:float):
     idx = (abs(ary - value)).argmin()
     return float(ary[idx])
 
-# initialize a measurement
-def init_meas(QuantumDevice_path:str)->Tuple[QDmanager, Cluster, MeasurementControl, InstrumentCoordinator, dict]:
+# connect the cluster which the QD file belongs to
+@traced("cluster_connect")
+def connect_cluster(QuantumDevice_path:str, QD_agent:QDmanager=None)->Cluster:
     """
-    Initialize a measurement by the following 2 cases:\n
-    ### Case 1: QD_path isn't given, create a new QD accordingly.\n
-    ### Case 2: QD_path is given, load the QD with that given path.\n
-    args:\n
-    mode: 'new'/'n' or 'load'/'l'. 'new' need a self defined hardware config. 'load' load the given path. 
+    Connect to the cluster registered for the DR written in the given QD path, try maximum 3 times to prevent the connect timeout error.\n
+    If the emulator is on (see `ClusterEmulator.use_emulator`), return the emulated cluster of the loaded `QD_agent` instead.
     """
     from qblox_drive_AS.support.UserFriend import warning_print
-    import quantify_core.data.handling as dh
-    meas_datadir = '.data'
-    dh.set_datadir(meas_datadir)
-
-
-    cfg, pth = {}, QuantumDevice_path 
+    if emulator_enabled():
+        if QD_agent is None:
+            raise ValueError("The emulated cluster is built from the QD, please give the loaded QD_agent !")
+        return emulated_cluster(QD_agent)
     dr_loc = get_dr_loca(QuantumDevice_path)
     cluster_ip = ip_register[dr_loc.lower()]
 
@@ -77,12 +80,28 @@ def init_meas(QuantumDevice_path:str)->Tuple[QDmanager, Cluster, MeasurementCont
         except:
             raise KeyError("Check your cluster ip had been log into Experiment_setup.py with its connected DR, and also is its ip-port")
     
-    ip = ip_register[dr_loc.lower()]
+    return cluster
+
+# initialize a measurement
+@traced("init_meas")
+def init_meas(QuantumDevice_path:str)->Tuple[QDmanager, Cluster, MeasurementControl, InstrumentCoordinator, dict]:
+    """
+    Initialize a measurement by the following 2 cases:\n
+    ### Case 1: QD_path isn't given, create a new QD accordingly.\n
+    ### Case 2: QD_path is given, load the QD with that given path.\n
+    args:\n
+    mode: 'new'/'n' or 'load'/'l'. 'new' need a self defined hardware config. 'load' load the given path. 
+    """
+    import quantify_core.data.handling as dh
+    meas_datadir = '.data'
+    dh.set_datadir(meas_datadir)
+
+    Qmanager = QDmanager(QuantumDevice_path)
+    Qmanager.QD_loader()
+    cluster = connect_cluster(QuantumDevice_path, Qmanager)
     
     # enable_QCMRF_LO(cluster) # for v0.6 firmware
     QRM_nco_init(cluster)
-    Qmanager = QDmanager(pth)
-    Qmanager.QD_loader()
     bias_controller = Qmanager.activate_str_Fctrl(cluster)
 
     meas_ctrl, ic = configure_measurement_control_loop(Qmanager.quantum_device, cluster)
@@ -140,8 +159,8 @@ def configure_measurement_control_loop(
 def configure_measurement_control_loop(
     device: QuantumDevice, cluster: Cluster, live_plotting: bool = False
     ) ->Tuple[MeasurementControl,InstrumentCoordinator]:
-    meas_ctrl = find_or_create_instrument(MeasurementControl, recreate=True, name="meas_ctrl")
-    ic = find_or_create_instrument(InstrumentCoordinator, recreate=True, name="ic")
+    meas_ctrl = find_or_create_instrument(traced_class(MeasurementControl, meas_ctrl_phases), recreate=True, name="meas_ctrl")
+    ic = find_or_create_instrument(traced_class(EmulatedCoordinator if is_emulated(cluster) else InstrumentCoordinator, coordinator_phases), recreate=True, name="ic")
     ic.timeout(60*60*120) # 120 hr maximum
     # Add cluster to instrument coordinator
     ic_cluster = ClusterComponent(cluster)
@@ -394,15 +413,8 @@ def rotate_onto_Inphase(point_1:ndarray, point_2:ndarray, angle_degree:float=Non
 
 
 def rotate_data(data:ndarray, angle_degree:float)->ndarray:
-    """ data shape (IQ, shots) """
-
-    angle = angle_degree*pi/180
-    S21 = data[0] + 1j*data[1] 
-
-    roted_S21 = array(S21*exp(-1j*angle))
-    data_rotated = array([real(roted_S21).tolist(), imag(roted_S21).tolist()])
-
-    return data_rotated
+    """ data shape (IQ, ...), see `IQtransform.rotate_IQ` for the batched and in-place version. """
+    return rotate_IQ(array(data), angle_degree)
 
 
 
@@ -1,9 +1,9 @@
 from numpy import asarray, ndarray, array, sqrt, sort, mean, std, pi, cos, sin, diag, linspace
-import sympy as sp
 from scipy.optimize import curve_fit
 import json, os
 from typing import Callable
 import matplotlib.pyplot as plt
+from qblox_drive_AS.support.FluxModel import FqEqn, bias_for_fq
 
 
 def find_nearest(ary:ndarray, near_target:float):
@@ -16,12 +16,6 @@ def IQ_data_dis(I_data:ndarray,Q_data:ndarray,ref_I:float,ref_Q:float):
     Dis= sqrt((I_data-ref_I)**2+(Q_data-ref_Q)**2)
     return Dis   
 
-def FqEqn(x,a,b,Ec,coefA,d):
-    """
-    a ~ period, b ~ offset, 
-    """
-    return sqrt(8*coefA*Ec*sqrt(cos(a*(x-b))**2+d**2*sin(a*(x-b))**2))-Ec
-
 def read_fq_data(json_path:str):
     """
     Read a json file contains the fq vs. flux data.\n
@@ -287,18 +281,9 @@ def get_biasWithFq_from(fitting_popts:list,target_fq_Hz:float, flux_guard:float=
     ### The given `fitting_popts` should follow the order: [a, b, Ec, Ej_sum, d]
     Return the bias unit in V.
     """
-    
-    z = sp.Symbol('z',real=True)
-    
-    a,b,Ec,Ej_sum,d = fitting_popts[0], fitting_popts[1], fitting_popts[2], fitting_popts[3], fitting_popts[4]
-    to_solve = sp.sqrt(8*Ej_sum*Ec*sp.sqrt(sp.cos(a*(z-b))**2+d**2*sp.sin(a*(z-b))**2))-Ec - target_fq_Hz*1e-9
-    candidators = array(sp.solvers.solve(to_solve, z))
-    
-    if candidators.shape[0] == 0:
-        answer = 'n'
+    answer = bias_for_fq(fitting_popts, target_fq_Hz, flux_guard)
+    if isinstance(answer, str):
         print(f"Can NOT find a bias makes the fq @ {target_fq_Hz*1e-9} GHz !")
-    else:
-        answer = find_nearest(candidators, 0) if find_nearest(candidators, 0) < flux_guard else flux_guard
 
     return answer
 